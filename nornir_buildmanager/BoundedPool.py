@@ -0,0 +1,99 @@
+'''
+Limits the work a stage queues on a nornir_pools pool.
+
+Stages that produce one task per output tile can queue tens of thousands of
+tasks long before the pool runs them.  When each task holds an image the
+queue holds every image of the section.  BoundedPool wraps a pool and makes
+add_task wait for the oldest of its tasks to finish while too many tasks, or
+too many bytes of task data, are in flight.  The producer then runs only as
+far ahead of the workers as the limits allow.
+
+Tasks are waited on in the order they were added, so the pool must run tasks
+in roughly that order, as nornir_pools pools do.
+
+'''
+
+import collections
+import multiprocessing
+
+from .Statistics import Statistics
+
+# Default limits used when a stage is not passed limits
+DefaultMaxTasksPerCPU = 8
+DefaultMaxBytes = 1 << 30
+
+
+class BoundedPoolStats(Statistics):
+    '''Counts tasks added to bounded pools and how often adding a task waited for an earlier task'''
+
+    Counters = ('Tasks', 'Waits', 'PeakTasks', 'PeakBytes')
+    Format = "Bounded pool tasks: %d waits: %d peak tasks in flight: %d peak bytes in flight: %d"
+
+
+Stats = BoundedPoolStats()
+
+
+class BoundedPool(object):
+    '''Adds tasks to a pool, waiting for earlier tasks when MaxTasks tasks or MaxBytes bytes are in flight'''
+
+    @property
+    def NumTasks(self):
+        return len(self._Tasks)
+
+    @property
+    def NumBytes(self):
+        return self._NumBytes
+
+    def __init__(self, Pool, MaxTasks=None, MaxBytes=None):
+        '''
+        :param Pool: nornir_pools pool the tasks run on
+        :param int MaxTasks: Largest number of tasks in flight, defaults to DefaultMaxTasksPerCPU per CPU
+        :param int MaxBytes: Largest total size of task data in flight, defaults to DefaultMaxBytes
+        '''
+        if MaxTasks is None:
+            MaxTasks = multiprocessing.cpu_count() * DefaultMaxTasksPerCPU
+
+        if MaxBytes is None:
+            MaxBytes = DefaultMaxBytes
+
+        self.Pool = Pool
+        self.MaxTasks = max(1, int(MaxTasks))
+        self.MaxBytes = max(1, int(MaxBytes))
+        self._Tasks = collections.deque()  # (task, bytes) in the order tasks were added
+        self._NumBytes = 0
+
+    def _WaitForOldest(self):
+        (task, nbytes) = self._Tasks.popleft()
+        self._NumBytes -= nbytes
+        Stats.Waits += 1
+
+        # Waiting raises any exception from the task
+        task.wait()
+
+    def add_task(self, name, func, *args, **kwargs):
+        '''Add a task whose data size does not count against MaxBytes'''
+        return self.add_sized_task(name, 0, func, *args, **kwargs)
+
+    def add_sized_task(self, name, nbytes, func, *args, **kwargs):
+        '''
+        Add a task that holds nbytes of data until it finishes.  Waits for earlier tasks first if the limits would be exceeded.
+        A task larger than MaxBytes is added once every earlier task finished.
+        '''
+        while len(self._Tasks) > 0 and (len(self._Tasks) >= self.MaxTasks or self._NumBytes + nbytes > self.MaxBytes):
+            self._WaitForOldest()
+
+        task = self.Pool.add_task(name, func, *args, **kwargs)
+        self._Tasks.append((task, nbytes))
+        self._NumBytes += nbytes
+
+        Stats.Tasks += 1
+        Stats.PeakTasks = max(Stats.PeakTasks, len(self._Tasks))
+        Stats.PeakBytes = max(Stats.PeakBytes, self._NumBytes)
+        return task
+
+    def wait_completion(self):
+        '''Wait for every task added through this BoundedPool.  Other tasks on the pool are not waited for.'''
+        while len(self._Tasks) > 0:
+            (task, nbytes) = self._Tasks.popleft()
+            self._NumBytes -= nbytes
+            task.wait()
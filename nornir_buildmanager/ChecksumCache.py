@@ -0,0 +1,161 @@
+'''
+Process-wide cache of file checksums used to validate transform and image nodes.
+
+Checksums are stored with the modification time and size of the file they
+were computed from.  As long as neither changes the file is not read again.
+The cache can be saved to a Checksums.cache file in the volume directory so
+later pipeline runs start with the checksums of unchanged files.
+
+'''
+
+import logging
+import os
+import pickle
+
+from . import VolumeDataWriter
+from .Statistics import Statistics
+
+CacheFilename = 'Checksums.cache'
+
+# Increment if the layout of the pickled data changes
+CacheVersion = 1
+
+# Set to False to keep the cache in memory only
+Persist = True
+
+
+class ChecksumCacheStats(Statistics):
+    '''Counts checksums returned from the cache and checksums computed from the file'''
+
+    Counters = ('Hits', 'Misses')
+    Format = "Checksum cache hits: %d misses: %d"
+
+
+Stats = ChecksumCacheStats()
+
+# Full path -> ((kind, mtime, size), checksum)
+_Checksums = {}
+
+# Full paths of checksums computed since TakeComputed was last called
+_Computed = set()
+
+
+def Get(fullpath, kind, calc_func):
+    '''
+    Returns the checksum of a file, computing it only if the file changed since it was last computed
+    :param str fullpath: File to checksum
+    :param str kind: Name of the checksum algorithm, different kinds are cached separately
+    :param func calc_func: Function taking the path that computes the checksum
+    '''
+    try:
+        st = os.stat(fullpath)
+    except OSError:
+        return calc_func(fullpath)
+
+    key = os.path.abspath(fullpath)
+    stamp = (kind, st.st_mtime_ns, st.st_size)
+
+    entry = _Checksums.get(key, None)
+    if entry is not None and entry[0] == stamp:
+        Stats.Hits += 1
+        return entry[1]
+
+    Stats.Misses += 1
+    checksum = calc_func(fullpath)
+    _Checksums[key] = (stamp, checksum)
+    _Computed.add(key)
+    return checksum
+
+
+def TryGet(fullpath, kind):
+    '''
+    :return: The cached checksum of a file, or None if it is not cached or the file changed since it was computed
+    '''
+    try:
+        st = os.stat(fullpath)
+    except OSError:
+        return None
+
+    entry = _Checksums.get(os.path.abspath(fullpath), None)
+    if entry is not None and entry[0] == (kind, st.st_mtime_ns, st.st_size):
+        Stats.Hits += 1
+        return entry[1]
+
+    return None
+
+
+def Clear():
+    _Checksums.clear()
+    _Computed.clear()
+
+
+def TakeComputed():
+    '''
+    :return: Dictionary of the cache entries computed since the last call, used to send checksums a worker process
+             computed to the process that saves the cache
+    '''
+    entries = {key: _Checksums[key] for key in _Computed if key in _Checksums}
+    _Computed.clear()
+    return entries
+
+
+def Merge(entries):
+    '''Add cache entries returned by TakeComputed in another process'''
+    _Checksums.update(entries)
+
+
+def CacheFullPath(volume_path):
+    return os.path.join(volume_path, CacheFilename)
+
+
+def Load(volume_path):
+    '''Add the checksums saved in the volume directory to the cache'''
+    if not Persist:
+        return
+
+    cache_fullpath = CacheFullPath(volume_path)
+
+    try:
+        with open(cache_fullpath, 'rb') as hFile:
+            (version, entries) = pickle.load(hFile)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger = logging.getLogger(__name__ + '.' + 'Load')
+        logger.info("Ignoring unreadable checksum cache {0}\n{1}".format(cache_fullpath, str(e)))
+        return
+
+    if version != CacheVersion:
+        return
+
+    # Paths are stored relative to the volume so the cache survives moving the volume
+    volume_fullpath = os.path.abspath(volume_path)
+    for (relpath, entry) in entries.items():
+        _Checksums.setdefault(os.path.join(volume_fullpath, relpath), entry)
+
+
+def Save(volume_path):
+    '''Write the cached checksums of files within the volume directory'''
+    if not Persist:
+        return
+
+    volume_fullpath = os.path.abspath(volume_path)
+    entries = {}
+    for (key, entry) in list(_Checksums.items()):
+        try:
+            relpath = os.path.relpath(key, volume_fullpath)
+        except ValueError:
+            # Different drive on Windows
+            continue
+
+        if relpath.startswith(os.pardir):
+            continue
+
+        entries[relpath] = entry
+
+    cache_fullpath = CacheFullPath(volume_path)
+    try:
+        VolumeDataWriter.AtomicWrite(cache_fullpath, pickle.dumps((CacheVersion, entries), protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError as e:
+        logger = logging.getLogger(__name__ + '.' + 'Save')
+        logger.info("Could not write checksum cache {0}\n{1}".format(cache_fullpath, str(e)))
@@ -0,0 +1,187 @@
+'''
+Cache of directory listings used to check for tiles without a stat call per file.
+
+The first query for a directory lists it once with os.scandir.  Later
+queries for files in the directory stat the directory and are answered from
+that listing if it has not changed.
+
+A listing is discarded when:
+
+* A query finds the directory's modification time changed, or the directory
+  was removed
+* Invalidate is called for the directory or a directory above it, which code
+  writing or deleting files in the directory must do when it is done
+
+File sizes and modification times come from the os.DirEntry objects.  On
+Windows the directory listing includes them, elsewhere each file is stat'ed
+at most once per listing.
+
+'''
+
+import fnmatch
+import os
+import threading
+import time
+
+from .Statistics import Statistics
+
+# Directory modification times may only have a resolution of a few seconds on
+# network file systems.  Listings taken within this many seconds of the
+# directory's modification time are rescanned because a later change may not
+# have changed the modification time.
+MTimeResolution = 2.0
+
+
+class DirectoryCacheStats(Statistics):
+    '''Counts directory scans and file system calls answered from a listing instead'''
+
+    Counters = ('Scans', 'StatsAvoided')
+    Format = "Directory listing cache scans: %d stat calls avoided: %d"
+
+
+Stats = DirectoryCacheStats()
+
+
+class DirectoryListing(object):
+    '''Snapshot of the entries in a directory'''
+
+    def __init__(self, path):
+        self.Path = path
+        self.Entries = {}
+        self.MTime = None
+        self.ScanTime = time.time()
+
+        try:
+            self.MTime = os.stat(path).st_mtime
+            with os.scandir(path) as it:
+                for entry in it:
+                    self.Entries[entry.name] = entry
+        except FileNotFoundError:
+            pass
+
+        Stats.Scans += 1
+
+    @property
+    def IsRacy(self):
+        '''True if files may have changed after the scan without changing the directory modification time'''
+        return self.MTime is None or self.ScanTime - self.MTime < MTimeResolution
+
+    def Exists(self, name):
+        return name in self.Entries
+
+    def _Stat(self, name):
+        entry = self.Entries.get(name, None)
+        if entry is None or os.name == 'nt':
+            Stats.StatsAvoided += 1
+
+        if entry is None:
+            return None
+
+        try:
+            return entry.stat()
+        except OSError:
+            return None
+
+    def GetSize(self, name):
+        '''
+        :return: Size of the file or None if it does not exist
+        '''
+        st = self._Stat(name)
+        return None if st is None else st.st_size
+
+    def GetMTime(self, name):
+        '''
+        :return: Modification time of the file or None if it does not exist
+        '''
+        st = self._Stat(name)
+        return None if st is None else st.st_mtime
+
+    def Glob(self, pattern):
+        '''
+        :return: Full paths of entries whose name matches the pattern
+        '''
+        return [os.path.join(self.Path, name) for name in fnmatch.filter(self.Entries.keys(), pattern)]
+
+
+_Lock = threading.Lock()
+_Listings = {}
+
+
+def _Key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def GetListing(path):
+    '''
+    Returns the listing of the directory.  The directory is rescanned if its modification time changed.
+    :param str path: Directory to list
+    :rtype: DirectoryListing
+    '''
+    key = _Key(path)
+    with _Lock:
+        listing = _Listings.get(key, None)
+
+    if listing is not None and not listing.IsRacy:
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+
+        if mtime == listing.MTime:
+            return listing
+
+    listing = DirectoryListing(path)
+    with _Lock:
+        _Listings[key] = listing
+
+    return listing
+
+
+def Invalidate(path):
+    '''Discard the listings of a directory and the directories below it after files in them were written or removed'''
+    key = _Key(path)
+    prefix = os.path.join(key, '')
+    with _Lock:
+        _Listings.pop(key, None)
+        for descendant in [k for k in _Listings.keys() if k.startswith(prefix)]:
+            del _Listings[descendant]
+
+
+def Clear():
+    with _Lock:
+        _Listings.clear()
+
+
+def Exists(fullpath):
+    '''os.path.exists for files, answered from the listing of the file's directory'''
+    (path, name) = os.path.split(fullpath)
+    return GetListing(path).Exists(name)
+
+
+def GetSize(fullpath):
+    '''
+    :return: Size of the file, or None if it does not exist
+    '''
+    (path, name) = os.path.split(fullpath)
+    return GetListing(path).GetSize(name)
+
+
+def OutdatedFile(ReferenceFilename, TestFilename):
+    '''
+    Compare modification times using directory listings
+    :return: True if both files exist and TestFilename is older than ReferenceFilename
+    '''
+    ReferenceMTime = GetListing(os.path.dirname(ReferenceFilename)).GetMTime(os.path.basename(ReferenceFilename))
+    TestMTime = GetListing(os.path.dirname(TestFilename)).GetMTime(os.path.basename(TestFilename))
+    if ReferenceMTime is None or TestMTime is None:
+        return False
+
+    return TestMTime < ReferenceMTime
+
+
+def Glob(path, pattern):
+    '''
+    glob.glob(os.path.join(path, pattern)) answered from the listing of the directory.  The directory is rescanned if it changed.
+    :return: Full paths of matching files
+    '''
+    return GetListing(path).Glob(pattern)
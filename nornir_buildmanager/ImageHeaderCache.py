@@ -0,0 +1,65 @@
+'''
+Process-wide cache of image dimensions read from image file headers.
+
+Dimensions are stored with the modification time and size of the file they
+were read from, so the header is only read again when the file changes.
+
+VerifyPolicy controls how often dimensions recorded in the volume meta-data
+are checked against the image file:
+
+* VerifyNever - Trust the meta-data
+* VerifyOnChange - Read the header when the file changed since it was last read
+* VerifyAlways - Read the header on every check
+
+'''
+
+import os
+
+from .Statistics import Statistics
+
+VerifyNever = 'never'
+VerifyOnChange = 'onchange'
+VerifyAlways = 'always'
+
+# Values of the -verifyimages build argument
+VerifyPolicies = (VerifyNever, VerifyOnChange, VerifyAlways)
+
+VerifyPolicy = VerifyOnChange
+
+
+class ImageHeaderCacheStats(Statistics):
+    '''Counts image sizes returned from the cache and image headers read'''
+
+    Counters = ('Hits', 'Misses')
+    Format = "Image header cache hits: %d misses: %d"
+
+
+Stats = ImageHeaderCacheStats()
+
+# Full path -> ((mtime, size), (height, width))
+_Sizes = {}
+
+
+def GetImageSize(fullpath):
+    '''
+    :return: (height, width) of the image, the header is only read if the file changed since it was last read
+    '''
+    st = os.stat(fullpath)
+    key = os.path.abspath(fullpath)
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    if VerifyPolicy != VerifyAlways:
+        entry = _Sizes.get(key, None)
+        if entry is not None and entry[0] == stamp:
+            Stats.Hits += 1
+            return entry[1]
+
+    Stats.Misses += 1
+    import nornir_imageregistration
+    size = tuple(nornir_imageregistration.GetImageSize(fullpath))
+    _Sizes[key] = (stamp, size)
+    return size
+
+
+def Clear():
+    _Sizes.clear()
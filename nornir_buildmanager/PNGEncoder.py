@@ -0,0 +1,292 @@
+'''
+Writes PNG images from numpy arrays without starting ImageMagick.
+
+Pillow does not write interlaced PNG files, so assembled images were saved
+and then interlaced with "magick convert -interlace PNG", which decoded and
+encoded every image a second time in a new process.  This module encodes
+the image once, in process, with optional Adam7 interlacing.
+
+Each row is filtered with the PNG filter that gives the smallest sum of
+absolute differences, the heuristic libpng uses for adaptive filtering.
+Rows are filtered in strips of StripRows rows that carry the last row of the
+previous strip, so the temporary arrays are a few times the size of a strip
+rather than of the image.
+
+Supported images are grayscale, grayscale with alpha, RGB and RGBA with 8 or
+16 bits per sample, and 1 bit grayscale.  ValueError is raised for other
+images so callers can fall back to ImageMagick.
+
+'''
+
+import struct
+import time
+import zlib
+
+import numpy
+
+from . import VolumeDataWriter
+from .Statistics import Statistics
+
+PNGSignature = b'\x89PNG\r\n\x1a\n'
+
+# zlib level used when a level is not passed
+DefaultCompressionLevel = 6
+
+# Largest IDAT chunk written
+MaxChunkBytes = 1 << 20
+
+# Rows filtered at once
+StripRows = 64
+
+# (X start, Y start, X step, Y step) of the seven Adam7 passes
+Adam7Passes = ((0, 0, 8, 8),
+               (4, 0, 8, 8),
+               (0, 4, 4, 8),
+               (2, 0, 4, 4),
+               (0, 2, 2, 4),
+               (1, 0, 2, 2),
+               (0, 1, 1, 2))
+
+# PNG color type for the number of channels
+ColorTypes = {1: 0, 2: 4, 3: 2, 4: 6}
+
+
+class PNGEncoderStats(Statistics):
+    '''Counts images and bytes written by the in-process encoder'''
+
+    Counters = ('Images', 'Bytes', 'Seconds')
+    Format = "PNG encoder images: %d bytes: %d seconds: %.2f"
+
+
+Stats = PNGEncoderStats()
+
+
+def ToBpp(image, bpp=None):
+    '''
+    Convert an image to the array type written for a bit depth
+    :param ndarray image: Float images are expected to be in the range 0 to 1
+    :param int bpp: Bits per sample, 1, 8 or 16.  If None integer images keep their depth and float images are written with 8 bits.
+    :return: bool, uint8 or uint16 array
+    '''
+    if bpp is None:
+        if image.dtype in (numpy.bool_, numpy.uint8, numpy.uint16):
+            return image
+
+        bpp = 8
+
+    bpp = int(bpp)
+    if bpp == 1:
+        if image.dtype == numpy.bool_:
+            return image
+
+        if numpy.issubdtype(image.dtype, numpy.floating):
+            return image >= 0.5
+
+        return image > 0
+
+    if bpp == 8:
+        dtype = numpy.uint8
+    elif bpp == 16:
+        dtype = numpy.uint16
+    else:
+        raise ValueError("Unsupported bits per pixel %d" % bpp)
+
+    if image.dtype == dtype:
+        return image
+
+    MaxVal = (1 << bpp) - 1
+    if image.dtype == numpy.bool_:
+        return image.astype(dtype) * dtype(MaxVal)
+
+    if numpy.issubdtype(image.dtype, numpy.floating):
+        return numpy.rint(numpy.clip(image, 0, 1) * MaxVal).astype(dtype)
+
+    # Integer images are rescaled from the range of their type, rounding to the nearest value
+    SourceBpp = image.dtype.itemsize * 8
+    if numpy.issubdtype(image.dtype, numpy.signedinteger):
+        image = numpy.clip(image, 0, None)
+        SourceBpp -= 1
+
+    SourceMaxVal = (1 << SourceBpp) - 1
+    return ((image.astype(numpy.uint64) * MaxVal + (SourceMaxVal // 2)) // SourceMaxVal).astype(dtype)
+
+
+def _Chunk(ChunkType, data):
+    return struct.pack('>I', len(data)) + ChunkType + data + struct.pack('>I', zlib.crc32(ChunkType + data) & 0xFFFFFFFF)
+
+
+def _Scanlines(pixels, BitDepth):
+    '''
+    :return: Rows of the image as a 2D uint8 array in PNG byte order
+    '''
+    if BitDepth == 1:
+        return numpy.packbits(pixels, axis=1)
+
+    if BitDepth == 16:
+        pixels = pixels.astype('>u2')
+
+    return numpy.ascontiguousarray(pixels).view(numpy.uint8).reshape(pixels.shape[0], -1)
+
+
+def _FilterScanlines(rows, prior, BytesPerPixel, Filter=None):
+    '''
+    Filter a strip of rows of the image
+    :param ndarray rows: 2D uint8 array of scanlines
+    :param ndarray prior: Scanline before the first row of the strip, zeros for the first row of an interlace pass
+    :param int Filter: PNG filter type used for every row, None to choose the filter for each row
+    :return: 2D uint8 array with the filter type prepended to each row
+    '''
+    above = numpy.empty_like(rows)
+    above[0] = prior
+    above[1:] = rows[:-1]
+    left = numpy.zeros_like(rows)
+    left[:, BytesPerPixel:] = rows[:, :-BytesPerPixel]
+    upleft = numpy.zeros_like(rows)
+    upleft[:, BytesPerPixel:] = above[:, :-BytesPerPixel]
+
+    def Paeth():
+        a = left.astype(numpy.int16)
+        b = above.astype(numpy.int16)
+        c = upleft.astype(numpy.int16)
+        pa = numpy.abs(b - c)
+        pb = numpy.abs(a - c)
+        pc = numpy.abs(a + b - 2 * c)
+        predictor = numpy.where((pa <= pb) & (pa <= pc), left, numpy.where(pb <= pc, above, upleft))
+        return rows - predictor
+
+    Filters = (lambda: rows,
+               lambda: rows - left,
+               lambda: rows - above,
+               lambda: rows - ((left.astype(numpy.uint16) + above) >> 1).astype(numpy.uint8),
+               Paeth)
+
+    filtered = numpy.empty((rows.shape[0], rows.shape[1] + 1), dtype=numpy.uint8)
+    if Filter is not None:
+        filtered[:, 0] = Filter
+        filtered[:, 1:] = Filters[Filter]()
+        return filtered
+
+    # Keep the cheapest filter of each row as the filters are calculated, the first filter wins ties
+    BestCosts = None
+    for (FilterType, CreateFilter) in enumerate(Filters):
+        candidate = CreateFilter()
+        Costs = numpy.abs(candidate.view(numpy.int8).astype(numpy.int16)).sum(axis=1)
+        Better = slice(None) if BestCosts is None else Costs < BestCosts
+        filtered[Better, 0] = FilterType
+        filtered[Better, 1:] = candidate[Better]
+        BestCosts = Costs if BestCosts is None else numpy.minimum(BestCosts, Costs)
+
+    return filtered
+
+
+def Encode(pixels, Interlace=True, CompressionLevel=None, Filter=None):
+    '''
+    Encode an image as a PNG file
+    :param ndarray pixels: bool, uint8 or uint16 image with shape (height, width) or (height, width, channels)
+    :param bool Interlace: Write the image with Adam7 interlacing
+    :param int CompressionLevel: zlib compression level, defaults to DefaultCompressionLevel
+    :param int Filter: PNG filter type used for every row, None to choose the filter for each row
+    :return: bytes of the PNG file
+    '''
+    if pixels.ndim == 2:
+        Channels = 1
+    elif pixels.ndim == 3 and pixels.shape[2] in ColorTypes:
+        Channels = pixels.shape[2]
+    else:
+        raise ValueError("Unsupported image shape %s" % str(pixels.shape))
+
+    if pixels.dtype == numpy.bool_:
+        BitDepth = 1
+    elif pixels.dtype == numpy.uint8:
+        BitDepth = 8
+    elif pixels.dtype == numpy.uint16:
+        BitDepth = 16
+    else:
+        raise ValueError("Unsupported image type %s" % str(pixels.dtype))
+
+    if BitDepth == 1:
+        if Channels != 1:
+            raise ValueError("1 bit images must be grayscale")
+
+        pixels = pixels.reshape(pixels.shape[0:2])
+
+        # Low bit depth images compress better without filtering
+        if Filter is None:
+            Filter = 0
+
+    (Height, Width) = pixels.shape[0:2]
+    if Height == 0 or Width == 0:
+        raise ValueError("Image is empty")
+
+    if CompressionLevel is None:
+        CompressionLevel = DefaultCompressionLevel
+
+    BytesPerPixel = max(1, (Channels * BitDepth) // 8)
+
+    Passes = Adam7Passes if Interlace else ((0, 0, 1, 1),)
+    compressor = zlib.compressobj(CompressionLevel)
+    compressed = []
+    for (XStart, YStart, XStep, YStep) in Passes:
+        PassPixels = pixels[YStart::YStep, XStart::XStep]
+        if PassPixels.shape[0] == 0 or PassPixels.shape[1] == 0:
+            continue
+
+        prior = None
+        for iStart in range(0, PassPixels.shape[0], StripRows):
+            rows = _Scanlines(PassPixels[iStart:iStart + StripRows], BitDepth)
+            if prior is None:
+                prior = numpy.zeros(rows.shape[1], dtype=numpy.uint8)
+
+            compressed.append(compressor.compress(_FilterScanlines(rows, prior, BytesPerPixel, Filter).tobytes()))
+            prior = rows[-1]
+
+    compressed.append(compressor.flush())
+    data = b''.join(compressed)
+
+    Header = struct.pack('>IIBBBBB', Width, Height, BitDepth, ColorTypes[Channels], 0, 0, 1 if Interlace else 0)
+    output = [PNGSignature, _Chunk(b'IHDR', Header)]
+    for iStart in range(0, len(data), MaxChunkBytes):
+        output.append(_Chunk(b'IDAT', data[iStart:iStart + MaxChunkBytes]))
+
+    output.append(_Chunk(b'IEND', b''))
+    return b''.join(output)
+
+
+def Save(ImageFullPath, image, bpp=None, Interlace=True, CompressionLevel=None):
+    '''
+    Write an image as a PNG file
+    :param int bpp: Bits per sample written, see ToBpp
+    '''
+    start = time.perf_counter()
+    data = Encode(ToBpp(image, bpp), Interlace=Interlace, CompressionLevel=CompressionLevel)
+    VolumeDataWriter.AtomicWrite(ImageFullPath, data)
+
+    Stats.Images += 1
+    Stats.Bytes += len(data)
+    Stats.Seconds += time.perf_counter() - start
+
+
+def ReadPixels(ImageFullPath):
+    '''
+    Read an image into an array Encode supports
+    '''
+    from PIL import Image
+
+    with Image.open(ImageFullPath) as im:
+        if im.mode == 'P':
+            im = im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+        elif im.mode not in ('1', 'L', 'LA', 'RGB', 'RGBA', 'I;16', 'I;16B'):
+            raise ValueError("Unsupported image mode %s in %s" % (im.mode, ImageFullPath))
+
+        return numpy.asarray(im)
+
+
+def Reencode(ImageFullPath, OutputFullPath=None, Interlace=True, CompressionLevel=None):
+    '''
+    Rewrite an existing image as a PNG file, interlaced by default
+    :param str OutputFullPath: Defaults to replacing ImageFullPath
+    '''
+    if OutputFullPath is None:
+        OutputFullPath = ImageFullPath
+
+    Save(OutputFullPath, ReadPixels(ImageFullPath), Interlace=Interlace, CompressionLevel=CompressionLevel)
@@ -0,0 +1,216 @@
+'''
+Per-stage timing and resource use of pipeline runs.
+
+The pipeline manager measures each <PythonCall> stage on each volume element
+it is called for.  A record holds:
+
+* WallTime - Seconds from calling the stage until its output was saved
+* CPUTime - CPU seconds used by this process and its reaped child processes
+* PeakRSS - Peak resident memory of the process in bytes when the stage finished
+* PeakRSSIncrease - Bytes the stage raised the peak resident memory by
+* BytesRead, BytesWritten - Disk I/O of this process during the stage
+* XMLFilesSaved - VolumeData.xml files written for the stage
+
+Work done in pool worker processes that are still alive when the stage ends
+is not included in CPU time or I/O.  Memory and I/O figures need psutil and
+are None if it is not available.
+
+At the end of a pipeline the records are written to StageProfile.json and
+StageProfile.csv in the volume directory.
+
+'''
+
+import csv
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+from . import VolumeDataWriter
+from . import VolumeManagerETree
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Set to False to skip measuring stages
+Enabled = True
+
+ProfileFilename = 'StageProfile'
+
+Fields = ['Stage', 'Element', 'WallTime', 'CPUTime', 'PeakRSS', 'PeakRSSIncrease', 'BytesRead', 'BytesWritten', 'XMLFilesSaved']
+
+
+class StageRecord(object):
+    '''Resources used by one call of a stage'''
+
+    def __init__(self, Stage, Element):
+        self.Stage = Stage
+        self.Element = Element
+        self.WallTime = None
+        self.CPUTime = None
+        self.PeakRSS = None
+        self.PeakRSSIncrease = None
+        self.BytesRead = None
+        self.BytesWritten = None
+        self.XMLFilesSaved = None
+
+    def ToDict(self):
+        return {name: getattr(self, name) for name in Fields}
+
+
+_Lock = threading.Lock()
+Records = []
+
+
+def _CPUTime():
+    t = time.process_time()
+    if resource is not None:
+        # Includes child processes that have exited, such as pool workers and command line tools
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        t += usage.ru_utime + usage.ru_stime
+
+    return t
+
+
+def _PeakRSS():
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    if psutil is None:
+        return None
+
+    return getattr(psutil.Process().memory_info(), 'peak_wset', None)
+
+
+def _IOCounters():
+    if psutil is None:
+        return None
+
+    try:
+        counters = psutil.Process().io_counters()
+    except (AttributeError, psutil.Error):
+        # Not supported on macOS
+        return None
+
+    return (counters.read_bytes, counters.write_bytes)
+
+
+def _XMLFilesSaved():
+    return VolumeManagerETree.SaveStats.Written
+
+
+class Measure(object):
+    '''Context manager recording the resources used by the code it wraps as a stage record'''
+
+    def __init__(self, Stage, Element):
+        self.Record = StageRecord(Stage, Element)
+
+    def __enter__(self):
+        if not Enabled:
+            return self.Record
+
+        self._StartIO = _IOCounters()
+        self._StartPeakRSS = _PeakRSS()
+        self._StartXMLFilesSaved = _XMLFilesSaved()
+        self._StartCPU = _CPUTime()
+        self._StartWall = time.perf_counter()
+        return self.Record
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not Enabled:
+            return False
+
+        record = self.Record
+        record.WallTime = time.perf_counter() - self._StartWall
+        record.CPUTime = _CPUTime() - self._StartCPU
+        record.XMLFilesSaved = _XMLFilesSaved() - self._StartXMLFilesSaved
+
+        record.PeakRSS = _PeakRSS()
+        if record.PeakRSS is not None and self._StartPeakRSS is not None:
+            record.PeakRSSIncrease = record.PeakRSS - self._StartPeakRSS
+
+        EndIO = _IOCounters()
+        if EndIO is not None and self._StartIO is not None:
+            record.BytesRead = EndIO[0] - self._StartIO[0]
+            record.BytesWritten = EndIO[1] - self._StartIO[1]
+
+        with _Lock:
+            Records.append(record)
+
+        return False
+
+
+def ElementName(VolumeElem, volume_path):
+    '''
+    :return: Tag and path relative to the volume of the element a stage was called for
+    '''
+    FullPath = getattr(VolumeElem, 'FullPath', None)
+    if FullPath is None:
+        return VolumeElem.tag
+
+    try:
+        return VolumeElem.tag + ' ' + os.path.relpath(FullPath, volume_path)
+    except ValueError:
+        return VolumeElem.tag + ' ' + FullPath
+
+
+def Clear():
+    with _Lock:
+        del Records[:]
+
+
+def Extend(records):
+    '''Add records measured in another process'''
+    with _Lock:
+        Records.extend(records)
+
+
+def Summary():
+    '''
+    :return: Total time and resources of each stage, slowest stage first
+    '''
+    with _Lock:
+        records = list(Records)
+
+    totals = {}
+    for r in records:
+        (count, wall, cpu, peak, saved) = totals.get(r.Stage, (0, 0.0, 0.0, 0, 0))
+        totals[r.Stage] = (count + 1,
+                           wall + (r.WallTime or 0),
+                           cpu + (r.CPUTime or 0),
+                           max(peak, r.PeakRSS or 0),
+                           saved + (r.XMLFilesSaved or 0))
+
+    lines = ["%-40s %6s %10s %10s %10s %6s" % ('Stage', 'Calls', 'Wall (s)', 'CPU (s)', 'Peak MB', 'Saved')]
+    for (stage, (count, wall, cpu, peak, saved)) in sorted(totals.items(), key=lambda kv: kv[1][1], reverse=True):
+        lines.append("%-40s %6d %10.1f %10.1f %10.1f %6d" % (stage, count, wall, cpu, peak / (1024.0 * 1024.0), saved))
+
+    return '\n'.join(lines)
+
+
+def Save(volume_path):
+    '''Write the records to StageProfile.json and StageProfile.csv in the volume directory'''
+    with _Lock:
+        records = [r.ToDict() for r in Records]
+
+    basename = os.path.join(volume_path, ProfileFilename)
+
+    VolumeDataWriter.AtomicWrite(basename + '.json', json.dumps(records, indent=2).encode('utf-8'))
+
+    csvtext = io.StringIO(newline='')
+    writer = csv.DictWriter(csvtext, fieldnames=Fields)
+    writer.writeheader()
+    writer.writerows(records)
+    VolumeDataWriter.AtomicWrite(basename + '.csv', csvtext.getvalue().encode('utf-8'))
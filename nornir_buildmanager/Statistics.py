@@ -0,0 +1,28 @@
+'''
+Counters kept by the caches and writers while a pipeline runs.
+
+Each module defines a subclass that lists the names of its counters and the
+message they are printed with, and a module level instance that the module
+increments.  The pipeline manager logs every instance when a pipeline ends.
+'''
+
+
+class Statistics(object):
+    '''
+    Base class for module counters.  Counters lists the attribute names, which
+    Reset sets to zero.  Format is filled with the counter values in the order
+    they are listed.
+    '''
+
+    Counters = ()
+    Format = ""
+
+    def __init__(self):
+        self.Reset()
+
+    def Reset(self):
+        for name in self.Counters:
+            setattr(self, name, 0)
+
+    def __str__(self):
+        return self.Format % tuple(getattr(self, name) for name in self.Counters)
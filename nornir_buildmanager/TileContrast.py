@@ -0,0 +1,177 @@
+'''
+Applies contrast settings to tiles with a lookup table.
+
+Every tile of a filter is converted with the same (Min, Max, Gamma, InputBpp,
+OutputBpp), so the output value for every possible input value is calculated
+once.  Converting a tile is then a single numpy indexing operation.  Tiles
+are converted in batches in worker processes, and each worker writes its own
+output tiles.
+
+The mapping matches "magick convert -level Min,Max -gamma Gamma":
+
+    out = clip((in - Min) / (Max - Min), 0, 1) ** (1 / Gamma)
+
+scaled to the range of OutputBpp and rounded to the nearest integer.
+
+Workers return the SHA1 of each input tile read from the bytes they already
+read, so callers can record which inputs a filter was built from.
+
+'''
+
+import hashlib
+import math
+import multiprocessing
+import os
+
+from . import ChecksumCache
+from .Statistics import Statistics
+
+ChecksumKind = 'sha1'
+
+
+class TileContrastStats(Statistics):
+    '''Counts tiles converted with lookup tables and tiles skipped because their input was unchanged'''
+
+    Counters = ('Converted', 'Unchanged', 'Failed')
+    Format = "Tile contrast converted: %d unchanged: %d failed: %d"
+
+
+Stats = TileContrastStats()
+
+
+def OutputDtype(OutputBpp):
+    import numpy
+    return numpy.uint8 if int(OutputBpp) <= 8 else numpy.uint16
+
+
+def CreateLUT(MinMax, Gamma, InputBpp, OutputBpp):
+    '''
+    :param tuple MinMax: (Min, Max) input values mapped to the lowest and highest output values
+    :param float Gamma: None for no gamma correction
+    :return: Array with the output value of every value of the input type
+    '''
+    import numpy
+
+    (MinVal, MaxVal) = (float(MinMax[0]), float(MinMax[1]))
+    if MaxVal < MinVal:
+        (MinVal, MaxVal) = (MaxVal, MinVal)
+
+    NumEntries = 1 << (8 if int(InputBpp) <= 8 else 16)
+    values = numpy.arange(NumEntries, dtype=numpy.float64)
+    if MaxVal > MinVal:
+        normalized = numpy.clip((values - MinVal) / (MaxVal - MinVal), 0, 1)
+    else:
+        normalized = (values >= MaxVal).astype(numpy.float64)
+
+    if Gamma is not None and float(Gamma) != 1.0:
+        normalized **= 1.0 / float(Gamma)
+
+    OutputMax = (1 << int(OutputBpp)) - 1
+    return numpy.rint(normalized * OutputMax).astype(OutputDtype(OutputBpp))
+
+
+def ApplyLUT(pixels, LUT):
+    '''
+    :return: pixels mapped through the lookup table
+    '''
+    import numpy
+
+    if pixels.dtype == numpy.bool_:
+        pixels = pixels.astype(numpy.uint8) * numpy.uint8(255)
+
+    if pixels.ndim == 3:
+        # Color tiles are converted to grayscale as ImageMagick's -colorspace Gray does
+        pixels = pixels[:, :, 0:3].mean(axis=2)
+
+    if not (pixels.dtype == numpy.uint8 or (pixels.dtype == numpy.uint16 and len(LUT) > 256)):
+        pixels = numpy.clip(numpy.rint(pixels), 0, len(LUT) - 1).astype(numpy.intp)
+
+    return LUT[pixels]
+
+
+def ConvertTile(InputFullPath, OutputFullPath, LUT):
+    '''
+    Convert one tile
+    :return: SHA1 of the input file
+    '''
+    from PIL import Image
+    from . import TileHistogram
+
+    with open(InputFullPath, 'rb') as hFile:
+        data = hFile.read()
+
+    pixels = ApplyLUT(TileHistogram.ReadPixels(InputFullPath, data), LUT)
+    Image.fromarray(pixels).save(OutputFullPath)
+    return hashlib.sha1(data).hexdigest()
+
+
+def ConvertTiles(Tiles, LUT):
+    '''
+    Convert a batch of tiles
+    :param list Tiles: (InputFullPath, OutputFullPath) for each tile
+    :return: List of (InputFullPath, checksum), the checksum is None if the tile could not be converted
+    '''
+    import nornir_shared.prettyoutput as prettyoutput
+
+    results = []
+    for (InputFullPath, OutputFullPath) in Tiles:
+        try:
+            results.append((InputFullPath, ConvertTile(InputFullPath, OutputFullPath, LUT)))
+        except Exception as e:
+            prettyoutput.LogErr("Could not convert {0}\n{1}".format(InputFullPath, str(e)))
+            results.append((InputFullPath, None))
+
+    return results
+
+
+def FileChecksum(fullpath):
+    '''
+    :return: SHA1 of a file, from ChecksumCache if the file has not changed
+    '''
+    def _Calculate(path):
+        with open(path, 'rb') as hFile:
+            return hashlib.sha1(hFile.read()).hexdigest()
+
+    return ChecksumCache.Get(fullpath, ChecksumKind, _Calculate)
+
+
+def ConvertTilesInDict(TilesToConvert, MinMax, Gamma, InputBpp, OutputBpp, Pool=None):
+    '''
+    Convert tiles with one lookup table in batches on a pool
+    :param dict TilesToConvert: Input full path -> output full path
+    :param Pool: Pool the batches run on, a local machine pool by default
+    :return: Dictionary of input full path -> checksum of the input for the tiles that were converted
+    '''
+    if len(TilesToConvert) == 0:
+        return {}
+
+    LUT = CreateLUT(MinMax, Gamma, InputBpp, OutputBpp)
+    Tiles = sorted(TilesToConvert.items())
+
+    if len(Tiles) == 1:
+        results = [ConvertTiles(Tiles, LUT)]
+    else:
+        if Pool is None:
+            import nornir_pools
+            Pool = nornir_pools.GetGlobalLocalMachinePool()
+
+        BatchSize = max(1, int(math.ceil(len(Tiles) / (multiprocessing.cpu_count() * 4.0))))
+        tasks = []
+        for iStart in range(0, len(Tiles), BatchSize):
+            batch = Tiles[iStart:iStart + BatchSize]
+            tasks.append(Pool.add_task("Contrast {0}".format(os.path.basename(batch[0][0])), ConvertTiles, batch, LUT))
+
+        results = [t.wait_return() for t in tasks]
+
+    Converted = {}
+    for batch in results:
+        for (InputFullPath, checksum) in batch:
+            if checksum is None:
+                Stats.Failed += 1
+                continue
+
+            Stats.Converted += 1
+            ChecksumCache.Get(InputFullPath, ChecksumKind, lambda path: checksum)
+            Converted[InputFullPath] = checksum
+
+    return Converted
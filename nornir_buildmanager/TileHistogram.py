@@ -0,0 +1,432 @@
+'''
+Intensity histograms of tile sets built from per-tile partial histograms.
+
+A partial histogram counts the pixels of one tile.  The histogram of a tile
+set is the sum of the partials of its tiles, so tiles can be added to or
+removed from a histogram without reading the other tiles again.
+
+Reading every tile at full resolution is the slowest part of choosing the
+contrast of a large section.  Two settings trade accuracy for speed:
+
+* SampleFraction - Fraction of the tiles read, chosen at random
+* Stride - Only every Nth pixel of every Nth row of a tile is counted
+
+TileHistogramAccumulator.ErrorBound reports how far the cumulative fraction
+of pixels below any intensity may be from the value for all pixels of all
+tiles.  The tile term is Serfling's bound for sampling without replacement.
+The pixel term applies the same bound to the counted pixels, which assumes
+neighboring pixels are no more alike than pixels chosen at random.
+
+Partials are cached by the SHA1 of the tile file and the binning, so a
+tile that was copied or renamed is not read again.  The cache can be saved
+to TileHistograms.cache in the volume directory.
+
+'''
+
+import collections
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import pickle
+
+from . import ChecksumCache
+from . import VolumeDataWriter
+from .Statistics import Statistics
+
+CacheFilename = 'TileHistograms.cache'
+
+# Increment if the layout of the pickled data changes
+CacheVersion = 1
+
+# Set to False to keep the cache in memory only
+Persist = True
+
+# Bytes of partial histogram counts kept in memory, the oldest partials are dropped first
+MaxCacheBytes = 256 << 20
+
+# Fewest tiles read when sampling tiles
+MinSampledTiles = 16
+
+ChecksumKind = 'sha1'
+
+
+class TileHistogramStats(Statistics):
+    '''Counts partial histograms returned from the cache and tiles read to compute them'''
+
+    Counters = ('Hits', 'Misses')
+    Format = "Tile histogram cache hits: %d misses: %d"
+
+
+Stats = TileHistogramStats()
+
+# (Checksum, Stride, MinVal, MaxVal, NumBins) -> TilePartial
+_Partials = collections.OrderedDict()
+_CacheBytes = 0
+
+
+class TilePartial(object):
+    '''Histogram of one tile.  Only bins from Offset to the last non-empty bin are stored.'''
+
+    __slots__ = ('Offset', 'Counts', 'NumPixels', 'NumCounted')
+
+    def __init__(self, Offset, Counts, NumPixels, NumCounted):
+        self.Offset = Offset
+        self.Counts = Counts  # Little endian uint32 bytes
+        self.NumPixels = NumPixels
+        self.NumCounted = NumCounted
+
+    @classmethod
+    def FromBins(cls, bins, NumPixels, NumCounted):
+        import numpy
+
+        nonzero = numpy.flatnonzero(bins)
+        if len(nonzero) == 0:
+            return TilePartial(0, b'', NumPixels, NumCounted)
+
+        first = int(nonzero[0])
+        last = int(nonzero[-1])
+        return TilePartial(first, bins[first:last + 1].astype('<u4').tobytes(), NumPixels, NumCounted)
+
+    def AddTo(self, bins, sign=1):
+        '''Add the counts of this tile to an array of bins'''
+        import numpy
+
+        counts = numpy.frombuffer(self.Counts, dtype='<u4')
+        bins[self.Offset:self.Offset + len(counts)] += sign * counts.astype(numpy.int64)
+
+    def __getstate__(self):
+        return (self.Offset, self.Counts, self.NumPixels, self.NumCounted)
+
+    def __setstate__(self, state):
+        (self.Offset, self.Counts, self.NumPixels, self.NumCounted) = state
+
+
+def ReadPixels(fullpath, data=None):
+    '''
+    :param bytes data: Contents of the file if they were already read
+    :return: Pixel values of the image without scaling
+    '''
+    import io
+    import numpy
+    from PIL import Image
+
+    if data is not None:
+        fullpath = io.BytesIO(data)
+
+    with Image.open(fullpath) as im:
+        return numpy.asarray(im)
+
+
+def CalculatePartial(pixels, MinVal, MaxVal, NumBins, Stride=1):
+    '''
+    Count pixels between MinVal and MaxVal into NumBins equal width bins.  Pixels outside the range are not counted.
+    :return: TilePartial
+    '''
+    import numpy
+
+    NumPixels = pixels.size
+    if Stride > 1:
+        pixels = pixels[::Stride, ::Stride]
+
+    values = pixels.ravel()
+    BinWidth = (MaxVal - MinVal) / float(NumBins)
+
+    if numpy.issubdtype(values.dtype, numpy.unsignedinteger) and values.dtype.itemsize <= 2:
+        # Count each intensity once, then bin the intensities.  Much faster than binning every pixel.
+        ValueCounts = numpy.bincount(values.astype(numpy.intp, copy=False))
+        intensities = numpy.arange(len(ValueCounts))
+        InRange = (intensities >= MinVal) & (intensities <= MaxVal) & (ValueCounts > 0)
+        iBins = numpy.minimum(((intensities[InRange] - MinVal) / BinWidth).astype(numpy.intp), NumBins - 1)
+        bins = numpy.bincount(iBins, weights=ValueCounts[InRange], minlength=NumBins).astype(numpy.int64)
+    else:
+        (bins, edges) = numpy.histogram(values, bins=NumBins, range=(MinVal, MaxVal))
+
+    return TilePartial.FromBins(bins, NumPixels, values.size)
+
+
+def CalculatePartials(fullpaths, MinVal, MaxVal, NumBins, Stride=1):
+    '''
+    Read tiles and calculate their partial histograms.  Each file is read once for both the checksum and the pixels.
+    :return: List of (fullpath, checksum, TilePartial)
+    '''
+    results = []
+    for fullpath in fullpaths:
+        with open(fullpath, 'rb') as hFile:
+            data = hFile.read()
+
+        checksum = hashlib.sha1(data).hexdigest()
+        pixels = ReadPixels(fullpath, data)
+        results.append((fullpath, checksum, CalculatePartial(pixels, MinVal, MaxVal, NumBins, Stride)))
+
+    return results
+
+
+def _PartialBytes(partial):
+    return len(partial.Counts) + 64
+
+
+def _AddToCache(key, partial):
+    global _CacheBytes
+
+    if key in _Partials:
+        _Partials.move_to_end(key)
+        return
+
+    _Partials[key] = partial
+    _CacheBytes += _PartialBytes(partial)
+
+    while _CacheBytes > MaxCacheBytes and len(_Partials) > 1:
+        (oldkey, old) = _Partials.popitem(last=False)
+        _CacheBytes -= _PartialBytes(old)
+
+
+def _GetFromCache(key):
+    partial = _Partials.get(key, None)
+    if partial is not None:
+        _Partials.move_to_end(key)
+
+    return partial
+
+
+def Merge(Calculated):
+    '''
+    Add partial histograms to the cache, along with the checksums of the tiles they were read from
+    :param list Calculated: TileHistogramAccumulator.Calculated from this or another process
+    '''
+    for (fullpath, key, partial) in Calculated:
+        ChecksumCache.Get(fullpath, ChecksumKind, lambda path: key[0])
+        _AddToCache(key, partial)
+
+
+def Clear():
+    global _CacheBytes
+    _Partials.clear()
+    _CacheBytes = 0
+
+
+def SampleTiles(fullpaths, SampleFraction=None, Seed=0):
+    '''
+    Choose a random subset of tiles.  The same tiles are chosen for the same list and seed.
+    :param float SampleFraction: Fraction of tiles to choose, all tiles are returned if None or >= 1
+    :return: Chosen tiles in the order they were listed
+    '''
+    fullpaths = list(fullpaths)
+    if SampleFraction is None or SampleFraction >= 1.0:
+        return fullpaths
+
+    NumSampled = max(int(math.ceil(len(fullpaths) * SampleFraction)), MinSampledTiles)
+    if NumSampled >= len(fullpaths):
+        return fullpaths
+
+    import numpy
+
+    rng = numpy.random.RandomState(Seed)
+    chosen = numpy.sort(rng.choice(len(fullpaths), size=NumSampled, replace=False))
+    return [fullpaths[i] for i in chosen]
+
+
+class TileHistogramAccumulator(object):
+    '''Sum of the partial histograms of a set of tiles'''
+
+    @property
+    def NumTiles(self):
+        return len(self._Tiles)
+
+    @property
+    def Bins(self):
+        return self._Bins
+
+    def __init__(self, MinVal, MaxVal, NumBins, Stride=1, PopulationSize=None):
+        '''
+        :param int Stride: Count every Nth pixel of every Nth row
+        :param int PopulationSize: Number of tiles the added tiles were sampled from, used for the error bound
+        '''
+        import numpy
+
+        self.MinVal = MinVal
+        self.MaxVal = MaxVal
+        self.NumBins = int(NumBins)
+        self.Stride = max(1, int(Stride))
+        self.PopulationSize = PopulationSize
+        self.NumPixels = 0
+        self.NumCounted = 0
+        self._Bins = numpy.zeros(self.NumBins, dtype=numpy.int64)
+        self._Tiles = {}  # Full path -> checksum
+
+        # (Full path, cache key, TilePartial) of each tile read by AddTiles.  Processes that build histograms for
+        # another process return these so the other process can add them to its cache with Merge.
+        self.Calculated = []
+
+    def _Key(self, checksum):
+        return (checksum, self.Stride, self.MinVal, self.MaxVal, self.NumBins)
+
+    def _Add(self, fullpath, checksum, partial):
+        if fullpath in self._Tiles:
+            return
+
+        self._Tiles[fullpath] = checksum
+        partial.AddTo(self._Bins)
+        self.NumPixels += partial.NumPixels
+        self.NumCounted += partial.NumCounted
+
+    def AddTiles(self, fullpaths, Pool=None):
+        '''
+        Add tiles to the histogram.  Tiles whose partial histogram is not cached are read in Pool, a local machine pool by default.
+        '''
+        missing = []
+        for fullpath in fullpaths:
+            if fullpath in self._Tiles:
+                continue
+
+            checksum = ChecksumCache.TryGet(fullpath, ChecksumKind)
+            partial = None if checksum is None else _GetFromCache(self._Key(checksum))
+            if partial is None:
+                missing.append(fullpath)
+                continue
+
+            Stats.Hits += 1
+            self._Add(fullpath, checksum, partial)
+
+        if len(missing) == 0:
+            return
+
+        Stats.Misses += len(missing)
+
+        if len(missing) == 1:
+            results = [CalculatePartials(missing, self.MinVal, self.MaxVal, self.NumBins, self.Stride)]
+        else:
+            if Pool is None:
+                import nornir_pools
+                Pool = nornir_pools.GetGlobalLocalMachinePool()
+
+            BatchSize = max(1, int(math.ceil(len(missing) / (multiprocessing.cpu_count() * 4.0))))
+            tasks = []
+            for iStart in range(0, len(missing), BatchSize):
+                batch = missing[iStart:iStart + BatchSize]
+                tasks.append(Pool.add_task("Histogram {0}".format(os.path.basename(batch[0])),
+                                           CalculatePartials, batch, self.MinVal, self.MaxVal, self.NumBins, self.Stride))
+
+            results = [t.wait_return() for t in tasks]
+
+        for batch in results:
+            for (fullpath, checksum, partial) in batch:
+                entry = (fullpath, self._Key(checksum), partial)
+                Merge([entry])
+                self.Calculated.append(entry)
+                self._Add(fullpath, checksum, partial)
+
+    def RemoveTile(self, fullpath):
+        '''Remove a tile from the histogram.  The tile is read again if its partial histogram is no longer cached.'''
+        checksum = self._Tiles.pop(fullpath, None)
+        if checksum is None:
+            return
+
+        partial = _GetFromCache(self._Key(checksum))
+        if partial is None:
+            [(path, checksum, partial)] = CalculatePartials([fullpath], self.MinVal, self.MaxVal, self.NumBins, self.Stride)
+
+        partial.AddTo(self._Bins, sign=-1)
+        self.NumPixels -= partial.NumPixels
+        self.NumCounted -= partial.NumCounted
+
+    def ErrorBound(self, Confidence=0.95):
+        '''
+        :return: Largest expected difference, at the given confidence, between the fraction of counted pixels
+                 below an intensity and the fraction of all pixels of all tiles below it.  0 if every pixel was counted.
+        '''
+        if self.NumTiles == 0:
+            return 1.0
+
+        Alpha = 1.0 - Confidence
+        bound = 0.0
+
+        PopulationSize = self.PopulationSize
+        if PopulationSize is not None and PopulationSize > self.NumTiles:
+            bound += _SerflingBound(self.NumTiles, PopulationSize, Alpha)
+
+        if self.NumPixels > self.NumCounted:
+            bound += _SerflingBound(self.NumCounted, self.NumPixels, Alpha)
+
+        return min(bound, 1.0)
+
+    def ToHistogram(self):
+        '''
+        :return: nornir_shared Histogram of the counted pixels
+        '''
+        from nornir_shared.histogram import Histogram
+
+        histogram = Histogram.Init(self.MinVal, self.MaxVal, self.NumBins)
+        histogram.Bins = self._Bins.tolist()
+        return histogram
+
+
+def _SerflingBound(n, N, Alpha):
+    '''Deviation of the mean of n values sampled without replacement from N values in [0,1] exceeded with probability Alpha'''
+    return math.sqrt(math.log(2.0 / Alpha) * (1.0 - (n - 1) / float(N)) / (2.0 * n))
+
+
+def Build(fullpaths, MinVal, MaxVal, NumBins, SampleFraction=None, Stride=None, Seed=0, Pool=None):
+    '''
+    Calculate the histogram of a set of tiles
+    :param float SampleFraction: Fraction of tiles to read, all tiles are read if None
+    :param int Stride: Count every Nth pixel of every Nth row, all pixels are counted if None
+    :return: TileHistogramAccumulator
+    '''
+    fullpaths = list(fullpaths)
+    if Stride is None:
+        Stride = 1
+
+    sampled = SampleTiles(fullpaths, SampleFraction, Seed)
+
+    accumulator = TileHistogramAccumulator(MinVal, MaxVal, NumBins, Stride=Stride, PopulationSize=len(fullpaths))
+    accumulator.AddTiles(sampled, Pool=Pool)
+
+    if accumulator.NumTiles < len(fullpaths) or Stride > 1:
+        logger = logging.getLogger(__name__ + '.' + 'Build')
+        logger.info("Histogram of {0} of {1} tiles with stride {2}, cumulative fraction error bound {3:.4g}".format(accumulator.NumTiles, len(fullpaths), Stride, accumulator.ErrorBound()))
+
+    return accumulator
+
+
+def CacheFullPath(volume_path):
+    return os.path.join(volume_path, CacheFilename)
+
+
+def Load(volume_path):
+    '''Add the partial histograms saved in the volume directory to the cache'''
+    if not Persist:
+        return
+
+    cache_fullpath = CacheFullPath(volume_path)
+
+    try:
+        with open(cache_fullpath, 'rb') as hFile:
+            (version, entries) = pickle.load(hFile)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger = logging.getLogger(__name__ + '.' + 'Load')
+        logger.info("Ignoring unreadable tile histogram cache {0}\n{1}".format(cache_fullpath, str(e)))
+        return
+
+    if version != CacheVersion:
+        return
+
+    for (key, partial) in entries:
+        if key not in _Partials:
+            _AddToCache(key, partial)
+
+
+def Save(volume_path):
+    '''Write the cached partial histograms, oldest first'''
+    if not Persist or len(_Partials) == 0:
+        return
+
+    cache_fullpath = CacheFullPath(volume_path)
+    try:
+        VolumeDataWriter.AtomicWrite(cache_fullpath, pickle.dumps((CacheVersion, list(_Partials.items())), protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError as e:
+        logger = logging.getLogger(__name__ + '.' + 'Save')
+        logger.info("Could not write tile histogram cache {0}\n{1}".format(cache_fullpath, str(e)))
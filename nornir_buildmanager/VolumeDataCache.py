@@ -0,0 +1,142 @@
+'''
+Persistent cache of parsed VolumeData.xml files.
+
+The parsed element tree of each VolumeData.xml file is pickled into a
+VolumeData.cache file in the same directory.  The cache records the inode,
+modification time in nanoseconds and size of the XML file it was built from,
+and a digest of its contents.  The XML file is still read on every load, but
+it is only parsed if the stat key or the digest differ, so a file rewritten
+within one modification time tick at the same size is not mistaken for the
+cached one.  A cache that does not match is rebuilt the next time the XML is
+parsed.
+
+The cache files are unpickled.  Anyone who can write to the volume directory
+can already change the volume, but a crafted cache file can also run code as
+the user building the volume.  Set Enabled to False when building volumes in
+directories that are writable by untrusted users.
+
+'''
+
+import hashlib
+import logging
+import os
+import pickle
+import xml.etree.ElementTree as ElementTree
+
+from .Statistics import Statistics
+
+CacheFilename = 'VolumeData.cache'
+
+# Increment if the layout of the pickled data changes
+CacheVersion = 2
+
+# Set to False to always parse the XML files
+Enabled = True
+
+
+class CacheStats(Statistics):
+    '''Counts cache hits and misses'''
+
+    Counters = ('Hits', 'Misses')
+    Format = "VolumeData cache hits: %d misses: %d"
+
+
+Stats = CacheStats()
+
+
+def CacheFullPath(xml_fullpath):
+    return os.path.join(os.path.dirname(xml_fullpath), CacheFilename)
+
+
+def _StatKey(xml_fullpath):
+    '''The key a cache entry must match to be used'''
+    st = os.stat(xml_fullpath)
+    return (CacheVersion, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _Digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def ElementToTuple(element):
+    return (element.tag, dict(element.attrib), element.text, element.tail, [ElementToTuple(child) for child in element])
+
+
+def TupleToElement(data):
+    (tag, attrib, text, tail, children) = data
+    element = ElementTree.Element(tag, attrib)
+    element.text = text
+    element.tail = tail
+    element.extend([TupleToElement(child) for child in children])
+    return element
+
+
+def _TryLoadCache(xml_fullpath, key, digest):
+    '''
+    :return: The root element stored in the cache or None if the cache does not exist or is out of date
+    '''
+    cache_fullpath = CacheFullPath(xml_fullpath)
+
+    try:
+        with open(cache_fullpath, 'rb') as hFile:
+            (cached_key, cached_digest, data) = pickle.load(hFile)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger = logging.getLogger(__name__ + '.' + '_TryLoadCache')
+        logger.info("Ignoring unreadable cache {0}\n{1}".format(cache_fullpath, str(e)))
+        return None
+
+    if cached_key != key or cached_digest != digest:
+        return None
+
+    return TupleToElement(data)
+
+
+def _Store(xml_fullpath, root, key, digest):
+    '''Write the element tree to the cache, the cache is replaced atomically so readers never see a partial file'''
+    cache_fullpath = CacheFullPath(xml_fullpath)
+    temp_fullpath = cache_fullpath + '.%d.tmp' % os.getpid()
+
+    try:
+        with open(temp_fullpath, 'wb') as hFile:
+            pickle.dump((key, digest, ElementToTuple(root)), hFile, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(temp_fullpath, cache_fullpath)
+    except OSError as e:
+        # Read-only volumes and similar are not errors, we just parse the XML next time
+        logger = logging.getLogger(__name__ + '.' + '_Store')
+        logger.info("Could not write cache {0}\n{1}".format(cache_fullpath, str(e)))
+        if os.path.exists(temp_fullpath):
+            os.remove(temp_fullpath)
+
+
+def Load(xml_fullpath, UseCache=True):
+    '''
+    Returns the root element of an XML file.  The cache is used if it matches
+    the XML file, otherwise the XML is parsed and the cache is updated.
+    :param str xml_fullpath: Full path to the VolumeData.xml file
+    :param bool UseCache: False to parse the XML file without consulting the cache
+    :return: Root element of the XML file
+    :rtype: ElementTree.Element
+    '''
+
+    if not (Enabled and UseCache):
+        return ElementTree.parse(xml_fullpath).getroot()
+
+    # Stat before reading.  If the file changes after the stat the key will not match the new file and the entry is ignored.
+    key = _StatKey(xml_fullpath)
+    with open(xml_fullpath, 'rb') as hFile:
+        xml_data = hFile.read()
+
+    digest = _Digest(xml_data)
+
+    root = _TryLoadCache(xml_fullpath, key, digest)
+    if root is not None:
+        Stats.Hits += 1
+        return root
+
+    Stats.Misses += 1
+    root = ElementTree.fromstring(xml_data)
+    _Store(xml_fullpath, root, key, digest)
+    return root
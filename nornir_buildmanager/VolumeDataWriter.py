@@ -0,0 +1,159 @@
+'''
+Background writer for VolumeData.xml files.
+
+Saves are serialized on the calling thread and handed to a single writer
+thread.  If a file is saved again before the previous contents reached the
+disk only the newest contents are written.  Files are written to a temporary
+file and moved over the original with os.replace so a crash never leaves a
+partially written VolumeData.xml behind.
+
+Call Flush to wait for all queued writes, the pipeline manager does this
+after every stage and after waiting on the pools at the end of a pipeline.
+
+'''
+
+import atexit
+import logging
+import os
+import threading
+
+from .Statistics import Statistics
+
+# Set to False to write files on the calling thread
+Asynchronous = True
+
+
+class WriterStatistics(Statistics):
+    '''Counts files queued, writes replaced by a newer save of the same file, and files written'''
+
+    Counters = ('Queued', 'Coalesced', 'Written')
+    Format = "VolumeData.xml writes queued: %d coalesced: %d written: %d"
+
+
+Stats = WriterStatistics()
+
+
+def _Key(fullpath):
+    return os.path.abspath(fullpath)
+
+
+def AtomicWrite(fullpath, data):
+    '''Write bytes to a temporary file and replace the destination with it'''
+    temp_fullpath = fullpath + '.%d.tmp' % os.getpid()
+    try:
+        with open(temp_fullpath, 'wb') as hFile:
+            hFile.write(data)
+
+        os.replace(temp_fullpath, fullpath)
+    except:
+        if os.path.exists(temp_fullpath):
+            os.remove(temp_fullpath)
+        raise
+
+
+class _Writer(object):
+
+    def __init__(self):
+        self._Condition = threading.Condition()
+        self._Pending = {}
+        self._InFlight = None
+        self._Errors = []
+        self._Thread = None
+
+    def Write(self, fullpath, data):
+        key = _Key(fullpath)
+        with self._Condition:
+            if key in self._Pending:
+                Stats.Coalesced += 1
+            else:
+                Stats.Queued += 1
+
+            self._Pending[key] = data
+
+            if self._Thread is None or not self._Thread.is_alive():
+                self._Thread = threading.Thread(target=self._Run, name='VolumeDataWriter', daemon=True)
+                self._Thread.start()
+
+            self._Condition.notify_all()
+
+    def _Run(self):
+        while True:
+            with self._Condition:
+                while len(self._Pending) == 0:
+                    self._Condition.wait()
+
+                # Write in the order files were first queued
+                key = next(iter(self._Pending))
+                data = self._Pending.pop(key)
+                self._InFlight = key
+
+            try:
+                AtomicWrite(key, data)
+                with self._Condition:
+                    Stats.Written += 1
+            except Exception as e:
+                logger = logging.getLogger(__name__ + '.' + '_Run')
+                logger.error("Could not write {0}\n{1}".format(key, str(e)))
+                with self._Condition:
+                    self._Errors.append(e)
+            finally:
+                with self._Condition:
+                    self._InFlight = None
+                    self._Condition.notify_all()
+
+    def IsPending(self, key):
+        return key in self._Pending or self._InFlight == key
+
+    def WaitForFile(self, fullpath):
+        key = _Key(fullpath)
+        with self._Condition:
+            self._Condition.wait_for(lambda: not self.IsPending(key))
+
+    def Flush(self):
+        with self._Condition:
+            self._Condition.wait_for(lambda: len(self._Pending) == 0 and self._InFlight is None)
+            errors = self._Errors
+            self._Errors = []
+
+        if len(errors) > 0:
+            raise errors[0]
+
+
+_writer = _Writer()
+
+
+def _ResetAfterFork():
+    '''The writer thread does not exist in a forked child, start with an empty queue'''
+    global _writer
+    _writer = _Writer()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_ResetAfterFork)
+
+
+def Write(fullpath, data):
+    '''
+    Queue bytes to be written to a file.  If the file is already queued its contents are replaced.
+    :param str fullpath: Destination file
+    :param bytes data: Contents of the file
+    '''
+    if not Asynchronous:
+        AtomicWrite(fullpath, data)
+        Stats.Written += 1
+        return
+
+    _writer.Write(fullpath, data)
+
+
+def WaitForFile(fullpath):
+    '''Block until any queued write of the file has completed'''
+    _writer.WaitForFile(fullpath)
+
+
+def Flush():
+    '''Block until all queued writes have completed.  Raises the first error encountered by the writer, if any.'''
+    _writer.Flush()
+
+
+atexit.register(Flush)
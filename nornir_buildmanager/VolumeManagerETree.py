@@ -7,20 +7,25 @@ import math
 import operator
 import os
 import pickle
+import re
 import shutil
 import sys
+import time
 import urllib.request, urllib.parse, urllib.error
 
 import nornir_buildmanager
 import nornir_buildmanager.validation.transforms
-from nornir_imageregistration.files import *
-import nornir_imageregistration.transforms.registrationtree
 import nornir_shared.checksum
 import nornir_shared.files
 import nornir_pools
 
+from . import ChecksumCache
+from . import DirectoryCache
+from . import ImageHeaderCache
+from . import VolumeDataCache
+from . import VolumeDataWriter
 from . import VolumeManagerHelpers as VMH
-import nornir_buildmanager.operations.tile as tile
+from .Statistics import Statistics
 import nornir_buildmanager.operations.versions as versions
 import nornir_shared.misc as misc
 import nornir_shared.prettyoutput as prettyoutput
@@ -30,7 +35,123 @@ import xml.etree.ElementTree as ElementTree
 # Used for debugging with conditional break's, each node gets a temporary unique ID
 nid = 0
 
-__LoadedVolumeXMLDict__ = dict()
+# Matches the predicates of an xpath step, i.e. "[@Number='812']"
+_XPathPredicateRegEx = re.compile(r"\[([^\]]*)\]")
+
+# Matches the attribute name tested by an attribute predicate, i.e. "@Number='812'"
+_XPathAttribPredicateRegEx = re.compile(r"^\s*@([^=!\s\]]+)")
+
+
+class LinkResolutionStats(Statistics):
+    '''Counts *_Link elements loaded from disk and those skipped because the attributes on the link ruled them out of a query'''
+
+    Counters = ('Resolved', 'Skipped')
+    Format = "Linked elements resolved: %d skipped: %d"
+
+
+LinkStats = LinkResolutionStats()
+
+
+class SaveStatistics(Statistics):
+    '''Counts VolumeData.xml files written and skipped because nothing in the file changed'''
+
+    Counters = ('Written', 'Skipped')
+    Format = "VolumeData.xml files written: %d skipped: %d"
+
+
+SaveStats = SaveStatistics()
+
+# True while a pipeline is run with -plan.  Invalid elements are left in place instead of cleaned so planning never
+# removes files.
+Planning = False
+
+_Missing = object()
+
+
+class _TrackedAttrib(dict):
+    '''Attribute dictionary that notifies the owning element when a value changes.
+       Changes to the Path attribute also invalidate cached full paths.'''
+
+    __slots__ = ('_owner',)
+
+    def __init__(self, owner, *args, **kwargs):
+        super(_TrackedAttrib, self).__init__(*args, **kwargs)
+        self._owner = owner
+
+    def __reduce__(self):
+        # Copies and pickles of the attributes are plain dictionaries
+        return (dict, (dict(self),))
+
+    def __setitem__(self, key, value):
+        changed = dict.get(self, key, _Missing) != value
+        super(_TrackedAttrib, self).__setitem__(key, value)
+        if changed:
+            if key == 'Path':
+                self._owner._InvalidateFullPath()
+            self._owner._AttributesChanged()
+
+    def __delitem__(self, key):
+        super(_TrackedAttrib, self).__delitem__(key)
+        if key == 'Path':
+            self._owner._InvalidateFullPath()
+        self._owner._AttributesChanged()
+
+    def pop(self, key, *args):
+        changed = key in self
+        value = super(_TrackedAttrib, self).pop(key, *args)
+        if changed:
+            if key == 'Path':
+                self._owner._InvalidateFullPath()
+            self._owner._AttributesChanged()
+        return value
+
+    def popitem(self):
+        item = super(_TrackedAttrib, self).popitem()
+        if item[0] == 'Path':
+            self._owner._InvalidateFullPath()
+        self._owner._AttributesChanged()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+
+        self[key] = default
+        return default
+
+    def update(self, *args, **kwargs):
+        super(_TrackedAttrib, self).update(*args, **kwargs)
+        self._owner._InvalidateFullPath()
+        self._owner._AttributesChanged()
+
+    def clear(self):
+        super(_TrackedAttrib, self).clear()
+        self._owner._InvalidateFullPath()
+        self._owner._AttributesChanged()
+
+
+def _LinkPredicateAttributes(xpath_step):
+    '''
+    Returns the attribute names tested by the predicates of a single xpath step.
+    :return: (bool, set) False if any predicate cannot be evaluated using only the attributes of a link element
+    '''
+    AttribNames = set()
+    for predicate in _XPathPredicateRegEx.findall(xpath_step):
+        match = _XPathAttribPredicateRegEx.match(predicate)
+        if match is None:
+            # Child element, text, or position predicates require the linked element to be loaded
+            return (False, AttribNames)
+
+        AttribNames.add(match.group(1))
+
+    return (True, AttribNames)
+
+
+def _ElementMatchesXPath(element, xpath_step):
+    '''Returns true if the element would be returned by the xpath step if it were evaluated on the element's parent'''
+    probe = ElementTree.Element('Probe')
+    probe.append(element)
+    return probe.find(xpath_step) is element
 
 
 def ValidateAttributesAreStrings(Element, logger=None):
@@ -76,6 +197,7 @@ class VolumeManager():
     def Load(cls, VolumePath, Create=False, UseCache=True):
         '''Load the volume information for the specified directory or create one if it doesn't exist'''
         Filename = os.path.join(VolumePath, "VolumeData.xml")
+        VolumeDataWriter.WaitForFile(Filename)
         if not os.path.exists(Filename):
             prettyoutput.Log("Provided volume description file does not exist: " + Filename)
 
@@ -101,17 +223,13 @@ class VolumeManager():
                 return None
         else:
             # 5/16/2012 Loading these XML files is really slow, so they are cached.
-            # if not __LoadedVolumeXMLDict__.get(Filename, None) is None and UseCache:
-            #    XMLTree = __LoadedVolumeXMLDict__[Filename]
-            # else:
-            XMLTree = ElementTree.parse(Filename)
-            # VolumeData = Volumes.CreateFromDOM(XMLTree)
-            # __LoadedVolumeXMLDict__[Filename] = XMLTree
-
-            VolumeRoot = XMLTree.getroot()
+            VolumeRoot = VolumeDataCache.Load(Filename, UseCache=UseCache)
 
         VolumeRoot.attrib['Path'] = VolumePath
         VolumeRoot = XContainerElementWrapper.wrap(VolumeRoot)
+        if not SaveNewVolume:
+            VolumeRoot._MarkClean()
+
         VolumeManager.__SetElementParent__(VolumeRoot)
         
         if SaveNewVolume:
@@ -131,16 +249,12 @@ class VolumeManager():
         :return: (bool, An object inheriting from XElementWrapper) Returns true if the element had to be wrapped
         '''
         
-        OverrideClassName = e.tag + 'Node'
-        OverrideClass = reflection.get_module_class('nornir_buildmanager.VolumeManagerETree', OverrideClassName, LogErrIfNotFound=False)
+        OverrideClass = NodeClassRegistry.get(e.tag, None)
         
         if OverrideClass is None:
+            # Path attributes are relative to the parent, so an isfile check on them here was never meaningful
             if "Path" in e.attrib:
-                if os.path.isfile(e.attrib.get("Path")):
-                    # TODO: Do we ever hit this path and do we need to make the os.path.isfile check anymore?
-                    OverrideClass = XFileElementWrapper
-                else:
-                    OverrideClass = XContainerElementWrapper
+                OverrideClass = XContainerElementWrapper
             else:
                 OverrideClass = XElementWrapper
         
@@ -332,8 +446,64 @@ class XElementWrapper(ElementTree.Element):
             
     def OnParentChanged(self):
         '''Actions that should occur when our parent changes'''
-        if '__fullpath' in self.__dict__:
-            del self.__dict__['__fullpath']
+        self._InvalidateFullPath()
+
+        # Unsaved changes in our file must be found when our new parent is saved
+        if isinstance(self, XContainerElementWrapper) and self.IsDirty:
+            self._PropagateSubtreeDirty()
+
+    def _InvalidateFullPath(self):
+        '''Drop the cached FullPath of this element and every element below it'''
+        cached = self.__dict__.pop('__fullpath', None)
+
+        # Computing FullPath caches the FullPath of every resource above the element,
+        # so nothing below a resource without a cached path can have one
+        if cached is None and isinstance(self, XResourceElementWrapper):
+            return
+
+        for child in self:
+            if isinstance(child, XElementWrapper):
+                child._InvalidateFullPath()
+
+    @property
+    def IsDirty(self):
+        '''True if this element, or an element below it, has changes that have not been saved.
+           Attribute changes, including set() and assigning attrib, and changes to the children of wrapped
+           elements are tracked.  Changes to children that have not been wrapped yet, such as those returned
+           by iterating an element before find or findall wrapped them, or those created with
+           ElementTree.SubElement, are not tracked; call SetDirty after changing them.'''
+        return self.__dict__.get('_Dirty', True) or self.__dict__.get('_SubtreeDirty', False)
+
+    def SetDirty(self):
+        '''Record that the VolumeData.xml file containing this element must be rewritten'''
+        owner = self
+        while owner is not None and not isinstance(owner, XContainerElementWrapper):
+            owner = owner.__dict__.get('_Parent', None)
+
+        if owner is None:
+            return
+
+        owner.__dict__['_Dirty'] = True
+        owner._PropagateSubtreeDirty()
+
+    def _PropagateSubtreeDirty(self):
+        '''Flag our parents so a recursive save from any of them reaches us'''
+        p = self.__dict__.get('_Parent', None)
+        while p is not None and not p.__dict__.get('_SubtreeDirty', False):
+            p.__dict__['_SubtreeDirty'] = True
+            p = p.__dict__.get('_Parent', None)
+
+    def _MarkClean(self):
+        '''Record that this element matches the file on disk'''
+        self.__dict__['_Dirty'] = False
+        self.__dict__['_SubtreeDirty'] = False
+
+    def _AttributesChanged(self):
+        self.SetDirty()
+
+        # The file of our parent container stores a link with a copy of our attributes
+        if isinstance(self, XContainerElementWrapper) and self._Parent is not None:
+            self._Parent.SetDirty()
              
     def indexofchild(self, obj):
         '''Return the index of a child element'''
@@ -355,6 +525,10 @@ class XElementWrapper(ElementTree.Element):
         self.__dict__['id'] = nid
         nid = nid + 1
 
+        # New elements have not been saved
+        self.__dict__['_Dirty'] = True
+        self.__dict__['_SubtreeDirty'] = False
+
         if(attrib is None):
             attrib = {}
         else:
@@ -372,6 +546,8 @@ class XElementWrapper(ElementTree.Element):
 
         self._Parent = None
 
+        super(XElementWrapper, self).__setattr__('attrib', _TrackedAttrib(self, self.attrib))
+
         if not self.tag.endswith("_Link"):
             self.attrib['CreationDate'] = XElementWrapper.__GetCreationTimeString__()
             self.Version = versions.GetLatestVersionForNodeType(tag)
@@ -408,6 +584,10 @@ class XElementWrapper(ElementTree.Element):
 
     def CleanIfInvalid(self):
         '''Remove the contents of this node if it is out of date, returns true if node was cleaned'''
+        # The pipeline manager reports invalid elements found while planning
+        if Planning:
+            return False
+        
         Valid = self.IsValid()
 
         if isinstance(Valid, bool):
@@ -540,6 +720,13 @@ class XElementWrapper(ElementTree.Element):
     def __setattr__(self, name, value):
 
         '''Called when an attribute assignment is attempted. This is called instead of the normal mechanism (i.e. store the value in the instance dictionary). name is the attribute name, value is the value to be assigned to it.'''
+        if name == 'attrib':
+            # Replacing the dictionary must not drop change tracking
+            super(XElementWrapper, self).__setattr__('attrib', _TrackedAttrib(self, value))
+            self._InvalidateFullPath()
+            self._AttributesChanged()
+            return
+
         if(hasattr(self.__class__, name)):
             attribute = getattr(self.__class__, name)
             if isinstance(attribute, property):
@@ -549,6 +736,10 @@ class XElementWrapper(ElementTree.Element):
                 else:
                     assert (not attribute.fset is None)  # Why are we trying to set a property without a setter?
             else:
+                if name == 'text' or name == 'tail':
+                    if getattr(self, name) != value:
+                        self.SetDirty()
+
                 super(XElementWrapper, self).__setattr__(name, value)
                 return
 
@@ -724,6 +915,42 @@ class XElementWrapper(ElementTree.Element):
         super(XElementWrapper, self).append(Child)
         Child.Parent = self
         assert(Child in self)
+        self.SetDirty()
+
+    def insert(self, index, Child):
+        super(XElementWrapper, self).insert(index, Child)
+        self.SetDirty()
+
+    def extend(self, Children):
+        super(XElementWrapper, self).extend(Children)
+        self.SetDirty()
+
+    def remove(self, Child):
+        super(XElementWrapper, self).remove(Child)
+        self.SetDirty()
+
+    def __delitem__(self, index):
+        super(XElementWrapper, self).__delitem__(index)
+        self.SetDirty()
+
+    def __setitem__(self, index, Child):
+        super(XElementWrapper, self).__setitem__(index, Child)
+        for c in (Child if isinstance(index, slice) else [Child]):
+            if isinstance(c, XElementWrapper):
+                c.Parent = self
+
+        self.SetDirty()
+
+    def set(self, key, value):
+        # Element.set writes to the attribute dictionary without calling __setitem__
+        self.attrib[key] = value
+
+    def clear(self):
+        super(XElementWrapper, self).clear()
+        super(XElementWrapper, self).__setattr__('attrib', _TrackedAttrib(self, self.attrib))
+        self._InvalidateFullPath()
+        self._AttributesChanged()
+        self.SetDirty()
 
     def FindParent(self, ParentTag):
         '''Find parent with specified tag'''
@@ -752,7 +979,8 @@ class XElementWrapper(ElementTree.Element):
         # print("Removing {0}".format(str(old)))
         i = self.indexofchild(old)
         
-        self[i] = new
+        # Swapping a link, raw or wrapped copy of the same element does not change the file
+        super(XElementWrapper, self).__setitem__(i, new)
         # self.remove(old)
         # self.insert(i, new)
         
@@ -776,6 +1004,12 @@ class XElementWrapper(ElementTree.Element):
         (wrapped, wrappedElement) = VolumeManager.WrapElement(child)
         
         if wrapped:
+            if isinstance(wrappedElement, XContainerElementWrapper):
+                # A container stored inside our file will be written to its own file and replaced with a link when we are saved
+                self.SetDirty()
+            else:
+                wrappedElement._MarkClean()
+
             self._ReplaceChildElementInPlace(child, wrappedElement)
             
         return wrappedElement
@@ -784,17 +1018,6 @@ class XElementWrapper(ElementTree.Element):
     def find(self, xpath):
 
         (UnlinkedElementsXPath, LinkedElementsXPath, RemainingXPath) = self.__ElementLinkNameFromXPath(xpath)
-        
-        if isinstance(self, XContainerElementWrapper):  # Only containers have linked elements
-            LinkMatches = super(XElementWrapper, self).findall(LinkedElementsXPath)
-            if LinkMatches is None:
-                return None
-            
-            num_matches = len(LinkMatches)
-            if num_matches > 0:
-                # if num_matches > 1:
-                #    prettyoutput.Log("Need to load {0} links".format(num_matches))
-                self._replace_links(LinkMatches)
 
         matchiterator = super(XElementWrapper, self).iterfind(UnlinkedElementsXPath)
         for match in matchiterator:
@@ -814,6 +1037,30 @@ class XElementWrapper(ElementTree.Element):
                     return foundChild
             else:
                 return match
+        
+        if not isinstance(self, XContainerElementWrapper):  # Only containers have linked elements
+            return None
+        
+        # Load linked elements one at a time so we stop reading XML as soon as a match is found
+        LinkMatches = self._LinkCandidates(LinkedElementsXPath)
+        for i, link_node in enumerate(LinkMatches):
+            loaded_element = self._replace_link(link_node)
+            if loaded_element is None:
+                continue
+            
+            # Links missing an attribute tested by the predicate are loaded without being filtered, so check the loaded element
+            if not _ElementMatchesXPath(loaded_element, UnlinkedElementsXPath):
+                continue
+            
+            if len(RemainingXPath) > 0:
+                foundChild = loaded_element.find(RemainingXPath)
+                if foundChild is None:
+                    continue
+            else:
+                foundChild = loaded_element
+                
+            LinkStats.Skipped += len(LinkMatches) - (i + 1)
+            return foundChild
  
         return None
 
@@ -824,9 +1071,7 @@ class XElementWrapper(ElementTree.Element):
         # TODO: Need to modify to only search one level at a time
         # OK, check for linked elements that also meet the criteria
 
-        LinkMatches = list(super(XElementWrapper, self).findall(LinkedElementsXPath))
-        if LinkMatches is None:
-            return  # matches
+        LinkMatches = self._LinkCandidates(LinkedElementsXPath)
         
         num_matches = len(LinkMatches)
         if num_matches > 0:
@@ -862,9 +1107,30 @@ class XElementWrapper(ElementTree.Element):
                             # m.insert(sm)
                             
                         (yield sm)
-            else: 
+            else:
                 (yield m)
-                
+
+    def _LinkCandidates(self, LinkedElementsXPath):
+        '''Returns the link elements that may satisfy the xpath step.
+           Link elements carry a copy of the linked container's attributes (Number, Name, Path, Downsample, ...)
+           so attribute predicates are evaluated against the link and only the links that pass need to be loaded.
+           Links missing an attribute the predicate tests are always returned.'''
+
+        LinkTag = LinkedElementsXPath.split('[')[0]
+        AllLinks = super(XElementWrapper, self).findall(LinkTag)
+        if len(AllLinks) == 0:
+            return AllLinks
+
+        (Answerable, AttribNames) = _LinkPredicateAttributes(LinkedElementsXPath)
+        if not Answerable:
+            return AllLinks
+
+        MatchedLinks = frozenset(map(id, super(XElementWrapper, self).findall(LinkedElementsXPath)))
+        Candidates = [link for link in AllLinks if id(link) in MatchedLinks or not AttribNames.issubset(link.attrib)]
+
+        LinkStats.Skipped += len(AllLinks) - len(Candidates)
+        return Candidates
+
     def __ElementLinkNameFromXPath(self, xpath):
         # OK, check if we have a linked element to load.
 
@@ -881,8 +1147,16 @@ class XElementWrapper(ElementTree.Element):
         RemainingXPath = xpath[len(UnlinkedElementsXPath) + 1:]
         return (UnlinkedElementsXPath, LinkedElementsXPath, RemainingXPath)
 
-    def LoadAllLinkedNodes(self):
-        '''Recursively load all of the linked nodes on this element'''
+    def LoadAllLinkedNodes(self, MaxWorkers=None):
+        '''Recursively load all of the linked nodes on this element
+        :param int MaxWorkers: Number of processes parsing linked VolumeData.xml files, defaults to the CPU count.  1 loads serially on this thread.'''
+        
+        if MaxWorkers is None:
+            MaxWorkers = os.cpu_count()
+        
+        if MaxWorkers > 1:
+            _PreloadLinkedNodes(self, MaxWorkers)
+            return
         
         child_nodes = list(self)
         for n in child_nodes:
@@ -892,11 +1166,87 @@ class XElementWrapper(ElementTree.Element):
                     continue
                 n = n_replaced
 
-                n.LoadAllLinkedNodes()
+                n.LoadAllLinkedNodes(MaxWorkers=MaxWorkers)
 
         return
 
 
+def _LoadLinkedXMLAsTuple(fullpath):
+    '''Runs in a worker process.  Returns the root element of the linked XML file as nested tuples, which are cheaper to send back than XML text.'''
+    return VolumeDataCache.ElementToTuple(XContainerElementWrapper._load_link_element(fullpath))
+
+
+def _FindLinkNodes(element):
+    '''Returns (parent, link_node) for every link below element that is reachable without loading links'''
+    links = []
+    for child in list(element):
+        if child.tag.endswith('_Link'):
+            links.append((element, child))
+        elif isinstance(child, XContainerElementWrapper):
+            links.extend(_FindLinkNodes(child))
+            
+    return links
+
+
+def _PreloadLinkedNodes(element, MaxWorkers):
+    '''Breadth-first load of every linked node below element.  Each level of links is parsed in parallel by worker processes
+       and the results are wrapped and attached to their parents on this thread.'''
+    
+    logger = logging.getLogger(__name__ + '.' + 'LoadAllLinkedNodes')
+    start_time = time.time()
+    
+    # Workers read the files from disk, so queued saves must be written first
+    VolumeDataWriter.Flush()
+    
+    pool = nornir_pools.GetMultithreadingPool('PreloadVolumeData', num_threads=MaxWorkers)
+    try:
+        (NumLoaded, NumLevels) = _PreloadLinkedNodesOnPool(element, pool, logger)
+    finally:
+        # The workers are only needed while the volume loads
+        pool.shutdown()
+    
+    logger.info("Preloaded %d linked VolumeData.xml files in %d levels with %d workers in %.2f seconds" % (NumLoaded, NumLevels, MaxWorkers, time.time() - start_time))
+
+
+def _PreloadLinkedNodesOnPool(element, pool, logger):
+    '''
+    :return: (Number of linked nodes loaded, number of levels of links)
+    '''
+    NumLoaded = 0
+    NumLevels = 0
+    frontier = _FindLinkNodes(element)
+    while len(frontier) > 0:
+        NumLevels += 1
+        
+        tasks = []
+        for (parent, link_node) in frontier:
+            fullpath = os.path.join(parent.FullPath, link_node.attrib["Path"])
+            t = pool.add_task("Preload " + fullpath, _LoadLinkedXMLAsTuple, fullpath)
+            t.parent = parent
+            t.link_node = link_node
+            t.fullpath = fullpath
+            tasks.append(t)
+        
+        frontier = []
+        for t in tasks:
+            try:
+                data = t.wait_return()
+            except (IOError, ElementTree.ParseError) as e:
+                logger.error("Removing link node after error loading linked XML file: {0}\n{1}".format(t.fullpath, str(e)))
+                t.parent.remove(t.link_node)
+                continue
+            except Exception as e:
+                logger.error("Unexpected error loading linked XML file: {0}\n{1}".format(t.fullpath, str(e)))
+                continue
+            
+            loaded_element = t.parent._ReplaceLinkWithLoadedElement(t.link_node, VolumeDataCache.TupleToElement(data))
+            NumLoaded += 1
+            if loaded_element is not None:
+                frontier.extend(_FindLinkNodes(loaded_element))
+
+    return (NumLoaded, NumLevels)
+
+
 class XResourceElementWrapper(VMH.Lockable, XElementWrapper):
     '''Wrapper for an XML element that refers to a file or directory'''
 
@@ -906,11 +1256,9 @@ class XResourceElementWrapper(VMH.Lockable, XElementWrapper):
 
     @Path.setter
     def Path(self, val):
+        # The attribute dictionary invalidates cached full paths
         self.attrib['Path'] = val
 
-        if hasattr(self, '__fullpath'):
-            del self.__dict__['__fullpath']
-
     @property
     def FullPath(self):
 
@@ -965,14 +1313,21 @@ class XResourceElementWrapper(VMH.Lockable, XElementWrapper):
             if not reason is None:
                 Logger.warning('Reason for attempt: %s' % reason)
             return
+        
+        if Planning:
+            Logger = logging.getLogger(__name__ + '.' + 'Clean')
+            Logger.warning('Not deleting resource while planning: %s' % self.FullPath)
+            return
             
         '''Remove the contents referred to by this node from the disk'''
         if os.path.exists(self.FullPath):
             try:
                 if os.path.isdir(self.FullPath):
                     shutil.rmtree(self.FullPath)
+                    DirectoryCache.Invalidate(self.FullPath)
                 else:
                     os.remove(self.FullPath)
+                    DirectoryCache.Invalidate(os.path.dirname(self.FullPath))
             except:
                 Logger = logging.getLogger(__name__ + '.' + 'Clean')
                 Logger.warning('Could not delete cleaned directory: ' + self.FullPath)
@@ -1012,6 +1367,7 @@ class XFileElementWrapper(XResourceElementWrapper):
 
     @Path.setter
     def Path(self, val):
+        # The attribute dictionary invalidates cached full paths, so FullPath is current here
         self.attrib['Path'] = val
         directory = os.path.dirname(self.FullPath)
 
@@ -1022,8 +1378,6 @@ class XFileElementWrapper(XResourceElementWrapper):
                 if not os.path.isdir(directory):
                     raise
 
-        if hasattr(self, '__fullpath'):
-            del self.__dict__['__fullpath']
         return
 
     def IsValid(self):
@@ -1132,10 +1486,9 @@ class XContainerElementWrapper(XResourceElementWrapper):
     def _load_link_element(fullpath):
         '''Loads an XML file from the file system and returns the root element'''
         Filename = os.path.join(fullpath, "VolumeData.xml")
+        VolumeDataWriter.WaitForFile(Filename)
          
-        XMLTree = ElementTree.parse(Filename)
-        
-        return XMLTree.getroot()
+        return VolumeDataCache.Load(Filename)
 
     def _load_and_wrap_link_element(self, fullpath):
         '''Loads an xml file containing a subset of our meta-data referred to by a LINK element.  Wraps the loaded XML in the correct meta-data class'''
@@ -1145,6 +1498,7 @@ class XContainerElementWrapper(XResourceElementWrapper):
         # SubContainer = XContainerElementWrapper.wrap(XMLElement)
 
         if wrapped: 
+            NewElement._MarkClean()
             VolumeManager.__SetElementParent__(NewElement, self)
 
         return NewElement
@@ -1173,7 +1527,8 @@ class XContainerElementWrapper(XResourceElementWrapper):
             logger = logging.getLogger(__name__ + '.' + '_load_link_element')
             logger.error("Unexpected error loading linked XML file: {0}\n{1}".format(fullpath, str(e)))
             return None
-              
+
+        LinkStats.Resolved += 1
         self._ReplaceChildElementInPlace(old=link_node, new=loaded_element)
         
         # Check to ensure the newly loaded element is valid
@@ -1227,21 +1582,33 @@ class XContainerElementWrapper(XResourceElementWrapper):
                 logger = logging.getLogger(__name__ + '.' + '_load_link_element')
                 logger.error("Unexpected error loading linked XML file: {0}\n{1}".format(fullpath, str(e)))
                 continue
-            
-            (wrapped, wrapped_loaded_element) = VolumeManager.WrapElement(loaded_element)
-            # SubContainer = XContainerElementWrapper.wrap(XMLElement)
-    
-            if wrapped: 
-                VolumeManager.__SetElementParent__(wrapped_loaded_element, self)
-            
-            self._ReplaceChildElementInPlace(old=link_node, new=wrapped_loaded_element)
-            
-            # Check to ensure the newly loaded element is valid
-            Cleaned = wrapped_loaded_element.CleanIfInvalid()
-            if not Cleaned:
+
+            wrapped_loaded_element = self._ReplaceLinkWithLoadedElement(link_node, loaded_element)
+            if wrapped_loaded_element is not None:
                 loaded_elements.append(wrapped_loaded_element)
                 
         return loaded_elements
+    
+    def _ReplaceLinkWithLoadedElement(self, link_node, loaded_element):
+        '''Wrap an element loaded from a linked XML file and replace the link node with it.
+        :return: The wrapped element, or None if it was invalid and cleaned'''
+        
+        LinkStats.Resolved += 1
+        (wrapped, wrapped_loaded_element) = VolumeManager.WrapElement(loaded_element)
+        # SubContainer = XContainerElementWrapper.wrap(XMLElement)
+
+        if wrapped: 
+            wrapped_loaded_element._MarkClean()
+            VolumeManager.__SetElementParent__(wrapped_loaded_element, self)
+        
+        self._ReplaceChildElementInPlace(old=link_node, new=wrapped_loaded_element)
+        
+        # Check to ensure the newly loaded element is valid
+        Cleaned = wrapped_loaded_element.CleanIfInvalid()
+        if Cleaned:
+            return None
+        
+        return wrapped_loaded_element
 
     def __init__(self, tag, attrib=None, **extra):
 
@@ -1256,7 +1623,8 @@ class XContainerElementWrapper(XResourceElementWrapper):
         # self.attrib['Path'] = Path
 
     def Save(self, tabLevel=None, recurse=True):
-        '''If recurse = False we only save this element, no child elements are saved'''
+        '''If recurse = False we only save this element, no child elements are saved.
+           Files are only written for containers that changed since they were loaded or last saved.'''
         
         if tabLevel is None:
             tabLevel = 0
@@ -1264,6 +1632,24 @@ class XContainerElementWrapper(XResourceElementWrapper):
                 logger = logging.getLogger(__name__ + '.' + 'Save')
                 logger.info("Saving " + self.FullPath)
 
+        if not self.__dict__.get('_Dirty', True):
+            # Nothing in our file changed, but containers below us may have
+            SaveStats.Skipped += 1
+            if recurse and self.__dict__.get('_SubtreeDirty', False):
+                for child in list(self):
+                    if isinstance(child, XContainerElementWrapper):
+                        child.Save(tabLevel + 1)
+
+                self.__dict__['_SubtreeDirty'] = False
+
+            return
+
+        # Clear the flags before copying ourselves so changes made while we are saving are not lost
+        if recurse:
+            self._MarkClean()
+        else:
+            self.__dict__['_Dirty'] = False
+
         self.sort()
 
         # pool = Pools.GetGlobalThreadPool()
@@ -1321,14 +1707,10 @@ class XContainerElementWrapper(XResourceElementWrapper):
                 SaveElement.append(child)
 
         self.__SaveXML(xmlfilename, SaveElement)
-#        pool.add_task("Saving self.FullPath",   self.__SaveXML, xmlfilename, SaveElement)
-
-        # If we are the root of all saves then make sure they have all completed before returning
-        # if(tabLevel == 0 or recurse==False):
-            # pool.wait_completion()
+        SaveStats.Written += 1
 
     def __SaveXML(self, xmlfilename, SaveElement):
-        '''Intended to be called on a thread from the save function'''
+        '''Serializes the element and queues the file with the background writer'''
         try: 
             os.makedirs(self.FullPath, exist_ok=True)
         except OSError as e:
@@ -1342,10 +1724,7 @@ class XContainerElementWrapper(XResourceElementWrapper):
         prettyoutput.Log("Saving %s" % XMLFilename)
         
         OutputXML = ElementTree.tostring(SaveElement, encoding="utf-8")
-        # print OutputXML
-        with open(XMLFilename, 'wb') as hFile:
-            hFile.write(OutputXML)
-            hFile.close()
+        VolumeDataWriter.Write(XMLFilename, OutputXML)
 
 
 class XNamedContainerElementWrapped(XContainerElementWrapper):
@@ -2331,6 +2710,8 @@ class StosMapNode(XElementWrapper):
     
     @classmethod
     def _SectionNumberFromParameter(self, input_value):
+        import nornir_imageregistration.transforms.registrationtree
+
         val = None
         if isinstance(input_value, nornir_imageregistration.transforms.registrationtree.RegistrationTreeNode):
             val = input_value.SectionNumber
@@ -2542,10 +2923,12 @@ class MosaicBaseNode(XFileElementWrapper):
         if not os.path.exists(self.FullPath):
             return None
 
+        from nornir_imageregistration.files import mosaicfile, stosfile
+
         if ext == '.stos':
-            return stosfile.StosFile.LoadChecksum(self.FullPath)
+            return ChecksumCache.Get(self.FullPath, 'stos', stosfile.StosFile.LoadChecksum)
         elif ext == '.mosaic':
-            return mosaicfile.MosaicFile.LoadChecksum(self.FullPath)
+            return ChecksumCache.Get(self.FullPath, 'mosaic', mosaicfile.MosaicFile.LoadChecksum)
         else:
             raise Exception("Cannot compute checksum for unknown transform type")
 
@@ -2875,6 +3258,7 @@ class ImageSetBaseNode(VMH.InputTransformHandler, VMH.PyramidLevelHandler, XCont
         return (SourceImage, SourceDownsample)
 
     def GenerateLevels(self, Levels):
+        import nornir_buildmanager.operations.tile as tile
         node = tile.BuildImagePyramid(self, Levels, Interlace=False)
         if not node is None:
             node.Save()
@@ -2892,6 +3276,7 @@ class ImageSetBaseNode(VMH.InputTransformHandler, VMH.PyramidLevelHandler, XCont
         if 'InputImageChecksum' in SourceImage.attrib:
             OutputImage.InputImageChecksum = SourceImage.InputImageChecksum
 
+        import nornir_imageregistration
         nornir_imageregistration.Shrink(SourceImage.FullPath, OutputImage.FullPath, float(SourceDownsample) / float(Downsample))
         
         return OutputImage
@@ -2937,9 +3322,7 @@ class ImageSetNode(ImageSetBaseNode):
         :return: (Bool, String) containing whether all tiles exist and a reason string
         '''
     
-        globfullpath = os.path.join(level_full_path, '*' + self.ImageFormatExt)
-
-        files = glob.glob(globfullpath)
+        files = DirectoryCache.Glob(level_full_path, '*' + self.ImageFormatExt)
 
         if(len(files) == 0):
             return [False, "No files in level"]
@@ -2985,7 +3368,7 @@ class ImageNode(VMH.InputTransformHandler, XFileElementWrapper):
         if not os.path.exists(self.FullPath):
             return [False, 'File does not exist']
 
-        if(self.Checksum != nornir_shared.checksum.FilesizeChecksum(self.FullPath)):
+        if(self.Checksum != ChecksumCache.Get(self.FullPath, 'filesize', nornir_shared.checksum.FilesizeChecksum)):
             return [False, "Checksum mismatch"]
 
         return super(ImageNode, self).IsValid()
@@ -2994,7 +3377,7 @@ class ImageNode(VMH.InputTransformHandler, XFileElementWrapper):
     def Checksum(self):
         checksum = self.get('Checksum', None)
         if checksum is None:
-            checksum = nornir_shared.checksum.FilesizeChecksum(self.FullPath)
+            checksum = ChecksumCache.Get(self.FullPath, 'filesize', nornir_shared.checksum.FilesizeChecksum)
             self.attrib['Checksum'] = str(checksum)
 
         return checksum
@@ -3006,16 +3389,19 @@ class ImageNode(VMH.InputTransformHandler, XFileElementWrapper):
         '''
         dims = self.attrib.get('Dimensions', None)
         if dims is None:
-            dims = nornir_imageregistration.GetImageSize(self.FullPath)
+            dims = ImageHeaderCache.GetImageSize(self.FullPath)
             self.attrib['Dimensions'] = "{0:d} {1:d}".format(dims[1], dims[0])
         else:
             dims = dims.split(' ')
             dims = (int(dims[1]), int(dims[0]))
             
-            # Todo: Remove after initial testing 
-            actual_dims = nornir_imageregistration.GetImageSize(self.FullPath)
-            assert(actual_dims[0] == dims[0])
-            assert(actual_dims[1] == dims[1])
+            if ImageHeaderCache.VerifyPolicy != ImageHeaderCache.VerifyNever:
+                actual_dims = ImageHeaderCache.GetImageSize(self.FullPath)
+                if actual_dims[0] != dims[0] or actual_dims[1] != dims[1]:
+                    logger = logging.getLogger(__name__ + '.' + 'Dimensions')
+                    logger.warning("Dimensions attribute {0} does not match image {1} {2}".format(str(dims), self.FullPath, str(actual_dims)))
+                    dims = actual_dims
+                    self.attrib['Dimensions'] = "{0:d} {1:d}".format(dims[1], dims[0])
             
         return dims
     
@@ -3254,9 +3640,7 @@ class TilePyramidNode(XContainerElementWrapper, VMH.PyramidLevelHandler):
         :return: (Bool, String) containing whether all tiles exist and a reason string
         '''
     
-        globfullpath = os.path.join(level_full_path, '*' + self.ImageFormatExt)
-
-        files = glob.glob(globfullpath)
+        files = DirectoryCache.Glob(level_full_path, '*' + self.ImageFormatExt)
 
         if(len(files) == 0):
             return [False, "No files in level"]
@@ -3293,6 +3677,7 @@ class TilePyramidNode(XContainerElementWrapper, VMH.PyramidLevelHandler):
         return obj 
 
     def GenerateLevels(self, Levels):
+        import nornir_buildmanager.operations.tile as tile
         node = tile.BuildTilePyramids(self, Levels)
         if not node is None:
             node.Save()
@@ -3364,6 +3749,7 @@ class TilesetNode(XContainerElementWrapper, VMH.PyramidLevelHandler):
             self.attrib['Path'] = TilesetNode.DefaultPath
 
     def GenerateLevels(self, Levels):
+        import nornir_buildmanager.operations.tile as tile
         node = tile.BuildTilesetPyramid(self)
         if not node is None:
             node.Save()
@@ -3376,6 +3762,9 @@ class TilesetNode(XContainerElementWrapper, VMH.PyramidLevelHandler):
         if GridDimX is None or GridDimY is None:
             return (False, "No grid dimensions found in tileset") 
         
+        # Rescan the level if it changed since it was listed so tiles written after the listing are found
+        DirectoryCache.GetListing(level_full_path)
+        
         GridXDim = GridDimX - 1  # int(GridDimX) - 1
         GridYDim = GridDimY - 1  # int(GridDimY) - 1
         
@@ -3390,7 +3779,7 @@ class TilesetNode(XContainerElementWrapper, VMH.PyramidLevelHandler):
                                                                                     'postfix' :  FilePostfix})
 
         # Start with the middle because it is more likely to have a match earlier
-        TestIndicies = list(range(GridYDim // 2, GridYDim))
+        TestIndicies = list(range(GridYDim // 2, GridYDim + 1))
         TestIndicies.extend(list(range((GridYDim // 2) - 1, -1, -1)))
         for iY in TestIndicies:
             # MatchString = os.path.join(OutputDir, FilePrefix +
@@ -3401,9 +3790,8 @@ class TilesetNode(XContainerElementWrapper, VMH.PyramidLevelHandler):
                                                                                     'X' : GridXString,
                                                                                     'Y' : nornir_buildmanager.templates.Current.GridTileCoordTemplate % iY,
                                                                                     'postfix' : FilePostfix})
-            if(os.path.exists(MatchString)):
-                [YSize, XSize] = nornir_imageregistration.GetImageSize(MatchString)
-                if YSize != self.TileYDim or XSize != self.TileXDim:
+            if(DirectoryCache.Exists(MatchString)):
+                if not self._TileSizeMatches(MatchString):
                     return [False, "Image size does not match meta-data"]
                 
                 return [True, "Last column of tileset found"]
@@ -3412,15 +3800,22 @@ class TilesetNode(XContainerElementWrapper, VMH.PyramidLevelHandler):
                                                                                     'X' : GridXDim,
                                                                                     'Y' : iY,
                                                                                     'postfix' : FilePostfix})
-            if(os.path.exists(MatchString)):
-                [YSize, XSize] = nornir_imageregistration.GetImageSize(MatchString)
-                if YSize != self.TileYDim or XSize != self.TileXDim:
+            if(DirectoryCache.Exists(MatchString)):
+                if not self._TileSizeMatches(MatchString):
                     return [False, "Image size does not match meta-data"]
                 
                 return [True, "Last column of tileset found"]
 
         return [False, "Last column of tileset not found"]
 
+    def _TileSizeMatches(self, tile_full_path):
+        '''Check the tile dimensions against the meta-data according to ImageHeaderCache.VerifyPolicy'''
+        if ImageHeaderCache.VerifyPolicy == ImageHeaderCache.VerifyNever:
+            return True
+        
+        [YSize, XSize] = ImageHeaderCache.GetImageSize(tile_full_path)
+        return YSize == self.TileYDim and XSize == self.TileXDim
+
 
 class LevelNode(XContainerElementWrapper):
 
@@ -3722,6 +4117,20 @@ class PruneNode(HistogramBase):
         return obj
 
 
+def _BuildNodeClassRegistry():
+    '''Map element tags to the <tag>Node class that wraps them'''
+    registry = {}
+    for (name, obj) in globals().items():
+        if name.endswith('Node') and isinstance(obj, type) and issubclass(obj, XElementWrapper):
+            registry[name[:-len('Node')]] = obj
+
+    return registry
+
+
+# Element tag -> wrapper class used by VolumeManager.WrapElement
+NodeClassRegistry = _BuildNodeClassRegistry()
+
+
 if __name__ == '__main__':
     VolumeManager.Load(r"C:\Temp")
 
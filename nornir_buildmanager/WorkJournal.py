@@ -0,0 +1,211 @@
+'''
+Journal of completed stage calls used to resume interrupted pipeline runs.
+
+Each time a stage finishes on a volume element and its output is saved a
+line is appended to WorkJournal.jsonl in the volume directory.  The line
+holds the stage, the element, a hash of the stage's arguments and a
+signature of the stage's inputs.  The signature hashes the attributes of
+every volume element passed to the stage and the checksum attributes of the
+elements below them, which include the checksums of transforms and images,
+and the values of all other arguments.
+
+When a pipeline is run with -resume a stage call whose stage, element,
+arguments and input signature match a journal entry is skipped without
+calling the stage.
+If any input changed the signature differs and the stage runs.  Files
+removed by hand are not detected, run without -resume to have stages check
+their output.
+
+The journal is only appended to while a pipeline runs, so killing the
+process loses at most the stage that was running.  At the end of a run it is
+rewritten with only the newest entry for each stage, element and arguments.
+
+'''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from . import VolumeDataWriter
+from .Statistics import Statistics
+
+JournalFilename = 'WorkJournal.jsonl'
+
+# Keyword arguments that are not inputs of the stage
+IgnoredArguments = frozenset(['Logger', 'VolumeNode'])
+
+# Command line options that change how a build runs or reports progress but not what it writes.  Stage attributes set
+# from these options, such as MaxTilesInFlight="#MaxTilesInFlight", are left out of the signature so changing them
+# does not invalidate the journal.
+IgnoredOptions = frozenset(['volumepath', 'debug', 'lowpriority', 'verbose', 'plan', 'planfile', 'resume', 'verifyimages',
+                            'max_temp_image_area', 'MaxTilesInFlight', 'MaxBytesInFlight'])
+
+
+class WorkJournalStats(Statistics):
+    '''Counts stage calls skipped because the journal recorded them as complete and stage calls recorded'''
+
+    Counters = ('Skipped', 'Recorded')
+    Format = "Work journal stages skipped: %d recorded: %d"
+
+
+Stats = WorkJournalStats()
+
+_Lock = threading.Lock()
+
+# (Stage, Element, Arguments) -> Input signature
+_Entries = {}
+
+
+def JournalFullPath(volume_path):
+    return os.path.join(volume_path, JournalFilename)
+
+
+def _IsVolumeElement(value):
+    return hasattr(value, 'attrib') and hasattr(value, 'tag')
+
+
+def _ArgumentText(value, nodes):
+    '''Convert a stage argument to a string that changes when the argument changes.  Volume elements are appended to nodes.'''
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return repr(value)
+
+    if isinstance(value, dict):
+        return '{' + ','.join(repr(k) + ':' + _ArgumentText(value[k], nodes) for k in sorted(value.keys(), key=str)) + '}'
+
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(_ArgumentText(v, nodes) for v in value) + ']'
+
+    if _IsVolumeElement(value):
+        nodes.append(value)
+        return '<' + value.tag + '>'
+
+    return type(value).__name__
+
+
+def _ChecksumAttributes(node):
+    return sorted((k, v) for (k, v) in node.attrib.items() if k.endswith('Checksum'))
+
+
+def _NodeText(node):
+    '''The attributes of the element and the checksum attributes of the elements below it, such as the images of
+       a filter.  Linked elements that have not been loaded are not included.'''
+    text = '<' + node.tag + ' ' + str(getattr(node, 'FullPath', '')) + ' ' + repr(sorted(node.attrib.items())) + '>'
+    for child in node.iter():
+        if child is node:
+            continue
+
+        checksums = _ChecksumAttributes(child)
+        if len(checksums) > 0:
+            text += '<' + child.tag + ' ' + repr(child.attrib.get('Path', '')) + ' ' + repr(checksums) + '>'
+
+    return text
+
+
+def IgnoredAttributes(PipelineNode):
+    '''
+    :return: Names of the attributes of a <PythonCall> node that are set from an option in IgnoredOptions
+    '''
+    return frozenset(key for (key, value) in PipelineNode.attrib.items() if value.startswith('#') and value[1:] in IgnoredOptions)
+
+
+class InputSignature(object):
+    '''Signature of the inputs of a stage call.
+       Created before the stage runs because stages may modify the parameter dictionary they are passed.
+       Volume elements are read when the signature is computed, so the signature recorded after a stage
+       runs matches the signature computed before the stage runs again with unchanged inputs.'''
+
+    def __init__(self, kwargs, Ignored=frozenset()):
+        '''
+        :param dict kwargs: Keyword arguments of the stage
+        :param frozenset Ignored: Names of additional keyword arguments that are not inputs of the stage
+        '''
+        self._Nodes = []
+        self._ArgumentText = _ArgumentText({k: v for (k, v) in kwargs.items() if k not in IgnoredArguments and k not in Ignored}, self._Nodes)
+
+    @property
+    def Arguments(self):
+        '''Hash of the stage arguments other than volume elements.  Part of the journal key so calls of one stage
+           on the same element with different arguments, such as from two pipelines, are recorded separately.'''
+        return hashlib.sha1(self._ArgumentText.encode('utf-8')).hexdigest()
+
+    def Compute(self):
+        text = self._ArgumentText + ''.join(_NodeText(n) for n in self._Nodes)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _ReadEntries(volume_path):
+    entries = {}
+    try:
+        with open(JournalFullPath(volume_path), 'r') as hFile:
+            for line in hFile:
+                try:
+                    entry = json.loads(line)
+                    entries[(entry['Stage'], entry['Element'], entry['Arguments'])] = entry['Signature']
+                except (ValueError, KeyError):
+                    # The last line may be incomplete if the process was killed while writing it
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return entries
+
+
+def Load(volume_path):
+    '''Read the journal of the volume, replacing any entries already loaded'''
+    entries = _ReadEntries(volume_path)
+    with _Lock:
+        _Entries.clear()
+        _Entries.update(entries)
+
+
+def Clear():
+    with _Lock:
+        _Entries.clear()
+
+
+def IsComplete(stage, element, arguments, signature):
+    '''
+    :return: True if the journal records the stage completing on the element with the same arguments and inputs
+    '''
+    with _Lock:
+        complete = _Entries.get((stage, element, arguments), None) == signature
+
+    if complete:
+        Stats.Skipped += 1
+
+    return complete
+
+
+def RecordComplete(volume_path, stage, element, arguments, signature):
+    '''Append a completed stage call to the journal'''
+    line = json.dumps({'Stage': stage, 'Element': element, 'Arguments': arguments, 'Signature': signature}) + '\n'
+    with _Lock:
+        _Entries[(stage, element, arguments)] = signature
+        try:
+            with open(JournalFullPath(volume_path), 'a') as hFile:
+                hFile.write(line)
+        except OSError as e:
+            logger = logging.getLogger(__name__ + '.' + 'RecordComplete')
+            logger.warning("Could not write work journal {0}\n{1}".format(JournalFullPath(volume_path), str(e)))
+            return
+
+    Stats.Recorded += 1
+
+
+def Compact(volume_path):
+    '''Rewrite the journal keeping the newest entry for each stage, element and arguments.
+       The file is read again so entries appended by worker processes are kept.'''
+    if not os.path.exists(JournalFullPath(volume_path)):
+        return
+
+    with _Lock:
+        entries = _ReadEntries(volume_path)
+        lines = [json.dumps({'Stage': stage, 'Element': element, 'Arguments': arguments, 'Signature': signature}) + '\n' for ((stage, element, arguments), signature) in entries.items()]
+
+        try:
+            VolumeDataWriter.AtomicWrite(JournalFullPath(volume_path), ''.join(lines).encode('utf-8'))
+        except OSError as e:
+            logger = logging.getLogger(__name__ + '.' + 'Compact')
+            logger.warning("Could not compact work journal {0}\n{1}".format(JournalFullPath(volume_path), str(e)))
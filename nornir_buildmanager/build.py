@@ -15,20 +15,16 @@ import os
 import sys
 import time
 
-import matplotlib 
 #Nornir build must use a backend that does not allocate windows in the GUI should be used. 
 #Otherwise bugs will appear in multi-threaded environments
+#matplotlib reads the backend from the environment when a stage first imports it, so matplotlib is not loaded for pipelines that do not plot 
 if not 'DEBUG' in os.environ: 
-    matplotlib.use('Agg') 
-
-import matplotlib.pyplot as plt
-plt.ioff()
+    os.environ['MPLBACKEND'] = 'Agg'
 
 from nornir_buildmanager import *
-from nornir_imageregistration.files import *
+from nornir_buildmanager import ImageHeaderCache
 from nornir_shared.misc import SetupLogging, lowpriority
 from nornir_shared.tasktimer import TaskTimer
-from pkg_resources import resource_filename
 
 import nornir_shared.prettyoutput as prettyoutput
 
@@ -36,7 +32,7 @@ CommandParserDict = {}
 
  
 def ConfigDataPath():
-    return resource_filename(__name__, 'config')
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config')
 
 
 def AddVolumeArgumentToParser(parser):
@@ -76,12 +72,46 @@ def _AddParserRootArguments(parser):
                         help='Provide additional output',
                         dest='verbose')
 
+    parser.add_argument('-plan', '--plan',
+                        action='store_true',
+                        required=False,
+                        default=False,
+                        help='Do not run the pipeline.  List the stages that would run and whether their output is out of date.',
+                        dest='plan')
+
+    parser.add_argument('-planfile',
+                        action='store',
+                        required=False,
+                        default=None,
+                        type=str,
+                        help='With -plan, also write the plan to this file as JSON',
+                        dest='planfile')
+
+    parser.add_argument('-resume',
+                        action='store_true',
+                        required=False,
+                        default=False,
+                        help='Skip stages the work journal records as completed with the same inputs.  Output files removed since are not detected.',
+                        dest='resume')
+
+    parser.add_argument('-verifyimages',
+                        action='store',
+                        required=False,
+                        default=ImageHeaderCache.VerifyOnChange,
+                        choices=ImageHeaderCache.VerifyPolicies,
+                        type=str,
+                        help='When image sizes recorded in the meta-data are checked against the image files.  never: trust the meta-data, onchange: read the headers of files that changed since they were last read, always: read the header on every check',
+                        dest='verifyimages')
+
 
 def _GetPipelineXMLPath():
     return os.path.join(ConfigDataPath(), 'Pipelines.xml')
 
 
-def BuildParserRoot():
+def BuildParserRoot(PipelineName=None):
+    '''
+    :param str PipelineName: If specified only the parser of this pipeline is populated with its arguments.  Other pipelines are listed with their help text only.
+    '''
 
     # conflict_handler = 'resolve' replaces old arguments with new if both use the same option flag
     parser = argparse.ArgumentParser('Buildscript', conflict_handler='resolve', description='Options available to all build commands.  Specific pipelines may extend the argument list.')
@@ -102,12 +132,12 @@ def BuildParserRoot():
     # update_parser = subparsers.add_parser('update', help='If directories have been copied directly into the volume this flag is required to detect them')
     
     pipeline_subparsers = parser.add_subparsers(title='Commands')
-    _AddPipelineParsers(pipeline_subparsers)
+    _AddPipelineParsers(pipeline_subparsers, PipelineName)
     
     return parser
 
 
-def _AddPipelineParsers(subparsers):
+def _AddPipelineParsers(subparsers, PipelineName=None):
 
     PipelineXML = _GetPipelineXMLPath()
     # Load the element tree once and pass it to the later functions so we aren't parsing the XML text in the loop
@@ -118,7 +148,9 @@ def _AddPipelineParsers(subparsers):
 
         pipeline_parser = subparsers.add_parser(pipeline_name, help=pipeline.Description, epilog=pipeline.Epilog)
 
-        pipeline.GetArgParser(pipeline_parser, IncludeGlobals=True)
+        # Adding the arguments of every pipeline is most of the startup time, only the pipeline being run needs them
+        if PipelineName is None or PipelineName == pipeline_name:
+            pipeline.GetArgParser(pipeline_parser, IncludeGlobals=True)
 
         pipeline_parser.set_defaults(func=call_pipeline, PipelineXmlFile=_GetPipelineXMLPath(), PipelineName=pipeline_name)
 
@@ -152,11 +184,33 @@ def _GetFromNamespace(ns, attribname, default=None):
         return default
 
 
-def InitLogging(buildArgs):
+def _PipelineNameFromArgs(buildArgs):
+    '''
+    :return: The name of the pipeline on the command line, or None if no pipeline name was found
+    '''
+    PipelineNames = frozenset(pipelinemanager.PipelineManager.ListPipelines(_GetPipelineXMLPath()))
+
+    # The first positional argument is the volume path, which could match a pipeline name
+    FoundVolumePath = False
+    for arg in buildArgs:
+        if arg.startswith('-'):
+            continue
+
+        if not FoundVolumePath:
+            FoundVolumePath = True
+            continue
+
+        if arg in PipelineNames:
+            return arg
+
+    return None
+
+
+def InitLogging(buildArgs, PipelineName=None):
 
 #    nornir_shared.Misc.RunWithProfiler('Execute()', "C:/Temp/profile.pr")
 
-    parser = BuildParserRoot()
+    parser = BuildParserRoot(PipelineName)
 
     (args, extraargs) = parser.parse_known_args(buildArgs)
 
@@ -177,11 +231,13 @@ def Execute(buildArgs=None):
     if buildArgs is None:
         buildArgs = sys.argv[1:]
 
-    InitLogging(buildArgs)
+    PipelineName = _PipelineNameFromArgs(buildArgs)
+
+    InitLogging(buildArgs, PipelineName)
 
     Timer = TaskTimer()
 
-    parser = BuildParserRoot()
+    parser = BuildParserRoot(PipelineName)
 
     args = parser.parse_args(buildArgs)
    
@@ -35,6 +35,8 @@ import nornir_buildmanager.templates
 from nornir_buildmanager.VolumeManagerETree import *
 from nornir_buildmanager.operations.tile import VerifyTiles
 import nornir_buildmanager.importers
+from nornir_buildmanager import TileHistogram
+import nornir_imageregistration
 from nornir_imageregistration.files import mosaicfile
 from nornir_imageregistration.mosaic import Mosaic
 from nornir_imageregistration import image_stats
@@ -52,6 +54,7 @@ import numpy
 import nornir_buildmanager.importers.serialemlog as serialemlog
 import nornir_buildmanager.importers.shared as shared
 import nornir_buildmanager.importers.serialem_utils as serialem_utils
+import nornir_buildmanager.importers.sectionpipeline as sectionpipeline
 
 
 def Import(VolumeElement, ImportPath, extension=None, *args, **kwargs):
@@ -66,6 +69,8 @@ def Import(VolumeElement, ImportPath, extension=None, *args, **kwargs):
     MaxCutoff = float(kwargs.get('Max'))
     ContrastCutoffs = (MinCutoff, MaxCutoff)
     CameraBpp = kwargs.get('CameraBpp',None)
+    SampleFraction = kwargs.get('SampleFraction', None)
+    Stride = kwargs.get('Stride', None)
         
     if MinCutoff < 0.0 or MinCutoff > 1.0:
         raise ValueError("Min must be between 0 and 1: %f" % MinCutoff)
@@ -76,6 +81,12 @@ def Import(VolumeElement, ImportPath, extension=None, *args, **kwargs):
     if MinCutoff >= MaxCutoff:
         raise ValueError("Max must be greater than Min: %f is not less than %f" % (MinCutoff, MaxCutoff))
     
+    if SampleFraction is not None and (SampleFraction <= 0.0 or SampleFraction > 1.0):
+        raise ValueError("Histogram sample fraction must be greater than 0 and at most 1: %f" % SampleFraction)
+    
+    if Stride is not None and Stride < 1:
+        raise ValueError("Histogram stride must be at least 1: %d" % Stride)
+    
     FlipList = nornir_buildmanager.importers.GetFlipList(ImportPath)
     histogramFilename = os.path.join(ImportPath, nornir_buildmanager.importers.DefaultHistogramFilename)
     ContrastMap = nornir_buildmanager.importers.LoadHistogramCutoffs(histogramFilename)
@@ -87,25 +98,46 @@ def Import(VolumeElement, ImportPath, extension=None, *args, **kwargs):
 
     DirList = files.RecurseSubdirectoriesGenerator(ImportPath, RequiredFiles="*." + extension, ExcludeNames=[], ExcludedDownsampleLevels=[])
 
-    DataFound = False 
-
+    Sections = []
     for path in DirList:
         for idocFullPath in glob.glob(os.path.join(path, '*.idoc')):
-            DataFound = True
-            yield SerialEMIDocImport.ToMosaic(VolumeElement,
-                                              idocFullPath,
-                                              ContrastCutoffs=ContrastCutoffs,
-                                              OutputImageExt=None,
-                                              FlipList=FlipList,
-                                              CameraBpp=CameraBpp,
-                                              ContrastMap=ContrastMap)
-
-    if not DataFound:
+            Sections.append((idocFullPath, ContrastCutoffs, FlipList, ContrastMap, CameraBpp, None, SampleFraction, Stride))
+
+    if len(Sections) == 0:
         raise ValueError("No data found in ImportPath %s" % ImportPath)
 
+    yield from sectionpipeline.ImportSections(Sections,
+                                              Prepare=SerialEMIDocImport.PrepareSection,
+                                              Apply=lambda section: SerialEMIDocImport.ApplySection(VolumeElement, section),
+                                              Convert=SerialEMIDocImport.ConvertSection,
+                                              Finish=SerialEMIDocImport.FinishSection,
+                                              MaxWorkers=kwargs.get('SectionWorkers', None),
+                                              VolumePath=VolumeElement.FullPath)
+
               
 
 
+class IDocSection(object):
+    '''Values read from a section's idoc and the volume elements created for it while the section is imported'''
+
+    def __init__(self):
+        self.idocFilePath = None
+        self.sectionDir = None
+        self.SectionNumber = None
+        self.SectionName = None
+        self.SectionPath = None
+        self.Flip = False
+        self.IDocData = None
+        self.FirstTile = None
+        self.ImageBpp = None
+        self.TargetBpp = None
+        self.histogramFullPath = None
+        self.ActualMosaicMin = None
+        self.ActualMosaicMax = None
+        self.Gamma = None
+        self.HistogramPartials = []  # Partial histograms read in the worker, merged into this process's cache by ApplySection
+
+
 class SerialEMIDocImport(object):
     
     
@@ -119,10 +151,29 @@ class SerialEMIDocImport(object):
         between the median min and max values
         :param list FlipList: List of section numbers which should have images flipped
         :param dict ContrastMap: Dictionary mapping section number to (Min, Max, Gamma) tuples 
+        :return: The highest element that needs to be saved, or None
+        '''
+        section = cls.PrepareSection(idocFileFullPath, ContrastCutoffs, FlipList, ContrastMap, CameraBpp, TargetBpp)
+        (ConvertArgs, section) = cls.ApplySection(VolumeObj, section, OutputImageExt)
+        
+        ConvertResult = None
+        if ConvertArgs is not None:
+            ConvertResult = cls.ConvertSection(*ConvertArgs)
+            
+        SaveNodes = cls.FinishSection(section, ConvertResult)
+        if len(SaveNodes) == 0:
+            return None
+        
+        return SaveNodes[0]
+
+    @classmethod
+    def PrepareSection(cls, idocFileFullPath, ContrastCutoffs, FlipList=None, ContrastMap=None, CameraBpp=None, TargetBpp=None, SampleFraction=None, Stride=None):
+        '''
+        Read the idoc and choose the contrast settings of a section.  Does not use the volume, so it can run in a worker process.
+        :param float SampleFraction: Fraction of tiles read to build the histogram, all tiles if None
+        :param int Stride: Count every Nth pixel of every Nth row of a tile to build the histogram, all pixels if None
+        :return: IDocSection
         '''
-        if(OutputImageExt is None):
-            OutputImageExt = 'png'
-  
         if TargetBpp is None:
             TargetBpp = 8
 
@@ -131,25 +182,21 @@ class SerialEMIDocImport(object):
 
         if ContrastMap is None:
             ContrastMap = {}
-   
-        SaveChannel = False
+            
+        section = IDocSection()
+        section.TargetBpp = TargetBpp
 
         idocFilePath = serialem_utils.GetPathWithoutSpaces(idocFileFullPath)
- 
-        OutputPath = VolumeObj.FullPath
+        section.idocFilePath = idocFilePath
 
-        os.makedirs(OutputPath, exist_ok=True)
-
-        logger = logging.getLogger(__name__ + '.' + str(cls.__name__) + "ToMosaic")
+        logger = logging.getLogger(__name__ + '.' + str(cls.__name__) + "PrepareSection")
 
         # Report the current stage to the user
         prettyoutput.CurseString('Stage', "SerialEM to Mosaic " + str(idocFileFullPath))
 
         SectionNumber = 0
         sectionDir = os.path.dirname(idocFileFullPath) #serialem_utils.GetDirectories(idocFileFullPath)
-
-        BlockObj = BlockNode.Create('TEM')
-        [saveBlock, BlockObj] = VolumeObj.UpdateOrAddChild(BlockObj)
+        section.sectionDir = sectionDir
 
         # If the parent directory doesn't have the section number in the name, change it
         ExistingSectionInfo = shared.GetSectionInfo(sectionDir)
@@ -180,29 +227,17 @@ class SerialEMIDocImport(object):
                     SectionName = parts[2]
         except:
             pass
+        
+        section.SectionNumber = SectionNumber
+        section.SectionName = SectionName
+        section.SectionPath = SectionPath
 
-        sectionObj = SectionNode.Create(SectionNumber,
-                                        SectionName,
-                                        SectionPath)
-
-        [saveSection, sectionObj] = BlockObj.UpdateOrAddChildByAttrib(sectionObj, 'Number')
-        sectionObj.Name = SectionName
-
-        # Create a channel group 
-        [saveChannel, channelObj] = sectionObj.UpdateOrAddChildByAttrib(ChannelNode.Create('TEM'), 'Name')
-   
-        # Create a channel group for the section
-
-        # I started ignoring existing supertile.mosaic files so I could rebuild sections where
-        # a handful of tiles were corrupt
-        # if(os.path.exists(SupertilePath)):
-        #    continue
-
-        Flip = SectionNumber in FlipList;
-        if(Flip):
+        section.Flip = SectionNumber in FlipList;
+        if(section.Flip):
             prettyoutput.Log("Found in FlipList.txt, flopping images")
 
         IDocData = IDoc.Load(idocFilePath, CameraBpp=CameraBpp)
+        section.IDocData = IDocData
 
         assert(hasattr(IDocData, 'PixelSpacing'))
         assert(hasattr(IDocData, 'DataMode'))
@@ -211,40 +246,102 @@ class SerialEMIDocImport(object):
         # If there are no tiles... return
         if IDocData.NumTiles == 0:
             prettyoutput.Log("No tiles found in IDoc: " + idocFilePath)
-            return
+            return section
+        
+        # AddIdocNode copies the attributes of the first tile listed in the idoc
+        section.FirstTile = IDocData.tiles[0].Attributes()
+        
+        # Parse the images
+        ImageBpp = IDocData.GetImageBpp()            
+        if ImageBpp is None:
+            ImageBpp = cls.GetImageBpp(IDocData, sectionDir) 
+        section.ImageBpp = ImageBpp
+
+        section.histogramFullPath = os.path.join(sectionDir, 'Histogram.xml')
+        
+        IDocData.RemoveMissingTiles(sectionDir)
+        source_tile_list = [os.path.join(sectionDir, t.Image) for t in IDocData.tiles ]
+          
+        (ActualMosaicMin, ActualMosaicMax, Gamma) = cls.GetSectionContrastSettings(SectionNumber, ContrastMap, ContrastCutoffs, source_tile_list, IDocData, section.histogramFullPath,
+                                                                                            SampleFraction=SampleFraction, Stride=Stride, Calculated=section.HistogramPartials)
+        section.ActualMosaicMax = numpy.around(ActualMosaicMax)
+        section.ActualMosaicMin = numpy.around(ActualMosaicMin)
+        section.Gamma = Gamma
+        
+        return section
+
+    @classmethod
+    def ApplySection(cls, VolumeObj, section, OutputImageExt=None):
+        '''
+        Add or update the elements for a prepared section in the volume and decide which tiles need to be converted.
+        :return: (ConvertArgs, section).  ConvertArgs are the arguments to ConvertSection, None if the mosaic is up to date.
+        '''
+        if(OutputImageExt is None):
+            OutputImageExt = 'png'
+
+        TileHistogram.Merge(section.HistogramPartials)
+            
+        if section.IDocData.NumTiles == 0:
+            return (None, section)
+        
+        IDocData = section.IDocData
+        TargetBpp = section.TargetBpp
+        sectionDir = section.sectionDir
+        idocFilePath = section.idocFilePath
+        ActualMosaicMin = section.ActualMosaicMin
+        ActualMosaicMax = section.ActualMosaicMax
+        Gamma = section.Gamma
+
+        OutputPath = VolumeObj.FullPath
+
+        os.makedirs(OutputPath, exist_ok=True)
+
+        logger = logging.getLogger(__name__ + '.' + str(cls.__name__) + "ApplySection")
+
+        BlockObj = BlockNode.Create('TEM')
+        [section.saveBlock, BlockObj] = VolumeObj.UpdateOrAddChild(BlockObj)
+
+        sectionObj = SectionNode.Create(section.SectionNumber,
+                                        section.SectionName,
+                                        section.SectionPath)
+
+        [section.saveSection, sectionObj] = BlockObj.UpdateOrAddChildByAttrib(sectionObj, 'Number')
+        sectionObj.Name = section.SectionName
+
+        # Create a channel group 
+        [section.saveChannel, channelObj] = sectionObj.UpdateOrAddChildByAttrib(ChannelNode.Create('TEM'), 'Name')
+        
+        section.VolumeObj = VolumeObj
+        section.BlockObj = BlockObj
+        section.sectionObj = sectionObj
+        section.channelObj = channelObj
+   
+        # Create a channel group for the section
+
+        # I started ignoring existing supertile.mosaic files so I could rebuild sections where
+        # a handful of tiles were corrupt
+        # if(os.path.exists(SupertilePath)):
+        #    continue
 
         # See if we can find a notes file...
         shared.TryAddNotes(channelObj, sectionDir, logger)
         serialem_utils.TryAddLogs(channelObj, sectionDir, logger)
 
-        AddIdocNode(channelObj, idocFilePath, IDocData, logger)
+        AddIdocNode(channelObj, idocFilePath, IDocData, logger, FirstTile=section.FirstTile)
 
         # Set the scale
         [added, ScaleObj] = cls.CreateScaleNode(IDocData, channelObj)
-        
-        # Parse the images
-        ImageBpp = IDocData.GetImageBpp()            
-        if ImageBpp is None:
-            ImageBpp = cls.GetImageBpp(IDocData, sectionDir) 
 
         FilterName = 'Raw' + str(TargetBpp)
         if(TargetBpp is None):
             FilterName = 'Raw'
-
-        histogramFullPath = os.path.join(sectionDir, 'Histogram.xml')
-        
-        IDocData.RemoveMissingTiles(sectionDir)
-        source_tile_list = [os.path.join(sectionDir, t.Image) for t in IDocData.tiles ]
-          
-        (ActualMosaicMin, ActualMosaicMax, Gamma) = cls.GetSectionContrastSettings(SectionNumber, ContrastMap, ContrastCutoffs, source_tile_list, IDocData, histogramFullPath)
-        ActualMosaicMax = numpy.around(ActualMosaicMax)
-        ActualMosaicMin = numpy.around(ActualMosaicMin)
         
         contrast_mismatch = channelObj.RemoveFilterOnContrastMismatch(FilterName, ActualMosaicMin, ActualMosaicMax, Gamma)
+        section.contrast_mismatch = contrast_mismatch
     
         Pool = nornir_pools.GetGlobalThreadPool()
         #_PlotHistogram(histogramFullPath, SectionNumber, ActualMosaicMin, ActualMosaicMax)
-        Pool.add_task(histogramFullPath, _PlotHistogram, histogramFullPath, SectionNumber, ActualMosaicMin, ActualMosaicMax, force_recreate=contrast_mismatch)
+        Pool.add_task(section.histogramFullPath, _PlotHistogram, section.histogramFullPath, section.SectionNumber, ActualMosaicMin, ActualMosaicMax, force_recreate=contrast_mismatch)
         
         
         ImageConversionRequired = contrast_mismatch
@@ -264,16 +361,17 @@ class SerialEMIDocImport(object):
         # Check to make sure our supertile mosaic file is valid
         RemoveOutdatedFile(idocFilePath, SupertilePath)
 
-        [added_transform, transformObj] = channelObj.UpdateOrAddChildByAttrib(TransformNode.Create(Name=SupertileName,
+        [section.added_transform, transformObj] = channelObj.UpdateOrAddChildByAttrib(TransformNode.Create(Name=SupertileName,
                                                                          Path=SupertileTransform,
                                                                          Type='Stage'),
                                                                          'Path')
+        section.transformObj = transformObj
 
-        [added_tilepyramid, PyramidNodeObj] = filterObj.UpdateOrAddChildByAttrib(TilePyramidNode.Create(Type='stage',
+        [section.added_tilepyramid, PyramidNodeObj] = filterObj.UpdateOrAddChildByAttrib(TilePyramidNode.Create(Type='stage',
                                                                             NumberOfTiles=IDocData.NumTiles),
                                                                             'Path')
 
-        [added_level, LevelObj] = PyramidNodeObj.GetOrCreateLevel(1, GenerateData=False)
+        [section.added_level, LevelObj] = PyramidNodeObj.GetOrCreateLevel(1, GenerateData=False)
 
         Tileset = NornirTileset.CreateTilesFromIDocTileData(IDocData.tiles, InputTileDir=sectionDir, OutputTileDir=LevelObj.FullPath, OutputImageExt=OutputImageExt)
 
@@ -290,54 +388,97 @@ class SerialEMIDocImport(object):
         if len(SourceToMissingTargetMap) == 0:
             ImageConversionRequired = False
         else:
-            ImageConversionRequired = (not ImageBpp == TargetBpp) or (ImageConversionRequired or Tileset.ImageConversionRequired)
+            ImageConversionRequired = (not section.ImageBpp == TargetBpp) or (ImageConversionRequired or Tileset.ImageConversionRequired)
+            
+        section.ImageConversionRequired = ImageConversionRequired
 
         if(ImageConversionRequired):
-            Invert = False 
             filterObj.SetContrastValues(ActualMosaicMin, ActualMosaicMax, Gamma)
             filterObj.TilePyramid.NumberOfTiles = IDocData.NumTiles
+            
+        # If we write new images replace the .mosaic file
+        if len(SourceToMissingTargetMap) == 0 and os.path.exists(SupertilePath):
+            return (None, section)
+        
+        return ((Tileset, SourceToMissingTargetMap, ImageConversionRequired, section.Flip, section.ImageBpp, TargetBpp,
+                 [ActualMosaicMin, ActualMosaicMax], Gamma, SupertilePath, IDocData.ImageSize, LevelObj.FullPath), section)
+
+    @classmethod
+    def ConvertSection(cls, Tileset, SourceToMissingTargetMap, ImageConversionRequired, Flip, ImageBpp, TargetBpp, MinMax, Gamma, SupertilePath, ImageSize, LevelFullPath):
+        '''
+        Convert or copy the tiles of a section and write the stage mosaic.  Does not use the volume, so it can run in a worker process.
+        :return: True if the mosaic file was written
+        '''
+        if(ImageConversionRequired):
+            Invert = False 
             # andValue = cls.GetBitmask(ActualMosaicMin, ActualMosaicMax, TargetBpp)
             #nornir_shared.images.ConvertImagesInDict(SourceToMissingTargetMap, Flip=Flip, Bpp=TargetBpp, Invert=Invert, bDeleteOriginal=False, MinMax=[ActualMosaicMin, ActualMosaicMax])
-            nornir_imageregistration.ConvertImagesInDict(SourceToMissingTargetMap, Flip=Flip, InputBpp=ImageBpp, OutputBpp=TargetBpp, Invert=Invert, bDeleteOriginal=False, MinMax=[ActualMosaicMin, ActualMosaicMax], Gamma=Gamma)
+            cls.ConvertTiles(SourceToMissingTargetMap, Flip=Flip, InputBpp=ImageBpp, OutputBpp=TargetBpp, Invert=Invert, bDeleteOriginal=False, MinMax=MinMax, Gamma=Gamma)
 
         elif(Tileset.ImageMoveRequired):
             for f in SourceToMissingTargetMap:
                 shutil.copy(f, SourceToMissingTargetMap[f])
 
-        # If we wrote new images replace the .mosaic file
-        if len(SourceToMissingTargetMap) > 0 or not os.path.exists(SupertilePath):
-            # Writing this file indicates import succeeded and we don't need to repeat these steps, writing it will possibly invalidate a lot of downstream data
-            # We need to flip the images.  This may be a Utah scope issue, our Y coordinates are inverted relative to the images.  To fix this
-            # we flop instead of flip and reverse when writing the coordinates
-            mosaicfile.MosaicFile.Write(SupertilePath, Entries=Tileset.GetPositionsForTargets(), Flip=not Flip, ImageSize=IDocData.ImageSize, Downsample=1);
-            MFile = mosaicfile.MosaicFile.Load(SupertilePath)
-
-            # Sometimes files fail to convert, when this occurs remove them from the .mosaic
-            if MFile.RemoveInvalidMosaicImages(LevelObj.FullPath):
-                MFile.Save(SupertilePath)
- 
-            Mosaic.TranslateMosaicFileToZeroOrigin(SupertilePath)
-            transformObj.ResetChecksum()
+        # Writing this file indicates import succeeded and we don't need to repeat these steps, writing it will possibly invalidate a lot of downstream data
+        # We need to flip the images.  This may be a Utah scope issue, our Y coordinates are inverted relative to the images.  To fix this
+        # we flop instead of flip and reverse when writing the coordinates
+        mosaicfile.MosaicFile.Write(SupertilePath, Entries=Tileset.GetPositionsForTargets(), Flip=not Flip, ImageSize=ImageSize, Downsample=1);
+        MFile = mosaicfile.MosaicFile.Load(SupertilePath)
+
+        # Sometimes files fail to convert, when this occurs remove them from the .mosaic
+        if MFile.RemoveInvalidMosaicImages(LevelFullPath):
+            MFile.Save(SupertilePath)
+
+        Mosaic.TranslateMosaicFileToZeroOrigin(SupertilePath)
+        return True
+
+    @classmethod
+    def ConvertTiles(cls, SourceToMissingTargetMap, **kwargs):
+        '''
+        Convert tiles with nornir_imageregistration.ConvertImagesInDict.  It converts the tiles it is passed on a pool of
+        its own, so in a section pipeline worker, where every CPU already has a worker, one tile is passed at a time.
+        '''
+        if not sectionpipeline.InWorker:
+            nornir_imageregistration.ConvertImagesInDict(SourceToMissingTargetMap, **kwargs)
+            return
+
+        for (source, target) in SourceToMissingTargetMap.items():
+            nornir_imageregistration.ConvertImagesInDict({source: target}, **kwargs)
+
+    @classmethod
+    def FinishSection(cls, section, MosaicWritten):
+        '''
+        Update the volume after the section's tiles were converted
+        :return: List containing the highest element that needs to be saved, or an empty list
+        '''
+        if section.IDocData.NumTiles == 0:
+            return []
+        
+        SaveChannel = False
+        if MosaicWritten:
+            section.transformObj.ResetChecksum()
             SaveChannel = True
             # transformObj.Checksum = MFile.Checksum
 
-        if saveBlock:
-            return VolumeObj
-        elif saveSection:
-            return BlockObj
-        elif saveChannel:
-            return sectionObj
-        elif  added_transform or added_tilepyramid or added_level or ImageConversionRequired or SaveChannel or contrast_mismatch:
-            return channelObj
-        return None
+        if section.saveBlock:
+            return [section.VolumeObj]
+        elif section.saveSection:
+            return [section.BlockObj]
+        elif section.saveChannel:
+            return [section.sectionObj]
+        elif section.added_transform or section.added_tilepyramid or section.added_level or section.ImageConversionRequired or SaveChannel or section.contrast_mismatch:
+            return [section.channelObj]
+        return []
 
     @classmethod
-    def GetSectionContrastSettings(cls, SectionNumber, ContrastMap, ContrastCutoffs, SourceImagesFullPaths, idoc_data, histogramFullPath):
-        '''Clear and recreate the filters tile pyramid node if the filters contrast node does not match'''
+    def GetSectionContrastSettings(cls, SectionNumber, ContrastMap, ContrastCutoffs, SourceImagesFullPaths, idoc_data, histogramFullPath, SampleFraction=None, Stride=None, Calculated=None):
+        '''Clear and recreate the filters tile pyramid node if the filters contrast node does not match
+        :param list Calculated: If not None, the partial histograms read from tiles are appended to this list'''
         Gamma = 1.0
         
         #We don't have to run this step, but it ensures the histogram is up to date
-        (ActualMosaicMin, ActualMosaicMax) = _GetMinMaxCutoffs(SourceImagesFullPaths, ContrastCutoffs[0], 1.0 - ContrastCutoffs[1], idoc_data, histogramFullPath)
+        (ActualMosaicMin, ActualMosaicMax) = _GetMinMaxCutoffs(SourceImagesFullPaths, ContrastCutoffs[0], 1.0 - ContrastCutoffs[1], idoc_data, histogramFullPath,
+                                                               SampleFraction=SampleFraction, Stride=Stride, Calculated=Calculated)
         
         if SectionNumber in ContrastMap:
             ActualMosaicMin = ContrastMap[SectionNumber].Min
@@ -398,8 +539,11 @@ class SerialEMIDocImport(object):
         return andValue
 
     
-def _GetMinMaxCutoffs(listfilenames, MinCutoff, MaxCutoff, idoc_data, histogramFullPath=None):
-    
+def _GetMinMaxCutoffs(listfilenames, MinCutoff, MaxCutoff, idoc_data, histogramFullPath=None, SampleFraction=None, Stride=None, Calculated=None):
+    '''
+    :param list Calculated: If not None, the partial histograms read from tiles are appended to this list so a worker process can return them
+    '''
+
     histogramObj = None
     if not histogramFullPath is None:
         if os.path.exists(histogramFullPath):
@@ -421,7 +565,15 @@ def _GetMinMaxCutoffs(listfilenames, MinCutoff, MaxCutoff, idoc_data, histogramF
             if (1 << idoc_data.CameraBpp) - 1 < maxVal:
                 maxVal = (1 << idoc_data.CameraBpp) - 1
             
-        histogramObj = image_stats.Histogram(listfilenames, Bpp=Bpp, MinVal=idoc_data.Min, MaxVal=idoc_data.Max, numBins=numBins)
+        accumulator = TileHistogram.Build(listfilenames, MinVal=idoc_data.Min, MaxVal=idoc_data.Max, NumBins=numBins, SampleFraction=SampleFraction, Stride=Stride,
+                                          Pool=sectionpipeline.WorkerPool())
+        if Calculated is not None:
+            Calculated.extend(accumulator.Calculated)
+
+        if accumulator.ErrorBound() > 0:
+            prettyoutput.Log("Histogram from {0} of {1} tiles, cutoffs may clip {2:.3g}% more or fewer pixels".format(accumulator.NumTiles, len(listfilenames), accumulator.ErrorBound() * 100.0))
+            
+        histogramObj = accumulator.ToHistogram()
 
         if not histogramFullPath is None:
             histogramObj = _CleanOutliersFromIDocHistogram(histogramObj)
@@ -465,6 +617,7 @@ def _PlotHistogram(histogramFullPath, sectionNumber, minCutoff, maxCutoff, force
 class NornirTileset():
     
     Tile = collections.namedtuple("NornirTile", ('SourceImageFullPath', 'TargetImageFullPath', 'Position'))
+    Tile.__qualname__ = 'NornirTileset.Tile'  # Tilesets are pickled to convert sections in worker processes
     
     @property
     def MissingInputImages(self):
@@ -584,7 +737,8 @@ class NornirTileset():
         return obj
 
 
-def AddIdocNode(containerObj, idocFullPath, idocObj, logger):
+def AddIdocNode(containerObj, idocFullPath, idocObj, logger, FirstTile=None):
+    ''':param dict FirstTile: Attributes of the first tile, read from idocObj if None'''
 
     # Copy the idoc file to the output directory
     idocPath = os.path.basename(idocFullPath)
@@ -617,11 +771,14 @@ def AddIdocNode(containerObj, idocFullPath, idocObj, logger):
 #            IDocNodeObj.attrib[k] = '%g' % v
 
     # Read the first tile obj, copy over common attributes
-    assert(len(idocObj.tiles) > 0)
-    tile = idocObj.tiles[0]
+    if FirstTile is None:
+        assert(len(idocObj.tiles) > 0)
+        FirstTile = idocObj.tiles[0].Attributes()
+        
+    attribs = FirstTile
 
-    for k in list(tile.__dict__.keys()):
-        v = tile.__dict__[k]
+    for k in list(attribs.keys()):
+        v = attribs[k]
 
         if k[0] == '_':
             continue
@@ -639,99 +796,433 @@ def AddIdocNode(containerObj, idocFullPath, idocObj, logger):
 
 
 
-class IDocTileData():
+def _ConvertIDocValues(values):
+    '''Convert the whitespace separated values of an idoc attribute to an int, float or string.
+    :return: The converted value, or a list of values if there is more than one'''
+    ConvertedValues = []
+    for v in values:
+        try:
+            convVal = int(v)
+        except ValueError:
+            try:
+                convVal = float(v)
+            except ValueError:
+                convVal = v
+
+        ConvertedValues.append(convVal)
+
+    if len(ConvertedValues) == 1:
+        return ConvertedValues[0]
+
+    return ConvertedValues
+
+
+class IDocColumn(object):
+    '''Values of one attribute for all tiles of an idoc.'''
+
+    __slots__ = ('Positions', 'Ints', 'Values', 'Rows')
+
+    def __init__(self, Positions=None, Ints=None, Values=None, Rows=None):
+        '''
+        :param list Positions: An array for each of the attribute's values with a row for each tile that has the attribute.  None if tiles have different numbers of values
+        :param list Ints: For each position, None or a boolean array marking the rows of a float array whose text was an int
+        :param list Values: Converted values with a row for each tile that has the attribute, used if Positions is None
+        :param ndarray Rows: Row for each tile, -1 if the tile does not have the attribute.  None if row and tile index are the same for all tiles
+        '''
+        self.Positions = Positions
+        self.Ints = Ints
+        self.Values = Values
+        self.Rows = Rows
+
+    @property
+    def IsDense(self):
+        '''True if every tile has a row in the Positions arrays'''
+        return self.Rows is None and self.Positions is not None
+
+    def Get(self, index):
+        '''
+        :return: Value for the tile, as the same python types the values would be converted to individually.  None if the tile does not have the attribute
+        '''
+        row = index if self.Rows is None else self.Rows[index]
+        if row < 0:
+            return None
+
+        if self.Positions is None:
+            return self.Values[row]
+
+        values = [self.PositionValue(i, row) for i in range(len(self.Positions))]
+        if len(values) == 1:
+            return values[0]
+
+        return values
+
+    def PositionValue(self, i, row):
+        '''
+        :return: Value at a position of a row, as the python type the text would be converted to individually
+        '''
+        p = self.Positions[i]
+        if p.dtype.kind == 'O':
+            # Object arrays hold tokens that were converted individually
+            return p[row]
+
+        value = p[row].item()
+        Ints = self.Ints[i] if self.Ints is not None else None
+        if Ints is not None and Ints[row]:
+            return int(value)
+
+        return value
+
+    def Take(self, indices):
+        '''
+        :return: Column for the tiles at indices
+        '''
+        NumRows = len(self.Values) if self.Positions is None else len(self.Positions[0])
+        rows = numpy.arange(NumRows) if self.Rows is None else self.Rows
+        rows = rows[indices]
+        if self.Positions is not None and numpy.all(rows >= 0):
+            Ints = None if self.Ints is None else [None if m is None else m[rows] for m in self.Ints]
+            return IDocColumn(Positions=[p[rows] for p in self.Positions], Ints=Ints)
+
+        return IDocColumn(self.Positions, self.Ints, self.Values, rows)
+
+
+class IDocColumnBuilder(object):
+    '''Collects the text of an attribute's values while an idoc is read and converts them all at once'''
+
+    __slots__ = ('Indices', 'Values')
+
+    def __init__(self):
+        self.Indices = []
+        self.Values = []
+
+    def Add(self, indices, values):
+        '''
+        :param ndarray indices: Index of the tile each value belongs to
+        :param ndarray values: Stripped value text
+        '''
+        self.Indices.append(indices)
+        self.Values.append(values)
+
+    # Ints longer than this may not be exact in a float array
+    MaxFloatIntDigits = 15
+
+    @classmethod
+    def _ConvertPosition(cls, tokens):
+        '''
+        :return: (Array of tokens converted to ints, or to floats if any is not an int, boolean array marking the int
+                 tokens of a float array or None).  If any token is not a number each token is converted individually.
+        '''
+        try:
+            return (tokens.astype(numpy.int64), None)
+        except (ValueError, OverflowError):
+            pass
+
+        try:
+            floats = tokens.astype(numpy.float64)
+            digits = numpy.char.lstrip(tokens, '+-')
+            Ints = numpy.char.isdigit(digits) & (numpy.char.str_len(tokens) - numpy.char.str_len(digits) <= 1)
+            if not numpy.any(Ints):
+                return (floats, None)
+
+            if not numpy.any(numpy.char.str_len(digits[Ints]) > IDocColumnBuilder.MaxFloatIntDigits):
+                return (floats, Ints)
+        except (ValueError, OverflowError):
+            pass
+
+        # Text such as dates often repeats, so only convert each distinct token once
+        (unique, inverse) = numpy.unique(tokens, return_inverse=True)
+        converted = numpy.empty(len(unique), dtype=object)
+        converted[:] = [_ConvertIDocValues([t]) for t in unique.tolist()]
+        return (converted[inverse.reshape(-1)], None)
+
+    @classmethod
+    def _SplitPositions(cls, values):
+        '''
+        :return: List with an array of tokens for each position, None if values have different numbers of tokens
+        '''
+        if numpy.any(numpy.char.find(values, '\t') >= 0):
+            values = numpy.char.replace(values, '\t', ' ')
+
+        while numpy.any(numpy.char.find(values, '  ') >= 0):
+            values = numpy.char.replace(values, '  ', ' ')
+
+        counts = numpy.char.count(values, ' ') + 1
+        NumValues = int(counts[0])
+        if numpy.any(counts != NumValues):
+            return None
+
+        tokens = numpy.array(' '.join(values.tolist()).split()).reshape((len(values), NumValues))
+        return [tokens[:, i] for i in range(NumValues)]
+
+    def Build(self, NumTiles):
+        '''
+        :return: IDocColumn for an idoc with NumTiles tiles
+        '''
+        indices = numpy.concatenate(self.Indices)
+        values = numpy.concatenate(self.Values)
+
+        column = IDocColumn()
+        Positions = IDocColumnBuilder._SplitPositions(values)
+        if Positions is not None:
+            Converted = [IDocColumnBuilder._ConvertPosition(p) for p in Positions]
+            column.Positions = [c[0] for c in Converted]
+            if any(c[1] is not None for c in Converted):
+                column.Ints = [c[1] for c in Converted]
+        else:
+            column.Values = [_ConvertIDocValues(v.split()) for v in values.tolist()]
+
+        if len(indices) == NumTiles and numpy.array_equal(indices, numpy.arange(NumTiles)):
+            return column
+
+        # Tiles missing the attribute have no row.  If a tile repeats the attribute the last value is used.
+        column.Rows = numpy.full(NumTiles, -1, dtype=numpy.int64)
+        column.Rows[indices] = numpy.arange(len(indices))
+        return column
+
+
+class IDocTileTable(object):
+    '''Meta-data of all tiles in an idoc, stored as one column per attribute'''
+
+    def __init__(self, Images):
+        self.Images = Images
+        self.Columns = {}
+
+        # Largest maximum intensity reported for a tile, larger values read from the idoc are replaced with it
+        self.MaxLimit = None
+
+        # Tile index -> {Attribute: value} for values assigned after the idoc was read
+        self._Overrides = {}
+
+    def __len__(self):
+        return len(self.Images)
+
+    @property
+    def HasOverrides(self):
+        return len(self._Overrides) > 0
+
+    def HasOverride(self, index, name):
+        return name in self._Overrides.get(index, ())
+
+    def Get(self, index, name):
+        overrides = self._Overrides.get(index, None)
+        if overrides is not None and name in overrides:
+            return overrides[name]
+
+        column = self.Columns.get(name, None)
+        if column is not None:
+            return column.Get(index)
+
+        if name in IDocTileData.KnownAttributes:
+            return None
+
+        raise AttributeError(name)
+
+    def Set(self, index, name, value):
+        self._Overrides.setdefault(index, {})[name] = value
+
+    def Remove(self, index, name):
+        overrides = self._Overrides.get(index, None)
+        if overrides is not None:
+            overrides.pop(name, None)
+
+    def Attributes(self, index):
+        '''
+        :return: Dictionary of all attributes of the tile
+        '''
+        attribs = {name: None for name in IDocTileData.KnownAttributes}
+        for (name, column) in self.Columns.items():
+            value = column.Get(index)
+            if value is not None:
+                attribs[name] = value
+
+        attribs.update(self._Overrides.get(index, {}))
+        attribs['Image'] = self.Images[index]
+        return attribs
+
+    def Take(self, indices):
+        '''
+        :return: IDocTileTable with the tiles at indices
+        '''
+        table = IDocTileTable([self.Images[i] for i in indices])
+        table.MaxLimit = self.MaxLimit
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        for (name, column) in self.Columns.items():
+            table.Columns[name] = column.Take(indices)
+
+        for (iNew, iOld) in enumerate(indices.tolist()):
+            if iOld in self._Overrides:
+                table._Overrides[iNew] = dict(self._Overrides[iOld])
+
+        return table
+
+
+class IDocTileData(object):
+    '''View of one tile's meta-data in an IDocTileTable'''
 
-    def __init__(self, ImageName):
+    __slots__ = ('_Table', '_Index')
+
+    # SerialEM Idoc meta-data reported as None when a tile does not have it
+    KnownAttributes = frozenset(['TiltAngle', 'PieceCoordinates', 'StagePosition', 'Intensity', 'ExposureDose',
+                                 'SpotSize', 'Defocus', 'ImageShift', 'RotationAngle', 'ExposureTime', 'TargetDefocus'])
+
+    def __init__(self, ImageName=None, Table=None, Index=0):
         '''Populate all known SerialEM Idoc meta-data'''
-        self.Image = ImageName  # Name of the image
-        self.TiltAngle = None
-        self.PieceCoordinates = None
-        self.StagePosition = None
-        self.Intensity = None
-        self.ExposureDose = None
-        self.SpotSize = None
-        self.Defocus = None
-        self.ImageShift = None
-        self.RotationAngle = None
-        self.ExposureTime = None
-        self._MinMaxMean = None
-        self.TargetDefocus = None
-        
-        self._Min = None
-        self._Max = None
-        self._Mean = None
+        if Table is None:
+            Table = IDocTileTable([ImageName])
+
+        object.__setattr__(self, '_Table', Table)
+        object.__setattr__(self, '_Index', Index)
+
+    def __getattr__(self, name):
+        '''Called for attributes that are not slots or properties'''
+        if name[0] == '_':
+            raise AttributeError(name)
+
+        return self._Table.Get(self._Index, name)
+
+    def __setattr__(self, name, value):
+        if name in IDocTileData.__slots__ or hasattr(IDocTileData, name):
+            object.__setattr__(self, name, value)
+        else:
+            self._Table.Set(self._Index, name, value)
 
     def __str__(self):
         return self.Image
-    
+
+    def Attributes(self):
+        '''
+        :return: Dictionary of all SerialEM meta-data of the tile
+        '''
+        return self._Table.Attributes(self._Index)
+
+    @property
+    def Image(self):
+        return self._Table.Images[self._Index]
+
+    @Image.setter
+    def Image(self, val):
+        self._Table.Images[self._Index] = val
+
+    def _MinMaxMeanValue(self, i):
+        MinMaxMean = self.MinMaxMean
+        if MinMaxMean is None:
+            return None
+
+        return MinMaxMean[i]
+
     @property
     def Min(self):
-        return self._Min
-    
+        return self._MinMaxMeanValue(0)
+
     @property
     def Max(self):
-        return self._Max
-    
+        if self._Table.HasOverride(self._Index, '_Max'):
+            return self._Table.Get(self._Index, '_Max')
+
+        Max = self._MinMaxMeanValue(1)
+        MaxLimit = self._Table.MaxLimit
+        if MaxLimit is not None and Max is not None and Max > MaxLimit:
+            return MaxLimit
+
+        return Max
+
     @Max.setter
     def Max(self, val):
-        self._Max = val
-    
+        self._Table.Set(self._Index, '_Max', val)
+
     @property
     def Mean(self):
-        return self._Mean
-    
+        return self._MinMaxMeanValue(2)
+
     @property
     def MinMaxMean(self):
-        return self._MinMaxMean
-    
+        return self._Table.Get(self._Index, 'MinMaxMean')
+
     @MinMaxMean.setter
     def MinMaxMean(self, val):
         '''Expects to be set to a three part list with integer or float values'''
-        self._MinMaxMean = val
-        
-        self._Min = val[0]
-        self._Max = val[1]
-        self._Mean = val[2]
-         
+        self._Table.Set(self._Index, 'MinMaxMean', val)
+        self._Table.Set(self._Index, '_Max', val[1])
+
 
 class IDoc():
     '''Class that parses a SerialEM idoc file'''
 
+    # Approximate number of characters read from the idoc at a time
+    ChunkSize = 1 << 20
+
     @property
     def NumTiles(self):
         return len(self.tiles)
-    
+
     @property
     def CameraBpp(self):
         return self._CameraBpp
 
+    @property
+    def tiles(self):
+        return self._Tiles
+
+    @tiles.setter
+    def tiles(self, val):
+        self._Tiles = list(val)
+        self._TileTable = None
+
     def __init__(self):
         self.DataMode = None
         self.PixelSpacing = None
         self.ImageSize = None
-        self.tiles = []
+        self._Tiles = []
+        self._TileTable = None
         self._CameraBpp = None
         pass
-            
+
+    def _SetTileTable(self, table):
+        self._TileTable = table
+        self._Tiles = [IDocTileData(Table=table, Index=i) for i in range(len(table))]
+
+    def _MinMaxMeanColumn(self):
+        '''
+        :return: IDocColumn of the min, max and mean values of all tiles.  None if the tiles must be read individually
+        '''
+        if self._TileTable is None or self._TileTable.HasOverrides:
+            return None
+
+        column = self._TileTable.Columns.get('MinMaxMean', None)
+        if column is None or not column.IsDense or len(column.Positions) != 3:
+            return None
+
+        if any(p.dtype.kind not in 'if' for p in column.Positions):
+            return None
+
+        return column
+
     def _SetCameraBpp(self, bpp):
-        '''Ensure the maximum intensity reported for tiles does not exceed the known capability of the camera'''
+        '''Ensure the maximum intensity reported for tiles does not exceed the known capability of the camera.
+           Like setting Max on each tile, MinMaxMean keeps the value read from the idoc.'''
         self._CameraBpp = bpp
-        
+
         if self._CameraBpp is not None:
             maxPossible = 1 << bpp
+            if self._TileTable is not None:
+                self._TileTable.MaxLimit = maxPossible
+                return
+
             for t in self.tiles:
                 if t.Max > maxPossible:
                     t.Max = maxPossible
 
-    
     def RemoveMissingTiles(self, path):
-        existingTiles = []
-        for t in self.tiles: 
+        existingIndices = []
+        for (i, t) in enumerate(self.tiles):
             tFullPath = os.path.join(path, t.Image)
             if os.path.exists(tFullPath):
-                existingTiles.append(t)
-                
-        self.tiles = existingTiles
+                existingIndices.append(i)
+
+        if self._TileTable is not None:
+            self._SetTileTable(self._TileTable.Take(existingIndices))
+        else:
+            self.tiles = [self.tiles[i] for i in existingIndices]
 
     def GetImageBpp(self):
         ''':return: Bits per pixel if specified in the IDoc, otherwise None'''
@@ -759,13 +1250,24 @@ class IDoc():
         By the time RC2 was collected in March 2012 this bug was fixed
             :return: Max pixel value across all tiles
         '''
-        
+        MinMaxMean = self._MinMaxMeanColumn()
+        if MinMaxMean is not None:
+            maxVal = MinMaxMean.PositionValue(1, int(numpy.argmax(MinMaxMean.Positions[1])))
+            if self._TileTable.MaxLimit is not None and maxVal > self._TileTable.MaxLimit:
+                return self._TileTable.MaxLimit
+
+            return maxVal
+
         return max([t.Max for t in self.tiles])
     
     @property
     def Min(self):
         ''':return: Max pixel value across all tiles'''
-        minVal = min([t.Min for t in self.tiles])
+        MinMaxMean = self._MinMaxMeanColumn()
+        if MinMaxMean is not None:
+            minVal = MinMaxMean.PositionValue(0, int(numpy.argmin(MinMaxMean.Positions[0])))
+        else:
+            minVal = min([t.Min for t in self.tiles])
         
         #Sanity check for a bug in SerialEM
         minVal = max(minVal, 0)
@@ -774,86 +1276,76 @@ class IDoc():
     @property
     def Mean(self):
         ''':return: Max pixel value across all tiles'''
+        MinMaxMean = self._MinMaxMeanColumn()
+        if MinMaxMean is not None:
+            return numpy.mean(MinMaxMean.Positions[2])
+
         return numpy.mean([t.Mean for t in self.tiles])
 
     @classmethod
     def Load(cls, idocfullPath, CameraBpp=None):
         '''
+        Reads the idoc in chunks of lines.  The lines of a chunk are split into attributes and values with numpy string
+        operations and the values of each tile attribute are collected, then converted to one numpy array per attribute
+        once the whole file is read.  Tiles are views of a row in the arrays.
+        
         :param int CameraBpp: Forces the maximum value of tiles to not exceed the known bits-per-pixel capability of the camera, ignored if None
         '''
         assert(os.path.exists(idocfullPath))
 
         with open(idocfullPath, 'r') as hIDoc:
-            idocText = hIDoc.read()
-
             idocObj = IDoc()
 
-            #imageStartIndicies = [m.start for m in re.finditer('\[Image', idocText)]
-            #NumImages = len(imageStartIndicies)
-
-            lines = idocText.split('\n')
-
-            tileObj = None  # Set to the last image name we've read in, if None we are reading montage properties
-
-            for iLine in range(0, len(lines)):
-                line = lines[iLine]
-                line = line.strip()
-                line = line.strip('[]')
-                parts = line.split('=')
-                if(len(parts) <= 1):
-                    continue
-
-                attribute = parts[0].strip()
-                # attribute = attribute.lower()
-
-                # If we find an image tag, create a new tiledata
-                if(attribute == 'Image'):
-                    imageFilename = parts[1].strip()
-                    tileObj = IDocTileData(imageFilename)
-                    idocObj.tiles.append(tileObj)
-                else:
-                    value = None
-                    if(len(parts) > 1):
-                        values = parts[1].split()
-
-                        vTemp = values[0].strip()
-                        if vTemp[0].isdigit() or vTemp[0] == '-':
-
-                            # Find out how many attributes we have.
-                            # Try to convert to ints, then to float
-                            ConvertedValues = []
-                            for v in values:
-                                v = v.strip()
-                                convVal = None
-                                
-                                try:
-                                    convVal = int(v)
-                                except ValueError:
-                                    try:
-                                        convVal = float(v)
-                                    except:
-                                        convVal = v
-                                        pass
-                                    pass
-                                                                    
-                                ConvertedValues.append(convVal)
-                                
-                            values = ConvertedValues
-                            if len(values) == 1:
-                                value = values[0]
-                            else:
-                                value = values
-
-                    if not value is None:
-                        if tileObj is None:
-                            setattr(idocObj, attribute, value)
-                            #idocObj.__dict__[attribute] = value
-                        else:
-                            setattr(tileObj, attribute, value) 
-                            
+            Images = []  # Names of the images we've read in, if empty we are reading montage properties
+            Builders = {}
+
+            while True:
+                lines = hIDoc.readlines(IDoc.ChunkSize)
+                if len(lines) == 0:
+                    break
+
+                lines = numpy.char.strip(numpy.char.strip(numpy.array(lines)), '[]')
+                parts = numpy.char.partition(lines, '=')
+                HasValue = parts[:, 1] == '='
+                attributes = numpy.char.strip(parts[:, 0])
+                values = parts[:, 2]
+                if numpy.any(numpy.char.find(values, '=') >= 0):
+                    values = numpy.char.partition(values, '=')[:, 0]
+
+                # If we find an image tag, start a new tile
+                IsImage = HasValue & (attributes == 'Image')
+                TileIndices = numpy.cumsum(IsImage) + (len(Images) - 1)
+                Images.extend(numpy.char.strip(values[IsImage]).tolist())
+
+                values = numpy.char.strip(values)
+                FirstChar = values.astype('U1')
+                IsNumeric = HasValue & ~IsImage & (numpy.char.isdigit(FirstChar) | (FirstChar == '-'))
+
+                IsMontageProperty = IsNumeric & (TileIndices < 0)
+                for (attribute, value) in zip(attributes[IsMontageProperty].tolist(), values[IsMontageProperty].tolist()):
+                    setattr(idocObj, attribute, _ConvertIDocValues(value.split()))
+
+                IsTileProperty = IsNumeric & (TileIndices >= 0)
+                attributes = attributes[IsTileProperty]
+                values = values[IsTileProperty]
+                TileIndices = TileIndices[IsTileProperty]
+
+                (names, AttributeIndices) = numpy.unique(attributes, return_inverse=True)
+                for (iName, attribute) in enumerate(names.tolist()):
+                    IsAttribute = AttributeIndices == iName
+                    builder = Builders.get(attribute, None)
+                    if builder is None:
+                        builder = IDocColumnBuilder()
+                        Builders[attribute] = builder
+
+                    builder.Add(TileIndices[IsAttribute], values[IsAttribute])
+
+            table = IDocTileTable(Images)
+            for (attribute, builder) in Builders.items():
+                table.Columns[attribute] = builder.Build(len(Images))
+
+            idocObj._SetTileTable(table)
             idocObj._SetCameraBpp(CameraBpp)
             return idocObj
 
         return None
-
-
@@ -5,6 +5,8 @@ Created on Apr 9, 2019
 '''
 
 import sys
+import math
+import multiprocessing
 import re
 import struct
 import enum
@@ -13,6 +15,8 @@ import nornir_buildmanager.templates
 from nornir_buildmanager.VolumeManagerETree import *
 from nornir_buildmanager.operations.tile import VerifyTiles
 import nornir_buildmanager.importers
+import nornir_imageregistration
+import nornir_imageregistration.transforms.factory
 from nornir_imageregistration.files import mosaicfile
 from nornir_imageregistration.mosaic import Mosaic
 from nornir_imageregistration import image_stats
@@ -29,7 +33,6 @@ import numpy
 import nornir_buildmanager.importers.serialemlog as serialemlog
 import nornir_buildmanager.importers.shared as shared
 import nornir_buildmanager.importers.serialem_utils as serialem_utils
-from pyglet.resource import file
 from . import GetFileNameForTileNumber
 
 
@@ -147,7 +150,7 @@ class MRCImport(object):
             (yield channelObj)
 
         (added_tilepyramid, PyramidNodeObj) = filterObj.UpdateOrAddChildByAttrib(TilePyramidNode.Create(Type='stage',
-                                                                            NumberOfTiles=mrcfile.num_tiles),
+                                                                            NumberOfTiles=mrcfile.num_stored_tiles),
                                                                             'Path')
         if added_tilepyramid:
             (yield filterObj)
@@ -174,23 +177,48 @@ class MRCImport(object):
     
     @classmethod
     def ExportImages(cls, mrcfile, output_dir, img_ext, min_max_gamma):
+        '''
+        Export all tiles of the mrc file.  The tiles are divided into a few batches per CPU.  Each task
+        maps the mrc file once and exports its batch of tiles from the map.
+        '''
         
         if isinstance(mrcfile, str):
             mrc_obj = MRCFile.Load(mrcfile)
+        else:
+            mrc_obj = mrcfile
         
         pool = nornir_pools.GetGlobalLocalMachinePool()
         
-        for iTile in range(0, mrc_obj.num_tiles):
-            pool.add_task(str(iTile),
-                              cls.ExportImage,
-                              mrcfile,
+        # Tiles missing from a truncated file are not exported
+        num_tiles = mrc_obj.num_stored_tiles
+        BatchSize = max(1, int(math.ceil(num_tiles / (multiprocessing.cpu_count() * 4.0))))
+        for iStart in range(0, num_tiles, BatchSize):
+            tile_numbers = list(range(iStart, min(iStart + BatchSize, num_tiles)))
+            pool.add_task("{0} tiles {1}-{2}".format(os.path.basename(mrc_obj.filename), tile_numbers[0], tile_numbers[-1]),
+                              cls.ExportImageBatch,
+                              mrc_obj.filename,
                               output_dir,
                               img_ext,
-                              iTile,
+                              tile_numbers,
                               min_max_gamma)
             
             #cls.ExportImage(mrcfile, output_dir, img_ext, iTile, min_max_gamma)
             
+    @classmethod
+    def ExportImageBatch(cls, mrcfile, output_dir, img_ext, tile_numbers, min_max_gamma=None):
+        '''Export the listed tiles of an mrc file
+        :return: Number of tiles written'''
+        
+        if isinstance(mrcfile, str):
+            mrcfile = MRCFile.Load(mrcfile)
+            
+        NumWritten = 0
+        for iTile in tile_numbers:
+            if cls.ExportImage(mrcfile, output_dir, img_ext, iTile, min_max_gamma):
+                NumWritten += 1
+                
+        return NumWritten
+            
     @classmethod
     def ExportImage(cls, mrcfile, output_dir, img_ext, iTile, min_max_gamma=None):
 
@@ -209,12 +237,12 @@ class MRCImport(object):
             #This mess is here because we can't really trust the min/max pixel values reported in the MRC file for a lot of our old data
             #t = mrcfile._repair_out_of_bounds_pixels(iTile, 14)
             img = mrcfile.get_tile_as_numpy(iTile)
-            dt = img.dtype
+            dt = img.dtype.newbyteorder('=')
             img = numpy.transpose(img)
 
-            #Quick correct out of bounds pixels
+            #Quick correct out of bounds pixels.  Converting to float copies the tile out of the memory map.
             outliers = img > min_max_gamma.max
-            img = numpy.copy(img).astype(numpy.float32)
+            img = img.astype(numpy.float32)
             img[outliers] = img[outliers] / 2.0 
             scale = numpy.iinfo(dt).max / min_max_gamma.max
             if min_max_gamma.min > 0:
@@ -255,7 +283,8 @@ class MRCImport(object):
     def CreateMosaic(cls, mrcfile, img_ext):
         mosaic = nornir_imageregistration.Mosaic()
         
-        for (i, t) in enumerate(mrcfile.tile_meta):
+        # Tiles missing from a truncated file are left out of the mosaic
+        for (i, t) in enumerate(mrcfile.tile_meta[0:mrcfile.num_stored_tiles]):
             image_shape = mrcfile.img_shape
             pixel_position = t.pixel_coords
             tile_transform = nornir_imageregistration.transforms.factory.CreateRigidMeshTransform(target_image_shape=image_shape,
@@ -290,7 +319,8 @@ class MRCFile(object):
     
     @classmethod
     def Load(cls, filename):
-        '''Read the header of an MRC file from disk and return an object for access'''
+        '''Read the header of an MRC file from disk and return an object for access.
+           The image data is memory mapped, not read.'''
          
         mrc = open(filename, 'rb');
         
@@ -298,6 +328,7 @@ class MRCFile(object):
         Header = mrc.read(cls.HeaderLength);
         IsBigEndian = cls.IsBigEndian(Header)
         obj = MRCFile(mrc, IsBigEndian)
+        obj.filename = filename
           
         (obj.img_XDim, obj.img_YDim, obj.num_tiles, obj.img_pixel_mode) = struct.unpack(obj.EndianChar + 'IIII', Header[0x00:0x10])
         
@@ -328,12 +359,40 @@ class MRCFile(object):
         (img_origin_x, img_origin_y, img_origin_z,) = struct.unpack(obj.EndianChar + 'fff', Header[0xC4: 0xD0])
         obj.img_origin = numpy.asarray((img_origin_x, img_origin_y, img_origin_z), numpy.float64)
         
-        for i in range(obj.num_tiles):
-            tile_meta = obj.ReadTileMeta(mrc, i)
-            obj.tile_meta.append(tile_meta)
+        obj.tile_meta = obj.ReadTileMeta(mrc)
+        obj.data = obj._map_data()
         
         return obj
     
+    def _map_data(self):
+        '''
+        :return: Read-only numpy.memmap of the image data with shape (num_tiles, img_XDim, img_YDim).
+                 If the file was truncated only the complete tiles are mapped.
+        '''
+        data_offset = MRCFile.HeaderLength + self.extended_header_size
+        dtype = self.pixel_dtype
+        tile_shape = tuple(self.img_shape)
+        tile_length = int(self.img_shape.prod()) * dtype.itemsize
+        
+        file_length = os.fstat(self.mrc.fileno()).st_size
+        num_complete_tiles = max(0, file_length - data_offset) // tile_length
+        num_tiles = min(self.num_tiles, num_complete_tiles)
+        if num_tiles < self.num_tiles:
+            logger = logging.getLogger(__name__ + '.' + 'MRCFile')
+            logger.warning("{0} has data for {1} of {2} tiles".format(self.filename, num_tiles, self.num_tiles))
+            
+        if num_tiles == 0:
+            return numpy.empty((0,) + tile_shape, dtype=dtype)
+        
+        return numpy.memmap(self.mrc, dtype=dtype, mode='r', offset=data_offset, shape=(num_tiles,) + tile_shape)
+    
+    @property
+    def num_stored_tiles(self):
+        '''
+        :return: Number of tiles with pixel data in the file, fewer than num_tiles if the file was truncated
+        '''
+        return len(self.data)
+
     @property
     def EndianChar(self):
         if self.IsBigEndian:
@@ -370,11 +429,11 @@ class MRCFile(object):
         elif(self.img_pixel_mode == 1):
             dtype = numpy.int16
         elif(self.img_pixel_mode == 2):
-            dtype = numpy.float
+            dtype = numpy.float32
         elif(self.img_pixel_mode == 3):
             dtype = numpy.dtype([('real', numpy.uint16), ('i', numpy.uint16)])
         elif(self.img_pixel_mode == 4):
-            dtype = numpy.complex
+            dtype = numpy.complex64
         elif(self.img_pixel_mode == 6):
             dtype = numpy.uint16
         elif(self.img_pixel_mode == 16):
@@ -382,12 +441,8 @@ class MRCFile(object):
         else:
             raise ValueError("Unknown pixel format")
         
-        sys_is_be = sys.byteorder == 'big'
-        if sys_is_be != self.IsBigEndian:
-            # OK, change the byte order of the numpy type
-            dtype = dtype.newbyteorder(self.EndianChar)
-        
-        return dtype
+        # Pixels are read in the byte order of the file
+        return numpy.dtype(dtype).newbyteorder(self.EndianChar)
     
     @property
     def pil_pixel_mode(self):
@@ -441,23 +496,14 @@ class MRCFile(object):
         '''
         Return bytes
         '''
-        image_offset = self._get_image_offset(iTile)
-        
-        self.mrc.seek(image_offset)
-        image_byte_length = self.image_length_in_bytes
-        image_bytes = self.mrc.read(image_byte_length)
-        while len(image_bytes) < image_byte_length:
-            image_bytes = image_bytes + self.mrc.read(image_byte_length - len(image_bytes));
-        
-        return image_bytes
+        return self.data[iTile].tobytes()
     
     def _repair_out_of_bounds_pixels(self, iTile, camera_bpp):
         '''
         Used to repair old mrc files where the maximum pixel values were sometimes incorrect
         :param int camera_bpp: The maximum number of bits that could be encoded by the camera capturing the image
         '''
-        image_bytes = self.get_tile_as_bytes(iTile)
-        img = numpy.frombuffer(image_bytes, dtype=self.pixel_dtype, count=self.img_shape.prod())
+        img = self.data[iTile].reshape(-1)
         max_val = (1 << camera_bpp) - 1 
         outliers = img > max_val
         (iPixels,) = numpy.where(outliers)
@@ -500,11 +546,9 @@ class MRCFile(object):
     
     def get_tile_as_numpy(self, iTile):
         '''
-        Return a numpy array
+        Return a read-only numpy array, a view of the memory mapped file that is not copied into memory until read
         '''
-        image_bytes = self.get_tile_as_bytes(iTile)
-        img = numpy.frombuffer(image_bytes, dtype=self.pixel_dtype, count=self.img_shape.prod()).reshape(self.img_shape)
-        return img
+        return self.data[iTile]
     
     def get_tile_as_image(self, iTile):
         '''
@@ -515,16 +559,25 @@ class MRCFile(object):
         im = im.convert(mode='I')
         return im
           
-    def ReadTileMeta(self, mrc, iTile):
-        mrc.seek(MRCFile.HeaderLength + (iTile * self.tile_header_size))
-        TileHeader = mrc.read(self.tile_header_size) 
-        while len(TileHeader) < self.tile_header_size:
-            TileHeader = TileHeader + mrc.read(self.tile_header_size - len(TileHeader));
-        
-        return MRCTileHeader.Load(iTile, TileHeader,
-                                  tile_flags=self.tile_header_flags,
-                                  nm_per_pixel=self.pixel_spacing[0:2],
-                                  big_endian=self.IsBigEndian)
+    def ReadTileMeta(self, mrc):
+        '''
+        Read the headers of all tiles from the extended header with a single read
+        :return: List of MRCTileHeader
+        '''
+        if self.num_tiles == 0:
+            return []
+        
+        mrc.seek(MRCFile.HeaderLength)
+        TileHeaders = mrc.read(self.num_tiles * self.tile_header_size)
+        if len(TileHeaders) < self.num_tiles * self.tile_header_size:
+            raise ValueError("MRC extended header is shorter than {0} tile headers of {1} bytes".format(self.num_tiles, self.tile_header_size))
+        
+        return MRCTileHeader.LoadAll(TileHeaders,
+                                     num_tiles=self.num_tiles,
+                                     tile_header_size=self.tile_header_size,
+                                     tile_flags=self.tile_header_flags,
+                                     nm_per_pixel=self.pixel_spacing[0:2],
+                                     big_endian=self.IsBigEndian)
          
     @property
     def img_shape(self): 
@@ -532,6 +585,7 @@ class MRCFile(object):
         
     def __init__(self, mrc, isBigEndian=False):
         self.mrc = mrc 
+        self.filename = None
         self.IsBigEndian = isBigEndian  # True for big-endian
         
         self.img_XDim = None
@@ -557,6 +611,8 @@ class MRCFile(object):
         self.tile_header_flags = None
         
         self.tile_meta = []
+        
+        self.data = None  # numpy.memmap of the tiles, indexed by tile number
 
         
 class MRCTileHeaderFlags(enum.IntFlag):
@@ -581,6 +637,77 @@ class MRCTileHeader(object):
     @property
     def pixel_coords(self):
         return self._pixel_coords
+    
+    @staticmethod
+    def HeaderDtype(tile_flags, tile_header_size, big_endian=False):
+        '''
+        :return: Structured numpy dtype of a tile header with the fields present in tile_flags
+        '''
+        Endian = '<'
+        if big_endian:
+            Endian = '>'
+            
+        fields = []
+        if(tile_flags & MRCTileHeaderFlags.TiltAngle):
+            fields.append(('tilt_angle', Endian + 'u2'))
+        if(tile_flags & MRCTileHeaderFlags.PieceCoord):
+            fields.append(('piece_coords', Endian + 'u2', (3,)))
+        if(tile_flags & MRCTileHeaderFlags.StageCoord):
+            fields.append(('stage_coords', Endian + 'u2', (2,)))
+        if(tile_flags & MRCTileHeaderFlags.Magnification):
+            fields.append(('mag', Endian + 'u2'))
+        if(tile_flags & MRCTileHeaderFlags.Intensity):
+            fields.append(('intensity', Endian + 'u2'))
+        if(tile_flags & MRCTileHeaderFlags.Exposure):
+            fields.append(('exposure', Endian + 'f4'))
+            
+        dtype = numpy.dtype(fields)
+        return numpy.dtype({'names': dtype.names,
+                            'formats': [dtype.fields[name][0] for name in dtype.names],
+                            'offsets': [dtype.fields[name][1] for name in dtype.names],
+                            'itemsize': tile_header_size})
+    
+    @staticmethod
+    def LoadAll(headers, num_tiles, tile_header_size, tile_flags, nm_per_pixel, big_endian=False):
+        '''
+        Decode the headers of all tiles at once
+        :param bytes headers: num_tiles tile headers of tile_header_size bytes each
+        :return: List of MRCTileHeader, with the tile number as ID
+        '''
+        records = numpy.frombuffer(headers, dtype=MRCTileHeader.HeaderDtype(tile_flags, tile_header_size, big_endian), count=num_tiles)
+        names = records.dtype.names
+        
+        tilt_angles = records['tilt_angle'].astype(numpy.float64) / 100.0 if 'tilt_angle' in names else None
+        piece_coords = records['piece_coords'].astype(numpy.int64) if 'piece_coords' in names else None
+        stage_coords = None
+        pixel_coords = None
+        if 'stage_coords' in names:
+            stage_coords = records['stage_coords'].astype(numpy.float32) / 25.0
+            pixel_coords = MRCTileHeader.calculate_pixel_coords(stage_coords, nm_per_pixel)
+        mags = records['mag'].astype(numpy.float64) * 100.0 if 'mag' in names else None
+        intensities = records['intensity'].astype(numpy.float64) / 25000.0 if 'intensity' in names else None
+        exposures = records['exposure'].astype(numpy.float64) if 'exposure' in names else None
+        
+        tiles = []
+        for iTile in range(num_tiles):
+            obj = MRCTileHeader(iTile, nm_per_pixel)
+            if tilt_angles is not None:
+                obj.tilt_angle = tilt_angles[iTile].item()
+            if piece_coords is not None:
+                obj.piece_coords = piece_coords[iTile]
+            if stage_coords is not None:
+                obj.stage_coords = stage_coords[iTile]
+                obj._pixel_coords = pixel_coords[iTile]
+            if mags is not None:
+                obj.mag = mags[iTile].item()
+            if intensities is not None:
+                obj.intensity = intensities[iTile].item()
+            if exposures is not None:
+                obj.exposure = exposures[iTile].item()
+                
+            tiles.append(obj)
+            
+        return tiles
          
     @staticmethod
     def Load(tile_id, header, tile_flags, nm_per_pixel, big_endian=False):
@@ -0,0 +1,139 @@
+'''
+Imports the sections of an import directory in parallel.
+
+Importing a section has four steps:
+
+1. Prepare - Read the section's meta-data and choose its contrast settings.  Runs in a worker process.
+2. Apply - Add or update the section's elements in the volume.  Runs in this process.
+3. Convert - Convert the tiles and write the stage mosaic.  Runs in a worker process.
+4. Finish - Update the volume with the results of the conversion.  Runs in this process.
+
+Steps that run in a worker process do not have access to the volume, so only
+this process changes the meta-data.  Every CPU already has a worker, so steps
+pass WorkerPool() to functions that would otherwise start a pool of their own, or call functions that do not take a
+pool with one item at a time when InWorker is set.  Sections are applied in the order they
+were found so the volume is the same as after a serial import.  At most
+MaxInFlight sections are between Prepare and Finish at a time, so reading
+sections does not get far ahead of converting them.
+
+'''
+
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+
+import nornir_pools
+
+from nornir_buildmanager import ChecksumCache
+from nornir_buildmanager import TileHistogram
+
+
+# True in the worker processes started by ImportSections
+InWorker = False
+
+
+def _InitWorker(VolumePath=None):
+    '''Workers start without our caches, so they load the ones saved in the volume directory'''
+    global InWorker
+    InWorker = True
+
+    if VolumePath is not None:
+        ChecksumCache.Load(VolumePath)
+        TileHistogram.Load(VolumePath)
+
+
+def WorkerPool():
+    '''
+    :return: A serial pool in a worker process, None in this process so the caller uses its default pool
+    '''
+    if not InWorker:
+        return None
+
+    return nornir_pools.GetGlobalSerialPool()
+
+
+class _InlineExecutor(object):
+    '''Runs submitted functions immediately, used when there is only one worker'''
+
+    def submit(self, func, *args):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+def _CreateExecutor(MaxWorkers, NumSections, VolumePath=None):
+    if MaxWorkers <= 1 or NumSections <= 1:
+        return _InlineExecutor()
+
+    # Importers create their own pools, so workers must be started fresh rather than forked with our pool threads
+    return concurrent.futures.ProcessPoolExecutor(max_workers=min(MaxWorkers, NumSections), mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_InitWorker, initargs=(VolumePath,))
+
+
+def ImportSections(Sections, Prepare, Apply, Convert, Finish, MaxWorkers=None, MaxInFlight=None, VolumePath=None):
+    '''
+    Generator that imports sections and yields the volume elements that need to be saved.
+
+    :param list Sections: Tuple of arguments to Prepare for each section
+    :param func Prepare: Called in a worker process with a section's arguments.  Must be picklable.
+    :param func Apply: Called with the result of Prepare.  Returns (ConvertArgs, State).  ConvertArgs is a tuple of arguments to Convert, or None if there is nothing to convert.
+    :param func Convert: Called in a worker process with ConvertArgs.  Must be picklable.
+    :param func Finish: Called with State and the result of Convert, or None if Convert was not called.  Returns a list of elements to save.
+    :param int MaxWorkers: Number of worker processes, defaults to the number of CPUs
+    :param int MaxInFlight: Number of sections that may be between Prepare and Finish, defaults to twice the number of workers
+    :param str VolumePath: Volume directory whose saved checksum and tile histogram caches are loaded by the workers
+    '''
+
+    if MaxWorkers is None:
+        MaxWorkers = os.cpu_count()
+
+    MaxWorkers = max(1, int(MaxWorkers))
+
+    if MaxInFlight is None:
+        MaxInFlight = MaxWorkers * 2
+
+    MaxInFlight = max(1, int(MaxInFlight))
+
+    logger = logging.getLogger(__name__ + '.' + 'ImportSections')
+    logger.info("Importing {0} sections with {1} workers".format(len(Sections), MaxWorkers))
+
+    executor = _CreateExecutor(MaxWorkers, len(Sections), VolumePath)
+
+    Preparing = collections.deque()  # Prepare futures in the order the sections were found
+    Converting = {}  # Convert future -> State
+    iNextSection = 0
+
+    try:
+        while iNextSection < len(Sections) or len(Preparing) > 0 or len(Converting) > 0:
+            while iNextSection < len(Sections) and len(Preparing) + len(Converting) < MaxInFlight:
+                Preparing.append(executor.submit(Prepare, *Sections[iNextSection]))
+                iNextSection += 1
+
+            Waiting = list(Converting.keys())
+            if len(Preparing) > 0:
+                Waiting.append(Preparing[0])
+
+            concurrent.futures.wait(Waiting, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in [f for f in Converting.keys() if f.done()]:
+                State = Converting.pop(future)
+                yield from Finish(State, future.result())
+
+            while len(Preparing) > 0 and Preparing[0].done():
+                Prepared = Preparing.popleft().result()
+                (ConvertArgs, State) = Apply(Prepared)
+                if ConvertArgs is None:
+                    yield from Finish(State, None)
+                else:
+                    Converting[executor.submit(Convert, *ConvertArgs)] = State
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -4,18 +4,17 @@ Created on Aug 27, 2013
 @author: u0490822
 '''
 
+import logging
 import os
+import shutil
 import subprocess
 import sys
 
 from nornir_buildmanager import *
 from nornir_buildmanager.VolumeManagerETree import *
 from nornir_buildmanager.validation import transforms
-from nornir_imageregistration.files import mosaicfile
-from nornir_imageregistration.transforms import *
 from nornir_shared import *
 from nornir_shared.files import RemoveOutdatedFile
-from nornir_shared.histogram import Histogram
 from nornir_shared.misc import SortedListFromDelimited
 
 
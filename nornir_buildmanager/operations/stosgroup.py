@@ -10,8 +10,6 @@ import os
 import shutil
 
 from nornir_buildmanager import VolumeManagerETree
-import nornir_imageregistration
-from nornir_imageregistration.files import stosfile
 
 
 def CreateStosGroup(GroupName, BlockNode, Downsample, **kwargs):
@@ -138,6 +136,7 @@ def ImportStos(InputStosFullpath, BlockNode, GroupName,
     # Copy the STOS file into the StosGroup directory
     if(ControlDownsample != MappedDownsample):
         # Adjust the mappedDownsample to match the control downsample
+        from nornir_imageregistration.files import stosfile
         stos = stosfile.StosFile.Load(InputStosFullpath)
         adjustedStos = stos.EqualizeStosGridPixelSpacing(ControlDownsample, MappedDownsample,
                                           MappedFilter.GetOrCreateImage(ControlDownsample).FullPath,
@@ -31,6 +31,13 @@ from nornir_shared.misc import SortedListFromDelimited
 from nornir_imageregistration import tileset_functions
 
 import nornir_buildmanager as nb
+from nornir_buildmanager import ChecksumCache
+from nornir_buildmanager import DirectoryCache
+from nornir_buildmanager import TileHistogram
+from nornir_buildmanager import BoundedPool
+from nornir_buildmanager import PNGEncoder
+from nornir_buildmanager import TileContrast
+from nornir_buildmanager import VolumeDataWriter
 import nornir_imageregistration.spatial as spatial
 import nornir_imageregistration.tileset as tiles
 import nornir_pools
@@ -45,6 +52,86 @@ ContrastMaxCutoffDefault = 0.5
 
 DefaultImageExtension = '.png'
 
+# ImageMagick -evaluate-sequence operators the in-process path supports
+EvaluateSequenceOperators = frozenset(['add', 'max', 'mean', 'median', 'min'])
+
+
+def _IsPNG(ImageFullPath):
+    return os.path.splitext(ImageFullPath)[1].lower() == '.png'
+
+
+def _InterlaceImage(ImageFullPath, InProcessEncoder=True):
+    '''Rewrite an image interlaced.  PNG files are encoded in process unless InProcessEncoder is False or the encoder does
+       not support the image, otherwise ImageMagick is used.'''
+    if InProcessEncoder and _IsPNG(ImageFullPath):
+        try:
+            PNGEncoder.Reencode(ImageFullPath, Interlace=True)
+            return
+        except ValueError as e:
+            prettyoutput.Log("Interlacing %s with ImageMagick: %s" % (ImageFullPath, str(e)))
+
+    ConvertCmd = 'magick convert ' + ImageFullPath + ' -quality 106 -interlace PNG ' + ImageFullPath
+    prettyoutput.Log(ConvertCmd)
+    subprocess.call(ConvertCmd + " && exit", shell=True)
+
+
+def _SaveImage(ImageFullPath, image, bpp=None, Interlace=False, InProcessEncoder=True):
+    '''Save an image, interlaced if requested.  PNG files are encoded once in process unless InProcessEncoder is False or the
+       encoder does not support the image, otherwise the image is saved with nornir_imageregistration and interlaced with
+       ImageMagick.'''
+    if InProcessEncoder and _IsPNG(ImageFullPath):
+        try:
+            PNGEncoder.Save(ImageFullPath, image, bpp=bpp, Interlace=Interlace)
+            return
+        except ValueError as e:
+            prettyoutput.Log("Saving %s with nornir_imageregistration: %s" % (ImageFullPath, str(e)))
+
+    nornir_imageregistration.SaveImage(ImageFullPath, image, bpp=bpp)
+
+    if Interlace:
+        _InterlaceImage(ImageFullPath, InProcessEncoder=False)
+
+
+def EvaluateSequence(ImageFullPaths, Operator):
+    '''
+    Combine images pixel by pixel as ImageMagick's -evaluate-sequence does.  Images other than the median are combined
+    one at a time so only one image is read into memory at once.
+    :param str Operator: One of EvaluateSequenceOperators
+    :return: Combined image with the type of the first image
+    '''
+    Operator = Operator.lower()
+    if Operator not in EvaluateSequenceOperators:
+        raise ValueError("Unsupported evaluate sequence operator %s" % Operator)
+
+    if len(ImageFullPaths) == 0:
+        raise ValueError("No images to evaluate")
+
+    Images = (PNGEncoder.ReadPixels(fullpath) for fullpath in ImageFullPaths)
+    if Operator == 'median':
+        Stack = numpy.stack(list(Images))
+        return numpy.rint(numpy.median(Stack, axis=0)).astype(Stack.dtype)
+
+    First = next(Images)
+    if Operator in ('min', 'max'):
+        Combine = numpy.minimum if Operator == 'min' else numpy.maximum
+        result = First.copy()
+        for pixels in Images:
+            Combine(result, pixels, out=result)
+
+        return result
+
+    total = First.astype(numpy.float64)
+    for pixels in Images:
+        total += pixels
+
+    if Operator == 'mean':
+        total /= len(ImageFullPaths)
+
+    if First.dtype == numpy.bool_:
+        return total >= 0.5
+
+    return numpy.clip(numpy.rint(total), 0, numpy.iinfo(First.dtype).max).astype(First.dtype)
+
 
 def VerifyImages(TilePyramidNode, **kwargs):
     '''Eliminate any image files which cannot be parsed by Image Magick's identify command'''
@@ -86,7 +173,7 @@ def VerifyTiles(LevelNode=None, **kwargs):
     TileExt = InputPyramidNode.attrib.get('ImageFormatExt', '.png')
 
     TileImageDir = InputLevelNode.FullPath
-    LevelFiles = glob.glob(os.path.join(TileImageDir, '*' + TileExt))
+    LevelFiles = DirectoryCache.Glob(TileImageDir, '*' + TileExt)
 
     if(len(LevelFiles) == 0):
         logger.info('No tiles found in level')
@@ -107,6 +194,8 @@ def VerifyTiles(LevelNode=None, **kwargs):
 
     if len(InvalidTiles) == 0:
         logger.info('Tiles all valid')
+    else:
+        DirectoryCache.Invalidate(TileImageDir)
 
     InputLevelNode.TilesValidated = len(LevelFiles) - len(InvalidTiles)
 
@@ -208,7 +297,9 @@ def FilterIsPopulated(InputFilterNode, Downsample, MosaicFullPath, OutputFilterN
 #         CmdLineFileList = ""
 
 
-def Evaluate(Parameters, FilterNode, OutputImageName=None, Level=1, PreEvaluateSequenceArg=None, EvaluateSequenceArg=None, PostEvaluateSequenceArg=None, **kwargs):
+def Evaluate(Parameters, FilterNode, OutputImageName=None, Level=1, PreEvaluateSequenceArg=None, EvaluateSequenceArg=None, PostEvaluateSequenceArg=None, InProcessEncoder=True, **kwargs):
+    ''':param bool InProcessEncoder: Combine the tiles in process when no ImageMagick arguments are needed before the
+                                  evaluate-sequence operator, otherwise use ImageMagick'''
     PyramidNode = FilterNode.find('TilePyramid')
     assert(not PyramidNode is None)
     levelNode = PyramidNode.GetChildByAttrib('Level', 'Downsample', Level)
@@ -245,17 +336,27 @@ def Evaluate(Parameters, FilterNode, OutputImageName=None, Level=1, PreEvaluateS
 
     TileFullPath = os.path.join(levelNode.FullPath, '*' + PyramidNode.ImageFormatExt)
 
-    Cmd = CmdTemplate % {'Images' : TileFullPath,
-                             'PreEvaluateSequenceArg' : PreEvaluateSequenceArg,
-                             'EvaluateSequenceArg' :  EvaluateSequenceArg,
-                             'OutputFile' : PreFinalTargetFullPath}
+    Evaluated = False
+    if InProcessEncoder and len(PreEvaluateSequenceArg.strip()) == 0 and EvaluateSequenceArg.lower() in EvaluateSequenceOperators and _IsPNG(PreFinalTargetFullPath):
+        try:
+            Combined = EvaluateSequence(sorted(glob.glob(TileFullPath)), EvaluateSequenceArg)
+            PNGEncoder.Save(PreFinalTargetFullPath, Combined, Interlace=False)
+            Evaluated = True
+        except ValueError as e:
+            prettyoutput.Log("Evaluating %s with ImageMagick: %s" % (TileFullPath, str(e)))
+
+    if not Evaluated:
+        Cmd = CmdTemplate % {'Images' : TileFullPath,
+                                 'PreEvaluateSequenceArg' : PreEvaluateSequenceArg,
+                                 'EvaluateSequenceArg' :  EvaluateSequenceArg,
+                                 'OutputFile' : PreFinalTargetFullPath}
 
-    prettyoutput.Log(Cmd)
-    subprocess.call(Cmd + " && exit", shell=True)
+        prettyoutput.Log(Cmd)
+        subprocess.call(Cmd + " && exit", shell=True)
 
     if not PostEvaluateSequenceArg is None:
         PostCmd = 'convert ' + PreFinalTargetFullPath + ' ' + PostEvaluateSequenceArg + ' ' + OutputImageNode.FullPath
-        prettyoutput.Log(Cmd)
+        prettyoutput.Log(PostCmd)
         proc = subprocess.call(PostCmd + " && exit", shell=True)
         os.remove(PreFinalTargetFullPath)
     else:
@@ -583,9 +684,56 @@ def _ClearInvalidHistogramElements(filterObj, checksum):
     return (HistogramElementRemoved, HistogramElement)
 
 
-def AutolevelTiles(Parameters, InputFilter, Downsample=1, TransformNode=None, OutputFilterName=None, **kwargs):
+# Name of the Data node on an output filter listing the checksums of the input tiles it was built from
+InputTileChecksumsName = 'InputTileChecksums'
+
+
+def _GetInputTileChecksumsNode(FilterNode, Downsample, Create=False):
+    for DataNode in FilterNode.findall('Data'):
+        if DataNode.get('Name', None) == InputTileChecksumsName and float(DataNode.get('Downsample', 0)) == float(Downsample):
+            return DataNode
+
+    if not Create:
+        return None
+
+    DataNode = nb.VolumeManager.DataNode.Create(Path='%s_%d.txt' % (InputTileChecksumsName, Downsample),
+                                                attrib={'Name': InputTileChecksumsName, 'Downsample': '%g' % Downsample})
+    [added, DataNode] = FilterNode.UpdateOrAddChildByAttrib(DataNode, 'Path')
+    return DataNode
+
+
+def LoadInputTileChecksums(FilterNode, Downsample):
+    '''
+    :return: Dictionary of tile filename -> checksum of the input tile the filter's tile was built from, None if no
+             checksums were recorded
+    '''
+    DataNode = _GetInputTileChecksumsNode(FilterNode, Downsample)
+    if DataNode is None or not os.path.exists(DataNode.FullPath):
+        return None
+
+    checksums = {}
+    with open(DataNode.FullPath, 'r') as hFile:
+        for line in hFile:
+            parts = line.split()
+            if len(parts) == 2:
+                checksums[parts[0]] = parts[1]
+
+    return checksums
+
+
+def SaveInputTileChecksums(FilterNode, Downsample, checksums):
+    '''Record the checksums of the input tiles the filter's tiles were built from'''
+    DataNode = _GetInputTileChecksumsNode(FilterNode, Downsample, Create=True)
+    lines = ["%s %s\n" % (filename, checksums[filename]) for filename in sorted(checksums)]
+    VolumeDataWriter.AtomicWrite(DataNode.FullPath, ''.join(lines).encode('utf-8'))
+    DataNode.attrib.pop('Checksum', None)
+
+
+def AutolevelTiles(Parameters, InputFilter, Downsample=1, TransformNode=None, OutputFilterName=None, Incremental=True, **kwargs):
     '''Create a new filter using the histogram of the input filter
-       @ChannelNode'''
+       @ChannelNode
+       :param bool Incremental: Only convert tiles whose input checksum differs from the checksum recorded on the output
+                                filter when the tile was last converted'''
 
     [added_level, InputLevelNode] = InputFilter.TilePyramid.GetOrCreateLevel(Downsample)
     InputTransformNode = TransformNode
@@ -686,6 +834,13 @@ def AutolevelTiles(Parameters, InputFilter, Downsample=1, TransformNode=None, Ou
     except OSError:
         if not os.path.isdir(OutputImageDir):
             raise
+
+    RecordedChecksums = None
+    if Incremental and not EntireTilePyramidNeedsBuilding:
+        RecordedChecksums = LoadInputTileChecksums(OutputFilterNode, InputLevelNode.Downsample)
+
+    # Checksums of the inputs of the tiles that are not rebuilt
+    InputChecksums = {}
         
     for tile in ImageFiles:
         InputTile = os.path.join(InputImagePath, tile)
@@ -694,9 +849,23 @@ def AutolevelTiles(Parameters, InputFilter, Downsample=1, TransformNode=None, Ou
             continue
         else:
             PredictedOutput = os.path.join(OutputImageDir, os.path.basename(tile))
-            RemoveOutdatedFile(InputTile, PredictedOutput)
-            if not os.path.exists(PredictedOutput):
+            RecordedChecksum = None if RecordedChecksums is None else RecordedChecksums.get(os.path.basename(tile), None)
+            if not DirectoryCache.Exists(PredictedOutput):
+                TilesToBuild.append(InputTile)
+            elif RecordedChecksum is not None:
+                # A tile whose input was copied or touched but not changed does not need converting
+                if TileContrast.FileChecksum(InputTile) != RecordedChecksum:
+                    TilesToBuild.append(InputTile)
+                else:
+                    TileContrast.Stats.Unchanged += 1
+                    InputChecksums[os.path.basename(tile)] = RecordedChecksum
+            elif DirectoryCache.OutdatedFile(InputTile, PredictedOutput):
+                RemoveOutdatedFile(InputTile, PredictedOutput)
                 TilesToBuild.append(InputTile)
+            else:
+                checksum = ChecksumCache.TryGet(InputTile, TileContrast.ChecksumKind)
+                if checksum is not None:
+                    InputChecksums[os.path.basename(tile)] = checksum
 
     #Pool = None
     #if len(TilesToBuild) > 0:
@@ -723,11 +892,19 @@ def AutolevelTiles(Parameters, InputFilter, Downsample=1, TransformNode=None, Ou
         
         TilesToConvert[InputImageFullPath] = ImageSaveFilename
     
-    nornir_imageregistration.ConvertImagesInDict(TilesToConvert,
-                                                 MinMax=(MinIntensityCutoff16bpp, MaxIntensityCutoff16bpp),
-                                                 Gamma=Gamma,
-                                                 InputBpp=InputFilter.BitsPerPixel,
-                                                 OutputBpp=OutputBpp)
+    # One lookup table converts every tile of the filter
+    Converted = TileContrast.ConvertTilesInDict(TilesToConvert,
+                                                MinMax=(MinIntensityCutoff16bpp, MaxIntensityCutoff16bpp),
+                                                Gamma=Gamma,
+                                                InputBpp=InputFilter.BitsPerPixel,
+                                                OutputBpp=OutputBpp)
+    DirectoryCache.Invalidate(OutputImageDir)
+
+    if len(Converted) > 0 or RecordedChecksums is None:
+        for (InputImageFullPath, checksum) in Converted.items():
+            InputChecksums[os.path.basename(InputImageFullPath)] = checksum
+
+        SaveInputTileChecksums(OutputFilterNode, InputLevelNode.Downsample, InputChecksums)
 #     
 # #         cmd = 'convert \"' + InputImageFullPath + '\" ' + \
 # #                '-level ' + str(MinIntensityCutoff16bpp) + \
@@ -819,9 +996,11 @@ def InvertFilter(Parameters, InputFilterNode, OutputFilterName, **kwargs):
     return 
 
 
-def HistogramFilter(Parameters, FilterNode, Downsample, TransformNode, **kwargs):
+def HistogramFilter(Parameters, FilterNode, Downsample, TransformNode, SampleFraction=None, Stride=None, **kwargs):
     '''Construct the intensity histogram for a filter
-       @FilterNode'''
+       @FilterNode
+       :param float SampleFraction: Fraction of tiles read, all tiles are read if None
+       :param int Stride: Count every Nth pixel of every Nth row of a tile, all pixels are counted if None'''
     NodeToSave = None
 
     [added_level, LevelNode] = FilterNode.TilePyramid.GetOrCreateLevel(Downsample)
@@ -874,6 +1053,13 @@ def HistogramFilter(Parameters, FilterNode, Downsample, TransformNode, **kwargs)
     if(NumBins > 2048):
         NumBins = 2048
 
+    # Rebuild the histogram if it was sampled differently
+    Sampled = SampleFraction is not None or Stride is not None
+    Sampling = {'SampleFraction': str(SampleFraction), 'Stride': str(Stride)} if Sampled else {}
+    if any(HistogramElement.attrib.get(k, None) != Sampling.get(k, None) for k in ('SampleFraction', 'Stride')):
+        if os.path.exists(DataNode.FullPath):
+            os.remove(DataNode.FullPath)
+
     ImageCreated = False
     if not os.path.exists(DataNode.FullPath):
         mosaic = mosaicfile.MosaicFile.Load(InputMosaicFullPath)
@@ -883,7 +1069,18 @@ def HistogramFilter(Parameters, FilterNode, Downsample, TransformNode, **kwargs)
         for k in list(mosaic.ImageToTransformString.keys()):
             fulltilepaths.append(os.path.join(FullTilePath, k))
 
-        histogramObj = nornir_imageregistration.Histogram(fulltilepaths, Bpp=Bpp, numBins=NumBins)
+        for k in ('SampleFraction', 'Stride', 'ErrorBound'):
+            if k in HistogramElement.attrib:
+                del HistogramElement.attrib[k]
+
+        if Sampled:
+            accumulator = TileHistogram.Build(fulltilepaths, MinVal=0, MaxVal=(1 << Bpp) - 1, NumBins=NumBins, SampleFraction=SampleFraction, Stride=Stride)
+            histogramObj = accumulator.ToHistogram()
+            HistogramElement.attrib.update(Sampling)
+            HistogramElement.attrib['ErrorBound'] = '%g' % accumulator.ErrorBound()
+        else:
+            histogramObj = nornir_imageregistration.Histogram(fulltilepaths, Bpp=Bpp, numBins=NumBins)
+
         histogramObj.Save(DataNode.FullPath)
 
         # Create a data node for the histogram
@@ -982,9 +1179,9 @@ def GenerateHistogramImage(HistogramElement, MinValue, MaxValue, Gamma, LineColo
         return None
 
 
-def AssembleTransform(Parameters, Logger, FilterNode, TransformNode, OutputChannelPrefix=None, UseCluster=True, ThumbnailSize=256, Interlace=True, CropBox=None, **kwargs):
+def AssembleTransform(Parameters, Logger, FilterNode, TransformNode, OutputChannelPrefix=None, UseCluster=True, ThumbnailSize=256, Interlace=True, CropBox=None, InProcessEncoder=True, **kwargs):
 
-    for yieldval in AssembleTransformScipy(Parameters, Logger, FilterNode, TransformNode, OutputChannelPrefix, UseCluster, ThumbnailSize, Interlace, CropBox=CropBox, **kwargs):
+    for yieldval in AssembleTransformScipy(Parameters, Logger, FilterNode, TransformNode, OutputChannelPrefix, UseCluster, ThumbnailSize, Interlace, CropBox=CropBox, InProcessEncoder=InProcessEncoder, **kwargs):
         yield yieldval
 
 
@@ -1081,8 +1278,9 @@ def VerifyAssembledImagePathIsCorrect(Parameters, Logger, FilterNode, extension=
             yield imageSet
     
         
-def AssembleTransformScipy(Parameters, Logger, FilterNode, TransformNode, OutputChannelPrefix=None, UseCluster=True, ThumbnailSize=256, Interlace=True, CropBox=None, **kwargs):
-    '''@ChannelNode - TransformNode lives under ChannelNode'''
+def AssembleTransformScipy(Parameters, Logger, FilterNode, TransformNode, OutputChannelPrefix=None, UseCluster=True, ThumbnailSize=256, Interlace=True, CropBox=None, InProcessEncoder=True, **kwargs):
+    '''@ChannelNode - TransformNode lives under ChannelNode
+       :param bool InProcessEncoder: Encode PNG images in process instead of interlacing them with ImageMagick'''
     
     if not CropBox is None:
         RequestedBoundingBox = [CropBox[1], CropBox[0], CropBox[3], CropBox[2]]
@@ -1188,15 +1386,10 @@ def AssembleTransformScipy(Parameters, Logger, FilterNode, TransformNode, Output
             mosaicImage = nornir_imageregistration.CropImage(mosaicImage, Xo, Yo, Width, Height)
             maskImage = nornir_imageregistration.CropImage(maskImage, Xo, Yo, Width, Height)
 
-        nornir_imageregistration.SaveImage(tempOutputFullPath, mosaicImage, bpp=OutputFilterNode.BitsPerPixel)
+        # Interlaced images are encoded once in process, ImageMagick is only run if the in-process encoder is disabled
+        _SaveImage(tempOutputFullPath, mosaicImage, bpp=OutputFilterNode.BitsPerPixel, Interlace=Interlace, InProcessEncoder=InProcessEncoder)
         nornir_imageregistration.SaveImage(tempMaskOutputFullPath, maskImage)
 
-        # Run convert on the output to make sure it is interlaced
-        if(Interlace):
-            ConvertCmd = 'magick convert ' + tempOutputFullPath + ' -quality 106 -interlace PNG ' + tempOutputFullPath
-            Logger.warn("Interlacing assembled image")
-            subprocess.call(ConvertCmd + " && exit", shell=True)
-
         shutil.move(tempOutputFullPath, ImageNode.FullPath)
         shutil.move(tempMaskOutputFullPath, MaskImageNode.FullPath)
 
@@ -1208,16 +1401,16 @@ def AssembleTransformScipy(Parameters, Logger, FilterNode, TransformNode, Output
         yield OutputFilterNode
         yield OutputMaskFilterNode
 
-    ImageSet = BuildImagePyramid(OutputFilterNode.Imageset, Interlace=Interlace, **kwargs)
+    ImageSet = BuildImagePyramid(OutputFilterNode.Imageset, Interlace=Interlace, InProcessEncoder=InProcessEncoder, **kwargs)
     if not ImageSet is None:
         yield ImageSet 
         
-    MaskImageSet = BuildImagePyramid(OutputMaskFilterNode.Imageset, Interlace=Interlace, **kwargs)
+    MaskImageSet = BuildImagePyramid(OutputMaskFilterNode.Imageset, Interlace=Interlace, InProcessEncoder=InProcessEncoder, **kwargs)
     if not MaskImageSet is None:
         yield MaskImageSet
  
 
-def AssembleTransformIrTools(Parameters, Logger, FilterNode, TransformNode, ThumbnailSize=256, Interlace=True, **kwargs):
+def AssembleTransformIrTools(Parameters, Logger, FilterNode, TransformNode, ThumbnailSize=256, Interlace=True, InProcessEncoder=True, **kwargs):
     '''Assemble a transform using the ir-tools
        @ChannelNode - TransformNode lives under ChannelNode
        '''
@@ -1310,10 +1503,9 @@ def AssembleTransformIrTools(Parameters, Logger, FilterNode, TransformNode, Thum
             # subprocess.call(maskcmd + " && exit", shell=True)
 
         # Run convert on the output to make sure it is interlaced
-        if(Interlace):
-            ConvertCmd = 'magick convert ' + tempOutputFullPath + ' -quality 106 -interlace PNG ' + tempOutputFullPath
+        if Interlace and os.path.exists(tempOutputFullPath):
             Logger.warn("Interlacing assembled image")
-            subprocess.call(ConvertCmd + " && exit", shell=True)
+            _InterlaceImage(tempOutputFullPath, InProcessEncoder=InProcessEncoder)
 
         if os.path.exists(tempOutputFullPath):
             shutil.move(tempOutputFullPath, ImageNode.FullPath)
@@ -1326,7 +1518,7 @@ def AssembleTransformIrTools(Parameters, Logger, FilterNode, TransformNode, Thum
     
     yield FilterNode
 
-    ImageSet = BuildImagePyramid(FilterNode.Imageset, Logger, **kwargs)
+    ImageSet = BuildImagePyramid(FilterNode.Imageset, Logger, InProcessEncoder=InProcessEncoder, **kwargs)
     if not ImageSet is None:
         yield ImageSet 
         
@@ -1419,10 +1611,12 @@ def _SaveImageAndCopy(ImageFullPath, temp_output_tile_fullpath, tile_image, bpp,
     shutil.copyfile(temp_output_tile_fullpath, ImageFullPath)
     return
 
-def AssembleTilesetNumpy(Parameters, FilterNode, PyramidNode, TransformNode, TileShape, TileSetName=None, max_temp_image_area=None, Logger=None, **kwargs):
+def AssembleTilesetNumpy(Parameters, FilterNode, PyramidNode, TransformNode, TileShape, TileSetName=None, max_temp_image_area=None, Logger=None, MaxTilesInFlight=None, MaxBytesInFlight=None, **kwargs):
     '''Create full resolution tiles of specfied size for the mosaics
        @FilterNode
-       @TransformNode'''
+       @TransformNode
+       :param int MaxTilesInFlight: Largest number of assembled tiles waiting to be saved
+       :param int MaxBytesInFlight: Largest number of bytes of assembled tiles waiting to be saved'''
     prettyoutput.CurseString('Stage', "Assemble Tile Pyramids")   
 
     TileWidth = TileShape[0]
@@ -1484,7 +1678,9 @@ def AssembleTilesetNumpy(Parameters, FilterNode, PyramidNode, TransformNode, Til
         #OutputXML = os.path.join(LevelOne.FullPath, FilterNode.Name + '.xml')
         
         #pool = nornir_pools.GetGlobalThreadPool()
-        pool = nornir_pools.GetThreadPool("IOPool", num_threads=multiprocessing.cpu_count() * 2)
+        # Tiles are generated faster than they are saved, stop generating while too many assembled tiles are waiting
+        pool = BoundedPool.BoundedPool(nornir_pools.GetThreadPool("IOPool", num_threads=multiprocessing.cpu_count() * 2),
+                                       MaxTasks=MaxTilesInFlight, MaxBytes=MaxBytesInFlight)
         
         mosaic = nornir_imageregistration.Mosaic.LoadFromMosaicFile(InputTransformNode.FullPath)
         expected_scale = 1.0 / LevelOne.Downsample
@@ -1512,10 +1708,11 @@ def AssembleTilesetNumpy(Parameters, FilterNode, PyramidNode, TransformNode, Til
             output_tile_fullpath = os.path.join(LevelOne.FullPath, tilename)
             #pool.add_task(tilename, nornir_imageregistration.SaveImage, ImageFullPath=temp_output_tile_fullpath, image=tile_image, bpp=bpp, optimize=True)
 
-            pool.add_task(tilename, _SaveImageAndCopy, ImageFullPath=output_tile_fullpath, temp_output_tile_fullpath=temp_output_tile_fullpath,  tile_image=tile_image, bpp=bpp, optimize=True)
+            pool.add_sized_task(tilename, tile_image.nbytes, _SaveImageAndCopy, ImageFullPath=output_tile_fullpath, temp_output_tile_fullpath=temp_output_tile_fullpath,  tile_image=tile_image, bpp=bpp, optimize=True)
         
         #Wait for the tiles to save
         pool.wait_completion()
+        DirectoryCache.Invalidate(LevelOne.FullPath)
         prettyoutput.Log("Generation of tileset complete")
 #         else:
 #             Logger.info("Assemble tiles output already exists")
@@ -1531,8 +1728,34 @@ def AssembleTilesetNumpy(Parameters, FilterNode, PyramidNode, TransformNode, Til
     return FilterNode
 
 
-def BuildImagePyramid(ImageSetNode, Levels=None, Interlace=True, **kwargs):
-    '''@ImageSetNode'''
+def _ShrinkImageInProcess(inputFile, outputFile, ShrinkFactor, Interlace):
+    '''
+    Shrink a PNG image and encode it once in process.  1 bit images such as masks are averaged as 8 bit images and
+    thresholded back to 1 bit.
+    :return: False if the images are not PNG files or the encoder does not support the image
+    '''
+    if not (_IsPNG(inputFile) and _IsPNG(outputFile)):
+        return False
+
+    try:
+        pixels = PNGEncoder.ReadPixels(inputFile)
+        if pixels.dtype == numpy.bool_:
+            pixels = ShrinkPixels(pixels.astype(numpy.uint8) * numpy.uint8(255), ShrinkFactor) >= 128
+        else:
+            pixels = ShrinkPixels(pixels, ShrinkFactor)
+
+        PNGEncoder.Save(outputFile, pixels, Interlace=Interlace)
+    except ValueError as e:
+        prettyoutput.Log("Shrinking %s with nornir_imageregistration: %s" % (inputFile, str(e)))
+        return False
+
+    return True
+
+
+def BuildImagePyramid(ImageSetNode, Levels=None, Interlace=True, InProcessEncoder=True, **kwargs):
+    '''@ImageSetNode
+       :param bool InProcessEncoder: Shrink and encode PNG images in process instead of using nornir_imageregistration.Shrink
+                                  and interlacing with ImageMagick'''
 
     PyramidLevels = _SortedNumberListFromLevelsParameter(Levels)
 
@@ -1585,7 +1808,13 @@ def BuildImagePyramid(ImageSetNode, Levels=None, Interlace=True, **kwargs):
 
         if buildLevel:
             scale = SourceLevel / thisLevel 
-            nornir_imageregistration.Shrink(SourceImageNode.FullPath, TargetImageNode.FullPath, scale)
+            if not (InProcessEncoder and _ShrinkImageInProcess(SourceImageNode.FullPath, TargetImageNode.FullPath, thisLevel / SourceLevel, Interlace)):
+                nornir_imageregistration.Shrink(SourceImageNode.FullPath, TargetImageNode.FullPath, scale)
+
+                if(Interlace):
+                    Logger.info('Interlacing start ' + TargetImageNode.FullPath)
+                    _InterlaceImage(TargetImageNode.FullPath, InProcessEncoder=False)
+
             SaveImageSet = True
 
             if 'InputImageChecksum' in SourceImageNode.attrib:
@@ -1593,12 +1822,6 @@ def BuildImagePyramid(ImageSetNode, Levels=None, Interlace=True, **kwargs):
 
             Logger.info('Shrunk ' + TargetImageNode.FullPath)
 
-            if(Interlace):
-                ConvertCmd = 'magick convert ' + TargetImageNode.FullPath + ' -quality 106 -interlace PNG ' + TargetImageNode.FullPath
-                Logger.info('Interlacing start ' + TargetImageNode.FullPath)
-                prettyoutput.Log(ConvertCmd)
-                subprocess.call(ConvertCmd + " && exit", shell=True)
-
             # TargetImageNode.Checksum = nornir_shared.Checksum.FilesizeChecksum(TargetImageNode.FullPath)
 
     if SaveImageSet:
@@ -1609,15 +1832,14 @@ def BuildImagePyramid(ImageSetNode, Levels=None, Interlace=True, **kwargs):
 
 def BuildTilePyramids(PyramidNode=None, Levels=None, **kwargs):
     ''' @PyramidNode
-        Build the image pyramid for the specified path.  We expect the "001" level of the pyramid to be pre-populated'''
+        Build the image pyramid for the specified path.  We expect the "001" level of the pyramid to be pre-populated.
+        Each tile of the most detailed level is read once and every requested level is produced from it in memory.'''
     prettyoutput.CurseString('Stage', "BuildPyramids")
 
     SavePyramidNode = False
 
     PyramidLevels = _SortedNumberListFromLevelsParameter(Levels) 
 
-    Pool = None
-
     if(PyramidNode is None):
         prettyoutput.LogErr("No volume element available for BuildTilePyramids")
         return
@@ -1632,124 +1854,223 @@ def BuildTilePyramids(PyramidNode=None, Levels=None, **kwargs):
     
     # Ensure each level is unique
     PyramidLevels = sorted(frozenset(PyramidLevels))
+    
+    GlobPattern = "*" + PyramidNode.ImageFormatExt
 
+    LevelTileDirs = []
+    for level in PyramidLevels:
+        LevelNode = nb.VolumeManager.LevelNode.Create(level)
+        [LevelNodeCreated, LevelNode] = PyramidNode.UpdateOrAddChildByAttrib(LevelNode, "Downsample")
+        if LevelNodeCreated:
+            SavePyramidNode = True
+            
+        LevelTileDirs.append(os.path.join(InputPyramidFullPath, LevelFormatStr % level))
+
+    InputTileDir = LevelTileDirs[0]
+    SourceFiles = DirectoryCache.Glob(InputTileDir, GlobPattern)
+    if len(SourceFiles) == 0 or len(PyramidLevels) < 2:
+        if SavePyramidNode:
+            return PyramidNode
+        return None
+    
+    # The tiles of each level that already exist, None if the level is complete
+    LevelDestFiles = [None]
     for i in range(1, len(PyramidLevels)):
+        OutputTileDir = LevelTileDirs[i]
+        os.makedirs(OutputTileDir, exist_ok=True)
 
-        LevelHeaderPrinted = False
+        # Simply a speedup so we aren't constantly hitting the server with exist requests for populated directories
+        DestFiles = DirectoryCache.Glob(OutputTileDir, GlobPattern)
+        UpLevelFiles = DirectoryCache.Glob(LevelTileDirs[i - 1], GlobPattern) 
+        if(len(DestFiles) == PyramidNode.NumberOfTiles and
+           len(UpLevelFiles) == len(DestFiles) and
+           not OutdatedFile(UpLevelFiles[0], DestFiles[0])):
+            LevelDestFiles.append(None)
+        else:
+            LevelDestFiles.append(frozenset([os.path.basename(x) for x in DestFiles]))
 
-        upLevel = PyramidLevels[i - 1]
-        thisLevel = PyramidLevels[i]
+    if all(DestFiles is None for DestFiles in LevelDestFiles[1:]):
+        if SavePyramidNode:
+            return PyramidNode
+        return None
 
-        upLevelPathStr = LevelFormatStr % upLevel
-        thisLevePathlStr = LevelFormatStr % thisLevel
+    # Shrink factor from the previous level to each level
+    ShrinkFactors = [float(PyramidLevels[i]) / float(PyramidLevels[i - 1]) for i in range(1, len(PyramidLevels))]
 
-        shrinkFactor = float(upLevel) / float(thisLevel) 
+    Tiles = []
+    for f in SourceFiles:
+        filename = os.path.basename(f)
+        inputFile = os.path.join(InputTileDir, filename)
 
-        upLevelNode = nb.VolumeManager.LevelNode.Create(upLevel)
-        [LevelNodeCreated, upLevelNode] = PyramidNode.UpdateOrAddChildByAttrib(upLevelNode, "Downsample")
-        if LevelNodeCreated:
-            SavePyramidNode = True
+        # Don't process if the input is temp file
+        InputSize = DirectoryCache.GetSize(inputFile)
+        if InputSize is None or InputSize <= 0:
+            continue
 
-        thisLevelNode = nb.VolumeManager.LevelNode.Create(thisLevel)
-        [LevelNodeCreated, thisLevelNode] = PyramidNode.UpdateOrAddChildByAttrib(thisLevelNode, "Downsample")
-        if LevelNodeCreated:
-            SavePyramidNode = True
+        OutputFiles = []
+        for i in range(1, len(PyramidLevels)):
+            outputFile = os.path.join(LevelTileDirs[i], filename)
+            OutputFiles.append(outputFile if _PyramidTileRequired(LevelDestFiles[i], os.path.join(LevelTileDirs[i - 1], filename), outputFile) else None)
 
-        InputTileDir = os.path.join(InputPyramidFullPath, upLevelPathStr)
-        OutputTileDir = os.path.join(InputPyramidFullPath, thisLevePathlStr)
+        # Levels past the last missing tile do not need to be calculated
+        while len(OutputFiles) > 0 and OutputFiles[-1] is None:
+            OutputFiles.pop()
 
-        InputGlobPattern = os.path.join(InputTileDir, "*" + PyramidNode.ImageFormatExt)
-        OutputGlobPattern = os.path.join(OutputTileDir, "*" + PyramidNode.ImageFormatExt)
+        if len(OutputFiles) > 0:
+            Tiles.append((inputFile, list(zip(ShrinkFactors, OutputFiles))))
 
-        SourceFiles = glob.glob(InputGlobPattern)
+    if len(Tiles) > 0:
+        Pool = nornir_pools.GetGlobalLocalMachinePool()
 
+        BatchSize = max(1, int(math.ceil(len(Tiles) / (multiprocessing.cpu_count() * 4.0))))
+        BatchSize = min(BatchSize, PyramidTileBatchSize)
         taskList = []
+        for iStart in range(0, len(Tiles), BatchSize):
+            batch = Tiles[iStart:iStart + BatchSize]
+            taskStr = "Pyramid {0} tiles from {1}".format(len(batch), batch[0][0])
+            taskList.append(Pool.add_task(taskStr, ShrinkTilesToLevels, batch))
+
+        for task in taskList:
+            # Waiting ensures any exceptions are raised
+            for inputFile in task.wait_return():
+                if not nornir_shared.images.IsValidImage(inputFile): 
+                    prettyoutput.LogErr('\n*** Suspected bad input file to pyramid, deleting the source image.  Rerun scripts to attempt adding the file again.\n')
+                    try:
+                        os.remove(inputFile)
+                    except:
+                        pass
 
-        # Create directories if we have source files and the directories are missing
-        if(len(SourceFiles) > 0):
-            os.makedirs(OutputTileDir, exist_ok=True)
+        for TileDir in LevelTileDirs:
+            DirectoryCache.Invalidate(TileDir)
 
-        # Simply a speedup so we aren't constantly hitting the server with exist requests for populated directories
-        DestFiles = glob.glob(OutputGlobPattern)
-        if(len(DestFiles) == PyramidNode.NumberOfTiles and
-           len(SourceFiles) == len(DestFiles)):
-            
-            # Double check that the files aren't out of date
-            if not OutdatedFile(SourceFiles[0], DestFiles[0]):
-                continue
+    if SavePyramidNode:
+        return PyramidNode
 
-        DestFiles = [os.path.basename(x) for x in DestFiles ]
+    return None
 
-        for f in SourceFiles:
-            filename = os.path.basename(f)
 
-            outputFile = os.path.join(OutputTileDir, filename)
-            inputFile = os.path.join(InputTileDir, filename)
+# Largest number of tiles read by one pyramid task
+PyramidTileBatchSize = 64
 
-            if(filename in DestFiles):
-                continue
 
-            # Don't process if the input is temp file
-            try:
-                if(os.path.getsize(inputFile) <= 0):
-                    continue
-            except:
-                continue
+def _PyramidTileRequired(DestFiles, inputFile, outputFile):
+    '''
+    :param frozenset DestFiles: Names of the tiles in the output level, None if the level is complete
+    :return: True if the tile of a pyramid level must be written
+    '''
+    if DestFiles is None:
+        return False
 
-            if os.path.exists(outputFile):
-                RemoveOutdatedFile(inputFile, outputFile)
-                RemoveInvalidImageFile(outputFile)
+    if os.path.basename(outputFile) in DestFiles:
+        return False
 
-            if(os.path.exists(outputFile)):
-                continue
+    if DirectoryCache.Exists(outputFile):
+        RemoveOutdatedFile(inputFile, outputFile)
+        RemoveInvalidImageFile(outputFile)
 
-            if Pool is None:
-                # Pool = nornir_pools.GetThreadPool('BuildTilePyramids {0}'.format(OutputTileDir), multiprocessing.cpu_count() * 2)
-                Pool = nornir_pools.GetGlobalLocalMachinePool()
-
-            if not LevelHeaderPrinted:
-       #         prettyoutput.Log(str(upLevel) + ' -> ' + str(thisLevel) + '\n')
-                LevelHeaderPrinted = True
-
-            taskStr = "{0} -> {1}".format(inputFile, outputFile)
-            task = Pool.add_task(taskStr, nornir_imageregistration.Shrink, inputFile, outputFile, shrinkFactor)
-            task.inputFile = inputFile
-            taskList.append(task)
-
-        if not Pool is None:
-
-            for task in taskList:
-                RemoveSource = False
-                if hasattr(task, 'returncode'):
-                    if task.returncode > 0:
-                        RemoveSource = True
-                        prettyoutput.LogErr('\n*** Suspected bad input file to pyramid, deleting the source image.  Rerun scripts to attempt adding the file again.\n')
-                        try:
-                            os.remove(task.inputFile)
-                        except:
-                            pass
-                else:
-                    try:
-                        task.wait()  # We do this to ensure any exeptions are raised
-                        RemoveSource = False
-                    except:
-                        RemoveSource = True
-                        
-                if RemoveSource:
-                    if not nornir_shared.images.IsValidImage(task.inputFile): 
-                        prettyoutput.LogErr('\n*** Suspected bad input file to pyramid, deleting the source image.  Rerun scripts to attempt adding the file again.\n')
-                        try:
-                            os.remove(task.inputFile)
-                        except:
-                            pass
-                        
-        # Pool.shutdown()
-        Pool = None                    
+        if(os.path.exists(outputFile)):
+            return False
 
-    if SavePyramidNode:
-        return PyramidNode
+    return True
+
+
+def _HalvingWeights(Size):
+    '''
+    Weights for halving a dimension of odd length.  Like nornir_imageregistration.Shrink, the Size // 2 output pixels
+    cover the whole input, so each averages the input pixels under it weighted by how much of them it covers.
+    :return: (Indices, Weights) arrays with a row for each of the up to four input pixels under an output pixel
+    '''
+    NewSize = max(Size // 2, 1)
+    Scale = Size / float(NewSize)
+    Start = numpy.arange(NewSize) * Scale
+    End = Start + Scale
+    Indices = numpy.floor(Start).astype(numpy.int64)[numpy.newaxis, :] + numpy.arange(4)[:, numpy.newaxis]
+    Weights = numpy.clip(numpy.minimum(Indices + 1, End) - numpy.maximum(Indices, Start), 0, None) / Scale
+    return (numpy.minimum(Indices, Size - 1), Weights)
+
+
+def _HalveAxis(pixels, axis):
+    (Indices, Weights) = _HalvingWeights(pixels.shape[axis])
+    shape = [1] * pixels.ndim
+    shape[axis] = Weights.shape[1]
+
+    total = numpy.take(pixels, Indices[0], axis=axis) * Weights[0].reshape(shape)
+    for i in range(1, Indices.shape[0]):
+        total += numpy.take(pixels, Indices[i], axis=axis) * Weights[i].reshape(shape)
+
+    return total
+
+
+def _HalveImage(pixels):
+    '''Average each 2x2 block of pixels.  Odd dimensions are resampled over their whole length, as Shrink does.'''
+    if pixels.shape[0] % 2 or pixels.shape[1] % 2:
+        total = _HalveAxis(_HalveAxis(pixels.astype(numpy.float64), 0), 1)
+        if numpy.issubdtype(pixels.dtype, numpy.integer):
+            return numpy.floor(total + 0.5).astype(pixels.dtype)
+
+        return total.astype(pixels.dtype)
+
+    if numpy.issubdtype(pixels.dtype, numpy.integer):
+        total = pixels[0::2, 0::2].astype(numpy.uint32)
+        total += pixels[1::2, 0::2]
+        total += pixels[0::2, 1::2]
+        total += pixels[1::2, 1::2]
+        total += 2
+        total >>= 2
+        return total.astype(pixels.dtype)
+
+    return (pixels[0::2, 0::2] + pixels[1::2, 0::2] + pixels[0::2, 1::2] + pixels[1::2, 1::2]) * 0.25
+
+
+def ShrinkPixels(pixels, ShrinkFactor):
+    '''
+    Downsample an image by area averaging
+    :param ndarray pixels: Image with shape (height, width) or (height, width, channels)
+    :param float ShrinkFactor: Factor to divide the image dimensions by
+    '''
+    NumHalvings = int(round(math.log2(ShrinkFactor)))
+    if NumHalvings > 0 and (1 << NumHalvings) == ShrinkFactor:
+        for i in range(NumHalvings):
+            pixels = _HalveImage(pixels)
+
+        return pixels
+
+    NewSize = (int(pixels.shape[1] // ShrinkFactor), int(pixels.shape[0] // ShrinkFactor))
+    return numpy.asarray(Image.fromarray(pixels).resize(NewSize, resample=Image.BOX))
+
+
+def ShrinkTileToLevels(inputFile, Levels):
+    '''
+    Read a tile once and write downsampled copies of it for several pyramid levels.  Each level is calculated from the
+    level before it, so the output matches shrinking the tile one level at a time.
+    :param list Levels: (ShrinkFactor, OutputFile) for each level.  ShrinkFactor is relative to the previous level.  Levels
+                        with an OutputFile of None are calculated but not written.
+    '''
+    with Image.open(inputFile) as im:
+        # Palette and bilevel images cannot be averaged
+        pixels = numpy.asarray(im.convert('L') if im.mode in ('P', '1') else im)
+
+    for (ShrinkFactor, outputFile) in Levels:
+        pixels = ShrinkPixels(pixels, ShrinkFactor)
+        if outputFile is not None:
+            Image.fromarray(pixels).save(outputFile)
 
-    return None
+
+def ShrinkTilesToLevels(Tiles):
+    '''
+    Run ShrinkTileToLevels for a batch of tiles
+    :param list Tiles: (inputFile, Levels) for each tile
+    :return: Input files that could not be shrunk
+    '''
+    Failed = []
+    for (inputFile, Levels) in Tiles:
+        try:
+            ShrinkTileToLevels(inputFile, Levels)
+        except Exception as e:
+            prettyoutput.LogErr("Could not build pyramid from {0}\n{1}".format(inputFile, str(e)))
+            Failed.append(inputFile)
+
+    return Failed
 
 
 def _InsertExistingLevelIfMissing(PyramidNode, Levels):
@@ -1918,11 +2239,14 @@ def BuildTilesetLevel(SourcePath, DestPath, DestGridDimensions, TileDim, FilePre
 
     if not Pool is None:
         Pool.wait_completion()
+
+    DirectoryCache.Invalidate(DestPath)
         
-def BuildTilesetLevelWithPillow(SourcePath, DestPath, DestGridDimensions, TileDim, FilePrefix, FilePostfix, Pool=None, **kwargs):
+def BuildTilesetLevelWithPillow(SourcePath, DestPath, DestGridDimensions, TileDim, FilePrefix, FilePostfix, Pool=None, MaxTilesInFlight=None, **kwargs):
     '''
     :param tuple SourceGridDimensions: (GridDimY,GridDimX) Number of tiles along each axis
     :param ndarray TileDim: Dimensions of tile (Y,X)
+    :param int MaxTilesInFlight: Largest number of output tiles queued on the pool
     
     '''
     
@@ -1935,15 +2259,16 @@ def BuildTilesetLevelWithPillow(SourcePath, DestPath, DestGridDimensions, TileDi
         Pool = nornir_pools.GetThreadPool("IOPool", num_threads=multiprocessing.cpu_count() * 2)
         #Pool = nornir_pools.GetGlobalSerialPool()
 
+    # We can easily saturate the pool with hundreds of thousands of tasks.
+    # Wait for the oldest tile to complete before queueing more.
+    Pool = BoundedPool.BoundedPool(Pool, MaxTasks=MaxTilesInFlight)
+
     # Merge all the tiles we can find into tiles of the same size
     
     #tile_params = []
      
     for iY in range(0, DestGridDimensions[0]):
 
-        '''We wait for the last task we queued for each row so we do not swamp the ProcessPool but are not waiting for the entire pool to empty'''
-        FirstTaskForRow = None
-
         for iX in range(0, DestGridDimensions[1]):
 
             X1 = iX * 2
@@ -1999,41 +2324,194 @@ def BuildTilesetLevelWithPillow(SourcePath, DestPath, DestGridDimensions, TileDi
                             TopLeft=TopLeft, TopRight=TopRight,
                             BottomLeft=BottomLeft, BottomRight=BottomRight,
                             OutputFileFullPath=OutputFileFullPath)
-            
-            if FirstTaskForRow is None:
-                FirstTaskForRow = task
                 
     #Pool.starmap_async(name=DestPath, func=tileset_functions.CreateOneTilesetTileWithPillow, iterable=tile_params)
 
         # TaskString = "Building tiles for downsample %g" % NextLevelNode.Downsample
         # prettyoutput.CurseProgress(TaskString, iY + 1, newYDim)
 
-        # We can easily saturate the pool with hundreds of thousands of tasks.
-        # If the pool has a reasonable number of tasks then we should wait for
-        # a task from a row to complete before queueing more.
-#             if hasattr(Pool, 'num_active_tasks'):
-#                 if Pool.num_active_tasks > 2048:#multiprocessing.cpu_count() * 8:
-#                     FirstTaskForRow.wait()
-#                     FirstTaskForRow = None
-#         elif hasattr(Pool, 'tasks') and isinstance(Pool.tasks, queue.Queue):
-#             if Pool.num_active_tasks > multiprocessing.cpu_count() * 8:
-#                 FirstTaskForRow.wait()
-#                 FirstTaskForRow = None
-#         elif hasattr(Pool, 'ActiveTasks'):
-#             if Pool.num_active_tasks > multiprocessing.cpu_count() * 8:
-#                 FirstTaskForRow.wait()
-#                 FirstTaskForRow = None 
-
         #prettyoutput.Log("\nBeginning Row %d of %d" % (iY + 1, DestGridDimensions[0]))
 
-    if not Pool is None:
-        Pool.wait_completion() 
-        #Pool.shutdown()
+    Pool.wait_completion() 
+    DirectoryCache.Invalidate(DestPath)
+
+
+def _TilesetTileName(FilePrefix, FilePostfix, iX, iY):
+    return nornir_buildmanager.templates.Current.GridTileNameTemplate % {'prefix' : FilePrefix,
+                                                                        'X' : iX,
+                                                                        'Y' : iY,
+                                                                        'postfix' : FilePostfix }
+
+
+def _ReadTilesetTile(SourcePath, TempPath, TileName, TileDim):
+    '''
+    Read a tileset tile, preferring the local temporary copy written when the tileset was assembled
+    :return: Pixels of the tile padded or cropped to TileDim, None if the tile does not exist
+    '''
+    fullpath = None
+    if TempPath is not None:
+        fullpath = os.path.join(TempPath, TileName)
+        if not os.path.exists(fullpath):
+            fullpath = None
+
+    if fullpath is None:
+        fullpath = os.path.join(SourcePath, TileName)
+        if not os.path.exists(fullpath):
+            return None
+
+    with Image.open(fullpath) as im:
+        pixels = numpy.asarray(im.convert('L') if im.mode in ('P', '1') else im)
+
+    if pixels.shape[0:2] != tuple(TileDim):
+        padded = numpy.zeros(tuple(TileDim) + pixels.shape[2:], dtype=pixels.dtype)
+        Height = min(TileDim[0], pixels.shape[0])
+        Width = min(TileDim[1], pixels.shape[1])
+        padded[0:Height, 0:Width] = pixels[0:Height, 0:Width]
+        pixels = padded
+
+    return pixels
+
+
+def _SaveTilesetTile(OutputFileFullPath, pixels):
+    Image.fromarray(pixels).save(OutputFileFullPath)
+
+
+class TilesetLevelStream(object):
+    '''
+    Builds one level of a tileset from rows of tiles of the level with twice its resolution.  Each pair of rows is merged
+    into one row of this level as soon as the second row arrives, so at most one row of tiles is held.  The rows this
+    level creates are passed to the next level's stream.
+    '''
+
+    def __init__(self, DestPath, DestGridDimensions, TileDim, FilePrefix, FilePostfix, Pool, Next=None):
+        '''
+        :param str DestPath: Directory tiles are written to, None if the level is calculated only to build the next level
+        :param tuple DestGridDimensions: (GridDimY,GridDimX) Number of tiles along each axis of this level
+        :param BoundedPool Pool: Pool tiles are saved on
+        :param TilesetLevelStream Next: Stream for the level with half our resolution
+        '''
+        self.DestPath = DestPath
+        self.DestGridDimensions = DestGridDimensions
+        self.TileDim = TileDim
+        self.FilePrefix = FilePrefix
+        self.FilePostfix = FilePostfix
+        self.Pool = Pool
+        self.Next = Next
+        self._PendingRow = None
+        self._iY = 0
+
+        if DestPath is not None:
+            os.makedirs(DestPath, exist_ok=True)
+
+    def AddRow(self, Tiles):
+        '''
+        :param list Tiles: Pixels of each tile in a row of the source level, None for missing tiles
+        '''
+        if self._PendingRow is None:
+            self._PendingRow = Tiles
+            return
+
+        self._MergeRows(self._PendingRow, Tiles)
+        self._PendingRow = None
+
+    def Finish(self):
+        '''Merge an odd last row with an empty row and finish the following levels'''
+        if self._PendingRow is not None:
+            self._MergeRows(self._PendingRow, [None] * len(self._PendingRow))
+            self._PendingRow = None
+
+        if self.Next is not None:
+            self.Next.Finish()
+
+    def _MergeRows(self, Top, Bottom):
+        (Height, Width) = self.TileDim
+        Row = []
+        for iX in range(0, self.DestGridDimensions[1]):
+            Quad = [SourceRow[iX * 2:(iX * 2) + 2] for SourceRow in (Top, Bottom)]
+            Existing = [t for pair in Quad for t in pair if t is not None]
+            if len(Existing) == 0:
+                Row.append(None)
+                continue
+
+            merged = numpy.zeros((Height * 2, Width * 2) + Existing[0].shape[2:], dtype=Existing[0].dtype)
+            for (iRow, pair) in enumerate(Quad):
+                for (iCol, t) in enumerate(pair):
+                    if t is not None:
+                        merged[iRow * Height:(iRow + 1) * Height, iCol * Width:(iCol + 1) * Width] = t
+
+            pixels = _HalveImage(merged)
+            Row.append(pixels)
+
+            if self.DestPath is not None:
+                OutputFileFullPath = os.path.join(self.DestPath, _TilesetTileName(self.FilePrefix, self.FilePostfix, iX, self._iY))
+                self.Pool.add_sized_task(OutputFileFullPath, pixels.nbytes, _SaveTilesetTile, OutputFileFullPath, pixels)
+
+        self._iY += 1
+        if self.Next is not None:
+            self.Next.AddRow(Row)
+
+
+def BuildTilesetLevelsStreaming(SourcePath, DestPaths, SourceGridDimensions, TileDim, FilePrefix, FilePostfix, TempPath=None, Pool=None, MaxTilesInFlight=None, **kwargs):
+    '''
+    Build several levels of a tileset in one sweep over the rows of the source level.  Each source tile is read once.
+    Two source rows are read at a time while the next two rows are read ahead on the pool.
+    :param list DestPaths: Directory of each level to build, each level has half the resolution of the one before it.
+                           None for levels that are only calculated to build the levels after them.
+    :param tuple SourceGridDimensions: (GridDimY,GridDimX) Number of tiles along each axis of the source level
+    :param ndarray TileDim: Dimensions of tile (Y,X)
+    :param str TempPath: Directory with local copies of the source tiles, used in place of SourcePath when a copy exists
+    :param int MaxTilesInFlight: Largest number of output tiles queued on the pool
+    '''
+    if Pool is None:
+        Pool = nornir_pools.GetThreadPool("IOPool", num_threads=multiprocessing.cpu_count() * 2)
+
+    TileDim = (int(TileDim[0]), int(TileDim[1]))
+    (SourceGridDimY, SourceGridDimX) = (int(SourceGridDimensions[0]), int(SourceGridDimensions[1]))
+
+    # Build the streams from the lowest resolution level up so each stream can pass its rows to the next
+    GridDims = []
+    (GridDimY, GridDimX) = (SourceGridDimY, SourceGridDimX)
+    for DestPath in DestPaths:
+        GridDimY = int(math.ceil(GridDimY / 2.0))
+        GridDimX = int(math.ceil(GridDimX / 2.0))
+        GridDims.append((GridDimY, GridDimX))
+
+    SavePool = BoundedPool.BoundedPool(Pool, MaxTasks=MaxTilesInFlight)
+    Stream = None
+    for (DestPath, DestGridDimensions) in reversed(list(zip(DestPaths, GridDims))):
+        Stream = TilesetLevelStream(DestPath, DestGridDimensions, TileDim, FilePrefix, FilePostfix, SavePool, Next=Stream)
+
+    def ReadRows(iY):
+        '''Queue reads of source rows iY and iY + 1'''
+        return [[Pool.add_task(_TilesetTileName(FilePrefix, FilePostfix, iX, Y), _ReadTilesetTile, SourcePath, TempPath,
+                               _TilesetTileName(FilePrefix, FilePostfix, iX, Y), TileDim) for iX in range(0, SourceGridDimX)]
+                for Y in range(iY, min(iY + 2, SourceGridDimY))]
+
+    ReadTasks = ReadRows(0)
+    for iY in range(0, SourceGridDimY, 2):
+        Rows = [[task.wait_return() for task in RowTasks] for RowTasks in ReadTasks]
+        ReadTasks = ReadRows(iY + 2)
+
+        for Row in Rows:
+            Stream.AddRow(Row)
+
+    Stream.Finish()
+    SavePool.wait_completion()
+
+    for DestPath in DestPaths:
+        if DestPath is not None:
+            DirectoryCache.Invalidate(DestPath)
 
 
 # OK, now build/check the remaining levels of the tile pyramids
-def BuildTilesetPyramid(TileSetNode, HighestDownsample=None, Pool=None, **kwargs):
-    '''@TileSetNode'''
+def BuildTilesetPyramid(TileSetNode, HighestDownsample=None, Pool=None, LevelByLevel=False, **kwargs):
+    '''@TileSetNode
+       :param bool LevelByLevel: Build each level from the previous level on disk instead of building every level in one
+                                 pass over the rows of the lowest downsample level'''
+
+    if not LevelByLevel:
+        yield from BuildTilesetPyramidStreaming(TileSetNode, HighestDownsample=HighestDownsample, Pool=Pool, **kwargs)
+        return
     
     MinResolutionLevel = TileSetNode.MinResLevel
 
@@ -2082,7 +2560,8 @@ def BuildTilesetPyramid(TileSetNode, HighestDownsample=None, Pool=None, **kwargs
                                TileDim=(TileSetNode.TileYDim, TileSetNode.TileXDim),
                                FilePrefix=TileSetNode.FilePrefix,
                                FilePostfix=TileSetNode.FilePostfix,
-                               Pool=Pool)
+                               Pool=Pool,
+                               MaxTilesInFlight=kwargs.get('MaxTilesInFlight', None))
             # This was a lot of work, make sure it is saved before queueing the next level
             yield TileSetNode
             prettyoutput.Log("\nTileset level %d completed" % NextLevelNode.Downsample)
@@ -2095,6 +2574,83 @@ def BuildTilesetPyramid(TileSetNode, HighestDownsample=None, Pool=None, **kwargs
     return
 
 
+def BuildTilesetPyramidStreaming(TileSetNode, HighestDownsample=None, Pool=None, **kwargs):
+    '''@TileSetNode
+       Build every missing level of the tileset in one pass over the rows of the lowest downsample level'''
+
+    if len(TileSetNode.Levels) == 0:
+        return
+
+    # Every level is built from the full resolution level
+    SourceLevel = TileSetNode.MaxResLevel
+
+    # The grid attributes are missing if the meta-data was created but there are no tiles
+    if not (hasattr(SourceLevel, 'GridDimX') and hasattr(SourceLevel, 'GridDimY')):
+        prettyoutput.Log("Tileset incomplete: " + TileSetNode.FullPath)
+        return
+
+    TempPath = tileset_functions.GetTempDirForLevelDir(SourceLevel.FullPath)
+
+    Downsample = SourceLevel.Downsample
+    (GridDimY, GridDimX) = (int(SourceLevel.GridDimY), int(SourceLevel.GridDimX))
+    LevelNodes = []
+    DestPaths = []
+    AddedLevel = False
+    while True:
+        # If the tileset is already a single tile, then do not downsample
+        if GridDimX == 1 and GridDimY == 1:
+            break
+
+        if HighestDownsample is not None and (Downsample >= float(HighestDownsample)):
+            break
+
+        GridDimY = int(math.ceil(GridDimY / 2.0))
+        GridDimX = int(math.ceil(GridDimX / 2.0))
+        if GridDimX == 1 and GridDimY == 1:
+            break
+
+        Downsample = Downsample * 2
+        NextLevelNode = nb.VolumeManager.LevelNode.Create(Downsample)
+        [added, NextLevelNode] = TileSetNode.UpdateOrAddChildByAttrib(NextLevelNode, 'Downsample')
+        NextLevelNode.GridDimX = GridDimX
+        NextLevelNode.GridDimY = GridDimY
+        AddedLevel = AddedLevel or added
+
+        # Every level is checked because an interrupted build can leave meta-data for levels without tiles.
+        # Levels that were already generated are still calculated to build the levels after them, but are not written
+        [Valid, Reason] = NextLevelNode.IsValid()
+        if Valid:
+            logging.info("Level was already generated " + str(NextLevelNode))
+
+        LevelNodes.append(NextLevelNode)
+        DestPaths.append(None if Valid else NextLevelNode.FullPath)
+
+    # Drop trailing levels that already exist, they are not needed to build any missing level
+    while len(DestPaths) > 0 and DestPaths[-1] is None:
+        DestPaths.pop()
+
+    # New levels are only saved once their tiles are written
+    if len(DestPaths) == 0:
+        if AddedLevel:
+            yield TileSetNode
+    else:
+        BuildTilesetLevelsStreaming(SourceLevel.FullPath, DestPaths,
+                                    SourceGridDimensions=(int(SourceLevel.GridDimY), int(SourceLevel.GridDimX)),
+                                    TileDim=(TileSetNode.TileYDim, TileSetNode.TileXDim),
+                                    FilePrefix=TileSetNode.FilePrefix,
+                                    FilePostfix=TileSetNode.FilePostfix,
+                                    TempPath=TempPath,
+                                    Pool=Pool,
+                                    MaxTilesInFlight=kwargs.get('MaxTilesInFlight', None))
+
+        # This was a lot of work, make sure it is saved
+        yield TileSetNode
+        prettyoutput.Log("\nTileset levels %s completed" % ", ".join(["%d" % node.Downsample for (node, path) in zip(LevelNodes, DestPaths) if path is not None]))
+
+    tileset_functions.ClearTempDirectories([TempPath])
+    return
+
+
 if __name__ == "__main__":
 
     TestImageDir = 'D:/BuildScript/Test/Images'
@@ -5,15 +5,31 @@ Created on Apr 2, 2012
 
 import collections
 import collections.abc
+import concurrent.futures
 import copy
+import functools
 import logging
+import multiprocessing
 import os
+import pickle
 import re
 import sys
 import traceback
 import platform
 from xml.etree import ElementTree
 from nornir_buildmanager import VolumeManagerETree
+from nornir_buildmanager import BoundedPool
+from nornir_buildmanager import PNGEncoder
+from nornir_buildmanager import TileContrast
+from nornir_buildmanager import ChecksumCache
+from nornir_buildmanager import DirectoryCache
+from nornir_buildmanager import ImageHeaderCache
+from nornir_buildmanager import VolumeDataCache
+from nornir_buildmanager import VolumeDataWriter
+from nornir_buildmanager import planner
+from nornir_buildmanager import StageProfile
+from nornir_buildmanager import TileHistogram
+from nornir_buildmanager import WorkJournal
 
 from .pipeline_exceptions import *
 
@@ -25,6 +41,20 @@ from inspect import isgenerator
 from . import argparsexml
 import nornir_shared.prettyoutput as prettyoutput
 
+# Counters logged when a pipeline finishes
+PipelineStats = [VolumeManagerETree.LinkStats,
+                 VolumeDataCache.Stats,
+                 VolumeManagerETree.SaveStats,
+                 VolumeDataWriter.Stats,
+                 ChecksumCache.Stats,
+                 ImageHeaderCache.Stats,
+                 DirectoryCache.Stats,
+                 WorkJournal.Stats,
+                 TileHistogram.Stats,
+                 BoundedPool.Stats,
+                 PNGEncoder.Stats,
+                 TileContrast.Stats]
+
 
 # import xml.etree
 class ArgumentSet():
@@ -160,6 +190,10 @@ class ArgumentSet():
                 self.Attribs[key] = val
                 continue
 
+            if '#' not in val:
+                self.Attribs[key] = _ParseConstant(val)
+                continue
+
             (found, subObj) = self.TryGetSubstituteObject(val)
             if found:
                 self.Attribs[key] = subObj
@@ -167,18 +201,7 @@ class ArgumentSet():
 
             val = self.SubstituteStringVariables(val)
 
-            self.Attribs[key] = val
-            try:
-                self.Attribs[key] = int(val)
-                continue
-            except:
-                pass
-
-            try:
-                self.Attribs[key] = float(val)
-                continue
-            except:
-                pass
+            self.Attribs[key] = _ParseConstant(val)
 
     def RemoveAttributes(self, Node):
         '''Remove attributes present in the node from the attrib dictionary'''
@@ -214,6 +237,10 @@ class ArgumentSet():
                     name = entryNode.attrib['Name']
                     val = entryNode.attrib.get('Value', '')
 
+                    if '#' not in val:
+                        NewParameters[name] = _ParseConstant(val)
+                        continue
+
                     (found, subObj) = self.TryGetSubstituteObject(val)
                     if found:
                         NewParameters[name] = subObj
@@ -221,22 +248,7 @@ class ArgumentSet():
 
                     val = self.SubstituteStringVariables(val)
 
-                    if len(val) == 0:
-                        NewParameters[name] = val
-                        continue
-
-                    NewParameters[name] = val
-                    try:
-                        NewParameters[name] = int(val)
-                        continue
-                    except:
-                        pass
-
-                    try:
-                        NewParameters[name] = float(val)
-                        continue
-                    except:
-                        pass
+                    NewParameters[name] = _ParseConstant(val)
 
         if dargsKeyname is None:
             self.Parameters.update(NewParameters)
@@ -277,6 +289,23 @@ class ArgumentSet():
 
 
 
+@functools.lru_cache(maxsize=4096)
+def _ParseConstant(val):
+    '''Convert an attribute or parameter value from a pipeline to an int or float if possible.
+       Values without variables repeat on every iteration, so conversions are cached.'''
+    try:
+        return int(val)
+    except ValueError:
+        pass
+
+    try:
+        return float(val)
+    except ValueError:
+        pass
+
+    return val
+
+
 class ExtensionData:
     def __init__(self):
         self.ext = None
@@ -297,6 +326,9 @@ class PipelineManager(object):
         self.defaultArgs = dict()
         self.PipelineRoot = pipelinesRoot
 
+        # Set when running with -plan, stages are recorded in the plan instead of being called
+        self.Plan = None
+
         if 'Description' in pipelineData.attrib:
             self._description = pipelineData.attrib['Description']
 
@@ -355,8 +387,15 @@ class PipelineManager(object):
 
         return True
 
+    # (Full path, modification time) -> Parsed pipeline XML
+    _PipelineXMLCache = {}
+
+    # (Module, Function) -> Stage function
+    _StageFunctionCache = {}
+
     @classmethod
     def LoadPipelineXML(cls, PipelineXML):
+        '''Parse a pipeline XML file.  The parsed file is reused until the file changes.'''
         #Python 3 switched to unicode always so the encoding should not be necessary for non-english character sets
         if int(platform.python_version_tuple()[0]) < 3:
             if isinstance(PipelineXML, str):
@@ -364,13 +403,33 @@ class PipelineManager(object):
 
         if isinstance(PipelineXML, str):
             if cls._CheckPipelineXMLExists(PipelineXML):
-                return ElementTree.parse(PipelineXML)
+                key = (os.path.abspath(PipelineXML), os.stat(PipelineXML).st_mtime_ns)
+                XMLDoc = cls._PipelineXMLCache.get(key, None)
+                if XMLDoc is None:
+                    XMLDoc = ElementTree.parse(PipelineXML)
+                    cls._PipelineXMLCache[key] = XMLDoc
+
+                return XMLDoc
 
         elif isinstance(PipelineXML, ElementTree.ElementTree):
                 return PipelineXML
 
         raise Exception("Invalid argument: " + str(PipelineXML))
 
+    @classmethod
+    def GetStageFunction(cls, PipelineModule, PipelineFunction):
+        '''
+        :return: The stage function named by a <PythonCall> element, or None if it does not exist.  Lookups are cached.
+        '''
+        key = (PipelineModule, PipelineFunction)
+        stageFunc = cls._StageFunctionCache.get(key, None)
+        if stageFunc is None:
+            stageFunc = nornir_shared.reflection.get_module_class(PipelineModule, PipelineFunction)
+            if stageFunc is not None:
+                cls._StageFunctionCache[key] = stageFunc
+
+        return stageFunc
+
     @classmethod
     def ListPipelines(cls, PipelineXML):
 
@@ -495,19 +554,65 @@ class PipelineManager(object):
 
         ArgSet.AddParameters(PipelineElement)
 
-        # Load the Volume.XML file in the output directory
-        self.VolumeTree = VolumeManagerETree.VolumeManager.Load(args.volumepath, Create=True)
+        if ArgSet.Arguments.get('plan', False):
+            self.Plan = planner.Plan(args.volumepath, PipelineElement.get('Name', None))
 
-        if(self.VolumeTree is None):
-            PipelineManager.logger.critical("Could not load or create volume.xml " + args.outputpath)
-            prettyoutput.LogErr("Could not load or create volume.xml " + args.outputpath)
-            sys.exit()
+        ImageHeaderCache.VerifyPolicy = ArgSet.Arguments.get('verifyimages', ImageHeaderCache.VerifyOnChange)
+        ChecksumCache.Load(args.volumepath)
+        TileHistogram.Load(args.volumepath)
+        WorkJournal.Load(args.volumepath)
+        StageProfile.Clear()
 
-        # dargs = copy.deepcopy(defaultDargs)
+        # A plan must not clean invalid elements found while loading linked files
+        VolumeManagerETree.Planning = self.Plan is not None
+        try:
+            # Load the Volume.XML file in the output directory
+            self.VolumeTree = VolumeManagerETree.VolumeManager.Load(args.volumepath, Create=self.Plan is None)
+
+            if(self.VolumeTree is None):
+                PipelineManager.logger.critical("Could not load or create volume.xml " + args.outputpath)
+                prettyoutput.LogErr("Could not load or create volume.xml " + args.outputpath)
+                sys.exit()
+
+            # dargs = copy.deepcopy(defaultDargs)
+
+            self.ExecuteChildPipelines(ArgSet, self.VolumeTree, PipelineElement)
+
+            nornir_pools.WaitOnAllPools()
+            VolumeDataWriter.Flush()
+        finally:
+            VolumeManagerETree.Planning = False
+
+        if self.Plan is not None:
+            self.Plan.Print()
+            PlanFile = ArgSet.Arguments.get('planfile', None)
+            if PlanFile is not None:
+                self.Plan.Save(PlanFile)
+        else:
+            ChecksumCache.Save(args.volumepath)
+            TileHistogram.Save(args.volumepath)
+            WorkJournal.Compact(args.volumepath)
+            self._SaveStageProfile(args.volumepath)
+
+        for stats in PipelineStats:
+            PipelineManager.logger.info(str(stats))
+            if(ArgSet.Arguments['verbose']):
+                prettyoutput.Log(str(stats))
 
-        self.ExecuteChildPipelines(ArgSet, self.VolumeTree, PipelineElement)
-        
-        nornir_pools.WaitOnAllPools()
+
+    def _SaveStageProfile(self, volume_path):
+        '''Write the per-stage timing records next to the volume and log the totals of each stage'''
+        if len(StageProfile.Records) == 0:
+            return
+
+        try:
+            StageProfile.Save(volume_path)
+        except OSError as e:
+            PipelineManager.logger.warning("Could not write stage profile to {0}\n{1}".format(volume_path, str(e)))
+
+        Summary = StageProfile.Summary()
+        PipelineManager.logger.info(Summary)
+        prettyoutput.Log(Summary)
 
     def ExecuteChildPipelines(self, ArgSet, VolumeElem, PipelineNode):
         '''Run all of the child pipeline elements on the volume element'''
@@ -516,6 +621,7 @@ class PipelineManager(object):
         # prettyoutput.Log(PipelineManager.ToElementString(PipelineNode))
 
         PipelinesRun = 0
+        NumStaleBefore = None if self.Plan is None else self.Plan.NumStale
         try:
             self.AddPipelineNodeVariable(PipelineNode, VolumeElem, ArgSet)
 
@@ -527,6 +633,9 @@ class PipelineManager(object):
                 except PipelineSelectFailed as e:
                     if ArgSet.Arguments["debug"]:
                         PipelineManager.logger.info(str(e))
+                    if self.Plan is not None and self.Plan.NumStale > NumStaleBefore:
+                        # The element may be created by one of the stale stages we did not run
+                        self.Plan.AddBlocked(VolumeElem, ChildNode, "Remaining steps depend on output of stale stages: " + PipelineManager.ToElementString(ChildNode))
                     PipelineManager.logger.info("Select statement did not match.  Skipping to next iteration\n")
                     break
                 except PipelineSearchFailed as e:
@@ -674,6 +783,11 @@ class PipelineManager(object):
                     if 'Locked' in SelectedVolumeElem.attrib:
                         if SelectedVolumeElem.Locked:
                             break
+
+                    if self.Plan is not None:
+                        # Without cleaning the element the search would find it again
+                        self.Plan.AddInvalidElement(SelectedVolumeElem, Reason)
+                        raise PipelineSelectFailed(PipelineNode=PipelineNode, VolumeElem=RootForSearch, xpath=xpath)
                         
                     SelectedVolumeElem.Clean(Reason)
                     PipelineManager._SaveNodes(SelectedVolumeElem.Parent)
@@ -695,16 +809,174 @@ class PipelineManager(object):
         CopiedArgSet = copy.copy(ArgSet)
 
         NumProcessed = 0
-        for VolumeElemChild in VolumeElemIter:
-            if VolumeElemChild.CleanIfInvalid():
-                PipelineManager._SaveNodes(VolumeElemChild.Parent)
-                continue
+        if self.Plan is not None:
+            for VolumeElemChild in VolumeElemIter:
+                Valid = VolumeElemChild.IsValid()
+                if isinstance(Valid, bool):
+                    Valid = [Valid, ""]
+
+                if not Valid[0]:
+                    # Report the element CleanIfInvalid would remove without removing it
+                    self.Plan.AddInvalidElement(VolumeElemChild, Valid[1])
+                    continue
+
+                NumProcessed += self.ExecuteChildPipelines(CopiedArgSet, VolumeElemChild, PipelineNode)
+        elif PipelineManager._IsParallelIterate(PipelineNode):
+            VolumeElems = []
+            for VolumeElemChild in VolumeElemIter:
+                if VolumeElemChild.CleanIfInvalid():
+                    PipelineManager._SaveNodes(VolumeElemChild.Parent)
+                    continue
+
+                VolumeElems.append(VolumeElemChild)
+
+            NumProcessed = self.ExecuteIterationsInParallel(CopiedArgSet, VolumeElems, PipelineNode)
+        else:
+            for VolumeElemChild in VolumeElemIter:
+                if VolumeElemChild.CleanIfInvalid():
+                    PipelineManager._SaveNodes(VolumeElemChild.Parent)
+                    continue
 
-            NumProcessed += self.ExecuteChildPipelines(CopiedArgSet, VolumeElemChild, PipelineNode)
+                NumProcessed += self.ExecuteChildPipelines(CopiedArgSet, VolumeElemChild, PipelineNode)
 
         if(NumProcessed == 0):
             raise PipelineSearchFailed(PipelineNode=PipelineNode, VolumeElem=RootForSearch, xpath=xpath)
 
+    @classmethod
+    def _IsParallelIterate(cls, PipelineNode):
+        '''True if an <Iterate> node requests its iterations run in worker processes'''
+        if _InParallelWorker:
+            # Iterations are already spread across processes, nested iterates run serially in the worker
+            return False
+
+        return PipelineNode.get('Parallel', 'false').lower() == 'true'
+
+    def ExecuteIterationsInParallel(self, ArgSet, VolumeElems, PipelineNode):
+        '''Run the child pipelines of an <Iterate> node for each element in a separate process.
+           Each worker loads the volume, runs the pipeline on its element and saves the element's subtree.
+           The saved subtrees are then loaded back into our volume.  Workers running at the same time may each save
+           their own copy of a parent, so the attribute changes each worker made to the elements above its element
+           are returned and applied to our copies, which are then saved.
+           :return: Number of pipelines run'''
+
+        VolumeElemLocators = [_ElementLocator(e) for e in VolumeElems]
+        (Variables, VariableLocators) = _SplitVariables(ArgSet.Variables)
+
+        if len(VolumeElems) < 2 or Variables is None or None in VolumeElemLocators:
+            if len(VolumeElems) > 1:
+                PipelineManager.logger.warning("Iterate elements or variables cannot be located in a worker process, running serially: " + PipelineManager.ToElementString(PipelineNode))
+
+            NumProcessed = 0
+            for VolumeElemChild in VolumeElems:
+                NumProcessed += self.ExecuteChildPipelines(ArgSet, VolumeElemChild, PipelineNode)
+
+            return NumProcessed
+
+        MaxWorkers = int(PipelineNode.get('MaxWorkers', os.cpu_count()))
+        PipelineXML = ElementTree.tostring(PipelineNode, encoding="utf-8")
+        Arguments = _PicklableArguments(ArgSet.Arguments)
+
+        # Workers load the volume from disk, so our changes must be written first
+        VolumeManagerETree.VolumeManager.Save(self.VolumeTree)
+        VolumeDataWriter.Flush()
+
+        prettyoutput.Log("Running %d iterations of %s with %d workers" % (len(VolumeElems), PipelineManager.ToElementString(PipelineNode), MaxWorkers))
+
+        # Stages create their own pools, so workers must be started fresh rather than forked with our pool threads
+        NumProcessed = 0
+        ParentsToSave = []  # (Parent, [Reloaded children], [Attribute changes of the ancestors from each worker])
+        with concurrent.futures.ProcessPoolExecutor(max_workers=MaxWorkers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(_ExecuteIterationInWorker, PipelineXML, Arguments, Variables, VariableLocators, locator) for locator in VolumeElemLocators]
+
+            for (VolumeElemChild, future) in zip(VolumeElems, futures):
+                (WorkerNumProcessed, WorkerStageRecords, AncestorChanges, Checksums) = future.result()
+                NumProcessed += WorkerNumProcessed
+                StageProfile.Extend(WorkerStageRecords)
+                ChecksumCache.Merge(Checksums)
+
+                Parent = VolumeElemChild.Parent
+                Reloaded = PipelineManager._ReloadSavedElement(VolumeElemChild)
+                Entry = next((entry for entry in ParentsToSave if entry[0] is Parent), None)
+                if Entry is None:
+                    Entry = (Parent, [], [])
+                    ParentsToSave.append(Entry)
+
+                if Reloaded is not None:
+                    Entry[1].append(Reloaded)
+
+                Entry[2].append(AncestorChanges)
+
+        # Structural changes workers made to a parent are taken from the last saved copy, then the attribute changes of
+        # every worker are applied in the order the elements were listed.  Workers saving the same parent may have
+        # overwritten each other's copies of the link attributes, saving fixes them.
+        NodesToSave = []
+        for (Parent, Children, WorkerChanges) in ParentsToSave:
+            PipelineManager._ReloadSavedParent(Parent, Children)
+            NodesToSave.append(Parent)
+
+            for AncestorChanges in WorkerChanges:
+                Ancestor = Parent
+                for (Changed, Removed) in AncestorChanges:
+                    if Ancestor is None:
+                        break
+
+                    for (key, value) in Changed.items():
+                        Ancestor.attrib[key] = value
+
+                    for key in Removed:
+                        Ancestor.attrib.pop(key, None)
+
+                    if (len(Changed) > 0 or len(Removed) > 0) and Ancestor not in NodesToSave:
+                        NodesToSave.append(Ancestor)
+
+                    Ancestor = Ancestor.Parent
+
+        PipelineManager._SaveNodes(NodesToSave)
+
+        return NumProcessed
+
+    @classmethod
+    def _ReloadSavedElement(cls, VolumeElem):
+        '''Replace an element with the version a worker process saved to disk
+           :return: The reloaded element, None if the worker removed it'''
+        Parent = VolumeElem.Parent
+
+        try:
+            Reloaded = Parent._load_and_wrap_link_element(VolumeElem.FullPath)
+        except IOError:
+            # The worker removed the element
+            Parent.remove(VolumeElem)
+            return None
+
+        Parent._ReplaceChildElementInPlace(old=VolumeElem, new=Reloaded)
+
+        # Our link element copies the attributes of the reloaded element
+        Parent.SetDirty()
+        return Reloaded
+
+    @classmethod
+    def _ReloadSavedParent(cls, Parent, Children):
+        '''Update the parent of elements run in worker processes with the version saved to disk, which includes the changes workers made to it.
+           The parent is updated in place because variables and callers refer to it.
+           :param list Children: Elements reloaded by _ReloadSavedElement, they replace their link elements in the saved version'''
+        try:
+            Saved = VolumeManagerETree.XContainerElementWrapper._load_link_element(Parent.FullPath)
+        except IOError:
+            return
+
+        Kept = collections.OrderedDict(((child.tag + '_Link', child.Path), child) for child in Children)
+        SavedChildren = [Kept.pop((child.tag, child.attrib.get('Path', None)), child) for child in Saved]
+        SavedChildren.extend(Kept.values())
+
+        for (key, value) in Saved.attrib.items():
+            Parent.attrib[key] = value
+
+        del Parent[:]
+        Parent.extend(SavedChildren)
+
+        for child in Children:
+            child.Parent = Parent
+
     @classmethod
     def _SaveNodes(cls, NodesToSave):
         if not NodesToSave is None:
@@ -724,7 +996,7 @@ class PipelineManager(object):
 
         PipelineFunction = PipelineNode.get('Function', PipelineNode.tag)
 
-        stageFunc = nornir_shared.reflection.get_module_class(str(PipelineModule), str(PipelineFunction))
+        stageFunc = PipelineManager.GetStageFunction(str(PipelineModule), str(PipelineFunction))
 
         if(ArgSet.Arguments['verbose']):
             prettyoutput.Log("CALL " + str(PipelineModule) + "." + str(PipelineFunction))
@@ -762,33 +1034,53 @@ class PipelineManager(object):
                 if 'Parameters' not in kwargs:
                     kwargs['Parameters'] = {}
 
+                if self.Plan is not None:
+                    self.Plan.AddStage(PipelineFunction, VolumeElem, kwargs)
+                    return
+
                 NodesToSave = None
 
-                if not ArgSet.Arguments["debug"]:
-                    try:
-                        NodesToSave = stageFunc(**kwargs)
-                    except:
-                        errorStr = '\n' + '-' * 60 + '\n'
-                        errorStr = errorStr + str(PipelineModule) + '.' + str(PipelineFunction) + " Exception\n"
-                        errorStr = errorStr + '-' * 60 + '\n'
-                        errorStr = errorStr + traceback.format_exc()
-                        errorStr = errorStr + '-' * 60 + '\n'
-                        PipelineManager.logger.error(errorStr)
-                        # prettyoutput.LogErr(errorStr)
-
-                        self.VolumeTree = VolumeManagerETree.VolumeManager.Load(self.VolumeTree.attrib["Path"], UseCache=False)
-                        return
-                         
+                VolumePath = self.VolumeTree.FullPath
+                ElementName = StageProfile.ElementName(VolumeElem, VolumePath)
+                Inputs = WorkJournal.InputSignature(kwargs, WorkJournal.IgnoredAttributes(PipelineNode))
+                if ArgSet.Arguments.get('resume', False) and WorkJournal.IsComplete(str(PipelineFunction), ElementName, Inputs.Arguments, Inputs.Compute()):
+                    if(ArgSet.Arguments['verbose']):
+                        prettyoutput.Log("Skipping " + str(PipelineFunction) + ", completed on " + ElementName + " by an earlier run")
+                    return
+
+                # Stages returning generators do their work while the nodes they yield are saved, so the measurement includes saving
+                with StageProfile.Measure(str(PipelineFunction), ElementName):
+                    if not ArgSet.Arguments["debug"]:
+                        try:
+                            NodesToSave = stageFunc(**kwargs)
+                        except:
+                            errorStr = '\n' + '-' * 60 + '\n'
+                            errorStr = errorStr + str(PipelineModule) + '.' + str(PipelineFunction) + " Exception\n"
+                            errorStr = errorStr + '-' * 60 + '\n'
+                            errorStr = errorStr + traceback.format_exc()
+                            errorStr = errorStr + '-' * 60 + '\n'
+                            PipelineManager.logger.error(errorStr)
+                            # prettyoutput.LogErr(errorStr)
+
+                            self.VolumeTree = VolumeManagerETree.VolumeManager.Load(self.VolumeTree.attrib["Path"], UseCache=False)
+                            return
+                             
+                            
+                    else:
+                        # In debug mode we do not want to catch any exceptions
+                        # stage functions can return None,True, or False to indicate they did work.
+                        # if they return false we do not need to run the expensive save operation
+                        print(str(PipelineModule) + '.' + str(PipelineFunction))
                         
-                else:
-                    # In debug mode we do not want to catch any exceptions
-                    # stage functions can return None,True, or False to indicate they did work.
-                    # if they return false we do not need to run the expensive save operation
-                    print(str(PipelineModule) + '.' + str(PipelineFunction))
-                    
-                    NodesToSave = stageFunc(**kwargs)
+                        NodesToSave = stageFunc(**kwargs)
+
+                    PipelineManager._SaveNodes(NodesToSave)
 
-                PipelineManager._SaveNodes(NodesToSave)
+                    # Stage boundary, make sure the stage's meta-data is on disk before the next stage runs
+                    VolumeDataWriter.Flush()
+
+                # Recorded with the inputs as the stage left them, which is how the next run will find them
+                WorkJournal.RecordComplete(VolumePath, str(PipelineFunction), ElementName, Inputs.Arguments, Inputs.Compute())
 
             finally:
                 ArgSet.ClearAttributes()
@@ -824,6 +1116,129 @@ class PipelineManager(object):
             del ArgSet.Variables[PipelineNode.attrib['VariableName']]
 
 
+# True in worker processes started for a parallel <Iterate>
+_InParallelWorker = False
+
+
+def _ElementLocator(element):
+    '''
+    :return: XPath from the volume root to a container element, or None if the element cannot be found that way
+    '''
+    steps = []
+    while element is not None and element.Parent is not None:
+        if not isinstance(element, VolumeManagerETree.XContainerElementWrapper):
+            return None
+
+        if "'" in element.Path:
+            return None
+
+        steps.insert(0, "%s[@Path='%s']" % (element.tag, element.Path))
+        element = element.Parent
+
+    return '/'.join(steps)
+
+
+def _FindByLocator(VolumeRoot, locator):
+    if len(locator) == 0:
+        return VolumeRoot
+
+    return VolumeRoot.find(locator)
+
+
+def _SplitVariables(Variables):
+    '''
+    Separate pipeline variables into values that can be sent to a worker process and volume elements the worker must find itself.
+    :return: (values, locators) or (None, None) if a variable cannot be sent to a worker
+    '''
+    values = {}
+    locators = {}
+    for (key, value) in Variables.items():
+        if isinstance(value, ElementTree.Element):
+            locator = _ElementLocator(value)
+            if locator is None:
+                return (None, None)
+
+            locators[key] = locator
+        else:
+            try:
+                pickle.dumps(value)
+            except Exception:
+                return (None, None)
+
+            values[key] = value
+
+    return (values, locators)
+
+
+def _PicklableArguments(Arguments):
+    '''Command line arguments that can be sent to a worker process.  Objects such as the argument parser are dropped.'''
+    picklable = {}
+    for (key, value) in Arguments.items():
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+
+        picklable[key] = value
+
+    return picklable
+
+
+def _AttributeChanges(Before, After):
+    '''
+    :return: (Attributes added or changed, names of attributes removed) between two attribute dictionaries
+    '''
+    Changed = {key: value for (key, value) in After.items() if Before.get(key, None) != value}
+    Removed = [key for key in Before.keys() if key not in After]
+    return (Changed, Removed)
+
+
+def _ExecuteIterationInWorker(PipelineXML, Arguments, Variables, VariableLocators, ElementLocator):
+    '''Runs one iteration of a parallel <Iterate> node in a worker process.
+    :return: Number of pipelines run, the stage profile records of the worker, the attribute changes made to each
+             element above the iterated element starting with its parent, and the checksums computed by the worker'''
+    global _InParallelWorker
+    _InParallelWorker = True
+
+    ImageHeaderCache.VerifyPolicy = Arguments.get('verifyimages', ImageHeaderCache.VerifyOnChange)
+    ChecksumCache.Load(Arguments['volumepath'])
+    ChecksumCache.TakeComputed()
+    WorkJournal.Load(Arguments['volumepath'])
+
+    # Pool workers are reused, only return the records of this iteration
+    StageProfile.Clear()
+
+    PipelineNode = ElementTree.fromstring(PipelineXML)
+    Pipeline = PipelineManager(pipelinesRoot=None, pipelineData=PipelineNode)
+    Pipeline.VolumeTree = VolumeManagerETree.VolumeManager.Load(Arguments['volumepath'])
+
+    ArgSet = ArgumentSet()
+    ArgSet.AddArguments(Arguments)
+    for (key, value) in Variables.items():
+        ArgSet.AddVariable(key, value)
+
+    for (key, locator) in VariableLocators.items():
+        ArgSet.AddVariable(key, _FindByLocator(Pipeline.VolumeTree, locator))
+
+    VolumeElem = _FindByLocator(Pipeline.VolumeTree, ElementLocator)
+
+    Ancestors = []
+    Ancestor = VolumeElem.Parent
+    while Ancestor is not None:
+        Ancestors.append(Ancestor)
+        Ancestor = Ancestor.Parent
+
+    AttributesBefore = [dict(Ancestor.attrib) for Ancestor in Ancestors]
+
+    NumProcessed = Pipeline.ExecuteChildPipelines(ArgSet, VolumeElem, PipelineNode)
+
+    nornir_pools.WaitOnAllPools()
+    VolumeDataWriter.Flush()
+
+    AncestorChanges = [_AttributeChanges(Before, Ancestor.attrib) for (Before, Ancestor) in zip(AttributesBefore, Ancestors)]
+    return (NumProcessed, StageProfile.Records, AncestorChanges, ChecksumCache.TakeComputed())
+
+
 def _GetVariableName(PipelineNode):
     if 'VariableName' in PipelineNode.attrib:
         return PipelineNode.attrib['VariableName']
@@ -0,0 +1,272 @@
+'''
+Dry-run planning of pipelines.
+
+When a pipeline is run with -plan the pipeline manager walks the pipeline
+and the volume as usual but stages are not called.  Instead each stage is
+handed to the staleness check registered for it, which inspects the volume
+meta-data and files to decide whether running the stage would do work.  The
+results are collected in a Plan that can be printed or written as JSON.
+
+Checks must be cheap and must not modify the volume.  Stages without a check
+are reported with an unknown status, they will run but may find nothing to do.
+
+'''
+
+import json
+import os
+
+import nornir_shared.misc
+import nornir_shared.prettyoutput as prettyoutput
+
+from nornir_buildmanager import DirectoryCache
+import nornir_buildmanager.templates
+import nornir_buildmanager.VolumeManagerETree as VolumeManagerETree
+
+Stale = 'stale'
+Current = 'current'
+Unknown = 'unknown'
+Blocked = 'blocked'
+
+# Stage function name, as written in the Function attribute of <PythonCall>, -> check function
+StalenessChecks = {}
+
+
+def StalenessCheck(*FunctionNames):
+    '''Decorator registering a check for the named stage functions.
+       A check takes the keyword arguments the stage would be called with and returns (Status, Reason, Cost).
+       Cost is the estimated number of tiles the stage will process, or None if unknown.'''
+
+    def Register(func):
+        for name in FunctionNames:
+            StalenessChecks[name] = func
+        return func
+
+    return Register
+
+
+class PlanEntry(object):
+    '''A stage the pipeline would call on an element'''
+
+    def __init__(self, Stage, Element, Status, Reason=None, Cost=None):
+        self.Stage = Stage
+        self.Element = Element
+        self.Status = Status
+        self.Reason = Reason
+        self.Cost = Cost
+
+    def ToDict(self):
+        return {'Stage': self.Stage,
+                'Element': self.Element,
+                'Status': self.Status,
+                'Reason': self.Reason,
+                'Cost': self.Cost}
+
+    def __str__(self):
+        outStr = "%-8s %-32s %s" % (self.Status, self.Stage, self.Element)
+        if self.Cost is not None:
+            outStr += " (%d tiles)" % self.Cost
+        if self.Reason is not None:
+            outStr += "\n         " + self.Reason
+        return outStr
+
+
+class Plan(object):
+    '''Stages a pipeline would run on a volume and whether each would do work'''
+
+    def __init__(self, VolumePath, PipelineName=None):
+        self.VolumePath = os.path.abspath(VolumePath)
+        self.PipelineName = PipelineName
+        self.Entries = []
+
+    @property
+    def NumStale(self):
+        return sum(1 for e in self.Entries if e.Status == Stale)
+
+    @property
+    def EstimatedCost(self):
+        return sum(e.Cost for e in self.Entries if e.Status == Stale and e.Cost is not None)
+
+    def _ElementName(self, VolumeElem):
+        FullPath = getattr(VolumeElem, 'FullPath', None)
+        if FullPath is None:
+            return VolumeElem.tag
+
+        try:
+            relpath = os.path.relpath(FullPath, self.VolumePath)
+        except ValueError:
+            return FullPath
+
+        return VolumeElem.tag + ' ' + relpath
+
+    def AddStage(self, FunctionName, VolumeElem, kwargs):
+        '''Record a stage call, using the stage's staleness check if one is registered'''
+        check = StalenessChecks.get(FunctionName, None)
+        if check is None:
+            entry = PlanEntry(FunctionName, self._ElementName(VolumeElem), Unknown, "No staleness check, stage will run")
+        else:
+            try:
+                (Status, Reason, Cost) = check(**kwargs)
+            except Exception as e:
+                (Status, Reason, Cost) = (Unknown, "Staleness check failed: " + str(e), None)
+
+            entry = PlanEntry(FunctionName, self._ElementName(VolumeElem), Status, Reason, Cost)
+
+        self.Entries.append(entry)
+        return entry
+
+    def AddInvalidElement(self, VolumeElem, Reason):
+        '''Record an element the pipeline would remove because it is invalid'''
+        self.Entries.append(PlanEntry('Clean', self._ElementName(VolumeElem), Stale, Reason))
+
+    def AddBlocked(self, VolumeElem, PipelineNode, Reason):
+        '''Record pipeline steps that depend on output of stale stages and cannot be checked until it exists'''
+        self.Entries.append(PlanEntry(PipelineNode.tag, self._ElementName(VolumeElem), Blocked, Reason))
+
+    def ToDict(self):
+        return {'Volume': self.VolumePath,
+                'Pipeline': self.PipelineName,
+                'Stages': [e.ToDict() for e in self.Entries],
+                'Stale': self.NumStale,
+                'EstimatedCost': self.EstimatedCost}
+
+    def Save(self, fullpath):
+        with open(fullpath, 'w') as hFile:
+            json.dump(self.ToDict(), hFile, indent=2)
+
+    def Print(self):
+        prettyoutput.Log("Plan for %s on %s" % (self.PipelineName, self.VolumePath))
+        for entry in self.Entries:
+            prettyoutput.Log(str(entry))
+
+        prettyoutput.Log("%d of %d stages would run, estimated %d tiles processed" % (self.NumStale, len(self.Entries), self.EstimatedCost))
+
+
+def _NumberOfTiles(FilterNode):
+    if FilterNode is None or not FilterNode.HasTilePyramid:
+        return None
+
+    return FilterNode.TilePyramid.NumberOfTiles
+
+
+def _CheckOutputTransform(TransformNode, FilterNode, OutputTransformPath):
+    '''Mirrors validation.transforms.LoadOrCleanExistingTransformForInputTransform without modifying the volume'''
+    Cost = _NumberOfTiles(FilterNode)
+
+    OutputTransformNode = TransformNode.Parent.GetChildByAttrib('Transform', 'Path', OutputTransformPath)
+    if OutputTransformNode is None:
+        return (Stale, "Output transform %s does not exist" % OutputTransformPath, Cost)
+
+    if not DirectoryCache.Exists(OutputTransformNode.FullPath):
+        return (Stale, "Output transform file missing %s" % OutputTransformNode.FullPath, Cost)
+
+    if OutputTransformNode.Locked:
+        return (Current, "Output transform %s is locked" % OutputTransformNode.Name, None)
+
+    if not OutputTransformNode.IsInputTransformMatched(TransformNode):
+        return (Stale, "Input transform %s changed" % TransformNode.Name, Cost)
+
+    return (Current, None, None)
+
+
+@StalenessCheck('registration.TranslateTransform')
+def _TranslateTransformIsStale(Parameters, TransformNode, FilterNode, **kwargs):
+    OutputTransformName = kwargs.get('OutputTransform', 'Translated_' + TransformNode.Name)
+    OutputTransformPath = VolumeManagerETree.MosaicBaseNode.GetFilename(OutputTransformName, "_Max0.5")
+    return _CheckOutputTransform(TransformNode, FilterNode, OutputTransformPath)
+
+
+@StalenessCheck('registration.GridTransform')
+def _GridTransformIsStale(Parameters, TransformNode, FilterNode, RegistrationDownsample, **kwargs):
+    (Valid, Reason) = TransformNode.IsValid()
+    if not Valid:
+        return (Current, "Input transform is invalid and will be skipped: " + Reason, None)
+
+    # GridTransform adds the pixel spacing to its parameters before naming the output
+    Parameters = dict(Parameters)
+    Parameters['sp'] = int(RegistrationDownsample)
+
+    OutputTransformName = kwargs.get('OutputTransform', 'Refined_' + TransformNode.Name)
+    OutputTransformPath = VolumeManagerETree.MosaicBaseNode.GetFilename(OutputTransformName, nornir_shared.misc.GenNameFromDict(Parameters))
+    return _CheckOutputTransform(TransformNode, FilterNode, OutputTransformPath)
+
+
+@StalenessCheck('tile.HistogramFilter')
+def _HistogramFilterIsStale(Parameters, FilterNode, TransformNode, **kwargs):
+    if TransformNode is None:
+        return (Current, "No transform, stage will be skipped", None)
+
+    Cost = _NumberOfTiles(FilterNode)
+    MangledName = nornir_shared.misc.GenNameFromDict(Parameters) + TransformNode.Type
+    HistogramElement = FilterNode.GetChildByAttrib('Histogram', 'Type', MangledName)
+    if HistogramElement is None:
+        return (Stale, "Histogram %s does not exist" % MangledName, Cost)
+
+    if not HistogramElement.IsInputTransformMatched(TransformNode):
+        return (Stale, "Input transform %s changed" % TransformNode.Name, Cost)
+
+    if not (DirectoryCache.Exists(HistogramElement.DataFullPath) and DirectoryCache.Exists(HistogramElement.ImageFullPath)):
+        return (Stale, "Histogram data or image file missing", Cost)
+
+    return (Current, None, None)
+
+
+@StalenessCheck('tile.AutolevelTiles')
+def _AutolevelTilesIsStale(Parameters, InputFilter, Downsample=1, TransformNode=None, OutputFilterName=None, **kwargs):
+    from nornir_buildmanager.operations import tile
+
+    if OutputFilterName is None:
+        OutputFilterName = 'Leveled'
+
+    Cost = _NumberOfTiles(InputFilter)
+    OutputFilterNode = InputFilter.Parent.GetFilter(OutputFilterName)
+    if OutputFilterNode is None:
+        return (Stale, "Output filter %s does not exist" % OutputFilterName, Cost)
+
+    if TransformNode is None:
+        return (Unknown, "No transform, the tiles to level cannot be determined", Cost)
+
+    if not tile.FilterIsPopulated(InputFilter, Downsample, TransformNode.FullPath, OutputFilterName):
+        return (Stale, "Output filter %s is missing tiles" % OutputFilterName, Cost)
+
+    if OutputFilterNode.Locked:
+        return (Current, "Output filter %s is locked" % OutputFilterName, None)
+
+    # A changed histogram or contrast setting also rebuilds the filter, which requires computing the cutoffs
+    return (Current, "Contrast settings are not checked", None)
+
+
+@StalenessCheck('tile.BuildTilePyramids')
+def _BuildTilePyramidsIsStale(PyramidNode=None, Levels=None, **kwargs):
+    if PyramidNode is None:
+        return (Current, "No pyramid, stage will be skipped", None)
+
+    if Levels is None:
+        Levels = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+    elif isinstance(Levels, str):
+        Levels = nornir_shared.misc.SortedListFromDelimited(Levels)
+    elif isinstance(Levels, int) or isinstance(Levels, float):
+        Levels = [Levels]
+
+    PyramidLevels = sorted(frozenset(Levels))
+    if not PyramidNode.HasLevel(PyramidLevels[0]):
+        MoreDetailedLevel = PyramidNode.MoreDetailedLevel(PyramidLevels[0])
+        if MoreDetailedLevel is None:
+            return (Unknown, "No pyramid level available with more detail than %d" % PyramidLevels[0], None)
+
+        PyramidLevels.insert(0, MoreDetailedLevel.Downsample)
+
+    LevelFormatStr = PyramidNode.attrib.get('LevelFormat', nornir_buildmanager.templates.Current.LevelFormat)
+    pattern = '*' + PyramidNode.ImageFormatExt
+
+    MissingTiles = 0
+    for i in range(1, len(PyramidLevels)):
+        InputTileDir = os.path.join(PyramidNode.FullPath, LevelFormatStr % PyramidLevels[i - 1])
+        OutputTileDir = os.path.join(PyramidNode.FullPath, LevelFormatStr % PyramidLevels[i])
+        NumInput = len(DirectoryCache.Glob(InputTileDir, pattern))
+        NumOutput = len(DirectoryCache.Glob(OutputTileDir, pattern))
+        MissingTiles += max(0, NumInput - NumOutput)
+
+    if MissingTiles > 0:
+        return (Stale, "%d tiles missing from downsampled levels" % MissingTiles, MissingTiles)
+
+    return (Current, None, None)
@@ -8,8 +8,6 @@ import logging
 import math
 import os
 
-import nornir_imageregistration
-
 
 def DimensionsMatch(imageFullPath, area):
     '''Return true if the area matches the area of the image.
@@ -20,6 +18,8 @@ def DimensionsMatch(imageFullPath, area):
     if area is None:
         raise TypeError("RemoveOnDimensionMismatch area parameter should be a (Width,Height) tuple instead of None")
 
+    import nornir_imageregistration
+
     try:
         size = nornir_imageregistration.GetImageSize(imageFullPath)
     except IOError as e:
@@ -3,14 +3,28 @@ Created on Feb 18, 2013
 
 @author: u0490822
 '''
+import argparse
 import glob
+import json
 import logging
 import os
 import shutil
+import time
 import unittest
+import unittest.mock
+import xml.etree.ElementTree as ElementTree
 
 from nornir_buildmanager.VolumeManagerETree import *
+import nornir_buildmanager.ChecksumCache as ChecksumCache
+import nornir_buildmanager.DirectoryCache as DirectoryCache
+import nornir_buildmanager.StageProfile as StageProfile
+import nornir_buildmanager.VolumeManagerETree as VolumeManagerETree
+import nornir_buildmanager.VolumeDataCache as VolumeDataCache
+import nornir_buildmanager.VolumeDataWriter as VolumeDataWriter
+import nornir_buildmanager.WorkJournal as WorkJournal
 import nornir_buildmanager.build
+import nornir_buildmanager.pipelinemanager
+import nornir_buildmanager.planner as planner
 import nornir_shared.files
 import nornir_shared.misc
 import test.testbase
@@ -18,6 +32,19 @@ import test.testbase
 import nornir_buildmanager.importers.pmg as pmg
 
 
+def _MarkSectionAndBlock(VolumeElement, **kwargs):
+    '''Stage run by ParallelIterateTest.  Changes the section it runs on and the block above it and checksums a file.'''
+    VolumeElement.attrib['Marked'] = 'True'
+    VolumeElement.Parent.attrib['MarkedSection%d' % VolumeElement.Number] = 'True'
+
+    os.makedirs(VolumeElement.FullPath, exist_ok=True)
+    with open(os.path.join(VolumeElement.FullPath, 'Checksummed.txt'), 'w') as hFile:
+        hFile.write(str(VolumeElement.Number))
+
+    ChecksumCache.Get(os.path.join(VolumeElement.FullPath, 'Checksummed.txt'), 'test', lambda path: 'Section%d' % VolumeElement.Number)
+    return VolumeElement.Parent
+
+
 class VolumeManagerTestBase(test.testbase.TestBase):
 
     def setUp(self):
@@ -31,6 +58,7 @@ class VolumeManagerTestBase(test.testbase.TestBase):
         self.VolumeObj = VolumeManager.Load(self.VolumeFullPath, Create=True)
         
     def tearDown(self):
+        VolumeDataWriter.Flush()
         if os.path.exists(self.VolumeFullPath):
             shutil.rmtree(self.VolumeFullPath)
             
@@ -104,6 +132,661 @@ class VolumeManagerFilterTest(VolumeManagerTestBase):
         nornir_buildmanager.build.Execute(buildArgs=[self.TestOutputPath, 'ListFilterContrast'])
         
 
+class VolumeManagerLinkTest(VolumeManagerTestBase):
+
+    def testLazyLinkResolution(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        self.assertTrue(added_block, "New block should return true")
+
+        for number in range(1, 11):
+            block.GetOrCreateSection(number)
+
+        self.VolumeObj.Save()
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        LinkStats.Reset()
+
+        section = self.VolumeObj.find("Block/Section[@Number='5']")
+        self.assertIsNotNone(section, "Section should be found through the link elements")
+        self.assertEqual(section.Number, 5)
+        self.assertEqual(LinkStats.Resolved, 2, "Only the block and the requested section should be loaded")
+        self.assertEqual(LinkStats.Skipped, 9, "Sections rejected by the predicate should not be loaded")
+
+        sections = list(self.VolumeObj.findall("Block/Section"))
+        self.assertEqual(len(sections), 10, "All sections should be returned by findall")
+        self.assertEqual(LinkStats.Resolved, 11, "Remaining sections should be loaded by findall")
+
+    def testParallelPreload(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        for number in range(1, 11):
+            block.GetOrCreateSection(number)
+
+        self.VolumeObj.Save()
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        LinkStats.Reset()
+        self.VolumeObj.LoadAllLinkedNodes(MaxWorkers=2)
+        self.assertEqual(LinkStats.Resolved, 11, "The block and every section should be loaded")
+
+        block = self.VolumeObj.find("Block")
+        self.assertFalse(any(child.tag.endswith('_Link') for child in block), "No links should remain after preloading")
+        self.assertEqual(len(list(block.findall("Section"))), 10)
+        self.assertFalse(self.VolumeObj.IsDirty, "Preloading should not require the volume to be saved")
+
+    def testSerialPreload(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        for number in range(1, 4):
+            block.GetOrCreateSection(number)
+
+        self.VolumeObj.Save()
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        LinkStats.Reset()
+
+        # Links below the first level are loaded serially too, even on a machine with several CPUs
+        with unittest.mock.patch.object(VolumeManagerETree.os, 'cpu_count', return_value=4), \
+             unittest.mock.patch.object(VolumeManagerETree, '_PreloadLinkedNodes', side_effect=AssertionError("MaxWorkers=1 should not start a pool")):
+            self.VolumeObj.LoadAllLinkedNodes(MaxWorkers=1)
+
+        self.assertEqual(LinkStats.Resolved, 4, "The block and every section should be loaded")
+
+
+class ParallelIterateTest(VolumeManagerTestBase):
+
+    PipelineXML = '''<Iterate Parallel="true" MaxWorkers="2" VariableName="SectionNode" XPath="Block/Section">
+                       <PythonCall Module="test.pipeline.test_VolumeManager" Function="_MarkSectionAndBlock"/>
+                     </Iterate>'''
+
+    def testWorkerChangesParent(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        for number in range(1, 5):
+            block.GetOrCreateSection(number)
+
+        self.VolumeObj.Save()
+        ChecksumCache.Clear()
+
+        PipelineNode = ElementTree.fromstring(self.PipelineXML)
+        Pipeline = nornir_buildmanager.pipelinemanager.PipelineManager(pipelinesRoot=None, pipelineData=PipelineNode)
+        Pipeline.VolumeTree = self.VolumeObj
+        ArgSet = nornir_buildmanager.pipelinemanager.ArgumentSet()
+        ArgSet.AddArguments({'volumepath': self.VolumeFullPath, 'verbose': False, 'debug': True})
+
+        NumProcessed = Pipeline.ExecuteIterationsInParallel(ArgSet, list(self.VolumeObj.findall("Block/Section")), PipelineNode)
+        self.assertEqual(NumProcessed, 4)
+        VolumeDataWriter.Flush()
+
+        # Workers running at the same time each save the block, the changes of every worker must survive
+        for VolumeObj in (self.VolumeObj, VolumeManager.Load(self.VolumeFullPath)):
+            block = VolumeObj.find("Block")
+            for number in range(1, 5):
+                self.assertEqual(block.attrib.get('MarkedSection%d' % number), 'True', "Change a worker made to the parent was lost")
+                self.assertEqual(block.GetSection(number).attrib.get('Marked'), 'True')
+
+            self.assertEqual(len(list(block.findall("Section"))), 4)
+
+        # Checksums computed by the workers are kept so they are saved with the cache
+        for number in range(1, 5):
+            ChecksumFile = os.path.join(block.GetSection(number).FullPath, 'Checksummed.txt')
+            self.assertEqual(ChecksumCache.TryGet(ChecksumFile, 'test'), 'Section%d' % number)
+
+
+class VolumeDataCacheTest(VolumeManagerTestBase):
+
+    def testCacheMatchesXML(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        block.GetOrCreateSection(1)
+        self.VolumeObj.Save()
+
+        VolumeDataCache.Stats.Reset()
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        self.assertIsNotNone(self.VolumeObj.find("Block/Section[@Number='1']"))
+        self.assertEqual(VolumeDataCache.Stats.Misses, 3, "First load should parse the XML of the volume, block, and section")
+
+        VolumeDataCache.Stats.Reset()
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        section = self.VolumeObj.find("Block/Section[@Number='1']")
+        self.assertIsNotNone(section)
+        self.assertEqual(VolumeDataCache.Stats.Hits, 3, "Unchanged XML files should be read from the cache")
+
+        # Changing the XML must invalidate the cache
+        section.Name = "Renamed"
+        section.Save()
+
+        VolumeDataCache.Stats.Reset()
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        section = self.VolumeObj.find("Block/Section[@Number='1']")
+        self.assertEqual(section.Name, "Renamed", "Cache should not return stale data")
+        self.assertEqual(VolumeDataCache.Stats.Misses, 1, "Only the saved section should be parsed")
+
+    def testRewriteWithinMTimeTick(self):
+        '''A file rewritten at the same size without a new modification time must not be read from the cache'''
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        block.Name = "Before"
+        self.VolumeObj.Save()
+        VolumeDataWriter.Flush()
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        self.assertEqual(self.VolumeObj.find("Block").Name, "Before")
+
+        XMLFullPath = os.path.join(self.VolumeFullPath, 'TEM', 'VolumeData.xml')
+        st = os.stat(XMLFullPath)
+        with open(XMLFullPath, 'rb') as hFile:
+            data = hFile.read()
+
+        # Rewrite in place so the inode is kept, then restore the modification time
+        with open(XMLFullPath, 'r+b') as hFile:
+            hFile.write(data.replace(b'"Before"', b'"After_"'))
+
+        os.utime(XMLFullPath, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(os.stat(XMLFullPath).st_size, st.st_size)
+
+        VolumeDataCache.Stats.Reset()
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        self.assertEqual(self.VolumeObj.find("Block").Name, "After_", "Cache should not return stale data")
+        self.assertEqual(VolumeDataCache.Stats.Misses, 1)
+
+
+class VolumeManagerSaveTest(VolumeManagerTestBase):
+
+    def testOnlyChangedFilesAreWritten(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        for number in range(1, 4):
+            block.GetOrCreateSection(number)
+
+        self.VolumeObj.Save()
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        sections = list(self.VolumeObj.findall("Block/Section"))
+        self.assertEqual(len(sections), 3)
+
+        SaveStats.Reset()
+        self.VolumeObj.Save()
+        self.assertEqual(SaveStats.Written, 0, "Unchanged volume should not write any files")
+
+        section = self.VolumeObj.find("Block/Section[@Number='2']")
+        section.Name = "Changed"
+        self.VolumeObj.Save()
+        self.assertEqual(SaveStats.Written, 2, "The section and the block holding its link should be written")
+
+        self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        section = self.VolumeObj.find("Block/Section[@Number='2']")
+        self.assertEqual(section.Name, "Changed", "Changes should be saved")
+
+    def testUntrackedMutationPaths(self):
+        '''set(), assigning attrib and replacing a child by index must all be saved'''
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        block.GetOrCreateSection(1)
+        self.VolumeObj.Save()
+
+        def LoadSection():
+            self.VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+            return self.VolumeObj.find("Block/Section[@Number='1']")
+
+        section = LoadSection()
+        section.set('Name', 'Set')
+        self.assertTrue(section.IsDirty)
+        self.VolumeObj.Save()
+        self.assertEqual(LoadSection().Name, 'Set')
+
+        section = LoadSection()
+        attrib = dict(section.attrib)
+        attrib['Name'] = 'Assigned'
+        section.attrib = attrib
+        self.assertTrue(section.IsDirty)
+        section.Name = 'AssignedThenSet'
+        self.VolumeObj.Save()
+        self.assertEqual(LoadSection().Name, 'AssignedThenSet')
+
+        section = LoadSection()
+        [added_channel, channel] = section.UpdateOrAddChild(ChannelNode.Create("YY"))
+        self.VolumeObj.Save()
+
+        section = LoadSection()
+        section[section.indexofchild(section.find('Channel'))] = ChannelNode.Create("ZZ")
+        self.assertTrue(section.IsDirty)
+        self.VolumeObj.Save()
+        self.assertIsNone(LoadSection().find("Channel[@Name='YY']"))
+        self.assertIsNotNone(LoadSection().find("Channel[@Name='ZZ']"))
+
+
+class VolumeDataWriterTest(VolumeManagerTestBase):
+
+    def testLastWriteWins(self):
+
+        XMLFilename = os.path.join(self.VolumeFullPath, "Writer.xml")
+        VolumeDataWriter.Flush()
+        VolumeDataWriter.Stats.Reset()
+
+        for i in range(0, 20):
+            VolumeDataWriter.Write(XMLFilename, ("<Test Value='%d'/>" % i).encode('utf-8'))
+
+        VolumeDataWriter.Flush()
+
+        with open(XMLFilename, 'rb') as hFile:
+            self.assertEqual(hFile.read(), "<Test Value='19'/>".encode('utf-8'), "Last queued contents should be written")
+
+        self.assertEqual(VolumeDataWriter.Stats.Queued + VolumeDataWriter.Stats.Coalesced, 20)
+        self.assertEqual(VolumeDataWriter.Stats.Written, VolumeDataWriter.Stats.Queued)
+        self.assertEqual(len(glob.glob(XMLFilename + '.*.tmp')), 0, "Temporary files should be replaced")
+
+
+class ChecksumCacheTest(VolumeManagerTestBase):
+
+    def testChecksumsFollowFileChanges(self):
+
+        TestFilename = os.path.join(self.VolumeFullPath, "Checksum.txt")
+        with open(TestFilename, 'w') as hFile:
+            hFile.write("Original")
+
+        def CalcChecksum(fullpath):
+            with open(fullpath, 'r') as hFile:
+                return hFile.read()
+
+        ChecksumCache.Clear()
+        ChecksumCache.Stats.Reset()
+        self.assertEqual(ChecksumCache.Get(TestFilename, 'test', CalcChecksum), "Original")
+        self.assertEqual(ChecksumCache.Get(TestFilename, 'test', CalcChecksum), "Original")
+        self.assertEqual(ChecksumCache.Stats.Misses, 1, "Unchanged file should only be read once")
+        self.assertEqual(ChecksumCache.Stats.Hits, 1)
+
+        with open(TestFilename, 'w') as hFile:
+            hFile.write("Changed file")
+
+        self.assertEqual(ChecksumCache.Get(TestFilename, 'test', CalcChecksum), "Changed file", "Changed file should be read again")
+
+        ChecksumCache.Save(self.VolumeFullPath)
+        ChecksumCache.Clear()
+        ChecksumCache.Load(self.VolumeFullPath)
+        ChecksumCache.Stats.Reset()
+        self.assertEqual(ChecksumCache.Get(TestFilename, 'test', CalcChecksum), "Changed file")
+        self.assertEqual(ChecksumCache.Stats.Hits, 1, "Checksum should be restored from the volume's cache file")
+
+
+def BackdateDirectory(path):
+    '''Set the modification time of a directory far enough in the past that its listing can be reused'''
+    past = os.stat(path).st_mtime - 2 * DirectoryCache.MTimeResolution
+    os.utime(path, (past, past))
+
+
+class DirectoryCacheTest(VolumeManagerTestBase):
+
+    def testListingFollowsChanges(self):
+
+        TileDir = os.path.join(self.VolumeFullPath, "Tiles")
+        os.makedirs(TileDir)
+        for i in range(0, 5):
+            with open(os.path.join(TileDir, "%03d.png" % i), 'w') as hFile:
+                hFile.write("x" * (i + 1))
+
+        BackdateDirectory(TileDir)
+        DirectoryCache.Clear()
+        DirectoryCache.Stats.Reset()
+
+        self.assertEqual(len(DirectoryCache.Glob(TileDir, "*.png")), 5)
+        self.assertTrue(DirectoryCache.Exists(os.path.join(TileDir, "004.png")))
+        self.assertFalse(DirectoryCache.Exists(os.path.join(TileDir, "005.png")))
+        self.assertEqual(DirectoryCache.GetSize(os.path.join(TileDir, "002.png")), 3)
+        self.assertEqual(DirectoryCache.Stats.Scans, 1, "Queries should be answered from a single listing")
+
+        os.remove(os.path.join(TileDir, "004.png"))
+        DirectoryCache.Invalidate(TileDir)
+        self.assertFalse(DirectoryCache.Exists(os.path.join(TileDir, "004.png")), "Invalidated listing should be rescanned")
+        self.assertEqual(len(DirectoryCache.Glob(TileDir, "*.png")), 4)
+
+    def testInvalidateDescendants(self):
+        LevelDir = os.path.join(self.VolumeFullPath, "Filter", "TilePyramid", "001")
+        os.makedirs(LevelDir)
+        with open(os.path.join(LevelDir, "000.png"), 'w') as hFile:
+            hFile.write("x")
+
+        BackdateDirectory(LevelDir)
+        DirectoryCache.Clear()
+        self.assertTrue(DirectoryCache.Exists(os.path.join(LevelDir, "000.png")))
+
+        DirectoryCache.Stats.Reset()
+        DirectoryCache.Invalidate(os.path.join(self.VolumeFullPath, "Filter"))
+        self.assertTrue(DirectoryCache.Exists(os.path.join(LevelDir, "000.png")))
+        self.assertEqual(DirectoryCache.Stats.Scans, 1, "Invalidating a directory should discard the listings below it")
+
+    def testCleanFilterThenRebuild(self):
+        '''Tiles of a cleaned filter are not reported to exist by listings taken before it was cleaned'''
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(BlockNode.Create("TEM"))
+        (added_section, section) = block.GetOrCreateSection(1)
+        [added_channel, channel] = section.UpdateOrAddChild(ChannelNode.Create("YY"))
+        (added_filter, raw) = channel.GetOrCreateFilter("Raw16")
+        (added_filter, leveled) = channel.GetOrCreateFilter("Leveled")
+
+        InputTile = os.path.join(raw.FullPath, "TilePyramid", "001", "000.png")
+        OutputTile = os.path.join(leveled.FullPath, "TilePyramid", "001", "000.png")
+        for tile in [InputTile, OutputTile]:
+            os.makedirs(os.path.dirname(tile))
+            with open(tile, 'w') as hFile:
+                hFile.write("x")
+
+        # The output is newer than the input, so it is not rebuilt
+        st = os.stat(OutputTile)
+        os.utime(InputTile, ns=(st.st_atime_ns, st.st_mtime_ns - 10 ** 9))
+        for tile in [InputTile, OutputTile]:
+            BackdateDirectory(os.path.dirname(tile))
+
+        DirectoryCache.Clear()
+        self.assertTrue(DirectoryCache.Exists(OutputTile))
+        self.assertFalse(DirectoryCache.OutdatedFile(InputTile, OutputTile))
+
+        leveled.Clean("Test")
+        self.assertFalse(os.path.exists(OutputTile))
+        self.assertFalse(DirectoryCache.Exists(OutputTile), "The tile must be rebuilt after its filter was cleaned")
+
+        # Rebuild the tile
+        os.makedirs(os.path.dirname(OutputTile))
+        with open(OutputTile, 'w') as hFile:
+            hFile.write("y")
+
+        self.assertTrue(DirectoryCache.Exists(OutputTile))
+        self.assertFalse(DirectoryCache.OutdatedFile(InputTile, OutputTile))
+
+
+class PipelinePlanTest(VolumeManagerTestBase):
+
+    PipelineXML = """<Pipeline Name="PlanTest">
+                       <Iterate VariableName="ChannelNode" XPath="Block/Section/Channel">
+                         <Select VariableName="PyramidNode" Root="ChannelNode" XPath="Filter[@Name='Raw8']/TilePyramid"/>
+                         <PythonCall Function="tile.BuildTilePyramids" Levels="1,2"/>
+                       </Iterate>
+                     </Pipeline>"""
+
+    def testPlanDoesNotRunStages(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        (added_section, section) = block.GetOrCreateSection(1)
+        [added_channel, channel] = section.UpdateOrAddChild(ChannelNode.Create("YY"))
+        (added_filter, filter) = channel.GetOrCreateFilter("Raw8")
+        (added_pyramid, pyramid) = filter.GetOrCreateTilePyramid()
+        pyramid.ImageFormatExt = '.png'
+        pyramid.LevelFormat = '%03d'
+        pyramid.NumberOfTiles = 3
+
+        for (level, NumTiles) in [(1, 3), (2, 1)]:
+            [added_level, level_node] = pyramid.GetOrCreateLevel(level, GenerateData=False)
+            os.makedirs(level_node.FullPath)
+            for i in range(0, NumTiles):
+                with open(os.path.join(level_node.FullPath, "%03d.png" % i), 'w') as hFile:
+                    hFile.write("x")
+
+        self.VolumeObj.Save()
+        VolumeDataWriter.Flush()
+
+        Level2Path = os.path.join(pyramid.FullPath, '002')
+
+        pipeline = nornir_buildmanager.pipelinemanager.PipelineManager(None, ElementTree.fromstring(self.PipelineXML))
+        PlanFile = os.path.join(self.VolumeFullPath, 'Plan.json')
+        args = argparse.Namespace(volumepath=self.VolumeFullPath, debug=True, verbose=False, plan=True, planfile=PlanFile)
+        pipeline.Execute(args)
+
+        self.assertEqual(len(glob.glob(os.path.join(Level2Path, '*.png'))), 1, "Planning must not build tiles")
+
+        with open(PlanFile, 'r') as hFile:
+            plan = json.load(hFile)
+
+        self.assertEqual(len(plan['Stages']), 1)
+        self.assertEqual(plan['Stages'][0]['Stage'], 'tile.BuildTilePyramids')
+        self.assertEqual(plan['Stages'][0]['Status'], 'stale', plan['Stages'][0]['Reason'])
+        self.assertEqual(plan['EstimatedCost'], 2)
+
+    def testPlanDoesNotCleanLinkedElements(self):
+
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(BlockNode.Create("TEM"))
+        (added_section, section) = block.GetOrCreateSection(1)
+        [added_channel, channel] = section.UpdateOrAddChild(ChannelNode.Create("YY"))
+        (added_filter, filter) = channel.GetOrCreateFilter("Raw8")
+        (added_pyramid, pyramid) = filter.GetOrCreateTilePyramid()
+        pyramid.ImageFormatExt = '.png'
+        pyramid.LevelFormat = '%03d'
+        pyramid.NumberOfTiles = 3
+
+        [added_level, level_node] = pyramid.GetOrCreateLevel(1, GenerateData=False)
+        LevelPath = level_node.FullPath
+        os.makedirs(LevelPath)
+
+        # More tiles than the pyramid has makes the linked level invalid
+        for i in range(0, 4):
+            with open(os.path.join(LevelPath, "%03d.png" % i), 'w') as hFile:
+                hFile.write("x")
+
+        self.VolumeObj.Save()
+        VolumeDataWriter.Flush()
+
+        PipelineXML = """<Pipeline Name="PlanTest">
+                           <Iterate VariableName="LevelNode" XPath="Block/Section/Channel/Filter/TilePyramid/Level">
+                             <PythonCall Function="tile.BuildTilePyramids" Levels="1,2"/>
+                           </Iterate>
+                         </Pipeline>"""
+
+        pipeline = nornir_buildmanager.pipelinemanager.PipelineManager(None, ElementTree.fromstring(PipelineXML))
+        PlanFile = os.path.join(self.VolumeFullPath, 'Plan.json')
+        args = argparse.Namespace(volumepath=self.VolumeFullPath, debug=True, verbose=False, plan=True, planfile=PlanFile)
+        pipeline.Execute(args)
+
+        self.assertFalse(VolumeManagerETree.Planning)
+        self.assertEqual(len(glob.glob(os.path.join(LevelPath, '*.png'))), 4, "Planning must not remove invalid elements")
+
+        with open(PlanFile, 'r') as hFile:
+            plan = json.load(hFile)
+
+        self.assertEqual([s['Stage'] for s in plan['Stages']], ['Clean'])
+
+    def testAutolevelPlanWithoutTransform(self):
+
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(BlockNode.Create("TEM"))
+        (added_section, section) = block.GetOrCreateSection(1)
+        [added_channel, channel] = section.UpdateOrAddChild(ChannelNode.Create("YY"))
+        (added_filter, InputFilter) = channel.GetOrCreateFilter("Raw8")
+        channel.GetOrCreateFilter("Leveled")
+
+        (Status, Reason, Cost) = planner.StalenessChecks['tile.AutolevelTiles'](Parameters={}, InputFilter=InputFilter, TransformNode=None)
+        self.assertEqual(Status, planner.Unknown, Reason)
+
+
+class StageProfileTest(VolumeManagerTestBase):
+
+    def testStageRecordsAreSaved(self):
+
+        StageProfile.Clear()
+
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(BlockNode.Create("TEM"))
+        for i in range(0, 2):
+            with StageProfile.Measure("test.AddSection", StageProfile.ElementName(block, self.VolumeFullPath)):
+                (added_section, section) = block.GetOrCreateSection(i)
+                self.VolumeObj.Save()
+                time.sleep(0.01)
+
+        self.assertEqual(len(StageProfile.Records), 2)
+        record = StageProfile.Records[0]
+        self.assertEqual(record.Element, "Block TEM")
+        self.assertGreater(record.WallTime, 0)
+        self.assertGreater(record.XMLFilesSaved, 0, "Adding a section should write VolumeData.xml files")
+
+        StageProfile.Save(self.VolumeFullPath)
+
+        with open(os.path.join(self.VolumeFullPath, StageProfile.ProfileFilename + '.json'), 'r') as hFile:
+            self.assertEqual(len(json.load(hFile)), 2)
+
+        with open(os.path.join(self.VolumeFullPath, StageProfile.ProfileFilename + '.csv'), 'r') as hFile:
+            self.assertEqual(len(hFile.readlines()), 3, "Expected a header and a row for each record")
+
+        self.assertEqual(glob.glob(os.path.join(self.VolumeFullPath, StageProfile.ProfileFilename + '*.tmp')), [], "Profile files should be written atomically")
+
+        self.assertIn("test.AddSection", StageProfile.Summary())
+
+
+JournalTestCalls = []
+
+
+def RecordJournalTestCall(FilterNode, **kwargs):
+    '''Stage used by WorkJournalTest'''
+    JournalTestCalls.append(FilterNode.Name)
+    return None
+
+
+class WorkJournalTest(VolumeManagerTestBase):
+
+    PipelineXML = """<Pipeline Name="JournalTest">
+                       <Iterate VariableName="ChannelNode" XPath="Block/Section/Channel">
+                         <Select VariableName="FilterNode" Root="ChannelNode" XPath="Filter[@Name='Raw8']"/>
+                         <PythonCall Module="test.pipeline.test_VolumeManager" Function="RecordJournalTestCall"
+                                     Verbose="#verbose" MaxTilesInFlight="#MaxTilesInFlight"/>
+                       </Iterate>
+                     </Pipeline>"""
+
+    def RunPipeline(self, verbose=False, MaxTilesInFlight=8):
+        pipeline = nornir_buildmanager.pipelinemanager.PipelineManager(None, ElementTree.fromstring(self.PipelineXML))
+        args = argparse.Namespace(volumepath=self.VolumeFullPath, debug=True, verbose=verbose, plan=False, planfile=None, resume=True, MaxTilesInFlight=MaxTilesInFlight)
+        pipeline.Execute(args)
+
+    def testCompletedStagesAreSkipped(self):
+
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(BlockNode.Create("TEM"))
+        for i in range(0, 2):
+            (added_section, section) = block.GetOrCreateSection(i)
+            [added_channel, channel] = section.UpdateOrAddChild(ChannelNode.Create("YY"))
+            channel.GetOrCreateFilter("Raw8")
+
+        self.VolumeObj.Save()
+        VolumeDataWriter.Flush()
+
+        del JournalTestCalls[:]
+        self.RunPipeline()
+        self.assertEqual(len(JournalTestCalls), 2)
+
+        del JournalTestCalls[:]
+        self.RunPipeline()
+        self.assertEqual(len(JournalTestCalls), 0, "Completed stages should be skipped when resuming")
+
+        # Options that do not change the output of a stage must not invalidate the journal
+        self.RunPipeline(verbose=True, MaxTilesInFlight=2)
+        self.assertEqual(len(JournalTestCalls), 0, "Changing -verbose or -MaxTilesInFlight should not rerun completed stages")
+
+        # Changing an input of one stage call must run the stage for that element again
+        VolumeObj = VolumeManager.Load(self.VolumeFullPath)
+        filter = VolumeObj.find("Block/Section/Channel/Filter[@Name='Raw8']")
+        filter.BitsPerPixel = 16
+        VolumeManager.Save(filter.Parent)
+        VolumeDataWriter.Flush()
+
+        self.RunPipeline()
+        self.assertEqual(len(JournalTestCalls), 1)
+
+        with open(WorkJournal.JournalFullPath(self.VolumeFullPath), 'r') as hFile:
+            self.assertEqual(len(hFile.readlines()), 2, "Journal should be compacted to one entry per stage and element")
+
+    def testDescendantChecksums(self):
+        '''Changing the checksum of an element below a stage's input, such as an image of a filter, changes the signature'''
+        filter = ElementTree.Element('Filter', {'Name': 'Raw8'})
+        imageset = ElementTree.SubElement(filter, 'ImageSet', {'Path': 'Images'})
+        image = ElementTree.SubElement(imageset, 'Image', {'Path': '001.png', 'Checksum': 'abc'})
+
+        Inputs = WorkJournal.InputSignature({'FilterNode': filter})
+        Signature = Inputs.Compute()
+        self.assertEqual(Signature, Inputs.Compute())
+
+        image.attrib['Checksum'] = 'abd'
+        self.assertNotEqual(Signature, Inputs.Compute())
+
+    def testArgumentsInKey(self):
+        '''Calls of a stage on one element with different arguments are recorded separately'''
+        filter = ElementTree.Element('Filter', {'Name': 'Raw8'})
+        Small = WorkJournal.InputSignature({'FilterNode': filter, 'Downsample': 2})
+        Large = WorkJournal.InputSignature({'FilterNode': filter, 'Downsample': 8})
+        self.assertNotEqual(Small.Arguments, Large.Arguments)
+
+        WorkJournal.Clear()
+        WorkJournal.RecordComplete(self.VolumeFullPath, 'Stage', 'Filter', Small.Arguments, Small.Compute())
+        WorkJournal.RecordComplete(self.VolumeFullPath, 'Stage', 'Filter', Large.Arguments, Large.Compute())
+        WorkJournal.Compact(self.VolumeFullPath)
+
+        WorkJournal.Load(self.VolumeFullPath)
+        self.assertTrue(WorkJournal.IsComplete('Stage', 'Filter', Small.Arguments, Small.Compute()))
+        self.assertTrue(WorkJournal.IsComplete('Stage', 'Filter', Large.Arguments, Large.Compute()))
+        self.assertFalse(WorkJournal.IsComplete('Stage', 'Filter', Small.Arguments, Large.Compute()))
+        WorkJournal.Clear()
+
+
+class PipelineStatsTest(test.testbase.TestBase):
+
+    def testResetAndFormat(self):
+        '''Every counter logged at the end of a pipeline is printed and cleared by Reset'''
+        for stats in nornir_buildmanager.pipelinemanager.PipelineStats:
+            for (i, name) in enumerate(stats.Counters):
+                setattr(stats, name, 7001 + i)
+
+            for i in range(len(stats.Counters)):
+                self.assertIn(str(7001 + i), str(stats))
+
+            stats.Reset()
+            self.assertEqual([getattr(stats, name) for name in stats.Counters], [0] * len(stats.Counters))
+
+
+@test.testbase.SkipUnlessBenchmarking
+class VolumeManagerWrapBenchmark(test.testbase.TestBase):
+
+    def testWrapThroughput(self):
+        
+        NumElements = 50000
+        tags = ['Level', 'Image', 'Transform', 'Tileset', 'Unknown']
+        elements = [ElementTree.Element(tags[i % len(tags)], {'Path': '%d' % i}) for i in range(0, NumElements)]
+
+        start_time = time.perf_counter()
+        wrapped = [VolumeManager.WrapElement(e)[1] for e in elements]
+        elapsed = time.perf_counter() - start_time
+
+        print("Wrapped %d elements in %.3f seconds, %d elements/second" % (NumElements, elapsed, NumElements / max(elapsed, 1e-9)))
+
+        self.assertIsInstance(wrapped[0], LevelNode)
+        self.assertIsInstance(wrapped[1], ImageNode)
+        self.assertIsInstance(wrapped[2], TransformNode)
+        self.assertIsInstance(wrapped[3], TilesetNode)
+        self.assertIs(type(wrapped[4]), XContainerElementWrapper, "Unregistered tags with a path should be containers")
+
+
+class VolumeManagerFullPathTest(VolumeManagerTestBase):
+
+    def testFullPathFollowsChanges(self):
+
+        block = BlockNode.Create("TEM")
+        [added_block, block] = self.VolumeObj.UpdateOrAddChild(block)
+        (added_section, section) = block.GetOrCreateSection(1)
+        channel = ChannelNode.Create("YY")
+        [added_channel, channel] = section.UpdateOrAddChild(channel)
+
+        self.assertEqual(channel.FullPath, os.path.join(self.VolumeFullPath, "TEM", section.Path, "YY"))
+
+        # Changing the path of an ancestor must update the cached paths below it
+        block.Path = "Renamed"
+        self.assertEqual(channel.FullPath, os.path.join(self.VolumeFullPath, "Renamed", section.Path, "YY"))
+
+        # Moving a node under a different parent must update its cached path
+        (added_section, other_section) = block.GetOrCreateSection(2)
+        section.remove(channel)
+        other_section.append(channel)
+        channel.Parent = other_section
+        self.assertEqual(channel.FullPath, os.path.join(self.VolumeFullPath, "Renamed", other_section.Path, "YY"))
+
+
 class VolumeManagerAppendTest(VolumeManagerTestBase):
 
     def runTest(self):
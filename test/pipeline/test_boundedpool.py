@@ -0,0 +1,169 @@
+'''
+Checks that a BoundedPool limits the tasks and bytes in flight.  The
+benchmark compares the peak memory traced by tracemalloc while a synthetic
+producer queues image sized tasks on a thread pool faster than it completes
+them.  It is not the resident memory of a pipeline stage; the StageProfile
+PeakRSSIncrease of an AssembleTiles run with and without -MaxTilesInFlight
+measures that.
+'''
+import concurrent.futures
+import threading
+import time
+import tracemalloc
+import unittest
+
+import numpy
+
+from nornir_buildmanager import BoundedPool
+import test.testbase
+
+
+class ThreadPoolTask(object):
+    '''The wait method nornir_pools tasks provide, over a concurrent.futures future'''
+
+    def __init__(self, future):
+        self.future = future
+
+    def wait(self):
+        self.future.result()
+
+    def wait_return(self):
+        return self.future.result()
+
+
+class ThreadPool(object):
+    '''Minimal nornir_pools style thread pool'''
+
+    def __init__(self, num_threads):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+        self.tasks = []
+
+    def add_task(self, name, func, *args, **kwargs):
+        task = ThreadPoolTask(self.executor.submit(func, *args, **kwargs))
+        self.tasks.append(task)
+        return task
+
+    def wait_completion(self):
+        for task in self.tasks:
+            task.wait()
+
+        self.tasks = []
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class ActiveCounter(object):
+    '''Records the most tasks holding data at once'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.Active = 0
+        self.Peak = 0
+
+    def SaveTile(self, tile_image):
+        with self.lock:
+            self.Active += 1
+            self.Peak = max(self.Peak, self.Active)
+
+        # Stand in for encoding and writing the tile
+        time.sleep(0.002)
+        checksum = int(tile_image[0, 0])
+
+        with self.lock:
+            self.Active -= 1
+
+        return checksum
+
+
+def ProduceTiles(pool, NumTiles, TileShape, Sized):
+    '''Queue one task per tile, as AssembleTilesetNumpy does'''
+    counter = ActiveCounter()
+    for iTile in range(NumTiles):
+        tile_image = numpy.full(TileShape, iTile % 256, dtype=numpy.uint8)
+        if Sized:
+            pool.add_sized_task(str(iTile), tile_image.nbytes, counter.SaveTile, tile_image)
+        else:
+            pool.add_task(str(iTile), counter.SaveTile, tile_image)
+
+    pool.wait_completion()
+    return counter
+
+
+class BoundedPoolTestBase(test.testbase.TestBase):
+
+    NumTiles = 200
+    TileShape = (512, 512)
+
+    def setUp(self):
+        super(BoundedPoolTestBase, self).setUp()
+        BoundedPool.Stats.Reset()
+        self.Pool = ThreadPool(num_threads=2)
+
+    def tearDown(self):
+        self.Pool.shutdown()
+        super(BoundedPoolTestBase, self).tearDown()
+
+
+class BoundedPoolTest(BoundedPoolTestBase):
+
+    def testMaxTasks(self):
+        pool = BoundedPool.BoundedPool(self.Pool, MaxTasks=4)
+        counter = ProduceTiles(pool, self.NumTiles, (16, 16), Sized=False)
+
+        self.assertEqual(pool.NumTasks, 0)
+        self.assertEqual(BoundedPool.Stats.Tasks, self.NumTiles)
+        self.assertEqual(BoundedPool.Stats.PeakTasks, 4)
+        self.assertLessEqual(counter.Peak, 4)
+
+    def testMaxBytes(self):
+        TileBytes = self.TileShape[0] * self.TileShape[1]
+        pool = BoundedPool.BoundedPool(self.Pool, MaxTasks=1000, MaxBytes=TileBytes * 3)
+        ProduceTiles(pool, self.NumTiles, self.TileShape, Sized=True)
+
+        self.assertEqual(pool.NumBytes, 0)
+        self.assertEqual(BoundedPool.Stats.PeakBytes, TileBytes * 3)
+        self.assertEqual(BoundedPool.Stats.PeakTasks, 3)
+
+    def testTaskLargerThanMaxBytes(self):
+        '''A task larger than the limit is still run, once the earlier tasks finish'''
+        pool = BoundedPool.BoundedPool(self.Pool, MaxBytes=10)
+        tasks = [pool.add_sized_task(str(i), 100, sum, [i, 1]) for i in range(3)]
+        pool.wait_completion()
+
+        self.assertEqual([task.wait_return() for task in tasks], [1, 2, 3])
+        self.assertEqual(BoundedPool.Stats.PeakTasks, 1)
+
+    def testExceptionRaised(self):
+        pool = BoundedPool.BoundedPool(self.Pool, MaxTasks=1)
+        pool.add_task('fails', int, 'not a number')
+        with self.assertRaises(ValueError):
+            pool.add_task('next', int, '1')
+
+
+@test.testbase.SkipUnlessBenchmarking
+class BoundedPoolBenchmark(BoundedPoolTestBase):
+
+    def testPeakMemory(self):
+        '''Peak python allocations traced while queueing every tile at once compared to a bounded queue'''
+        TileBytes = self.TileShape[0] * self.TileShape[1]
+
+        tracemalloc.start()
+        try:
+            ProduceTiles(self.Pool, self.NumTiles, self.TileShape, Sized=False)
+            (current, Unbounded) = tracemalloc.get_traced_memory()
+
+            tracemalloc.reset_peak()
+            pool = BoundedPool.BoundedPool(self.Pool, MaxTasks=8)
+            ProduceTiles(pool, self.NumTiles, self.TileShape, Sized=True)
+            (current, Bounded) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        print("%d synthetic tiles of %d bytes on a thread pool: peak traced allocations unbounded %.1f MB, bounded to 8 tasks %.1f MB" % (self.NumTiles, TileBytes, Unbounded / 1e6, Bounded / 1e6))
+        self.assertLess(Bounded, TileBytes * 16)
+        self.assertLess(Bounded, Unbounded)
+
+
+if __name__ == "__main__":
+    unittest.main()
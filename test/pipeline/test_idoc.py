@@ -6,10 +6,13 @@ Created on Feb 13, 2013
 import glob
 import logging
 import os
+import random
 import shutil
 import time
 import unittest
 
+import numpy
+
 from nornir_buildmanager.VolumeManagerETree import VolumeManager 
 import nornir_buildmanager.importers
 from nornir_buildmanager.importers.serialemlog import SerialEMLog
@@ -20,6 +23,7 @@ import nornir_shared.misc
 import nornir_buildmanager.build as build
 import nornir_buildmanager.importers.serialemlog as serialemlog
 import nornir_buildmanager.importers.idoc as idoc
+import test.testbase
 from . import setup_pipeline
 
 
@@ -689,6 +693,222 @@ class LogReaderTest(IDocTest):
         serialemlog.PlotDriftSettleTime(cachedLogData, outputDrift)
         return
 
+def WriteSyntheticIDoc(fullpath, NumTiles, TilesPerRow=250, TileSize=4080, Overlap=490):
+    '''Write an idoc with the attributes SerialEM records for each piece of a montage'''
+    Step = TileSize - Overlap
+    with open(fullpath, 'w') as hFile:
+        hFile.write("PixelSpacing = 21.76\nImageFile = Synthetic.st\nImageSize = %d %d\nMontage = 1\nDataMode = 1\nImageSeries = 1\n\n" % (TileSize, TileSize))
+        for i in range(0, NumTiles):
+            (Y, X) = divmod(i, TilesPerRow)
+            hFile.write("[Image = %d.tif]\n" % (10000 + i))
+            hFile.write("TiltAngle = 0.00193729\n")
+            hFile.write("PieceCoordinates = %d %d 0\n" % (X * Step, Y * Step))
+            hFile.write("StagePosition = %g %g\n" % (-171.37 + X * 0.078, -22.6453 + Y * 0.078))
+            hFile.write("StageZ = 5.33\n")
+            hFile.write("Magnification = 5000\n")
+            hFile.write("Intensity = 0.549157\n")
+            hFile.write("ExposureDose = 0\n")
+            hFile.write("SpotSize = 2\n")
+            hFile.write("Defocus = %g\n" % (-6.8902 + (i % 7) * 0.01))
+            hFile.write("ImageShift = 0 0\n")
+            hFile.write("RotationAngle = -178.3\n")
+            hFile.write("ExposureTime = 0.75\n")
+            hFile.write("MinMaxMean = %d %d %g\n" % (1000 + (i % 100), 9000 + (i % 1000), 4000.5 + (i % 10)))
+            if i % 2 == 0:
+                hFile.write("TargetDefocus = -7\n")
+            hFile.write("DateTime = 22-Apr-12  16:05:12\n\n")
+
+
+def LoadIDocPerTile(idocfullPath, CameraBpp=None):
+    '''Reads an idoc one line at a time the way IDoc.Load did before it read columns.
+    :return: (Montage attributes, list of (Image, tile attributes)) with the Max of each tile limited by CameraBpp'''
+    Montage = {}
+    Tiles = []
+    with open(idocfullPath, 'r') as hIDoc:
+        for line in hIDoc.read().split('\n'):
+            parts = line.strip().strip('[]').split('=')
+            if len(parts) <= 1:
+                continue
+
+            attribute = parts[0].strip()
+            if attribute == 'Image':
+                Tiles.append((parts[1].strip(), {}))
+                continue
+
+            values = parts[1].split()
+            if not (values[0][0].isdigit() or values[0][0] == '-'):
+                continue
+
+            ConvertedValues = []
+            for v in values:
+                try:
+                    ConvertedValues.append(int(v))
+                except ValueError:
+                    try:
+                        ConvertedValues.append(float(v))
+                    except ValueError:
+                        ConvertedValues.append(v)
+
+            value = ConvertedValues[0] if len(ConvertedValues) == 1 else ConvertedValues
+            if len(Tiles) == 0:
+                Montage[attribute] = value
+            else:
+                Tiles[-1][1][attribute] = value
+
+    for (Image, attribs) in Tiles:
+        attribs['Max'] = attribs['MinMaxMean'][1]
+        if CameraBpp is not None and attribs['Max'] > (1 << CameraBpp):
+            attribs['Max'] = 1 << CameraBpp
+
+    return (Montage, Tiles)
+
+
+def WriteIrregularIDoc(fullpath, NumTiles, Seed=0, IrregularMinMaxMean=False):
+    '''Write an idoc whose tiles have missing attributes, columns mixing ints and floats, varying numbers of values
+       and tokens that are not numbers
+    :param bool IrregularMinMaxMean: One tile reports an extra MinMaxMean value, so the column cannot be read as arrays'''
+    rng = random.Random(Seed)
+    with open(fullpath, 'w') as hFile:
+        hFile.write("PixelSpacing = 21.76\nImageSize = 4080 4080\nDataMode = 1\nMontage = 1\n\n")
+        for i in range(0, NumTiles):
+            hFile.write("[Image = %d.tif]\n" % (10000 + i))
+            hFile.write("PieceCoordinates = %d %d 0\n" % (i * 3590, rng.choice([0, 3590])))
+            MinMaxMean = "%d %s %s" % (rng.randint(-5, 2000), rng.choice(['8191', '8192', '9000', '16383', '8191.5']), rng.choice(['4000', '4000.5', '1e3']))
+            if IrregularMinMaxMean and i == NumTiles // 2:
+                MinMaxMean += " 7"
+            hFile.write("MinMaxMean = %s\n" % MinMaxMean)
+            hFile.write("Defocus = %s\n" % rng.choice(['0', '-6.8902', '-7', '12345678901234567']))
+            if rng.random() < 0.5:
+                hFile.write("TargetDefocus = -7\n")
+            if rng.random() < 0.7:
+                hFile.write("ImageShift = %s\n" % rng.choice(['0 0', '0.5 -1', '1 2 3']))
+            if rng.random() < 0.5:
+                hFile.write("Comment = %s\n" % rng.choice(['-none', '-1.5x', '3']))
+            if rng.random() < 0.3:
+                hFile.write("SpotSize = %s\n" % rng.choice(['2', '-3', '99999999999999999999']))
+            hFile.write("DateTime = 22-Apr-12  16:05:12\n\n")
+
+
+class IDocParserTest(test.testbase.TestBase):
+    '''Compares the columns IDoc.Load reads with reading each tile's lines individually'''
+
+    NumTiles = 60
+    CameraBpp = 13
+
+    def assertSameValue(self, value, expected, msg=None):
+        '''Values must be equal and of the same python types'''
+        self.assertEqual(value, expected, msg)
+        self.assertEqual(repr(value), repr(expected), msg)
+
+    def assertMatchesPerTile(self, IDocData, Montage, Tiles):
+        for (name, value) in Montage.items():
+            self.assertSameValue(getattr(IDocData, name), value)
+
+        self.assertEqual([t.Image for t in IDocData.tiles], [Image for (Image, attribs) in Tiles])
+        for (tile, (Image, attribs)) in zip(IDocData.tiles, Tiles):
+            for name in set(attribs.keys()).union(idoc.IDocTileData.KnownAttributes):
+                self.assertSameValue(getattr(tile, name), attribs.get(name, None), "%s of %s" % (name, Image))
+
+            self.assertSameValue(tile.Min, attribs['MinMaxMean'][0])
+            self.assertSameValue(tile.Mean, attribs['MinMaxMean'][2])
+
+        self.assertSameValue(IDocData.Max, max([attribs['Max'] for (Image, attribs) in Tiles]))
+        self.assertSameValue(IDocData.Min, max(min([attribs['MinMaxMean'][0] for (Image, attribs) in Tiles]), 0))
+        self.assertAlmostEqual(IDocData.Mean, numpy.mean([attribs['MinMaxMean'][2] for (Image, attribs) in Tiles]))
+
+    def CheckIDoc(self, IrregularMinMaxMean):
+        IDocFullPath = os.path.join(self.TestOutputPath, 'Irregular.idoc')
+        WriteIrregularIDoc(IDocFullPath, IDocParserTest.NumTiles, IrregularMinMaxMean=IrregularMinMaxMean)
+
+        (Montage, Tiles) = LoadIDocPerTile(IDocFullPath, CameraBpp=IDocParserTest.CameraBpp)
+        IDocData = idoc.IDoc.Load(IDocFullPath, CameraBpp=IDocParserTest.CameraBpp)
+        self.assertEqual(IDocData.NumTiles, IDocParserTest.NumTiles)
+        self.assertMatchesPerTile(IDocData, Montage, Tiles)
+        for (tile, (Image, attribs)) in zip(IDocData.tiles, Tiles):
+            self.assertSameValue(tile.Max, attribs['Max'], "Max of %s" % Image)
+
+        # Tiles whose image is missing are removed
+        for (i, (Image, attribs)) in enumerate(Tiles):
+            if i % 3 != 1:
+                with open(os.path.join(self.TestOutputPath, Image), 'w') as hFile:
+                    hFile.write(Image)
+
+        IDocData.RemoveMissingTiles(self.TestOutputPath)
+        Tiles = [Tiles[i] for i in range(len(Tiles)) if i % 3 != 1]
+        self.assertMatchesPerTile(IDocData, Montage, Tiles)
+
+        # Assigning Max replaces the limited value, assigning MinMaxMean replaces Max
+        tile = IDocData.tiles[0]
+        tile.Max = 12345
+        Tiles[0][1]['Max'] = 12345
+        self.assertSameValue(tile.Max, 12345)
+        self.assertSameValue(tile.MinMaxMean, Tiles[0][1]['MinMaxMean'])
+
+        tile = IDocData.tiles[1]
+        tile.MinMaxMean = [1, 20000, 3.5]
+        Tiles[1][1]['MinMaxMean'] = [1, 20000, 3.5]
+        Tiles[1][1]['Max'] = 20000
+        self.assertSameValue(tile.Max, 20000)
+        self.assertMatchesPerTile(IDocData, Montage, Tiles)
+
+    def testColumnsMatchPerTileParsing(self):
+        self.CheckIDoc(IrregularMinMaxMean=False)
+
+    def testIrregularColumnsMatchPerTileParsing(self):
+        self.CheckIDoc(IrregularMinMaxMean=True)
+
+
+@test.testbase.SkipUnlessBenchmarking
+class IDocParserBenchmark(test.testbase.TestBase):
+    '''Loads a synthetic idoc with the number of pieces of a large montage'''
+
+    NumTiles = 50000
+
+    # Seconds allowed to load the idoc
+    BudgetSeconds = 5.0
+
+    def setUp(self):
+        super(IDocParserBenchmark, self).setUp()
+        self.TempDir = self.TestOutputPath
+        self.IDocFullPath = os.path.join(self.TempDir, 'Synthetic.idoc')
+        WriteSyntheticIDoc(self.IDocFullPath, IDocParserBenchmark.NumTiles)
+
+    def runTest(self):
+        start = time.perf_counter()
+        IDocData = idoc.IDoc.Load(self.IDocFullPath, CameraBpp=13)
+        elapsed = time.perf_counter() - start
+        print("Loaded %d tiles in %.3f seconds" % (IDocData.NumTiles, elapsed))
+
+        self.assertEqual(IDocData.NumTiles, IDocParserBenchmark.NumTiles)
+        self.assertEqual(IDocData.PixelSpacing, 21.76)
+        self.assertEqual(IDocData.ImageSize, [4080, 4080])
+        self.assertEqual(IDocData.DataMode, 1)
+
+        TileData = IDocData.tiles[1234]
+        self.assertEqual(TileData.Image, '11234.tif')
+        self.assertEqual(TileData.PieceCoordinates, [234 * 3590, 4 * 3590, 0])
+        self.assertEqual(TileData.Magnification, 5000)
+        self.assertEqual(TileData.Intensity, 0.549157)
+        self.assertEqual(TileData.SpotSize, 2)
+        self.assertEqual(TileData.ExposureTime, 0.75)
+        self.assertEqual(TileData.ImageShift, [0, 0])
+        self.assertEqual(TileData.Min, 1034)
+        self.assertIsInstance(TileData.Min, int)
+        self.assertEqual(TileData.Mean, 4004.5)
+
+        # Values above the 13-bit camera's capability are clamped, MinMaxMean keeps the value from the idoc
+        self.assertEqual(TileData.Max, 1 << 13)
+        self.assertEqual(TileData.MinMaxMean, [1034, 9234, 4004.5])
+        self.assertEqual(IDocData.Max, 1 << 13)
+        self.assertEqual(IDocData.Min, 1000)
+
+        # Known attributes missing from a tile are None
+        self.assertEqual(TileData.TargetDefocus, -7)
+        self.assertIsNone(IDocData.tiles[1235].TargetDefocus)
+
+        self.assertLessEqual(elapsed, IDocParserBenchmark.BudgetSeconds, "Loading %d tiles took %.3f seconds" % (IDocParserBenchmark.NumTiles, elapsed))
+
+
 if __name__ == "__main__":
     # import syssys.argv = ['', 'Test.testName']
     unittest.main()
@@ -0,0 +1,76 @@
+'''
+Checks image sizes recorded in the meta-data against image files with each
+ImageHeaderCache.VerifyPolicy
+'''
+import os
+import unittest
+
+import numpy
+from PIL import Image
+
+from nornir_buildmanager import ImageHeaderCache
+from nornir_buildmanager.VolumeManagerETree import VolumeManager, ImageNode
+import test.testbase
+
+
+class ImageHeaderCacheTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(ImageHeaderCacheTest, self).setUp()
+        ImageHeaderCache.Clear()
+        ImageHeaderCache.Stats.Reset()
+        self.ImageFullPath = os.path.join(self.VolumeDir, 'Image.png')
+        self.WriteImage((48, 64))
+
+    def tearDown(self):
+        ImageHeaderCache.VerifyPolicy = ImageHeaderCache.VerifyOnChange
+        ImageHeaderCache.Clear()
+        super(ImageHeaderCacheTest, self).tearDown()
+
+    def WriteImage(self, shape):
+        Image.fromarray(numpy.zeros(shape, dtype=numpy.uint8)).save(self.ImageFullPath)
+
+        # Make sure the rewritten file does not share a modification time with the last one
+        st = os.stat(self.ImageFullPath)
+        os.utime(self.ImageFullPath, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+    def CreateImageNode(self):
+        '''An image node whose Dimensions attribute records the size of the image'''
+        VolumeObj = VolumeManager.Load(self.VolumeDir, Create=True)
+        ImageObj = ImageNode.Create(os.path.basename(self.ImageFullPath))
+        VolumeObj.append(ImageObj)
+        self.assertEqual(ImageObj.Dimensions, (48, 64))
+        return ImageObj
+
+    def testOnChange(self):
+        ImageHeaderCache.VerifyPolicy = ImageHeaderCache.VerifyOnChange
+        self.assertEqual(ImageHeaderCache.GetImageSize(self.ImageFullPath), (48, 64))
+        self.assertEqual(ImageHeaderCache.GetImageSize(self.ImageFullPath), (48, 64))
+        self.assertEqual((ImageHeaderCache.Stats.Hits, ImageHeaderCache.Stats.Misses), (1, 1), "Unchanged headers should be read once")
+
+        ImageObj = self.CreateImageNode()
+        self.WriteImage((32, 16))
+        ImageHeaderCache.Stats.Reset()
+        self.assertEqual(ImageObj.Dimensions, (32, 16), "The changed image should be read again")
+        self.assertEqual(ImageHeaderCache.Stats.Misses, 1)
+        self.assertEqual(ImageObj.attrib['Dimensions'], '16 32')
+
+    def testAlways(self):
+        ImageHeaderCache.VerifyPolicy = ImageHeaderCache.VerifyAlways
+        for i in range(3):
+            self.assertEqual(ImageHeaderCache.GetImageSize(self.ImageFullPath), (48, 64))
+
+        self.assertEqual((ImageHeaderCache.Stats.Hits, ImageHeaderCache.Stats.Misses), (0, 3), "Every check should read the header")
+
+    def testNever(self):
+        ImageObj = self.CreateImageNode()
+
+        ImageHeaderCache.VerifyPolicy = ImageHeaderCache.VerifyNever
+        self.WriteImage((32, 16))
+        ImageHeaderCache.Stats.Reset()
+        self.assertEqual(ImageObj.Dimensions, (48, 64), "The meta-data should be trusted")
+        self.assertEqual((ImageHeaderCache.Stats.Hits, ImageHeaderCache.Stats.Misses), (0, 0), "No header should be read")
+
+
+if __name__ == "__main__":
+    unittest.main()
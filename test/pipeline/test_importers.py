@@ -0,0 +1,67 @@
+'''
+Imports every importer module and checks that each package the module
+refers to by its dotted name, such as nornir_imageregistration.Mosaic, is
+bound in the module.  Names that were only available through a wildcard
+import are not found until the stage runs, so they are checked here.
+'''
+
+import ast
+import importlib
+import pkgutil
+import unittest
+
+import nornir_buildmanager.importers
+import test.testbase
+
+# Packages referred to by dotted names in the importers
+CheckedPackages = ('nornir_buildmanager', 'nornir_imageregistration', 'nornir_pools', 'nornir_shared', 'numpy')
+
+
+def DottedNameRoots(source):
+    '''
+    :return: Set of names that begin an attribute chain, such as "numpy" in numpy.zeros
+    '''
+    roots = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Attribute):
+            value = node.value
+            while isinstance(value, ast.Attribute):
+                value = value.value
+
+            if isinstance(value, ast.Name):
+                roots.add(value.id)
+
+    return roots
+
+
+def ImporterModuleNames():
+    return sorted(nornir_buildmanager.importers.__name__ + '.' + name for (_, name, ispkg) in pkgutil.iter_modules(nornir_buildmanager.importers.__path__) if not ispkg)
+
+
+class ImportersTest(test.testbase.TestBase):
+
+    def testImportersBindPackages(self):
+        ModuleNames = ImporterModuleNames()
+        self.assertGreater(len(ModuleNames), 0)
+
+        for ModuleName in ModuleNames:
+            with self.subTest(module=ModuleName):
+                try:
+                    module = importlib.import_module(ModuleName)
+                except ImportError as e:
+                    # Importers for optional formats, such as dm4, need packages that may not be installed
+                    if e.name is not None and e.name.split('.')[0] not in CheckedPackages:
+                        self.skipTest("%s requires %s" % (ModuleName, e.name))
+
+                    raise
+
+                with open(module.__file__, 'r') as hFile:
+                    roots = DottedNameRoots(hFile.read())
+
+                for package in CheckedPackages:
+                    if package in roots:
+                        self.assertTrue(hasattr(module, package), "%s uses %s without importing it" % (ModuleName, package))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+'''
+Reads a synthetic SerialEM .mrc montage file
+'''
+import os
+import struct
+import unittest
+
+import numpy
+
+import nornir_pools
+import nornir_buildmanager.importers.mrc as mrc
+import test.testbase
+
+
+def WriteSyntheticMRC(fullpath, tiles, stage_coords, tile_header_size=32, extended_header_size=None):
+    '''
+    Write a little endian mode 6 (uint16) mrc file with piece and stage coordinates in the tile headers
+    :param ndarray tiles: Pixels with shape (num_tiles, XDim, YDim)
+    :param ndarray stage_coords: Stage coordinates of each tile, as stored in the file
+    '''
+    (num_tiles, XDim, YDim) = tiles.shape
+    if extended_header_size is None:
+        extended_header_size = num_tiles * tile_header_size
+
+    Header = bytearray(mrc.MRCFile.HeaderLength)
+    struct.pack_into('<IIII', Header, 0x00, XDim, YDim, num_tiles, 6)
+    struct.pack_into('<III', Header, 0x1C, XDim, YDim, 1)
+    struct.pack_into('<fff', Header, 0x28, XDim * 21.76, YDim * 21.76, 1.0)
+    struct.pack_into('<III', Header, 0x40, 1, 2, 3)
+    struct.pack_into('<fff', Header, 0x4C, float(tiles.min()), float(tiles.max()), float(tiles.mean()))
+    struct.pack_into('<I', Header, 0x5C, extended_header_size)
+    struct.pack_into('<HH', Header, 0x80, tile_header_size, mrc.MRCTileHeaderFlags.PieceCoord | mrc.MRCTileHeaderFlags.StageCoord)
+    struct.pack_into('<I', Header, 0xD4, 68)
+
+    ExtendedHeader = bytearray(extended_header_size)
+    for iTile in range(num_tiles):
+        struct.pack_into('<HHHHH', ExtendedHeader, iTile * tile_header_size, iTile * 100, iTile * 200, 0, stage_coords[iTile][0], stage_coords[iTile][1])
+
+    with open(fullpath, 'wb') as hFile:
+        hFile.write(Header)
+        hFile.write(ExtendedHeader)
+        hFile.write(tiles.astype('<u2').tobytes())
+
+
+class MRCFileTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(MRCFileTest, self).setUp()
+        self.TempDir = self.TestOutputPath
+        self.MRCFullPath = os.path.join(self.TempDir, 'Synthetic.mrc')
+
+        rng = numpy.random.RandomState(0)
+        self.Tiles = rng.randint(0, 1 << 14, size=(6, 32, 24)).astype(numpy.uint16)
+        self.StageCoords = [(1000 + i * 50, 2000 + i * 25) for i in range(6)]
+
+        # SerialEM pads the extended header past the last tile header
+        WriteSyntheticMRC(self.MRCFullPath, self.Tiles, self.StageCoords, extended_header_size=6 * 32 + 1024)
+
+    def testTileMeta(self):
+        mrcfile = mrc.MRCFile.Load(self.MRCFullPath)
+        self.assertEqual(mrcfile.num_tiles, 6)
+        self.assertEqual(len(mrcfile.tile_meta), 6)
+
+        with open(self.MRCFullPath, 'rb') as hFile:
+            hFile.seek(mrc.MRCFile.HeaderLength)
+            ExtendedHeader = hFile.read(6 * 32)
+
+        for (iTile, t) in enumerate(mrcfile.tile_meta):
+            # Compare to decoding the tile header alone
+            expected = mrc.MRCTileHeader.Load(iTile, ExtendedHeader[iTile * 32:(iTile + 1) * 32],
+                                              tile_flags=mrcfile.tile_header_flags,
+                                              nm_per_pixel=mrcfile.pixel_spacing[0:2])
+            self.assertEqual(t.ID, iTile)
+            self.assertTrue(numpy.array_equal(t.piece_coords, [iTile * 100, iTile * 200, 0]))
+            self.assertTrue(numpy.array_equal(t.stage_coords, expected.stage_coords))
+            self.assertTrue(numpy.allclose(t.pixel_coords, expected.pixel_coords))
+
+    def testMappedTiles(self):
+        mrcfile = mrc.MRCFile.Load(self.MRCFullPath)
+        self.assertIsInstance(mrcfile.data, numpy.memmap)
+        self.assertEqual(mrcfile.data.shape, self.Tiles.shape)
+
+        for iTile in range(self.Tiles.shape[0]):
+            img = mrcfile.get_tile_as_numpy(iTile)
+            self.assertTrue(numpy.shares_memory(img, mrcfile.data), "Tile should be a view of the memory map")
+            self.assertTrue(numpy.array_equal(img, self.Tiles[iTile]))
+            self.assertEqual(mrcfile.get_tile_as_bytes(iTile), self.Tiles[iTile].astype('<u2').tobytes())
+
+    def testTruncatedFile(self):
+        with open(self.MRCFullPath, 'r+b') as hFile:
+            hFile.truncate(os.path.getsize(self.MRCFullPath) - 10)
+
+        mrcfile = mrc.MRCFile.Load(self.MRCFullPath)
+        self.assertEqual(mrcfile.data.shape[0], 5, "Only complete tiles should be mapped")
+        self.assertEqual(mrcfile.num_stored_tiles, 5)
+        self.assertTrue(numpy.array_equal(mrcfile.get_tile_as_numpy(4), self.Tiles[4]))
+
+        # The incomplete tile is left out of the mosaic and is not exported
+        mosaic = mrc.MRCImport.CreateMosaic(mrcfile, img_ext='png')
+        self.assertEqual(sorted(mosaic.ImageToTransform.keys()), [mrc.GetFileNameForTileNumber(i, 'png') for i in range(5)])
+
+        OutputDir = os.path.join(self.TempDir, 'Output')
+        os.makedirs(OutputDir)
+        mrc.MRCImport.ExportImages(mrcfile, OutputDir, img_ext='png', min_max_gamma=None)
+        nornir_pools.WaitOnAllPools()
+        self.assertEqual(sorted(os.listdir(OutputDir)), [mrc.GetFileNameForTileNumber(i, 'png') for i in range(5)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -105,6 +105,24 @@ class Test(unittest.TestCase):
         kwargs = argset.KeyWordArgs()
         print((repr(kwargs)))
 
+    def test_AttributeConversion(self):
+        argset = pm.ArgumentSet()
+        argset.AddVariable('Section', 12)
+
+        node = LoadPipeline('<PythonCall Function="tile.BuildTilePyramids" Levels="1,2" Downsample="4" Scale="0.5" Empty="" Name="Section#Section"/>')
+        argset.AddAttributes(node)
+
+        self.assertEqual(argset.Attribs['Levels'], "1,2")
+        self.assertEqual(argset.Attribs['Downsample'], 4)
+        self.assertEqual(argset.Attribs['Scale'], 0.5)
+        self.assertEqual(argset.Attribs['Empty'], "")
+        self.assertEqual(argset.Attribs['Name'], "Section12")
+
+    def test_StageFunctionCache(self):
+        stageFunc = pm.PipelineManager.GetStageFunction('nornir_buildmanager.pipelinemanager', '_GetVariableName')
+        self.assertIs(stageFunc, pm._GetVariableName)
+        self.assertIs(pm.PipelineManager._StageFunctionCache[('nornir_buildmanager.pipelinemanager', '_GetVariableName')], stageFunc)
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
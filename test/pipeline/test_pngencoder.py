@@ -0,0 +1,182 @@
+'''
+Encodes synthetic images with the in-process PNG encoder, decodes them with
+Pillow and compares the pixels.  The benchmark compares images per second to
+saving with Pillow and interlacing with ImageMagick, which the encoder replaced.
+'''
+import io
+import os
+import shutil
+import subprocess
+import time
+import tracemalloc
+import unittest
+import unittest.mock
+
+import numpy
+from PIL import Image
+
+from nornir_buildmanager import PNGEncoder
+import nornir_buildmanager.operations.tile as tile
+from nornir_buildmanager.VolumeManagerETree import VolumeManager, FilterNode, TilePyramidNode
+import test.testbase
+
+
+def Decode(data):
+    with Image.open(io.BytesIO(data)) as im:
+        im.load()
+        return (numpy.asarray(im), im.info.get('interlace', 0))
+
+
+class PNGEncoderTest(test.testbase.TestBase):
+
+    def setUp(self):
+        super(PNGEncoderTest, self).setUp()
+        self.TempDir = self.TestOutputPath
+
+    def assertRoundTrip(self, pixels, **kwargs):
+        for Interlace in (True, False):
+            (decoded, interlace) = Decode(PNGEncoder.Encode(pixels, Interlace=Interlace, **kwargs))
+            self.assertEqual(interlace, 1 if Interlace else 0)
+            self.assertTrue(numpy.array_equal(decoded, pixels), "%s %s interlace %s does not match" % (str(pixels.shape), str(pixels.dtype), Interlace))
+
+    def testGrayscale(self):
+        self.assertRoundTrip(test.testbase.SmoothPixels((61, 83)))
+        self.assertRoundTrip(test.testbase.SmoothPixels((61, 83), dtype=numpy.uint16))
+
+    def testColor(self):
+        self.assertRoundTrip(test.testbase.SmoothPixels((29, 31, 3)))
+        self.assertRoundTrip(test.testbase.SmoothPixels((29, 31, 4)))
+        self.assertRoundTrip(test.testbase.SmoothPixels((29, 31, 2)))
+
+    def testMask(self):
+        self.assertRoundTrip(test.testbase.SmoothPixels((37, 45)) > 128)
+
+    def testSmallImages(self):
+        '''Images smaller than an Adam7 block leave some passes empty'''
+        for Shape in ((1, 1), (1, 7), (5, 1), (3, 3)):
+            self.assertRoundTrip(test.testbase.SmoothPixels(Shape))
+
+    def testEachFilter(self):
+        pixels = test.testbase.SmoothPixels((40, 50, 3))
+        for Filter in range(5):
+            self.assertRoundTrip(pixels, Filter=Filter)
+
+    def testAdaptiveFilterCompresses(self):
+        pixels = test.testbase.SmoothPixels((256, 256))
+        self.assertLess(len(PNGEncoder.Encode(pixels)), len(PNGEncoder.Encode(pixels, Filter=0)))
+
+    def testToBpp(self):
+        self.assertTrue(numpy.array_equal(PNGEncoder.ToBpp(numpy.array([0, 0.25, 1.0]), 8), [0, 64, 255]))
+        self.assertTrue(numpy.array_equal(PNGEncoder.ToBpp(numpy.array([0, 128, 255], dtype=numpy.uint8), 16), [0, 32896, 65535]))
+        self.assertTrue(numpy.array_equal(PNGEncoder.ToBpp(numpy.array([0, 32896, 65535], dtype=numpy.uint16), 8), [0, 128, 255]))
+        self.assertEqual(PNGEncoder.ToBpp(numpy.array([0.2, 0.7]), 1).dtype, numpy.bool_)
+        with self.assertRaises(ValueError):
+            PNGEncoder.ToBpp(numpy.zeros((2, 2)), 12)
+
+    def testReencode(self):
+        pixels = test.testbase.SmoothPixels((70, 90))
+        fullpath = os.path.join(self.TempDir, 'image.png')
+        Image.fromarray(pixels).save(fullpath)
+
+        PNGEncoder.Reencode(fullpath)
+        with Image.open(fullpath) as im:
+            self.assertEqual(im.info.get('interlace', 0), 1)
+            self.assertTrue(numpy.array_equal(numpy.asarray(im), pixels))
+
+    def testShrinkMask(self):
+        mask = numpy.zeros((64, 64), dtype=numpy.bool_)
+        mask[8:40, 16:48] = True
+        inputFile = os.path.join(self.TempDir, 'mask.png')
+        outputFile = os.path.join(self.TempDir, 'mask_4.png')
+        PNGEncoder.Save(inputFile, mask, Interlace=False)
+
+        self.assertTrue(tile._ShrinkImageInProcess(inputFile, outputFile, 4, Interlace=True))
+        with Image.open(outputFile) as im:
+            self.assertEqual(im.mode, '1')
+            self.assertTrue(numpy.array_equal(numpy.asarray(im), mask[::4, ::4]))
+
+    def testFilterMemory(self):
+        '''Rows are filtered in strips, so the encoder does not hold copies of the whole image for every filter'''
+        pixels = test.testbase.SmoothPixels((1024, 1024))
+        tracemalloc.start()
+        try:
+            PNGEncoder.Encode(pixels, Interlace=True)
+            Peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(Peak, 4 * pixels.nbytes, "Traced allocations while encoding: %d bytes" % Peak)
+
+    def testEvaluateSequence(self):
+        Images = [test.testbase.SmoothPixels((20, 30), Seed=i) for i in range(5)]
+        fullpaths = []
+        for (i, pixels) in enumerate(Images):
+            fullpaths.append(os.path.join(self.TempDir, '%d.png' % i))
+            Image.fromarray(pixels).save(fullpaths[-1])
+
+        Stack = numpy.stack(Images).astype(numpy.float64)
+        self.assertTrue(numpy.array_equal(tile.EvaluateSequence(fullpaths, 'Min'), Stack.min(axis=0)))
+        self.assertTrue(numpy.array_equal(tile.EvaluateSequence(fullpaths, 'Max'), Stack.max(axis=0)))
+        self.assertTrue(numpy.array_equal(tile.EvaluateSequence(fullpaths, 'Mean'), numpy.rint(Stack.mean(axis=0))))
+        self.assertTrue(numpy.array_equal(tile.EvaluateSequence(fullpaths, 'Median'), numpy.median(Stack, axis=0)))
+        self.assertTrue(numpy.array_equal(tile.EvaluateSequence(fullpaths, 'Add'), Stack.sum(axis=0).clip(0, 255)))
+        with self.assertRaises(ValueError):
+            tile.EvaluateSequence(fullpaths, 'Pow')
+
+    def testEvaluatePostArgument(self):
+        '''Tiles combined in process are passed to ImageMagick when there are arguments for after the evaluate-sequence'''
+        VolumeObj = VolumeManager.Load(self.TempDir, Create=True)
+        [added, FilterObj] = VolumeObj.UpdateOrAddChildByAttrib(FilterNode.Create('Raw8'), 'Name')
+        [added, PyramidNode] = FilterObj.UpdateOrAddChild(TilePyramidNode.Create(Type='stage', NumberOfTiles=3))
+        [added, LevelObj] = PyramidNode.GetOrCreateLevel(1, GenerateData=False)
+        test.testbase.WriteSyntheticTiles(LevelObj.FullPath, 3, CreatePixels=lambda iTile, Shape: test.testbase.SmoothPixels(Shape, Seed=iTile))
+
+        with unittest.mock.patch.object(tile.subprocess, 'call') as Call:
+            tile.Evaluate({}, FilterObj, OutputImageName='min', EvaluateSequenceArg='min', PostEvaluateSequenceArg='-negate')
+
+        PreFinalFullPath = os.path.join(FilterObj.FullPath, 'Pre-min' + PyramidNode.ImageFormatExt)
+        Call.assert_called_once()
+        self.assertIn('%s -negate' % PreFinalFullPath, Call.call_args[0][0])
+        self.assertFalse(os.path.exists(PreFinalFullPath))
+
+
+@test.testbase.SkipUnlessBenchmarking
+class PNGEncoderBenchmark(test.testbase.TestBase):
+    '''Interlaced images per second'''
+
+    NumImages = 8
+    Shape = (2048, 2048)
+
+    def setUp(self):
+        super(PNGEncoderBenchmark, self).setUp()
+        self.TempDir = self.TestOutputPath
+        self.Images = [test.testbase.SmoothPixels(self.Shape, Seed=i) for i in range(self.NumImages)]
+
+    def OutputFile(self, name, i):
+        return os.path.join(self.TempDir, '%s%d.png' % (name, i))
+
+    def testThroughput(self):
+        if shutil.which('magick') is None:
+            self.skipTest("ImageMagick magick command not found")
+
+        start = time.perf_counter()
+        for (i, pixels) in enumerate(self.Images):
+            PNGEncoder.Save(self.OutputFile('InProcess', i), pixels, Interlace=True)
+        InProcess = self.NumImages / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for (i, pixels) in enumerate(self.Images):
+            fullpath = self.OutputFile('Magick', i)
+            Image.fromarray(pixels).save(fullpath)
+            subprocess.call('magick convert ' + fullpath + ' -quality 106 -interlace PNG ' + fullpath, shell=True)
+        Magick = self.NumImages / (time.perf_counter() - start)
+
+        print("%d %dx%d images: in-process interlaced %.2f images/sec, Pillow then magick convert interlaced %.2f images/sec" % (self.NumImages, self.Shape[1], self.Shape[0], InProcess, Magick))
+
+        for (i, pixels) in enumerate(self.Images):
+            with Image.open(self.OutputFile('InProcess', i)) as im:
+                self.assertTrue(numpy.array_equal(numpy.asarray(im), pixels))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+'''
+Builds tile pyramids from synthetic tiles in a single pass and compares them
+to building the pyramid one level at a time
+'''
+import os
+import time
+import unittest
+
+import numpy
+from PIL import Image
+
+import nornir_buildmanager.operations.tile as tile
+from nornir_buildmanager.VolumeManagerETree import VolumeManager, TilePyramidNode
+import test.testbase
+
+PyramidLevels = [1, 2, 4, 8, 16]
+
+
+def WritePyramidTiles(TileDir, NumTiles, Shape=(510, 381), Noise=4):
+    '''
+    :return: Filenames of the tiles
+    '''
+    (fullpaths, pixels) = test.testbase.WriteSyntheticTiles(TileDir, NumTiles, Shape=Shape,
+                                                            CreatePixels=lambda iTile, Shape: test.testbase.SmoothPixels(Shape, Seed=iTile, Noise=Noise))
+    return [os.path.basename(fullpath) for fullpath in fullpaths]
+
+
+def ReadPixels(fullpath):
+    with Image.open(fullpath) as im:
+        return numpy.asarray(im)
+
+
+class PyramidTest(test.testbase.TestBase):
+
+    NumTiles = 6
+
+    def setUp(self):
+        super(PyramidTest, self).setUp()
+        self.TempDir = self.TestOutputPath
+        self.VolumeObj = VolumeManager.Load(self.TempDir, Create=True)
+        [added, self.PyramidNode] = self.VolumeObj.UpdateOrAddChild(TilePyramidNode.Create(Type='stage', NumberOfTiles=self.NumTiles))
+        self.PyramidNode.GetOrCreateLevel(1, GenerateData=False)
+
+        self.Filenames = WritePyramidTiles(self.LevelDir(1), self.NumTiles)
+
+    def LevelDir(self, Level):
+        return os.path.join(self.PyramidNode.FullPath, self.PyramidNode.LevelFormat % Level)
+
+    def testSinglePassMatchesLevelByLevel(self):
+        '''Shrinking a level read back from disk gives the same pixels as shrinking it in memory'''
+        tile.BuildTilePyramids(self.PyramidNode, PyramidLevels)
+
+        for filename in self.Filenames:
+            for iLevel in range(1, len(PyramidLevels)):
+                UpLevelPixels = ReadPixels(os.path.join(self.LevelDir(PyramidLevels[iLevel - 1]), filename))
+                Expected = tile.ShrinkPixels(UpLevelPixels, PyramidLevels[iLevel] / PyramidLevels[iLevel - 1])
+                Actual = ReadPixels(os.path.join(self.LevelDir(PyramidLevels[iLevel]), filename))
+                self.assertTrue(numpy.array_equal(Expected, Actual), "Level %d of %s does not match" % (PyramidLevels[iLevel], filename))
+
+    def testMatchesShrink(self):
+        '''Each level must be close to shrinking the level above it with nornir_imageregistration.Shrink.  Levels are
+           compared one step at a time so differences do not compound.  The tiles are noisy and most levels have an odd
+           number of rows or columns, so the last row and column are checked separately.  The filters differ, so pixels
+           may differ by a few grey levels, but not on average.'''
+        tile.BuildTilePyramids(self.PyramidNode, PyramidLevels)
+
+        import nornir_imageregistration
+        ShrinkDir = os.path.join(self.TempDir, 'Shrink')
+        for filename in self.Filenames:
+            for iLevel in range(1, len(PyramidLevels)):
+                inputFile = os.path.join(self.LevelDir(PyramidLevels[iLevel - 1]), filename)
+                outputFile = os.path.join(ShrinkDir, str(PyramidLevels[iLevel]), filename)
+                os.makedirs(os.path.dirname(outputFile), exist_ok=True)
+                nornir_imageregistration.Shrink(inputFile, outputFile, PyramidLevels[iLevel] / PyramidLevels[iLevel - 1])
+
+                Expected = ReadPixels(outputFile).astype(numpy.int32)
+                Actual = ReadPixels(os.path.join(self.LevelDir(PyramidLevels[iLevel]), filename)).astype(numpy.int32)
+                self.assertEqual(Expected.shape, Actual.shape)
+
+                Difference = numpy.abs(Expected - Actual)
+                Message = "Level %d of %s differs from Shrink" % (PyramidLevels[iLevel], filename)
+                self.assertLessEqual(Difference.max(), 5, Message)
+                self.assertLessEqual(Difference.mean(), 0.75, Message)
+                self.assertLessEqual(Difference[-1, :].mean(), 1.0, Message + " in the last row")
+                self.assertLessEqual(Difference[:, -1].mean(), 1.0, Message + " in the last column")
+
+    def testHalveOddSizes(self):
+        '''Odd dimensions are resampled over their whole length, even dimensions average 2x2 blocks'''
+        pixels = test.testbase.SmoothPixels((255, 191))
+        for dtype in (numpy.uint8, numpy.uint16, numpy.float32):
+            Halved = tile._HalveImage(pixels.astype(dtype))
+            self.assertEqual(Halved.shape, (127, 95))
+            self.assertEqual(Halved.dtype, dtype)
+
+        # Every pixel of a constant image keeps its value, including the last row and column
+        self.assertTrue(numpy.array_equal(tile._HalveImage(numpy.full((7, 5), 200, dtype=numpy.uint8)), numpy.full((3, 2), 200, dtype=numpy.uint8)))
+
+        # 25 rows halve to 12 rows covering 25 / 12 input rows each.  Dropping the last row would give the last two rows
+        # the average of rows 22 and 23.
+        Ramp = numpy.repeat(numpy.arange(0, 250, 10, dtype=numpy.uint8)[:, numpy.newaxis], 4, axis=1)
+        self.assertEqual(tile._HalveImage(Ramp)[-1, 0], numpy.average(Ramp[22:25, 0], weights=[1 / 12.0, 1, 1]).round())
+
+    def testOnlyMissingTilesWritten(self):
+        tile.BuildTilePyramids(self.PyramidNode, PyramidLevels)
+
+        Removed = os.path.join(self.LevelDir(4), self.Filenames[2])
+        Kept = os.path.join(self.LevelDir(8), self.Filenames[3])
+        os.remove(Removed)
+        KeptTime = os.path.getmtime(Kept)
+
+        tile.BuildTilePyramids(self.PyramidNode, PyramidLevels)
+        self.assertTrue(os.path.exists(Removed))
+        self.assertEqual(os.path.getmtime(Kept), KeptTime)
+
+        for level in PyramidLevels:
+            self.assertTrue(self.PyramidNode.HasLevel(level))
+
+
+@test.testbase.SkipUnlessBenchmarking
+class PyramidBenchmark(test.testbase.TestBase):
+    '''Tiles per second for the single pass builder and for shrinking one level at a time from disk with Shrink'''
+
+    NumTiles = 24
+    TileShape = (1024, 1024)
+
+    def setUp(self):
+        super(PyramidBenchmark, self).setUp()
+        self.TempDir = self.TestOutputPath
+        self.InputDir = os.path.join(self.TempDir, '001')
+        self.Filenames = WritePyramidTiles(self.InputDir, self.NumTiles, Shape=self.TileShape)
+
+    def OutputFile(self, name, Level, filename):
+        path = os.path.join(self.TempDir, name, str(Level))
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, filename)
+
+    def testThroughput(self):
+        import nornir_imageregistration
+
+        start = time.perf_counter()
+        LevelByLevelBytesRead = 0
+        for filename in self.Filenames:
+            inputFile = os.path.join(self.InputDir, filename)
+            for iLevel in range(1, len(PyramidLevels)):
+                outputFile = self.OutputFile('LevelByLevel', PyramidLevels[iLevel], filename)
+                LevelByLevelBytesRead += os.path.getsize(inputFile)
+                nornir_imageregistration.Shrink(inputFile, outputFile, 2)
+                inputFile = outputFile
+        LevelByLevel = self.NumTiles / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        Tiles = [(os.path.join(self.InputDir, filename), [(2, self.OutputFile('SinglePass', level, filename)) for level in PyramidLevels[1:]]) for filename in self.Filenames]
+        SinglePassBytesRead = sum(os.path.getsize(t[0]) for t in Tiles)
+        Failed = tile.ShrinkTilesToLevels(Tiles)
+        SinglePass = self.NumTiles / (time.perf_counter() - start)
+
+        print("Pyramid levels %s: Shrink level by level %.1f tiles/sec %d bytes read, single pass %.1f tiles/sec %d bytes read" % (PyramidLevels[1:], LevelByLevel, LevelByLevelBytesRead, SinglePass, SinglePassBytesRead))
+        self.assertEqual(len(Failed), 0)
+        self.assertLess(SinglePassBytesRead, LevelByLevelBytesRead)
+
+        for level in PyramidLevels[1:]:
+            for filename in self.Filenames:
+                self.assertEqual(ReadPixels(self.OutputFile('LevelByLevel', level, filename)).shape,
+                                 ReadPixels(self.OutputFile('SinglePass', level, filename)).shape)
+
+if __name__ == "__main__":
+    unittest.main()
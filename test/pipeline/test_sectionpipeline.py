@@ -0,0 +1,95 @@
+'''
+Imports fake sections with the section pipeline used by the importers
+'''
+import os
+import unittest
+import unittest.mock
+
+import nornir_buildmanager.importers.sectionpipeline as sectionpipeline
+import test.testbase
+
+
+def _Prepare(number, value):
+    return (number, value, sectionpipeline.InWorker)
+
+
+def _Convert(number, value):
+    return (number, value * 2, os.getpid())
+
+
+class SectionPipelineTest(test.testbase.TestBase):
+
+    def RunPipeline(self, NumSections, MaxWorkers, MaxInFlight=None, InWorker=False):
+        Applied = []
+        InFlight = {'Now': 0, 'Max': 0}
+
+        def Apply(prepared):
+            (number, value, PreparedInWorker) = prepared
+            self.assertEqual(PreparedInWorker, InWorker)
+            Applied.append(number)
+            InFlight['Now'] += 1
+            InFlight['Max'] = max(InFlight['Max'], InFlight['Now'])
+
+            # Odd sections have nothing to convert
+            if number % 2:
+                return (None, number)
+
+            return ((number, value), number)
+
+        def Finish(number, result):
+            InFlight['Now'] -= 1
+            if result is None:
+                return [('Skipped', number)]
+
+            self.assertEqual(result[0], number)
+            self.assertEqual(result[1], number * 20)
+            return [('Converted', number)]
+
+        Sections = [(i, i * 10) for i in range(NumSections)]
+        Saved = list(sectionpipeline.ImportSections(Sections, _Prepare, Apply, _Convert, Finish, MaxWorkers=MaxWorkers, MaxInFlight=MaxInFlight))
+
+        self.assertEqual(Applied, list(range(NumSections)), "Sections should be applied in the order they were found")
+        self.assertEqual(sorted(n for (kind, n) in Saved), list(range(NumSections)))
+        for (kind, n) in Saved:
+            self.assertEqual(kind, 'Skipped' if n % 2 else 'Converted')
+
+        return InFlight['Max']
+
+    def testInline(self):
+        self.RunPipeline(NumSections=7, MaxWorkers=1)
+        self.assertIsNone(sectionpipeline.WorkerPool(), "Steps run in this process should use their default pools")
+
+    def testWorkers(self):
+        MaxInFlight = 3
+        Max = self.RunPipeline(NumSections=12, MaxWorkers=2, MaxInFlight=MaxInFlight, InWorker=True)
+        self.assertLessEqual(Max, MaxInFlight, "More sections were in flight than allowed")
+
+
+class ConvertTilesTest(test.testbase.TestBase):
+    '''Section pipeline workers must not convert all of a section's tiles on another pool'''
+
+    def RunConvert(self, InWorker):
+        import nornir_buildmanager.importers.idoc as idoc
+
+        SourceToTarget = {'%d.tif' % i: '%d.png' % i for i in range(5)}
+        with unittest.mock.patch.object(sectionpipeline, 'InWorker', InWorker), \
+             unittest.mock.patch.object(idoc.nornir_imageregistration, 'ConvertImagesInDict') as Convert:
+            idoc.SerialEMIDocImport.ConvertTiles(SourceToTarget, Flip=False, OutputBpp=8)
+
+        Converted = {}
+        for call in Convert.call_args_list:
+            self.assertEqual(call[1], {'Flip': False, 'OutputBpp': 8})
+            Converted.update(call[0][0])
+
+        self.assertEqual(Converted, SourceToTarget)
+        return Convert.call_count
+
+    def testConvertInProcess(self):
+        self.assertEqual(self.RunConvert(InWorker=False), 1, "Tiles should be converted in one call on the default pool")
+
+    def testConvertInWorker(self):
+        self.assertEqual(self.RunConvert(InWorker=True), 5, "Workers should convert one tile at a time")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+'''
+Startup cost of nornir-build for pipelines that only read or edit meta-data.
+
+Runs a fresh interpreter with python -X importtime and checks that the
+scientific stack is not imported.  With BENCHMARK set the total import time
+is also checked against a budget.
+'''
+
+import subprocess
+import sys
+import unittest
+
+import test.testbase
+
+# Modules pipelines that only read or edit meta-data should not need
+HeavyPackages = ['scipy', 'matplotlib', 'nornir_imageregistration']
+
+# Modules loaded to run pipelines such as ListStosGroups or PrintContrast
+MetadataPipelineModules = ['nornir_buildmanager.build',
+                           'nornir_buildmanager.operations.general',
+                           'nornir_buildmanager.operations.setters',
+                           'nornir_buildmanager.operations.stosgroup',
+                           'nornir_buildmanager.operations.stosmap']
+
+
+def ImportTimes(modules):
+    '''
+    Import modules in a new interpreter.
+    :return: List of (module name, self time in seconds, cumulative time in seconds) for every module imported
+    '''
+    code = '; '.join(['import ' + m for m in modules])
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+    if proc.returncode != 0:
+        raise Exception("Importing %s failed:\n%s" % (code, proc.stderr))
+
+    times = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+
+        try:
+            self_us = int(fields[0])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            # Header line
+            continue
+
+        times.append((fields[2].strip(), self_us / 1e6, cumulative_us / 1e6))
+
+    return times
+
+
+class StartupImportsTest(test.testbase.TestBase):
+
+    def testMetadataPipelineSkipsHeavyPackages(self):
+
+        imported = frozenset(t[0] for t in ImportTimes(MetadataPipelineModules))
+        self.assertGreater(len(imported), 0, "No import times reported")
+
+        for package in HeavyPackages:
+            self.assertNotIn(package, imported, "%s should only be imported when a stage that uses it is called" % package)
+
+
+@test.testbase.SkipUnlessBenchmarking
+class StartupBenchmark(test.testbase.TestBase):
+
+    # Seconds allowed for all imports of a meta-data only pipeline
+    BudgetSeconds = 1.5
+
+    def testMetadataPipelineImports(self):
+
+        times = ImportTimes(MetadataPipelineModules)
+        self.assertGreater(len(times), 0, "No import times reported")
+
+        total = sum(t[1] for t in times)
+        print("Imported %d modules in %.3f seconds" % (len(times), total))
+        for (name, self_time, cumulative) in sorted(times, key=lambda t: t[2], reverse=True)[0:10]:
+            print("  %8.3f %s" % (cumulative, name))
+
+        self.assertLessEqual(total, StartupBenchmark.BudgetSeconds, "Importing meta-data pipeline modules took %.3f seconds" % total)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+'''
+Converts synthetic 16-bit tiles with a contrast lookup table and compares the
+output to applying the contrast settings to each pixel
+'''
+import os
+import shutil
+import time
+import unittest
+
+import numpy
+from PIL import Image
+
+from nornir_buildmanager import ChecksumCache
+from nornir_buildmanager import TileContrast
+from nornir_buildmanager.VolumeManagerETree import VolumeManager, FilterNode
+import nornir_buildmanager.operations.tile as tile
+import test.testbase
+
+
+def WriteContrastTiles(path, NumTiles, Shape=(128, 96)):
+    '''
+    Write 14-bit tiles stored as 16-bit images
+    :return: Dictionary of input full path -> output full path
+    '''
+    (fullpaths, pixels) = test.testbase.WriteSyntheticTiles(path, NumTiles, Shape=Shape)
+    os.makedirs(os.path.join(path, 'Output'), exist_ok=True)
+    return {fullpath: os.path.join(path, 'Output', os.path.basename(fullpath)) for fullpath in fullpaths}
+
+
+def ReadPixels(fullpath):
+    with Image.open(fullpath) as im:
+        return numpy.asarray(im)
+
+
+def ConvertPixels(pixels, MinMax, Gamma, OutputBpp):
+    '''The contrast settings applied to each pixel'''
+    normalized = numpy.clip((pixels.astype(numpy.float64) - MinMax[0]) / (MinMax[1] - MinMax[0]), 0, 1)
+    if Gamma is not None:
+        normalized = normalized ** (1.0 / Gamma)
+
+    return numpy.rint(normalized * ((1 << OutputBpp) - 1)).astype(TileContrast.OutputDtype(OutputBpp))
+
+
+class TileContrastTest(test.testbase.TestBase):
+
+    MinMax = (2500, 6000)
+    Gamma = 1.3
+
+    def setUp(self):
+        super(TileContrastTest, self).setUp()
+        ChecksumCache.Clear()
+        TileContrast.Stats.Reset()
+        self.TempDir = self.TestOutputPath
+        self.Tiles = WriteContrastTiles(self.TempDir, 12)
+
+    def tearDown(self):
+        ChecksumCache.Clear()
+        super(TileContrastTest, self).tearDown()
+
+    def testLUT(self):
+        values = numpy.arange(1 << 16, dtype=numpy.uint16)
+        for OutputBpp in (8, 16):
+            for Gamma in (None, 0.7, self.Gamma):
+                LUT = TileContrast.CreateLUT(self.MinMax, Gamma, 14, OutputBpp)
+                self.assertTrue(numpy.array_equal(TileContrast.ApplyLUT(values, LUT), ConvertPixels(values, self.MinMax, Gamma, OutputBpp)))
+
+        # Swapped cutoffs are put back in order
+        self.assertTrue(numpy.array_equal(TileContrast.CreateLUT((6000, 2500), None, 14, 8), TileContrast.CreateLUT((2500, 6000), None, 14, 8)))
+
+    def testConvertTiles(self):
+        Converted = TileContrast.ConvertTilesInDict(self.Tiles, self.MinMax, self.Gamma, InputBpp=14, OutputBpp=8)
+        self.assertEqual(sorted(Converted.keys()), sorted(self.Tiles.keys()))
+        self.assertEqual(TileContrast.Stats.Converted, len(self.Tiles))
+
+        for (InputFullPath, OutputFullPath) in self.Tiles.items():
+            Expected = ConvertPixels(ReadPixels(InputFullPath), self.MinMax, self.Gamma, 8)
+            self.assertTrue(numpy.array_equal(ReadPixels(OutputFullPath), Expected))
+
+            # The checksum read by the worker is cached
+            self.assertEqual(ChecksumCache.TryGet(InputFullPath, TileContrast.ChecksumKind), Converted[InputFullPath])
+
+    def testFailedTile(self):
+        Tiles = dict(self.Tiles)
+        Missing = os.path.join(self.TempDir, 'missing.png')
+        Tiles[Missing] = os.path.join(self.TempDir, 'Output', 'missing.png')
+
+        Converted = TileContrast.ConvertTilesInDict(Tiles, self.MinMax, self.Gamma, InputBpp=14, OutputBpp=8)
+        self.assertNotIn(Missing, Converted)
+        self.assertEqual(len(Converted), len(self.Tiles))
+        self.assertEqual(TileContrast.Stats.Failed, 1)
+
+    def testInputTileChecksums(self):
+        VolumeObj = VolumeManager.Load(self.TempDir, Create=True)
+        [added, OutputFilterNode] = VolumeObj.UpdateOrAddChildByAttrib(FilterNode.Create('Leveled'), 'Name')
+        os.makedirs(OutputFilterNode.FullPath, exist_ok=True)
+
+        self.assertIsNone(tile.LoadInputTileChecksums(OutputFilterNode, 1))
+
+        Converted = TileContrast.ConvertTilesInDict(self.Tiles, self.MinMax, self.Gamma, InputBpp=14, OutputBpp=8)
+        checksums = {os.path.basename(fullpath): checksum for (fullpath, checksum) in Converted.items()}
+        tile.SaveInputTileChecksums(OutputFilterNode, 1, checksums)
+
+        self.assertEqual(tile.LoadInputTileChecksums(OutputFilterNode, 1), checksums)
+        self.assertIsNone(tile.LoadInputTileChecksums(OutputFilterNode, 2))
+
+        # Rewriting a tile with the same pixels does not change its checksum, changing a pixel does
+        (Unchanged, Changed) = sorted(self.Tiles.keys())[0:2]
+        shutil.copyfile(Unchanged, Unchanged + '.copy')
+        os.replace(Unchanged + '.copy', Unchanged)
+        pixels = ReadPixels(Changed).copy()
+        pixels[0, 0] += 1
+        Image.fromarray(pixels).save(Changed)
+
+        self.assertEqual(TileContrast.FileChecksum(Unchanged), checksums[os.path.basename(Unchanged)])
+        self.assertNotEqual(TileContrast.FileChecksum(Changed), checksums[os.path.basename(Changed)])
+
+
+@test.testbase.SkipUnlessBenchmarking
+class TileContrastBenchmark(test.testbase.TestBase):
+    '''Tiles per second converting with one lookup table compared to applying the contrast settings to each tile'''
+
+    NumTiles = 48
+    Shape = (1024, 1024)
+    MinMax = (2500, 6000)
+    Gamma = 1.3
+
+    def setUp(self):
+        super(TileContrastBenchmark, self).setUp()
+        self.Tiles = WriteContrastTiles(self.TestOutputPath, self.NumTiles, Shape=self.Shape)
+
+    def testThroughput(self):
+        start = time.perf_counter()
+        for (InputFullPath, OutputFullPath) in self.Tiles.items():
+            Image.fromarray(ConvertPixels(ReadPixels(InputFullPath), self.MinMax, self.Gamma, 8)).save(OutputFullPath + '.pertile.png')
+        PerTile = self.NumTiles / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        TileContrast.ConvertTilesInDict(self.Tiles, self.MinMax, self.Gamma, InputBpp=14, OutputBpp=8)
+        LUT = self.NumTiles / (time.perf_counter() - start)
+
+        print("%d %dx%d tiles: per tile float conversion %.1f tiles/sec, lookup table %.1f tiles/sec" % (self.NumTiles, self.Shape[1], self.Shape[0], PerTile, LUT))
+
+        for OutputFullPath in self.Tiles.values():
+            self.assertTrue(numpy.array_equal(ReadPixels(OutputFullPath), ReadPixels(OutputFullPath + '.pertile.png')))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+'''
+Builds histograms of synthetic 16-bit tiles from per-tile partial histograms
+'''
+import os
+import shutil
+import unittest
+
+import numpy
+
+from nornir_buildmanager import ChecksumCache
+from nornir_buildmanager import TileHistogram
+import nornir_buildmanager.importers.sectionpipeline as sectionpipeline
+import test.testbase
+
+
+def _BuildHistogramInWorker(fullpaths, MinVal, MaxVal, NumBins):
+    '''Prepare step of TileHistogramTest.ImportInWorkers
+    :return: Partials the worker calculated and the number of tiles it read'''
+    Misses = TileHistogram.Stats.Misses
+    accumulator = TileHistogram.Build(fullpaths, MinVal, MaxVal, NumBins, Pool=sectionpipeline.WorkerPool())
+    return (accumulator.Calculated, TileHistogram.Stats.Misses - Misses)
+
+
+class TileHistogramTest(test.testbase.TestBase):
+
+    MinVal = 0
+    MaxVal = (1 << 14) - 1
+    NumBins = 2048
+
+    def setUp(self):
+        super(TileHistogramTest, self).setUp()
+        TileHistogram.Clear()
+        ChecksumCache.Clear()
+        TileHistogram.Stats.Reset()
+        self.TempDir = self.TestOutputPath
+        (self.Tiles, self.Pixels) = test.testbase.WriteSyntheticTiles(self.TempDir, 40, Ext='tif')
+
+    def tearDown(self):
+        TileHistogram.Clear()
+        ChecksumCache.Clear()
+        super(TileHistogramTest, self).tearDown()
+
+    def Expected(self, pixels):
+        (bins, edges) = numpy.histogram(pixels, bins=self.NumBins, range=(self.MinVal, self.MaxVal))
+        return bins
+
+    def Accumulator(self, Stride=1):
+        return TileHistogram.TileHistogramAccumulator(self.MinVal, self.MaxVal, self.NumBins, Stride=Stride, PopulationSize=len(self.Tiles))
+
+    def testAllTiles(self):
+        accumulator = TileHistogram.Build(self.Tiles, self.MinVal, self.MaxVal, self.NumBins, Pool=None)
+        self.assertEqual(accumulator.NumTiles, len(self.Tiles))
+        self.assertTrue(numpy.array_equal(accumulator.Bins, self.Expected(self.Pixels)))
+        self.assertEqual(accumulator.ErrorBound(), 0)
+
+    def testIncremental(self):
+        accumulator = self.Accumulator()
+        accumulator.AddTiles(self.Tiles[0:10])
+        accumulator.AddTiles(self.Tiles[5:20])
+        self.assertTrue(numpy.array_equal(accumulator.Bins, self.Expected(self.Pixels[0:20])))
+        self.assertEqual(TileHistogram.Stats.Misses, 20, "Tiles already added should not be read again")
+
+        accumulator.RemoveTile(self.Tiles[3])
+        Remaining = [i for i in range(20) if i != 3]
+        self.assertTrue(numpy.array_equal(accumulator.Bins, self.Expected(self.Pixels[Remaining])))
+
+    def testCachedPartials(self):
+        TileHistogram.Build(self.Tiles, self.MinVal, self.MaxVal, self.NumBins)
+        TileHistogram.Stats.Reset()
+
+        # A copied tile has the same checksum and is not decoded again
+        CopyFullPath = os.path.join(self.TempDir, 'copy.tif')
+        shutil.copy(self.Tiles[0], CopyFullPath)
+
+        accumulator = TileHistogram.Build(self.Tiles, self.MinVal, self.MaxVal, self.NumBins)
+        self.assertEqual(TileHistogram.Stats.Misses, 0)
+        self.assertEqual(TileHistogram.Stats.Hits, len(self.Tiles))
+        self.assertTrue(numpy.array_equal(accumulator.Bins, self.Expected(self.Pixels)))
+
+        TileHistogram.Save(self.TempDir)
+        TileHistogram.Clear()
+        TileHistogram.Load(self.TempDir)
+        TileHistogram.Stats.Reset()
+
+        accumulator = TileHistogram.Build([CopyFullPath], self.MinVal, self.MaxVal, self.NumBins)
+        self.assertTrue(numpy.array_equal(accumulator.Bins, self.Expected(self.Pixels[0])))
+
+    def testMergeCalculated(self):
+        '''Partials a worker process read are added to the cache of the process that merges them'''
+        accumulator = TileHistogram.Build(self.Tiles, self.MinVal, self.MaxVal, self.NumBins)
+        self.assertEqual(len(accumulator.Calculated), len(self.Tiles))
+
+        TileHistogram.Clear()
+        ChecksumCache.Clear()
+        TileHistogram.Merge(accumulator.Calculated)
+        TileHistogram.Stats.Reset()
+
+        for fullpath in self.Tiles:
+            self.assertIsNotNone(ChecksumCache.TryGet(fullpath, TileHistogram.ChecksumKind))
+
+        accumulator = TileHistogram.Build(self.Tiles, self.MinVal, self.MaxVal, self.NumBins)
+        self.assertEqual(TileHistogram.Stats.Misses, 0)
+        self.assertEqual(len(accumulator.Calculated), 0)
+        self.assertTrue(numpy.array_equal(accumulator.Bins, self.Expected(self.Pixels)))
+
+    def testSampledErrorBound(self):
+        accumulator = TileHistogram.Build(self.Tiles, self.MinVal, self.MaxVal, self.NumBins, SampleFraction=0.5, Stride=2)
+        self.assertEqual(accumulator.NumTiles, 20)
+        self.assertEqual(accumulator.NumCounted * 4, accumulator.NumPixels)
+
+        bound = accumulator.ErrorBound()
+        self.assertGreater(bound, 0)
+        self.assertLess(bound, 1)
+
+        ExpectedCDF = numpy.cumsum(self.Expected(self.Pixels)) / float(self.Pixels.size)
+        SampledCDF = numpy.cumsum(accumulator.Bins) / float(accumulator.NumCounted)
+        Error = numpy.abs(ExpectedCDF - SampledCDF).max()
+        self.assertLessEqual(Error, bound, "Sampled cumulative fraction error %.4f exceeds the bound" % Error)
+
+    def ImportInWorkers(self):
+        '''
+        Build the histogram of each half of the tiles in section pipeline workers
+        :return: Number of tiles the workers read
+        '''
+        Misses = []
+
+        def Apply(Prepared):
+            (Calculated, NumRead) = Prepared
+            TileHistogram.Merge(Calculated)
+            Misses.append(NumRead)
+            return (None, None)
+
+        Sections = [(self.Tiles[0:20], self.MinVal, self.MaxVal, self.NumBins), (self.Tiles[20:], self.MinVal, self.MaxVal, self.NumBins)]
+        list(sectionpipeline.ImportSections(Sections, _BuildHistogramInWorker, Apply, None, lambda State, Result: [],
+                                            MaxWorkers=2, VolumePath=self.TempDir))
+        return sum(Misses)
+
+    def testWorkersUseSavedCache(self):
+        '''A second import started in new worker processes reads the partials the first import saved'''
+        self.assertEqual(self.ImportInWorkers(), len(self.Tiles))
+
+        ChecksumCache.Save(self.TempDir)
+        TileHistogram.Save(self.TempDir)
+
+        self.assertEqual(self.ImportInWorkers(), 0, "Workers should not read tiles whose histograms were saved")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,273 @@
+'''
+Builds tileset levels from a synthetic grid of tiles in one sweep over the
+rows of the full resolution level and compares them to downsampling the
+whole mosaic
+'''
+import math
+import os
+import shutil
+import time
+import unittest
+
+import numpy
+from PIL import Image
+
+from nornir_buildmanager import DirectoryCache
+from nornir_buildmanager.VolumeManagerETree import VolumeManager, FilterNode, TilesetNode, LevelNode
+import nornir_buildmanager.operations.tile as tile
+import test.testbase
+
+FilePrefix = 'Tile'
+FilePostfix = '.png'
+
+
+def WriteSyntheticTileset(LevelDir, GridDims, TileDim, Missing=()):
+    '''
+    Write a grid of tiles cut from one smooth 8-bit image
+    :return: Mosaic of the grid with missing tiles set to zero
+    '''
+    mosaic = test.testbase.SmoothPixels((GridDims[0] * TileDim[0], GridDims[1] * TileDim[1]))
+    Regions = {}
+    for iY in range(GridDims[0]):
+        for iX in range(GridDims[1]):
+            Regions[(iY, iX)] = mosaic[iY * TileDim[0]:(iY + 1) * TileDim[0], iX * TileDim[1]:(iX + 1) * TileDim[1]]
+
+    for Coord in Missing:
+        Regions.pop(Coord)[:] = 0
+
+    Coords = sorted(Regions.keys())
+    test.testbase.WriteSyntheticTiles(LevelDir, len(Coords), Shape=TileDim,
+                                      Filenames=[tile._TilesetTileName(FilePrefix, FilePostfix, iX, iY) for (iY, iX) in Coords],
+                                      CreatePixels=lambda iTile, Shape: Regions[Coords[iTile]])
+    return mosaic
+
+
+def ExpectedTile(mosaic, Level, iX, iY, TileDim):
+    '''Tile of the mosaic after halving it Level times, None if the tile is outside the mosaic'''
+    for i in range(Level):
+        # Pad to whole tiles so odd grid dimensions halve the same way the tileset does
+        Padded = numpy.zeros((int(numpy.ceil(mosaic.shape[0] / (TileDim[0] * 2.0))) * TileDim[0] * 2,
+                              int(numpy.ceil(mosaic.shape[1] / (TileDim[1] * 2.0))) * TileDim[1] * 2), dtype=mosaic.dtype)
+        Padded[0:mosaic.shape[0], 0:mosaic.shape[1]] = mosaic
+        mosaic = tile._HalveImage(Padded)
+
+    return mosaic[iY * TileDim[0]:(iY + 1) * TileDim[0], iX * TileDim[1]:(iX + 1) * TileDim[1]]
+
+
+def ReadPixels(fullpath):
+    with Image.open(fullpath) as im:
+        return numpy.asarray(im)
+
+
+def BuildLevelsWithPillow(SourceDir, DestDirs, GridDims, TileDim):
+    '''Build each level from the level before it on disk with BuildTilesetLevelWithPillow'''
+    for DestDir in DestDirs:
+        GridDims = ((GridDims[0] + 1) // 2, (GridDims[1] + 1) // 2)
+        tile.BuildTilesetLevelWithPillow(SourceDir, DestDir, GridDims, TileDim, FilePrefix, FilePostfix)
+        SourceDir = DestDir
+
+
+def LevelBytes(LevelDir):
+    return sum(os.path.getsize(os.path.join(LevelDir, f)) for f in os.listdir(LevelDir))
+
+
+class TilesetStreamTest(test.testbase.TestBase):
+
+    GridDims = (7, 10)
+    TileDim = (64, 48)
+    NumLevels = 3
+
+    def setUp(self):
+        super(TilesetStreamTest, self).setUp()
+        self.TempDir = self.TestOutputPath
+        self.SourceDir = os.path.join(self.TempDir, '001')
+        self.Missing = [(0, 0), (0, 1), (1, 0), (1, 1), (3, 5)]
+        self.Mosaic = WriteSyntheticTileset(self.SourceDir, self.GridDims, self.TileDim, Missing=self.Missing)
+        self.DestDirs = [os.path.join(self.TempDir, '%03d' % (1 << (i + 1))) for i in range(self.NumLevels)]
+
+    def Build(self, DestDirs, TempPath=None):
+        tile.BuildTilesetLevelsStreaming(self.SourceDir, DestDirs, self.GridDims, self.TileDim, FilePrefix, FilePostfix, TempPath=TempPath, MaxTilesInFlight=4)
+
+    def testMatchesMosaic(self):
+        self.Build(self.DestDirs)
+
+        (GridDimY, GridDimX) = self.GridDims
+        for (iLevel, DestDir) in enumerate(self.DestDirs):
+            GridDimY = (GridDimY + 1) // 2
+            GridDimX = (GridDimX + 1) // 2
+            for iY in range(GridDimY):
+                for iX in range(GridDimX):
+                    fullpath = os.path.join(DestDir, tile._TilesetTileName(FilePrefix, FilePostfix, iX, iY))
+                    if iLevel == 0 and iY == 0 and iX == 0:
+                        # All four source tiles are missing
+                        self.assertFalse(os.path.exists(fullpath))
+                        continue
+
+                    Expected = ExpectedTile(self.Mosaic, iLevel + 1, iX, iY, self.TileDim)
+                    self.assertTrue(numpy.array_equal(ReadPixels(fullpath), Expected), "Level %d tile %d,%d does not match" % (iLevel + 1, iX, iY))
+
+    def testMatchesPillow(self):
+        '''Each level is close to building it from the level before it on disk with BuildTilesetLevelWithPillow, which
+           resamples with Pillow instead of averaging blocks of pixels.  Pillow's filter rings at the edges of missing
+           tiles and the error grows with each level, so only the mean and median difference are limited.'''
+        PillowDirs = [os.path.join(self.TempDir, 'Pillow', os.path.basename(DestDir)) for DestDir in self.DestDirs]
+        BuildLevelsWithPillow(self.SourceDir, PillowDirs, self.GridDims, self.TileDim)
+        self.Build(self.DestDirs)
+
+        for (DestDir, PillowDir) in zip(self.DestDirs, PillowDirs):
+            for filename in os.listdir(DestDir):
+                PillowFullPath = os.path.join(PillowDir, filename)
+                self.assertTrue(os.path.exists(PillowFullPath), "%s was not built with Pillow" % PillowFullPath)
+
+                Difference = numpy.abs(ReadPixels(os.path.join(DestDir, filename)).astype(numpy.int16) - ReadPixels(PillowFullPath).astype(numpy.int16))
+                Message = "%s differs from Pillow" % os.path.join(DestDir, filename)
+                self.assertLessEqual(Difference.mean(), 1.5, Message)
+                self.assertLessEqual(numpy.median(Difference), 1, Message)
+
+    def testSkippedLevel(self):
+        '''Levels without a path are calculated but not written'''
+        self.Build([None, self.DestDirs[1]])
+        self.assertFalse(os.path.exists(self.DestDirs[0]))
+
+        Expected = ExpectedTile(self.Mosaic, 2, 1, 1, self.TileDim)
+        self.assertTrue(numpy.array_equal(ReadPixels(os.path.join(self.DestDirs[1], tile._TilesetTileName(FilePrefix, FilePostfix, 1, 1))), Expected))
+
+    def testListingInvalidated(self):
+        '''Tiles written by the build are found in a directory listed before the build'''
+        os.makedirs(self.DestDirs[0])
+        TileFullPath = os.path.join(self.DestDirs[0], tile._TilesetTileName(FilePrefix, FilePostfix, 1, 1))
+        self.assertFalse(DirectoryCache.Exists(TileFullPath))
+
+        self.Build(self.DestDirs)
+        self.assertTrue(DirectoryCache.Exists(TileFullPath))
+
+    def testTempCopyPreferred(self):
+        TempCopyDir = os.path.join(self.TempDir, 'LocalCopy')
+        shutil.copytree(self.SourceDir, TempCopyDir)
+
+        # Clear one source tile so we can tell which copy was read
+        Name = tile._TilesetTileName(FilePrefix, FilePostfix, 4, 4)
+        Image.fromarray(numpy.zeros(self.TileDim, dtype=numpy.uint8)).save(os.path.join(self.SourceDir, Name))
+
+        self.Build(self.DestDirs[0:1], TempPath=TempCopyDir)
+        Expected = ExpectedTile(self.Mosaic, 1, 2, 2, self.TileDim)
+        self.assertTrue(numpy.array_equal(ReadPixels(os.path.join(self.DestDirs[0], tile._TilesetTileName(FilePrefix, FilePostfix, 2, 2))), Expected))
+
+
+class TilesetPyramidStreamingTest(test.testbase.TestBase):
+    '''Builds the levels of a tileset node from its full resolution level'''
+
+    GridDims = (7, 10)
+    TileDim = (64, 48)
+
+    # Downsample of each level built from the 7x10 full resolution grid
+    Downsamples = (2, 4, 8)
+
+    def setUp(self):
+        super(TilesetPyramidStreamingTest, self).setUp()
+        self.TempDir = self.TestOutputPath
+        self.VolumeObj = VolumeManager.Load(self.TempDir, Create=True)
+        [added, FilterObj] = self.VolumeObj.UpdateOrAddChildByAttrib(FilterNode.Create('Leveled'), 'Name')
+
+        [added, self.TileSetNode] = FilterObj.UpdateOrAddChildByAttrib(TilesetNode.Create(), 'Path')
+        self.TileSetNode.TileXDim = self.TileDim[1]
+        self.TileSetNode.TileYDim = self.TileDim[0]
+        self.TileSetNode.FilePrefix = FilePrefix
+        self.TileSetNode.FilePostfix = FilePostfix
+
+        [added, LevelOne] = self.TileSetNode.UpdateOrAddChildByAttrib(LevelNode.Create(1), 'Downsample')
+        LevelOne.GridDimY = self.GridDims[0]
+        LevelOne.GridDimX = self.GridDims[1]
+        self.Mosaic = WriteSyntheticTileset(LevelOne.FullPath, self.GridDims, self.TileDim)
+
+    def Build(self):
+        return list(tile.BuildTilesetPyramidStreaming(self.TileSetNode, MaxTilesInFlight=4))
+
+    def assertLevelsMatchMosaic(self):
+        for Downsample in self.Downsamples:
+            Level = self.TileSetNode.GetLevel(Downsample)
+            self.assertIsNotNone(Level, "Level %d was not added" % Downsample)
+            self.assertTrue(Level.IsValid()[0], "Level %d is not valid" % Downsample)
+
+            for iY in range(Level.GridDimY):
+                for iX in range(Level.GridDimX):
+                    Expected = ExpectedTile(self.Mosaic, int(math.log2(Downsample)), iX, iY, self.TileDim)
+                    Actual = ReadPixels(os.path.join(Level.FullPath, tile._TilesetTileName(FilePrefix, FilePostfix, iX, iY)))
+                    self.assertTrue(numpy.array_equal(Actual, Expected), "Level %d tile %d,%d does not match" % (Downsample, iX, iY))
+
+    def testBuildsEveryLevel(self):
+        self.assertEqual(len(self.Build()), 1, "The tileset should be saved once, after the tiles are written")
+        self.assertLevelsMatchMosaic()
+        self.assertEqual(self.Build(), [], "Nothing should be built when every level is valid")
+
+    def testInterruptedBuild(self):
+        '''Levels saved in the meta-data without tiles are built from the full resolution level'''
+        (GridDimY, GridDimX) = self.GridDims
+        for Downsample in self.Downsamples:
+            (GridDimY, GridDimX) = ((GridDimY + 1) // 2, (GridDimX + 1) // 2)
+            [added, Level] = self.TileSetNode.UpdateOrAddChildByAttrib(LevelNode.Create(Downsample), 'Downsample')
+            Level.GridDimY = GridDimY
+            Level.GridDimX = GridDimX
+            os.makedirs(Level.FullPath, exist_ok=True)
+
+        self.Build()
+        self.assertLevelsMatchMosaic()
+
+    def testMissingLevelRebuilt(self):
+        '''Only the missing level is written, valid levels are left as they are'''
+        self.Build()
+
+        KeptTile = os.path.join(self.TileSetNode.GetLevel(2).FullPath, tile._TilesetTileName(FilePrefix, FilePostfix, 0, 0))
+        KeptMTime = os.stat(KeptTile).st_mtime_ns
+        shutil.rmtree(self.TileSetNode.GetLevel(4).FullPath)
+
+        self.Build()
+        self.assertLevelsMatchMosaic()
+        self.assertEqual(os.stat(KeptTile).st_mtime_ns, KeptMTime)
+
+
+@test.testbase.SkipUnlessBenchmarking
+class TilesetStreamBenchmark(test.testbase.TestBase):
+    '''Tiles per second and bytes read building every level in one sweep compared to building one level at a time from
+       disk with BuildTilesetLevelWithPillow'''
+
+    GridDims = (32, 32)
+    TileDim = (256, 256)
+    NumLevels = 4
+
+    def setUp(self):
+        super(TilesetStreamBenchmark, self).setUp()
+        self.TempDir = self.TestOutputPath
+        self.SourceDir = os.path.join(self.TempDir, '001')
+        WriteSyntheticTileset(self.SourceDir, self.GridDims, self.TileDim)
+
+    def LevelDirs(self, name):
+        return [os.path.join(self.TempDir, name, '%03d' % (1 << (i + 1))) for i in range(self.NumLevels)]
+
+    def testThroughput(self):
+        NumTiles = self.GridDims[0] * self.GridDims[1]
+
+        LevelByLevelDirs = self.LevelDirs('LevelByLevel')
+        start = time.perf_counter()
+        BuildLevelsWithPillow(self.SourceDir, LevelByLevelDirs, self.GridDims, self.TileDim)
+        LevelByLevel = NumTiles / (time.perf_counter() - start)
+        LevelByLevelBytesRead = LevelBytes(self.SourceDir) + sum(LevelBytes(DestDir) for DestDir in LevelByLevelDirs[0:-1])
+
+        SinglePassDirs = self.LevelDirs('SinglePass')
+        start = time.perf_counter()
+        SinglePassBytesRead = LevelBytes(self.SourceDir)
+        tile.BuildTilesetLevelsStreaming(self.SourceDir, SinglePassDirs, self.GridDims, self.TileDim, FilePrefix, FilePostfix)
+        SinglePass = NumTiles / (time.perf_counter() - start)
+
+        print("%d levels from %d source tiles: level by level %.1f tiles/sec %d bytes read, single sweep %.1f tiles/sec %d bytes read" % (self.NumLevels, NumTiles, LevelByLevel, LevelByLevelBytesRead, SinglePass, SinglePassBytesRead))
+        self.assertLess(SinglePassBytesRead, LevelByLevelBytesRead)
+
+        # The levels are resampled with different filters, so only the tiles and their shapes are compared
+        for (LevelByLevelDir, SinglePassDir) in zip(LevelByLevelDirs, SinglePassDirs):
+            self.assertEqual(sorted(os.listdir(LevelByLevelDir)), sorted(os.listdir(SinglePassDir)))
+            for filename in os.listdir(SinglePassDir):
+                self.assertEqual(ReadPixels(os.path.join(LevelByLevelDir, filename)).shape, ReadPixels(os.path.join(SinglePassDir, filename)).shape)
+
+
+if __name__ == "__main__":
+    unittest.main()
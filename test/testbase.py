@@ -12,9 +12,61 @@ import pstats
 import shutil
 import unittest
 
+import numpy
+from PIL import Image
+
 import nornir_pools
 from nornir_shared.misc import SetupLogging
 
+# Benchmarks take a long time and only report timings, so they only run when the BENCHMARK environment variable is set
+SkipUnlessBenchmarking = unittest.skipUnless('BENCHMARK' in os.environ, "Set the BENCHMARK environment variable to run benchmarks")
+
+
+def SmoothPixels(Shape, Seed=0, Noise=4, dtype=numpy.uint8):
+    '''
+    Smooth image, a product of a sine and a cosine about mid-gray, with a little noise
+    :param tuple Shape: (Y,X) or (Y,X,Channels), every channel has the same pixels
+    :param float Noise: Standard deviation of the noise, in 8-bit intensity levels
+    :param dtype dtype: Integer type of the pixels, the image is scaled to the range of the type
+    '''
+    rng = numpy.random.RandomState(Seed)
+    (Y, X) = numpy.mgrid[0:Shape[0], 0:Shape[1]]
+    pixels = 128 + 60 * numpy.sin(X / (60.0 + Seed)) * numpy.cos(Y / 45.0)
+    if Noise > 0:
+        pixels += rng.normal(scale=Noise, size=Shape[0:2])
+
+    pixels = pixels.clip(0, 255) * (numpy.iinfo(dtype).max / 255.0)
+    if len(Shape) == 3:
+        pixels = numpy.dstack([pixels] * Shape[2])
+
+    return pixels.astype(dtype)
+
+
+def WriteSyntheticTiles(path, NumTiles, Shape=(64, 48), Seed=0, Ext='png', CreatePixels=None, Filenames=None):
+    '''
+    Write tiles named 000.<Ext>, 001.<Ext>, ...
+    :param func CreatePixels: Called with (tile number, Shape) to create the pixels of a tile.  By default 14-bit noise
+                              stored as 16-bit pixels, with a mean intensity that differs between tiles.
+    :param list Filenames: Name of each tile, used in place of the tile number
+    :return: (List of tile full paths, array of the pixels of every tile)
+    '''
+    if CreatePixels is None:
+        rng = numpy.random.RandomState(Seed)
+        CreatePixels = lambda iTile, Shape: rng.normal(loc=4000 + iTile * 40, scale=600, size=Shape).clip(0, (1 << 14) - 1).astype(numpy.uint16)
+
+    os.makedirs(path, exist_ok=True)
+    fullpaths = []
+    tiles = []
+    for iTile in range(NumTiles):
+        pixels = CreatePixels(iTile, Shape)
+        filename = '%03d.%s' % (iTile, Ext) if Filenames is None else Filenames[iTile]
+        fullpath = os.path.join(path, filename)
+        Image.fromarray(pixels).save(fullpath)
+        fullpaths.append(fullpath)
+        tiles.append(pixels)
+
+    return (fullpaths, numpy.stack(tiles))
+
 
 class PickleHelper(object):
          